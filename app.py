@@ -116,6 +116,113 @@ with app.app_context():
             except Exception as e:
                 app.logger.error(f"Errore durante il controllo dei promemoria: {str(e)}")
     
+    # Riallineamento periodico dell'indice delle posizioni dei file
+    from services.location_index import rescan as rescan_file_locations, claim_rescan, RESCAN_INTERVAL_HOURS
+    
+    @scheduler.scheduled_job(IntervalTrigger(hours=RESCAN_INTERVAL_HOURS))
+    def scheduled_location_rescan():
+        app.logger.info("Esecuzione riallineamento schedulato dell'indice delle posizioni")
+        try:
+            stats = rescan_file_locations()
+            app.logger.info(f"Riallineamento completato: {stats['scanned']} file indicizzati, {stats['removed']} voci rimosse")
+        except Exception as e:
+            app.logger.error(f"Errore durante il riallineamento dell'indice delle posizioni: {str(e)}")
+    
+    # Replica in background delle copie secondarie dello storage permanente
+    from services.replication_queue import process_replication_queue, REPLICATION_INTERVAL_SECONDS
+    
+    @scheduler.scheduled_job(IntervalTrigger(seconds=REPLICATION_INTERVAL_SECONDS))
+    def scheduled_replication():
+        with app.app_context():
+            try:
+                process_replication_queue()
+            except Exception as e:
+                app.logger.error(f"Errore durante l'elaborazione della coda di replica: {str(e)}")
+    
+    # Riallineamento periodico dei contatori incrementali dello storage
+    from services.storage_stats import (reconcile_document_counters, has_document_counters,
+                                        STATS_RECONCILE_INTERVAL_HOURS)
+    from services.location_index import reconcile_stats as reconcile_location_stats
+    
+    @scheduler.scheduled_job(IntervalTrigger(hours=STATS_RECONCILE_INTERVAL_HOURS))
+    def scheduled_storage_counters_reconcile():
+        with app.app_context():
+            try:
+                reconcile_document_counters()
+                reconcile_location_stats()
+            except Exception as e:
+                app.logger.error(f"Errore durante il riallineamento dei contatori dello storage: {str(e)}")
+    
+    # All'avvio, una sola esecuzione e solo se necessaria: indice delle posizioni vuoto o non
+    # riallineato nell'ultimo intervallo (prenotato da un solo processo), contatori mai calcolati.
+    # Worker web e script che importano app non scansionano così il filesystem ad ogni avvio
+    @scheduler.scheduled_job('date')
+    def startup_storage_index_check():
+        try:
+            if claim_rescan():
+                scheduled_location_rescan()
+        except Exception as e:
+            app.logger.error(f"Errore durante la verifica iniziale dell'indice delle posizioni: {str(e)}")
+        with app.app_context():
+            try:
+                if not has_document_counters():
+                    scheduled_storage_counters_reconcile()
+            except Exception as e:
+                app.logger.error(f"Errore durante la verifica iniziale dei contatori dello storage: {str(e)}")
+    
+    # Compressione dei blob poco usati (storage freddo)
+    from services.compression_tier import run_compression_tier, COMPRESSION_INTERVAL_HOURS
+    
+    @scheduler.scheduled_job(IntervalTrigger(hours=COMPRESSION_INTERVAL_HOURS))
+    def scheduled_compression_tier():
+        with app.app_context():
+            try:
+                run_compression_tier()
+            except Exception as e:
+                app.logger.error(f"Errore durante la compressione dello storage freddo: {str(e)}")
+    
+    # Pulizia dei caricamenti a blocchi abbandonati
+    from services.chunked_upload import expire_upload_sessions, UPLOAD_CLEANUP_INTERVAL_HOURS
+    
+    @scheduler.scheduled_job(IntervalTrigger(hours=UPLOAD_CLEANUP_INTERVAL_HOURS))
+    def scheduled_upload_sessions_cleanup():
+        with app.app_context():
+            try:
+                expire_upload_sessions()
+            except Exception as e:
+                app.logger.error(f"Errore durante la pulizia dei caricamenti a blocchi scaduti: {str(e)}")
+    
+    # Riallineamento e limite di spazio della cache degli artefatti derivati
+    from services.artifact_cache import reconcile_cache, ARTIFACT_CACHE_RECONCILE_INTERVAL_HOURS
+    
+    @scheduler.scheduled_job(IntervalTrigger(hours=ARTIFACT_CACHE_RECONCILE_INTERVAL_HOURS))
+    def scheduled_artifact_cache_reconcile():
+        try:
+            reconcile_cache()
+        except Exception as e:
+            app.logger.error(f"Errore durante il riallineamento della cache degli artefatti: {str(e)}")
+    
+    # Elaborazione in background dei documenti caricati (se non affidata ai worker di process_documents.py)
+    from services.processing_queue import (process_processing_queue, purge_finished_jobs,
+                                           PROCESSING_QUEUE_MODE, PROCESSING_INTERVAL_SECONDS)
+    
+    if PROCESSING_QUEUE_MODE == 'scheduler':
+        @scheduler.scheduled_job(IntervalTrigger(seconds=PROCESSING_INTERVAL_SECONDS))
+        def scheduled_document_processing():
+            with app.app_context():
+                try:
+                    process_processing_queue()
+                except Exception as e:
+                    app.logger.error(f"Errore durante l'elaborazione della coda dei documenti: {str(e)}")
+    
+    @scheduler.scheduled_job(IntervalTrigger(hours=24))
+    def scheduled_processing_jobs_purge():
+        with app.app_context():
+            try:
+                purge_finished_jobs()
+            except Exception as e:
+                app.logger.error(f"Errore durante la pulizia dei job di elaborazione conclusi: {str(e)}")
+    
     # Avvia lo scheduler
     try:
         scheduler.start()
@@ -0,0 +1,85 @@
+"""
+Script per confrontare il tempo di worker di un download con e senza offload al proxy.
+
+Per ogni modalità ('' = byte inviati dal worker Python, 'nginx' = X-Accel-Redirect,
+'sendfile' = X-Sendfile) misura quanto tempo send_stored_file tiene occupato il
+worker per generare la risposta completa di un file di prova. Con l'offload il
+worker restituisce solo le intestazioni; senza offload resta occupato per tutto
+il trasferimento (nella realtà anche più a lungo, se il client è lento).
+
+Uso:
+    python benchmark_download_offload.py [--size-mb N] [--rounds N]
+"""
+
+import os
+import time
+import argparse
+import logging
+from app import app
+from services import storage_backend
+
+# Configurazione dei percorsi assoluti
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+BENCHMARK_DIR = os.path.join(BASE_DIR, 'uploads', '.benchmark')
+
+# Modalità confrontate
+MODES = [('', 'worker Python'), ('nginx', 'X-Accel-Redirect'), ('sendfile', 'X-Sendfile')]
+
+# Configura il logging
+logging.basicConfig(level=logging.INFO,
+                   format='%(asctime)s - %(levelname)s - %(message)s')
+
+def measure(path, mode, rounds):
+    """
+    Misura il tempo medio di worker per un download completo nella modalità indicata.
+
+    Returns:
+        tuple: (secondi per download, byte inviati dal worker)
+    """
+    storage_backend.DOWNLOAD_OFFLOAD = mode
+    total = 0.0
+    sent = 0
+    for _ in range(rounds):
+        with app.test_request_context('/'):
+            started = time.perf_counter()
+            response = storage_backend.send_stored_file(path, download_name='benchmark.bin', as_attachment=True)
+            sent = sum(len(chunk) for chunk in response.response)
+            response.close()
+            total += time.perf_counter() - started
+    return total / rounds, sent
+
+def main():
+    """Funzione principale per avviare il benchmark"""
+    parser = argparse.ArgumentParser(description='Benchmark dei download con e senza offload al proxy')
+    parser.add_argument('--size-mb', type=int, default=256, help='Dimensione del file di prova in MB')
+    parser.add_argument('--rounds', type=int, default=3, help='Ripetizioni per modalità')
+    args = parser.parse_args()
+
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    path = os.path.join(BENCHMARK_DIR, 'download.bin')
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        for _ in range(args.size_mb):
+            f.write(block)
+
+    configured = storage_backend.DOWNLOAD_OFFLOAD
+    try:
+        logging.info(f"==== Download di {args.size_mb} MB (offload configurato: {configured or 'nessuno'}) ====")
+        baseline = None
+        for mode, label in MODES:
+            seconds, sent = measure(path, mode, args.rounds)
+            baseline = baseline or seconds
+            per_worker = 1 / seconds if seconds else float('inf')
+            logging.info(f"{label:18} {seconds * 1000:10.2f} ms di worker per download, "
+                         f"{sent / (1024 * 1024):8.1f} MB dal worker, {per_worker:10.1f} download/s per worker "
+                         f"({baseline / seconds if seconds else float('inf'):.0f}x)")
+    finally:
+        storage_backend.DOWNLOAD_OFFLOAD = configured
+        os.remove(path)
+        try:
+            os.rmdir(BENCHMARK_DIR)
+        except OSError:
+            pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Script per confrontare l'estrazione del testo dei PDF seriale e suddivisa per pagine.
+
+Genera PDF di prova con il numero di pagine indicato (testo su ogni pagina) e
+misura extract_text_from_pdf con un solo processo e con il pool di processi di
+services/ocr.py, verificando che il testo estratto sia identico.
+
+Con --scanned-pages genera anche un PDF di pagine scansionate (immagini JPEG
+senza testo) e misura le pagine al secondo dell'OCR con tesseract: seriale,
+con il pool di processi e dalla cache degli artefatti.
+
+Uso:
+    python benchmark_pdf_extraction.py [--pages 10 100 1000] [--workers N] [--rounds N]
+                                       [--scanned-pages N]
+"""
+
+import io
+import os
+import time
+import hashlib
+import argparse
+import logging
+from PIL import Image, ImageDraw
+from services import ocr
+from services.artifact_cache import invalidate_artifacts
+
+# Configurazione dei percorsi assoluti
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+BENCHMARK_DIR = os.path.join(BASE_DIR, 'uploads', '.benchmark')
+
+# Righe di testo per pagina nei PDF di prova
+LINES_PER_PAGE = 45
+
+# Configura il logging
+logging.basicConfig(level=logging.INFO,
+                   format='%(asctime)s - %(levelname)s - %(message)s')
+
+def _page_lines(page):
+    return [f"Pagina {page + 1} riga {line + 1}: contratto di locazione dell'immobile, "
+            f"canone e scadenze del documento di prova" for line in range(LINES_PER_PAGE)]
+
+def _scanned_page(page):
+    """Immagine JPEG in scala di grigi (A4 a 150 DPI) con il testo della pagina."""
+    image = Image.new('L', (1240, 1754), 235)
+    draw = ImageDraw.Draw(image)
+    for number, line in enumerate(_page_lines(page)):
+        draw.text((80, 80 + number * 36), line, fill=20, font_size=24)
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=75)
+    return image.size, output.getvalue()
+
+def build_test_pdf(path, pages, scanned=False):
+    """
+    Scrive un PDF di prova con una pagina di testo (font Helvetica) per ogni pagina richiesta.
+
+    Args:
+        path: Percorso del file da creare
+        pages: Numero di pagine
+        scanned: Se True le pagine sono immagini JPEG del testo, senza testo estraibile
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # Albero delle pagine, scritto dopo aver calcolato i riferimenti
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    ]
+    page_refs = []
+    for page in range(pages):
+        if scanned:
+            (width, height), jpeg = _scanned_page(page)
+            objects.append(b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray "
+                           b"/BitsPerComponent 8 /Filter /DCTDecode /Length %d >>\nstream\n" % (width, height, len(jpeg))
+                           + jpeg + b"\nendstream")
+            resources = b"/XObject << /Im1 %d 0 R >>" % len(objects)
+            content = b"q 595 0 0 842 0 0 cm /Im1 Do Q"
+        else:
+            text = " T* ".join(f"({line.replace(chr(39), ' ')}) Tj" for line in _page_lines(page))
+            resources = b"/Font << /F1 3 0 R >>"
+            content = f"BT /F1 9 Tf 11 TL 40 800 Td {text} ET".encode('latin-1')
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        content_ref = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << " + resources + b" >> /Contents %d 0 R >>" % content_ref)
+        page_refs.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % ref for ref in page_refs)
+    objects[1] = b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % pages
+
+    with open(path, 'wb') as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+        xref_offset = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset))
+
+def measure(path, workers, rounds, cold_cache=False):
+    """
+    Misura il tempo medio di estrazione con il numero di processi indicato.
+
+    Args:
+        cold_cache: Se True il testo OCR del file viene rimosso dalla cache prima di ogni misura
+
+    Returns:
+        tuple: (secondi per estrazione, testo estratto)
+    """
+    total = 0.0
+    text = None
+    for _ in range(rounds):
+        if cold_cache:
+            with open(path, 'rb') as f:
+                invalidate_artifacts(hashlib.sha256(f.read()).hexdigest())
+        started = time.perf_counter()
+        text = ocr.extract_text_from_pdf(path, workers=workers)
+        total += time.perf_counter() - started
+    return total / rounds, text
+
+def main():
+    """Funzione principale per avviare il benchmark"""
+    parser = argparse.ArgumentParser(description="Benchmark dell'estrazione del testo dei PDF suddivisa per pagine")
+    parser.add_argument('--pages', type=int, nargs='+', default=[10, 100, 1000], help='Numero di pagine dei PDF di prova')
+    parser.add_argument('--workers', type=int, default=max(2, ocr.PDF_PARALLEL_WORKERS),
+                        help='Processi per l\'estrazione in parallelo')
+    parser.add_argument('--rounds', type=int, default=1, help='Ripetizioni per misura')
+    parser.add_argument('--scanned-pages', type=int, default=0,
+                        help='Pagine del PDF scansionato per la misura dell\'OCR (0 = nessuna misura)')
+    args = parser.parse_args()
+
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    logging.info(f"CPU disponibili: {os.cpu_count()} - processi in parallelo: {args.workers} - "
+                 f"soglia per l'estrazione in parallelo: {ocr.PDF_PARALLEL_MIN_PAGES} pagine")
+
+    for pages in args.pages:
+        path = os.path.join(BENCHMARK_DIR, f'extraction_{pages}.pdf')
+        build_test_pdf(path, pages)
+        try:
+            serial_seconds, serial_text = measure(path, 1, args.rounds)
+            parallel_seconds, parallel_text = measure(path, args.workers, args.rounds)
+        finally:
+            os.remove(path)
+
+        mode = 'in parallelo' if pages >= ocr.PDF_PARALLEL_MIN_PAGES else 'seriale (sotto soglia)'
+        logging.info(f"{pages} pagine: seriale {serial_seconds:.2f} s ({pages / serial_seconds:.0f} pagine/s), "
+                     f"{mode} {parallel_seconds:.2f} s ({pages / parallel_seconds:.0f} pagine/s), "
+                     f"speedup {serial_seconds / parallel_seconds:.2f}x, "
+                     f"testo identico: {'sì' if serial_text == parallel_text else 'NO'}")
+
+    if args.scanned_pages:
+        benchmark_ocr(args.scanned_pages, args.workers, args.rounds)
+
+def benchmark_ocr(pages, workers, rounds):
+    """Misura le pagine al secondo dell'OCR delle pagine scansionate."""
+    if not ocr.ocr_available():
+        logging.error("OCR non disponibile: installare tesseract (o impostare TESSERACT_CMD)")
+        return
+
+    path = os.path.join(BENCHMARK_DIR, f'scanned_{pages}.pdf')
+    build_test_pdf(path, pages, scanned=True)
+    try:
+        serial_seconds, serial_text = measure(path, 1, rounds, cold_cache=True)
+        parallel_seconds, parallel_text = measure(path, workers, rounds, cold_cache=True)
+        cached_seconds, cached_text = measure(path, workers, rounds)
+        with open(path, 'rb') as f:
+            invalidate_artifacts(hashlib.sha256(f.read()).hexdigest())
+    finally:
+        os.remove(path)
+
+    logging.info(f"OCR di {pages} pagine scansionate: seriale {serial_seconds:.2f} s ({pages / serial_seconds:.2f} pagine/s), "
+                 f"{workers} processi {parallel_seconds:.2f} s ({pages / parallel_seconds:.2f} pagine/s), "
+                 f"dalla cache {cached_seconds:.2f} s ({pages / cached_seconds:.0f} pagine/s), "
+                 f"testo identico: {'sì' if serial_text == parallel_text == cached_text else 'NO'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Script per confrontare le strategie di copia delle repliche con shutil.copy2.
+
+Misura ogni strategia sul filesystem delle directory di storage indicate (di
+default quelle di backup) e mostra la strategia scelta in automatico.
+
+Uso:
+    python benchmark_replica_copy.py [--size-mb N] [--rounds N] [directory ...]
+"""
+
+import os
+import argparse
+import logging
+from services.replica_copy import benchmark_strategies, get_replica_strategy
+
+# Configurazione dei percorsi assoluti
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+# Directory misurate di default (dove vengono scritte le repliche)
+DEFAULT_DIRECTORIES = [
+    os.path.join(BASE_DIR, 'document_storage', 'backup'),
+    os.path.join(BASE_DIR, 'permanent_storage', 'backup')
+]
+
+# Configura il logging
+logging.basicConfig(level=logging.INFO,
+                   format='%(asctime)s - %(levelname)s - %(message)s')
+
+def main():
+    """Funzione principale per avviare il benchmark"""
+    parser = argparse.ArgumentParser(description='Benchmark delle strategie di copia delle repliche')
+    parser.add_argument('directories', nargs='*', default=DEFAULT_DIRECTORIES,
+                        help='Directory da misurare')
+    parser.add_argument('--size-mb', type=int, default=64, help='Dimensione del file di prova in MB')
+    parser.add_argument('--rounds', type=int, default=3, help='Ripetizioni per strategia')
+    args = parser.parse_args()
+
+    for directory in args.directories:
+        logging.info(f"==== {directory} (strategia configurata: {get_replica_strategy(os.path.join(directory, 'x'))}) ====")
+        results = benchmark_strategies(os.path.join(directory, '.benchmark'), size_mb=args.size_mb,
+                                       rounds=args.rounds)
+        baseline = results['shutil.copy2']['seconds']
+        for name, result in results.items():
+            if result['seconds'] is None:
+                logging.info(f"{name:16} non supportata ({result['error']})")
+                continue
+            speedup = f"{baseline / result['seconds']:.1f}x" if baseline and result['seconds'] else '-'
+            logging.info(f"{name:16} {result['seconds']:.4f} s  {result['mb_per_second']} MB/s  "
+                         f"(vs shutil.copy2: {speedup})")
+        try:
+            os.rmdir(os.path.join(directory, '.benchmark'))
+        except OSError:
+            pass
+
+if __name__ == "__main__":
+    main()
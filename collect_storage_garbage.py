@@ -0,0 +1,56 @@
+"""
+Script per la raccolta dei file orfani in tutte le directory di storage.
+
+Usa il garbage collector mark-and-sweep di services/storage_gc.py. Senza
+--commit esegue solo una simulazione e salva il report dei file che verrebbero
+eliminati.
+
+Uso:
+    python collect_storage_garbage.py [--commit] [--grace-hours N] [--max-deletions N] [--rate N]
+"""
+
+import argparse
+import logging
+from app import app
+from services.storage_gc import (
+    collect_garbage,
+    write_gc_report,
+    GC_GRACE_HOURS,
+    GC_MAX_DELETIONS,
+    GC_DELETIONS_PER_SECOND
+)
+
+# Configura il logging
+logging.basicConfig(level=logging.INFO,
+                   format='%(asctime)s - %(levelname)s - %(message)s')
+
+def main():
+    """Funzione principale per avviare la raccolta"""
+    parser = argparse.ArgumentParser(description='Individua ed elimina i file orfani dello storage')
+    parser.add_argument('--commit', action='store_true',
+                        help='Elimina i file orfani (altrimenti solo simulazione)')
+    parser.add_argument('--grace-hours', type=float, default=GC_GRACE_HOURS,
+                        help='Età minima in ore dei file eliminabili')
+    parser.add_argument('--max-deletions', type=int, default=GC_MAX_DELETIONS,
+                        help='Numero massimo di file eliminati')
+    parser.add_argument('--rate', type=float, default=GC_DELETIONS_PER_SECOND,
+                        help='Eliminazioni massime al secondo')
+    args = parser.parse_args()
+
+    with app.app_context():
+        report = collect_garbage(
+            commit=args.commit,
+            grace_hours=args.grace_hours,
+            max_deletions=args.max_deletions,
+            deletions_per_second=args.rate
+        )
+        report_file = write_gc_report(report)
+
+        logging.info("==== Riepilogo Garbage Collector ====")
+        logging.info(f"File esaminati: {report['scanned']}")
+        logging.info(f"File orfani: {report['identified']} ({report['identified_bytes']} byte)")
+        logging.info(f"File eliminati: {report['removed']}")
+        logging.info(f"Report salvato in: {report_file}")
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,12 @@
-import os
 import json
 import datetime
 from functools import wraps
-from flask import render_template, request, redirect, url_for, flash, jsonify, send_file, abort
+from flask import (render_template, request, redirect, url_for, flash, jsonify, send_file, abort,
+                   Response, stream_with_context)
 from flask_login import login_required, current_user
 from app import app, db, EmptyForm
 from models import (User, Document, Company, Folder, Permission, ActivityLog, AccessLevel, 
-                   Reminder, Tag, DocumentMetadata)
+                   Reminder, Tag)
 import shutil
 from routes import log_activity, admin_required
 
@@ -414,6 +414,42 @@ def folder_detail(folder_id):
                           current_order=sort_order,
                           form=form)
 
+@app.route('/folders/<int:folder_id>/download-zip')
+@login_required
+def download_folder_zip(folder_id):
+    """Scarica una cartella e tutte le sue sottocartelle come archivio ZIP (generato in streaming)"""
+    from services.zip_export import folder_tree, downloadable_documents, stream_zip
+
+    folder = Folder.query.get_or_404(folder_id)
+    tree = folder_tree(folder)
+    paths = dict(tree)
+
+    # Solo i documenti che l'utente può scaricare, nell'ordine delle cartelle
+    rows = downloadable_documents(current_user).with_entities(Document.id, Document.folder_id).filter(
+        Document.folder_id.in_(paths.keys())
+    ).order_by(Document.id).all()
+    order = {folder_id: index for index, (folder_id, _) in enumerate(tree)}
+    rows.sort(key=lambda row: order[row.folder_id])
+    documents = [(row.id, paths[row.folder_id]) for row in rows]
+
+    # Un'unica voce di audit per l'intera esportazione
+    log_activity(
+        user_id=current_user.id,
+        action="download_zip",
+        details=json.dumps({
+            "folder_id": folder.id,
+            "folder_path": folder.get_path(),
+            "document_count": len(documents),
+            "document_ids": [doc_id for doc_id, _ in documents]
+        })
+    )
+
+    response = Response(stream_with_context(stream_zip(documents, directories=[path for _, path in tree])),
+                        mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=f"{paths[folder.id]}.zip")
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @app.route('/folders/create/<int:parent_id>', methods=['GET', 'POST'])
 @login_required
 def create_folder(parent_id):
@@ -764,19 +800,29 @@ def delete_folder(folder_id):
         folders_to_process.extend(subfolders)
     
     # Eliminazione dei documenti e dei loro file fisici
+    from services.blob_store import release_blob
+    from services.location_index import remove_location
+    from services.storage_backend import file_exists, delete_file
     for document in documents_to_delete:
+        # Documenti nel blob store: rilascia solo il riferimento al contenuto
+        if document.content_hash:
+            release_blob(document.content_hash)
         # Eliminare il file fisico
-        if os.path.exists(document.file_path):
+        elif file_exists(document.file_path):
             try:
-                os.remove(document.file_path)
+                delete_file(document.file_path)
+                remove_location(document.file_path)
             except Exception as e:
                 print(f"Errore nell'eliminazione del file {document.file_path}: {e}")
         
         # Rimuovere le versioni dei documenti
         for version in document.versions:
-            if os.path.exists(version.file_path):
+            if version.content_hash:
+                release_blob(version.content_hash)
+            elif file_exists(version.file_path):
                 try:
-                    os.remove(version.file_path)
+                    delete_file(version.file_path)
+                    remove_location(version.file_path)
                 except Exception as e:
                     print(f"Errore nell'eliminazione della versione {version.file_path}: {e}")
     
@@ -903,47 +949,34 @@ def upload_document_to_folder(folder_id):
             flash('Nessun file selezionato', 'danger')
             return redirect(request.url)
         
-        from services.document_processor import allowed_file, extract_document_metadata
-        from services.ai_classifier import classify_document
-        from services.ocr import extract_text_from_document
+        from services.document_processor import allowed_file
         
         if file and allowed_file(file.filename):
-            # Save the uploaded file
-            from werkzeug.utils import secure_filename
-            import uuid
-            
-            filename = secure_filename(file.filename)
-            unique_filename = f"{str(uuid.uuid4())}_{filename}"
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            
-            # Assicurati che la directory esista
-            upload_dir = os.path.dirname(file_path)
-            if not os.path.exists(upload_dir):
-                os.makedirs(upload_dir, exist_ok=True)
-                app.logger.info(f"Directory creata: {upload_dir}")
+            # Save the uploaded file nel blob store indirizzato per contenuto
+            from services.document_processor import save_document
             
-            # Salva il file
-            file.save(file_path)
-            
-            # Verifica che il file sia stato salvato correttamente
-            if not os.path.exists(file_path):
-                app.logger.error(f"Errore: Il file non è stato salvato in {file_path}")
+            document_data = save_document(file, current_user.id)
+            if not document_data:
+                app.logger.error(f"Errore: Il file {file.filename} non è stato salvato")
                 flash('Errore durante il salvataggio del file. Contattare l\'amministratore.', 'danger')
                 return redirect(request.url)
-            else:
-                app.logger.info(f"File salvato correttamente in: {file_path} - dimensione: {os.path.getsize(file_path)} bytes")
+            
+            filename = document_data['original_filename']
+            file_path = document_data['file_path']
+            app.logger.info(f"File salvato correttamente in: {file_path} - dimensione: {document_data['file_size']} bytes")
             
             # Extract basic metadata
-            file_type = filename.rsplit('.', 1)[1].lower()
-            file_size = os.path.getsize(file_path)
+            file_type = document_data['file_type']
+            file_size = document_data['file_size']
             
             # Create new document record
             document = Document(
-                filename=unique_filename,
+                filename=document_data['filename'],
                 original_filename=filename,
                 file_path=file_path,
                 file_type=file_type,
                 file_size=file_size,
+                content_hash=document_data['content_hash'],
                 title=request.form.get('title', filename),
                 description=request.form.get('description', ''),
                 owner_id=current_user.id,
@@ -966,53 +999,29 @@ def upload_document_to_folder(folder_id):
             db.session.add(document)
             db.session.commit()
             
-            # Process the document asynchronously (in a real app, this would be a background task)
+            # Log activity
+            log_activity(
+                user_id=current_user.id,
+                document_id=document.id,
+                action="upload_document",
+                details=json.dumps({
+                    "folder_id": folder_id,
+                    "folder_path": folder.get_path(),
+                    "document_name": filename,
+                    "document_type": file_type,
+                    "document_size": file_size
+                })
+            )
+            
+            # Estrazione del testo, metadati e miniatura vengono eseguiti in background
             try:
-                # Extract text with OCR if applicable
-                try:
-                    extracted_text = extract_text_from_document(file_path, file_type)
-                    # Assicuriamoci che non ci siano caratteri NULL anche qui
-                    if extracted_text and '\x00' in extracted_text:
-                        extracted_text = extracted_text.replace('\x00', ' ')
-                    document.content_text = extracted_text
-                except Exception as text_error:
-                    app.logger.error(f"Text extraction error: {str(text_error)}")
-                    document.content_text = "Estrazione testo fallita: verifica se il file è protetto o danneggiato."
-                
-                # La classificazione è stata rimossa a favore dei tag
-                
-                # Extract metadata from document
-                metadata_dict = extract_document_metadata(file_path, file_type)
-                from models import DocumentMetadata
-                for key, value in metadata_dict.items():
-                    metadata = DocumentMetadata(
-                        document_id=document.id,
-                        key=key,
-                        value=str(value),
-                        modified_by_id=current_user.id
-                    )
-                    db.session.add(metadata)
-                
-                db.session.commit()
-                
-                # Log activity
-                log_activity(
-                    user_id=current_user.id,
-                    document_id=document.id,
-                    action="upload_document",
-                    details=json.dumps({
-                        "folder_id": folder_id,
-                        "folder_path": folder.get_path(),
-                        "document_name": filename,
-                        "document_type": file_type,
-                        "document_size": file_size
-                    })
-                )
-                
-                flash('Document uploaded and processed successfully!', 'success')
+                from services.processing_queue import enqueue_document_processing, PRIORITY_HIGH
+                enqueue_document_processing(document, user_id=current_user.id, priority=PRIORITY_HIGH)
+                flash('Documento caricato con successo! L\'elaborazione del contenuto è in corso.', 'success')
             except Exception as e:
-                app.logger.error(f"Error processing document: {str(e)}")
-                flash(f'Document uploaded but processing failed: {str(e)}', 'warning')
+                db.session.rollback()
+                app.logger.error(f"Errore durante l'accodamento dell'elaborazione del documento {document.id}: {str(e)}")
+                flash('Documento caricato, ma non è stato possibile avviarne l\'elaborazione.', 'warning')
             
             return redirect(url_for('folder_detail', folder_id=folder_id))
         else:
@@ -0,0 +1,92 @@
+"""
+Script per archiviare come delta binari le versioni precedenti dei documenti esistenti.
+
+Le nuove versioni vengono codificate in background dopo il caricamento (job
+delta_versions della coda di elaborazione); questo script applica la stessa politica alla cronologia già presente: per ogni
+documento con versioni, ogni versione precedente diventa un delta rispetto alla
+successiva, con catene limitate a MAX_DELTA_CHAIN (services/delta_store.py).
+
+Uso:
+    python deltify_version_history.py [--document-id ID]
+"""
+
+import argparse
+import logging
+import datetime
+from sqlalchemy import func
+from app import app, db
+from models import Document, DocumentVersion, StorageBlob
+from services.delta_store import deltify_document_history, MAX_DELTA_CHAIN
+
+# Configura il logging
+logging.basicConfig(level=logging.INFO,
+                   format='%(asctime)s - %(levelname)s - %(message)s')
+
+def create_delta_report(stats):
+    """Crea un report della codifica delta e lo salva in un file"""
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_file = f"delta_report_{timestamp}.txt"
+
+    with open(report_file, 'w') as f:
+        f.write("== Report Archiviazione Versioni come Delta ==\n")
+        f.write(f"Data: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        f.write(f"Lunghezza massima delle catene: {MAX_DELTA_CHAIN}\n\n")
+
+        f.write(f"Documenti elaborati: {stats['documents']}\n")
+        f.write(f"Versioni archiviate come delta: {stats['delta']}\n")
+        f.write(f"Versioni lasciate complete (non idonee o limite della catena): {stats['skipped']}\n")
+        f.write(f"Versioni con delta non conveniente: {stats['not_worth_it']}\n")
+        f.write(f"Spazio occupato dai delta: {stats['stored_bytes'] / (1024 * 1024):.1f} MB "
+                f"(invece di {stats['original_bytes'] / (1024 * 1024):.1f} MB)\n\n")
+
+        if stats['errors']:
+            f.write("== Dettagli Errori ==\n")
+            for error in stats['errors']:
+                f.write(f"{error}\n")
+
+        f.write("\n== Fine Report ==\n")
+
+    logging.info(f"Report salvato in: {report_file}")
+    return report_file
+
+def main():
+    """Funzione principale per avviare la codifica delta della cronologia"""
+    parser = argparse.ArgumentParser(description='Archivia come delta le versioni precedenti dei documenti')
+    parser.add_argument('--document-id', type=int, help='Elabora solo il documento indicato')
+    args = parser.parse_args()
+
+    stats = {'documents': 0, 'delta': 0, 'skipped': 0, 'not_worth_it': 0,
+             'original_bytes': 0, 'stored_bytes': 0, 'errors': []}
+
+    with app.app_context():
+        query = Document.query.filter(Document.id.in_(db.session.query(DocumentVersion.document_id)))
+        if args.document_id:
+            query = query.filter(Document.id == args.document_id)
+
+        for document in query.order_by(Document.id).all():
+            try:
+                result = deltify_document_history(document)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                stats['errors'].append(f"Documento ID {document.id}: {str(e)}")
+                continue
+            stats['documents'] += 1
+            for key in ('delta', 'skipped', 'not_worth_it'):
+                stats[key] += result[key]
+
+        original_bytes, stored_bytes = db.session.query(
+            func.sum(StorageBlob.file_size), func.sum(StorageBlob.stored_size)
+        ).filter(StorageBlob.compression == 'delta').one()
+        stats['original_bytes'] = int(original_bytes or 0)
+        stats['stored_bytes'] = int(stored_bytes or 0)
+
+        report_file = create_delta_report(stats)
+
+        logging.info("==== Riepilogo ====")
+        logging.info(f"Documenti elaborati: {stats['documents']}")
+        logging.info(f"Versioni archiviate come delta: {stats['delta']}")
+        logging.info(f"Report salvato in: {report_file}")
+
+if __name__ == "__main__":
+    main()
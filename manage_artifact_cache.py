@@ -0,0 +1,48 @@
+"""
+Script di gestione della cache degli artefatti derivati (document_cache/artifacts).
+
+Mostra occupazione e metriche della cache (hit, miss, evizioni) condivise tra
+tutti i worker; opzionalmente riallinea indice e file su disco o svuota la cache.
+
+Uso:
+    python manage_artifact_cache.py [--reconcile] [--clear]
+"""
+
+import argparse
+import logging
+from services.artifact_cache import get_cache_stats, reconcile_cache, evict
+
+# Configura il logging
+logging.basicConfig(level=logging.INFO,
+                   format='%(asctime)s - %(levelname)s - %(message)s')
+
+def main():
+    """Funzione principale per la gestione della cache"""
+    parser = argparse.ArgumentParser(description='Gestisce la cache degli artefatti derivati')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='Riallinea indice e file su disco e applica il limite di spazio')
+    parser.add_argument('--clear', action='store_true',
+                        help='Elimina tutti gli artefatti in cache')
+    args = parser.parse_args()
+
+    if args.reconcile:
+        reconcile_cache()
+    if args.clear:
+        result = evict(target_bytes=0)
+        logging.info(f"Cache svuotata: {result['evicted']} artefatti eliminati")
+
+    stats = get_cache_stats()
+    logging.info("==== Cache degli artefatti ====")
+    logging.info(f"Politica di evizione: {stats['policy'].upper()}")
+    logging.info(f"Artefatti: {stats['entries']}")
+    logging.info(f"Spazio occupato: {stats['bytes'] / (1024 * 1024):.1f} MB "
+                 f"su {stats['max_bytes'] / (1024 * 1024):.0f} MB")
+    logging.info(f"Hit: {stats['hits']} - Miss: {stats['misses']} - Evizioni: {stats['evictions']}")
+    if stats['hit_ratio'] is not None:
+        logging.info(f"Percentuale di hit: {stats['hit_ratio'] * 100:.1f}%")
+    for artifact_type, totals in sorted(stats['by_type'].items()):
+        logging.info(f"  {artifact_type}: {totals['entries']} artefatti, "
+                     f"{totals['bytes'] / (1024 * 1024):.1f} MB")
+
+if __name__ == "__main__":
+    main()
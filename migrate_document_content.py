@@ -0,0 +1,85 @@
+"""
+Script per spostare il testo estratto dei documenti nella tabella document_content.
+
+Il testo completo (colonna document.content_text) viene copiato nella tabella
+document_content, caricata solo quando serve, e nel documento resta l'estratto
+content_preview usato da liste e anteprime. Lo spostamento avviene a blocchi,
+svuotando la vecchia colonna man mano: lo script può essere interrotto e
+rieseguito. Con --drop-column la vecchia colonna viene infine eliminata.
+
+Uso:
+    python migrate_document_content.py [--batch-size N] [--drop-column]
+"""
+
+import argparse
+from app import app, db
+from sqlalchemy import text, inspect
+from models import DocumentContent, make_content_preview, CONTENT_PREVIEW_LENGTH
+
+def document_columns():
+    return [column['name'] for column in inspect(db.engine).get_columns('document')]
+
+def move_content(batch_size):
+    """Copia il testo dei documenti in document_content a blocchi e svuota la vecchia colonna."""
+    moved = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(text(
+            "SELECT id, content_text FROM document "
+            "WHERE content_text IS NOT NULL AND id > :last_id ORDER BY id LIMIT :limit"
+        ), {'last_id': last_id, 'limit': batch_size}).fetchall()
+        if not rows:
+            break
+
+        for document_id, content_text in rows:
+            content = db.session.get(DocumentContent, document_id)
+            if content is None:
+                db.session.add(DocumentContent(document_id=document_id, text=content_text))
+            else:
+                # Il testo già presente in document_content è più recente
+                content_text = content.text
+            db.session.execute(text(
+                "UPDATE document SET content_preview = :preview, content_text = NULL WHERE id = :id"
+            ), {'preview': make_content_preview(content_text), 'id': document_id})
+            last_id = document_id
+
+        db.session.commit()
+        moved += len(rows)
+        print(f"Spostato il testo di {moved} documenti...")
+    return moved
+
+def main():
+    """Funzione principale per la migrazione."""
+    parser = argparse.ArgumentParser(description='Sposta il testo estratto dei documenti nella tabella document_content')
+    parser.add_argument('--batch-size', type=int, default=200, help='Documenti per transazione')
+    parser.add_argument('--drop-column', action='store_true',
+                        help='Elimina la colonna document.content_text al termine')
+    args = parser.parse_args()
+
+    with app.app_context():
+        print("Avvio migrazione del testo estratto dei documenti...")
+
+        # Crea la tabella document_content se non esiste
+        db.create_all()
+
+        if 'content_preview' not in document_columns():
+            print("Aggiunta colonna document.content_preview...")
+            db.session.execute(text(f"ALTER TABLE document ADD COLUMN content_preview VARCHAR({CONTENT_PREVIEW_LENGTH});"))
+            db.session.commit()
+
+        if 'content_text' not in document_columns():
+            print("Colonna document.content_text non presente: nessun testo da spostare.")
+            return
+
+        moved = move_content(args.batch_size)
+        print(f"Testo di {moved} documenti spostato in document_content.")
+
+        if args.drop_column:
+            print("Rimozione colonna document.content_text...")
+            db.session.execute(text("ALTER TABLE document DROP COLUMN content_text;"))
+            db.session.commit()
+
+        print("Migrazione completata con successo!")
+
+if __name__ == "__main__":
+    main()
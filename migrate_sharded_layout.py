@@ -0,0 +1,191 @@
+"""
+Script per migrare i file delle directory di storage dal layout piatto al layout
+partizionato (es. originals/ab/cd/<nome_file>).
+
+I file vengono spostati sul posto con os.replace (nessuna copia) e i percorsi
+registrati nel database (Document, DocumentVersion, StorageBlob) e nell'indice
+dello storage permanente vengono aggiornati di conseguenza.
+
+Gli spostamenti avvengono a blocchi: per ogni blocco i nuovi percorsi vengono
+salvati nel database prima di spostare i file. Se lo script si interrompe, le
+righe puntano al percorso partizionato mentre il file è ancora in quello piatto:
+resolve_path li trova entrambi e una nuova esecuzione completa lo spostamento.
+
+Uso:
+    python migrate_sharded_layout.py            # esegue la migrazione
+    python migrate_sharded_layout.py --dry-run  # mostra solo cosa verrebbe spostato
+"""
+
+import os
+import sys
+import logging
+import datetime
+from app import app, db
+from models import Document, DocumentVersion, StorageBlob
+from services.storage_layout import migrate_directory
+from services.simple_storage import UPLOAD_FOLDER
+from services.blob_store import BLOB_STORE_DIR
+from services.central_storage import ORIGINAL_FILES_DIR, BACKUP_FILES_DIR
+from services.persistent_storage import (
+    PERMANENT_ORIGINALS_DIR,
+    PERMANENT_BACKUP_DIR,
+    SECONDARY_STORAGE_DIRS
+)
+from services import storage_index, location_index
+
+# Configura il logging
+logging.basicConfig(level=logging.INFO,
+                   format='%(asctime)s - %(levelname)s - %(message)s')
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+UPLOADS_DIR = os.path.join(BASE_DIR, UPLOAD_FOLDER)
+
+# Directory di storage da migrare al layout partizionato
+STORAGE_DIRECTORIES = [
+    UPLOADS_DIR,
+    BLOB_STORE_DIR,
+    ORIGINAL_FILES_DIR,
+    BACKUP_FILES_DIR,
+    PERMANENT_ORIGINALS_DIR,
+    PERMANENT_BACKUP_DIR
+] + [directory for directory in SECONDARY_STORAGE_DIRS
+     if directory not in (UPLOADS_DIR, ORIGINAL_FILES_DIR, BACKUP_FILES_DIR)]
+
+# Numero di percorsi per ogni query di aggiornamento
+UPDATE_BATCH_SIZE = 500
+
+def update_database_paths(moves):
+    """
+    Aggiorna i percorsi dei file spostati nelle tabelle del database.
+
+    Args:
+        moves: Dizionario vecchio percorso -> nuovo percorso
+
+    Returns:
+        int: Numero di righe aggiornate
+    """
+    # I percorsi possono essere registrati sia assoluti che relativi alla directory del progetto
+    lookup = {}
+    for old_path, new_path in moves.items():
+        lookup[old_path] = new_path
+        lookup[os.path.relpath(old_path, BASE_DIR)] = new_path
+
+    keys = list(lookup.keys())
+    updated = 0
+
+    for model in (Document, DocumentVersion, StorageBlob):
+        for start in range(0, len(keys), UPDATE_BATCH_SIZE):
+            batch = keys[start:start + UPDATE_BATCH_SIZE]
+            for record in model.query.filter(model.file_path.in_(batch)).all():
+                record.file_path = lookup[record.file_path]
+                updated += 1
+        db.session.commit()
+
+    return updated
+
+def move_files(report):
+    """
+    Sposta i file pianificati da migrate_directory a blocchi, salvando i nuovi
+    percorsi nel database prima di ogni blocco di spostamenti.
+
+    Args:
+        report: Report di migrate_directory calcolato con dry_run=True
+
+    Returns:
+        tuple: (righe del database aggiornate, voci dell'indice aggiornate)
+    """
+    planned = list(report['moves'].items())
+    report['moves'] = {}
+    report['moved'] = 0
+    db_updated = 0
+    index_updated = 0
+
+    for start in range(0, len(planned), UPDATE_BATCH_SIZE):
+        batch = dict(planned[start:start + UPDATE_BATCH_SIZE])
+        db_updated += update_database_paths(batch)
+
+        moved = {}
+        failed = {}
+        for old_path, new_path in batch.items():
+            try:
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                os.replace(old_path, new_path)
+                moved[old_path] = new_path
+            except OSError as e:
+                failed[new_path] = old_path
+                error_msg = f"Errore durante lo spostamento di {old_path}: {str(e)}"
+                report['errors'].append(error_msg)
+                logging.error(error_msg)
+
+        if failed:
+            # Il file è rimasto nel layout piatto: ripristina il percorso nel database
+            update_database_paths(failed)
+
+        if moved:
+            index_updated += storage_index.update_paths(moved)
+            location_index.update_paths(moved)
+        report['moves'].update(moved)
+        report['moved'] += len(moved)
+
+    return db_updated, index_updated
+
+def create_migration_report(reports, db_updated, index_updated, dry_run):
+    """Crea un report di migrazione e lo salva in un file"""
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_file = f"migration_report_{timestamp}.txt"
+
+    with open(report_file, 'w') as f:
+        f.write("== Report di Migrazione al Layout Partizionato ==\n")
+        f.write(f"Data: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        if dry_run:
+            f.write("Modalità simulazione: nessun file è stato spostato\n")
+        f.write("\n")
+
+        for report in reports:
+            f.write(f"{report['directory']}: {report['moved']} spostati, "
+                    f"{report['skipped']} già presenti, {len(report['errors'])} errori\n")
+
+        f.write(f"\nRighe del database aggiornate: {db_updated}\n")
+        f.write(f"Voci dell'indice aggiornate: {index_updated}\n\n")
+
+        errors = [error for report in reports for error in report['errors']]
+        if errors:
+            f.write("== Dettagli Errori ==\n")
+            for error in errors:
+                f.write(f"{error}\n")
+
+        f.write("\n== Fine Report ==\n")
+
+    logging.info(f"Report di migrazione salvato in: {report_file}")
+    return report_file
+
+def main():
+    """Funzione principale per avviare la migrazione"""
+    dry_run = '--dry-run' in sys.argv
+
+    with app.app_context():
+        logging.info("Avvio migrazione al layout partizionato...")
+
+        reports = []
+        moves = {}
+        db_updated = 0
+        index_updated = 0
+        for directory in STORAGE_DIRECTORIES:
+            report = migrate_directory(directory, dry_run=True)
+            if not dry_run:
+                directory_db_updated, directory_index_updated = move_files(report)
+                db_updated += directory_db_updated
+                index_updated += directory_index_updated
+            logging.info(f"{directory}: {report['moved']} file da spostare/spostati")
+            moves.update(report['moves'])
+            reports.append(report)
+
+        report_file = create_migration_report(reports, db_updated, index_updated, dry_run)
+
+        logging.info("==== Riepilogo Migrazione ====")
+        logging.info(f"File spostati: {len(moves)}")
+        logging.info(f"Righe del database aggiornate: {db_updated}")
+        logging.info(f"Report salvato in: {report_file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Script per importare il vecchio permanent_storage/storage_index.json nell'indice SQLite.
+
+Da eseguire una sola volta: al termine il file JSON viene rinominato in
+storage_index.json.imported, così un'esecuzione successiva non reimporta le voci.
+"""
+
+import os
+import logging
+from app import app
+from services.persistent_storage import STORAGE_INDEX_FILE
+from services import storage_index
+
+# Configura il logging
+logging.basicConfig(level=logging.INFO,
+                   format='%(asctime)s - %(levelname)s - %(message)s')
+
+def main():
+    """Funzione principale per avviare l'importazione"""
+    with app.app_context():
+        if not os.path.exists(STORAGE_INDEX_FILE):
+            logging.info(f"Nessun indice JSON da importare in {STORAGE_INDEX_FILE}")
+            return
+
+        try:
+            imported = storage_index.import_json_index(STORAGE_INDEX_FILE)
+        except Exception as e:
+            logging.error(f"Errore durante l'importazione dell'indice: {str(e)}")
+            return
+
+        os.replace(STORAGE_INDEX_FILE, f"{STORAGE_INDEX_FILE}.imported")
+
+        stats = storage_index.get_stats()
+        logging.info("==== Riepilogo Importazione ====")
+        logging.info(f"Voci importate: {imported}")
+        logging.info(f"File nell'indice: {stats.get('total_files', 0)}")
+        logging.info(f"Dimensione totale: {stats.get('total_size', 0)} byte")
+        logging.info(f"Indice salvato in: {storage_index.STORAGE_INDEX_DB}")
+
+if __name__ == "__main__":
+    main()
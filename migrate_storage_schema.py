@@ -0,0 +1,89 @@
+"""
+Script per aggiornare lo schema del database con le colonne richieste
+dai servizi di storage (blob store indirizzato per contenuto, ecc.).
+
+Le nuove tabelle vengono create automaticamente da db.create_all() all'avvio
+dell'applicazione; questo script aggiunge le colonne mancanti alle tabelle esistenti.
+"""
+
+from app import app, db
+from sqlalchemy import text, inspect
+
+# Definizione delle nuove colonne da aggiungere, per tabella
+NEW_COLUMNS = {
+    'document': [
+        ("content_hash", "VARCHAR(64)"),
+    ],
+    'document_version': [
+        ("content_hash", "VARCHAR(64)"),
+    ],
+    'storage_blob': [
+        ("mime_type", "VARCHAR(128)"),
+        ("compression", "VARCHAR(16)"),
+        ("stored_size", "BIGINT"),
+        ("compression_cpu_ms", "FLOAT"),
+        ("compressed_at", "TIMESTAMP"),
+        ("delta_base_hash", "VARCHAR(64)"),
+    ],
+}
+
+# Indici da creare sulle nuove colonne
+NEW_INDEXES = [
+    ("ix_document_content_hash", "document", "content_hash"),
+    ("ix_document_version_content_hash", "document_version", "content_hash"),
+    ("ix_storage_blob_delta_base_hash", "storage_blob", "delta_base_hash"),
+]
+
+def create_column_if_not_exists(table_name, column_name, column_type):
+    """Aggiunge una colonna se non esiste già nella tabella."""
+    # Usa l'inspector di SQLAlchemy per supportare sia PostgreSQL che SQLite
+    existing_columns = [column['name'] for column in inspect(db.engine).get_columns(table_name)]
+
+    if column_name not in existing_columns:
+        print(f"Aggiunta colonna {table_name}.{column_name}...")
+        alter_query = text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type};")
+        db.session.execute(alter_query)
+        return True
+    else:
+        print(f"Colonna {table_name}.{column_name} già esistente.")
+        return False
+
+def create_index_if_not_exists(index_name, table_name, column_name):
+    """Crea un indice se non esiste già."""
+    existing_indexes = [index['name'] for index in inspect(db.engine).get_indexes(table_name)]
+
+    if index_name not in existing_indexes:
+        print(f"Creazione indice {index_name}...")
+        db.session.execute(text(f"CREATE INDEX {index_name} ON {table_name} ({column_name});"))
+        return True
+    return False
+
+def main():
+    """Funzione principale per la migrazione."""
+    with app.app_context():
+        print("Avvio migrazione dello schema di storage...")
+
+        # Crea le nuove tabelle (es. storage_blob) se non esistono
+        db.create_all()
+
+        # Aggiungi le nuove colonne
+        columns_added = 0
+        for table_name, columns in NEW_COLUMNS.items():
+            for column_name, column_type in columns:
+                if create_column_if_not_exists(table_name, column_name, column_type):
+                    columns_added += 1
+        db.session.commit()
+
+        for index_name, table_name, column_name in NEW_INDEXES:
+            create_index_if_not_exists(index_name, table_name, column_name)
+        db.session.commit()
+
+        if columns_added > 0:
+            print(f"Aggiunte {columns_added} nuove colonne.")
+        else:
+            print("Lo schema è già aggiornato con tutte le colonne necessarie.")
+
+        print("Migrazione completata con successo!")
+
+if __name__ == "__main__":
+    main()
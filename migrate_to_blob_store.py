@@ -0,0 +1,132 @@
+"""
+Script per importare i file dei documenti esistenti nel blob store indirizzato per contenuto.
+
+Per ogni Document e DocumentVersion senza content_hash il file viene importato nel
+blob store (i contenuti identici vengono memorizzati una sola volta) e il percorso
+nel database viene aggiornato. I file originali nella directory uploads vengono
+eliminati solo se si passa l'opzione --delete-originals.
+"""
+
+import os
+import sys
+import logging
+import datetime
+from app import app, db
+from models import Document, DocumentVersion
+from services.blob_store import store_blob, acquire_blob, BLOB_STORE_DIR
+from services.location_index import remove_location
+
+# Configura il logging
+logging.basicConfig(level=logging.INFO,
+                   format='%(asctime)s - %(levelname)s - %(message)s')
+
+UPLOADS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'uploads'))
+
+def import_record(record, imported_paths, stats):
+    """
+    Importa nel blob store il file di una riga Document o DocumentVersion.
+
+    Args:
+        record: Riga Document o DocumentVersion da importare
+        imported_paths: Dizionario percorso -> content_hash dei file già importati
+        stats: Statistiche della migrazione da aggiornare
+    """
+    old_path = record.file_path
+    if not old_path or not os.path.exists(old_path):
+        stats['missing'] += 1
+        stats['errors'].append(f"{type(record).__name__} ID {record.id}: file non trovato ({old_path})")
+        return
+
+    if old_path in imported_paths:
+        # Stesso file fisico già importato (es. documento e sua ultima versione)
+        content_hash = imported_paths[old_path]
+        blob = acquire_blob(content_hash)
+    else:
+        blob = store_blob(file_path=old_path)
+        if blob is None:
+            stats['failed'] += 1
+            stats['errors'].append(f"{type(record).__name__} ID {record.id}: importazione fallita")
+            return
+        imported_paths[old_path] = blob.content_hash
+        if blob.ref_count > 1:
+            stats['deduplicated_bytes'] += blob.file_size
+
+    record.content_hash = blob.content_hash
+    record.file_path = blob.file_path
+    stats['imported'] += 1
+
+def create_migration_report(stats):
+    """Crea un report di migrazione e lo salva in un file"""
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_file = f"migration_report_{timestamp}.txt"
+
+    with open(report_file, 'w') as f:
+        f.write("== Report di Migrazione al Blob Store ==\n")
+        f.write(f"Data: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+
+        f.write(f"Righe importate: {stats['imported']}\n")
+        f.write(f"File mancanti: {stats['missing']}\n")
+        f.write(f"Importazioni fallite: {stats['failed']}\n")
+        f.write(f"Byte deduplicati: {stats['deduplicated_bytes']}\n")
+        f.write(f"File originali eliminati: {stats['originals_removed']}\n\n")
+
+        if stats['errors']:
+            f.write("== Dettagli Errori ==\n")
+            for error in stats['errors']:
+                f.write(f"{error}\n")
+
+        f.write("\n== Fine Report ==\n")
+
+    logging.info(f"Report di migrazione salvato in: {report_file}")
+    return report_file
+
+def main():
+    """Funzione principale per avviare la migrazione"""
+    delete_originals = '--delete-originals' in sys.argv
+
+    stats = {
+        'imported': 0,
+        'missing': 0,
+        'failed': 0,
+        'deduplicated_bytes': 0,
+        'originals_removed': 0,
+        'errors': []
+    }
+    imported_paths = {}
+
+    with app.app_context():
+        logging.info("Avvio importazione dei documenti nel blob store...")
+
+        for model in (Document, DocumentVersion):
+            records = model.query.filter(model.content_hash.is_(None)).all()
+            logging.info(f"Trovate {len(records)} righe {model.__name__} da importare")
+
+            for record in records:
+                try:
+                    import_record(record, imported_paths, stats)
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    stats['failed'] += 1
+                    stats['errors'].append(f"{model.__name__} ID {record.id}: {str(e)}")
+
+        # Elimina le copie originali nella directory uploads (ora duplicate nel blob store)
+        if delete_originals:
+            for old_path in imported_paths:
+                if old_path.startswith(UPLOADS_DIR) and not old_path.startswith(BLOB_STORE_DIR):
+                    try:
+                        os.remove(old_path)
+                        remove_location(old_path)
+                        stats['originals_removed'] += 1
+                    except OSError as e:
+                        stats['errors'].append(f"Impossibile eliminare {old_path}: {str(e)}")
+
+        report_file = create_migration_report(stats)
+
+        logging.info("==== Riepilogo Migrazione ====")
+        logging.info(f"Righe importate: {stats['imported']}")
+        logging.info(f"Byte deduplicati: {stats['deduplicated_bytes']}")
+        logging.info(f"Report salvato in: {report_file}")
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,30 @@
 """
 Script per migrare automaticamente tutti i documenti esistenti al nuovo sistema di storage centralizzato.
 Questo script deve essere eseguito una sola volta per trasferire tutti i documenti dal vecchio al nuovo sistema.
+
+La migrazione usa il runner di services/migration_runner.py: i documenti vengono
+copiati in parallelo e, se lo script viene interrotto, una nuova esecuzione
+riprende dall'ultimo blocco completato.
+
+Uso:
+    python migrate_to_central_storage.py [--workers N] [--batch-size N] [--max-mb-per-second N] [--restart]
 """
 
-import os
 import sys
+import argparse
 import logging
-import datetime
 from app import app, db
 from models import Document
 from services.central_storage import (
     ensure_storage_directories,
-    migrate_files_to_central_storage,
     verify_and_repair_storage
 )
+from services.migration_runner import (
+    run_migration,
+    write_migration_report,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_MAX_WORKERS
+)
 
 # Configura il logging
 logging.basicConfig(
@@ -22,36 +33,19 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def create_migration_report(report_data):
-    """Crea un report di migrazione e lo salva in un file"""
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    report_filename = f"migration_report_{timestamp}.txt"
-    
-    with open(report_filename, 'w') as f:
-        f.write("=== REPORT DI MIGRAZIONE AL SISTEMA DI STORAGE CENTRALIZZATO ===\n")
-        f.write(f"Data: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
-        
-        # Scrivi i dati principali
-        f.write(f"Documenti totali: {report_data['total_documents']}\n")
-        f.write(f"Migrati con successo: {report_data['migrated_successfully']}\n")
-        f.write(f"Già migrati: {report_data['already_migrated']}\n")
-        f.write(f"Migrazione fallita: {report_data['migration_failed']}\n\n")
-        
-        # Scrivi eventuali errori
-        if report_data['errors'] and len(report_data['errors']) > 0:
-            f.write("ERRORI DURANTE LA MIGRAZIONE:\n")
-            for i, error in enumerate(report_data['errors'], 1):
-                f.write(f"{i}. {error}\n")
-        else:
-            f.write("Nessun errore durante la migrazione.\n")
-            
-        f.write("\n=== FINE REPORT ===\n")
-    
-    logger.info(f"Report di migrazione creato: {report_filename}")
-    return report_filename
-
 def main():
     """Funzione principale per avviare la migrazione"""
+    parser = argparse.ArgumentParser(description='Migra i documenti allo storage centralizzato')
+    parser.add_argument('--workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help='Thread di copia in parallelo')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Documenti per blocco (un checkpoint per blocco)')
+    parser.add_argument('--max-mb-per-second', type=float, default=None,
+                        help='Limite della velocità di copia')
+    parser.add_argument('--restart', action='store_true',
+                        help="Ignora la migrazione interrotta e riparte dall'inizio")
+    args = parser.parse_args()
+
     try:
         logger.info("Avvio della migrazione al sistema di storage centralizzato...")
         
@@ -67,10 +61,21 @@ def main():
             
             # Avvia la migrazione
             logger.info("Migrazione dei file al sistema di storage centralizzato...")
-            migration_report = migrate_files_to_central_storage(update_database=True)
+            run = run_migration(
+                'central',
+                restart=args.restart,
+                batch_size=args.batch_size,
+                max_workers=args.workers,
+                max_mb_per_second=args.max_mb_per_second
+            )
             
             # Crea un report di migrazione
-            report_file = create_migration_report(migration_report)
+            report_file = write_migration_report(run, "REPORT DI MIGRAZIONE AL SISTEMA DI STORAGE CENTRALIZZATO")
+            
+            if run.status != 'completed':
+                logger.error(f"Migrazione non completata ({run.status}): rieseguire lo script per riprenderla")
+                logger.info(f"Report di migrazione salvato in: {report_file}")
+                return 1
             
             # Verifica e ripara lo storage
             logger.info("Verifica e riparazione dello storage...")
@@ -80,10 +85,11 @@ def main():
                       f"{repair_report['files_restored']} file ripristinati")
             
             logger.info("Migrazione completata con successo!")
+            logger.info(f"Throughput: {run.docs_per_second:.1f} documenti/s, {run.mb_per_second:.2f} MB/s")
             logger.info(f"Report di migrazione salvato in: {report_file}")
             
-            if migration_report['migration_failed'] > 0:
-                logger.warning(f"ATTENZIONE: {migration_report['migration_failed']} documenti non sono stati migrati correttamente!")
+            if run.failed_count > 0:
+                logger.warning(f"ATTENZIONE: {run.failed_count} documenti non sono stati migrati correttamente!")
                 logger.warning("Controlla il report per i dettagli")
                 return 1
             
@@ -0,0 +1,142 @@
+"""
+Script per spostare i file dei documenti meno recenti sullo storage a oggetti (S3).
+
+Carica sul bucket configurato (S3_BUCKET, S3_ENDPOINT_URL, ...) i file dei
+documenti e delle versioni creati da più di N giorni, usando come chiave il
+percorso relativo alla directory dell'applicazione. Con l'opzione --delete-local
+la copia locale viene eliminata dopo aver verificato la dimensione dell'oggetto
+caricato; le route continuano a servire il file tramite services/storage_backend.py
+(con STORAGE_BACKEND=s3).
+
+Uso:
+    python migrate_to_object_storage.py [--older-than-days=N] [--delete-local]
+"""
+
+import os
+import sys
+import logging
+import datetime
+from app import app, db
+from models import Document, DocumentVersion
+from services.storage_backend import get_object_storage_backend, key_for_path
+from services.location_index import remove_location
+
+# Configura il logging
+logging.basicConfig(level=logging.INFO,
+                   format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Età minima (in giorni) dei documenti da spostare
+DEFAULT_OLDER_THAN_DAYS = 90
+
+def upload_path(remote, path, delete_local, stats):
+    """
+    Carica un file sullo storage a oggetti (se non già presente) ed eventualmente elimina la copia locale.
+
+    Args:
+        remote: Backend S3 di destinazione
+        path: Percorso locale del file
+        delete_local: Se True, elimina la copia locale dopo il caricamento
+        stats: Statistiche della migrazione da aggiornare
+    """
+    if not os.path.isfile(path):
+        stats['skipped'] += 1
+        return
+
+    key = key_for_path(path)
+    local_size = os.path.getsize(path)
+    remote_info = remote.stat(key)
+
+    if remote_info is None or remote_info['size'] != local_size:
+        remote.put(key, path)
+        remote_info = remote.stat(key)
+        stats['uploaded'] += 1
+        stats['uploaded_bytes'] += local_size
+    else:
+        stats['already_present'] += 1
+
+    if delete_local:
+        if remote_info is None or remote_info['size'] != local_size:
+            stats['errors'].append(f"{path}: dimensione remota non corrispondente, copia locale mantenuta")
+            return
+        os.remove(path)
+        remove_location(path)
+        stats['local_removed'] += 1
+
+def create_migration_report(stats):
+    """Crea un report di migrazione e lo salva in un file"""
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_file = f"migration_report_{timestamp}.txt"
+
+    with open(report_file, 'w') as f:
+        f.write("== Report di Migrazione allo Storage a Oggetti ==\n")
+        f.write(f"Data: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+
+        f.write(f"File caricati: {stats['uploaded']} ({stats['uploaded_bytes']} byte)\n")
+        f.write(f"File già presenti: {stats['already_present']}\n")
+        f.write(f"File non presenti su disco: {stats['skipped']}\n")
+        f.write(f"Copie locali eliminate: {stats['local_removed']}\n\n")
+
+        if stats['errors']:
+            f.write("== Dettagli Errori ==\n")
+            for error in stats['errors']:
+                f.write(f"{error}\n")
+
+        f.write("\n== Fine Report ==\n")
+
+    logging.info(f"Report di migrazione salvato in: {report_file}")
+    return report_file
+
+def main():
+    """Funzione principale per avviare la migrazione"""
+    delete_local = '--delete-local' in sys.argv
+    older_than_days = DEFAULT_OLDER_THAN_DAYS
+    for arg in sys.argv[1:]:
+        if arg.startswith('--older-than-days='):
+            older_than_days = int(arg.split('=', 1)[1])
+
+    remote = get_object_storage_backend()
+    if remote is None:
+        logging.error("S3_BUCKET non impostato: configurare lo storage a oggetti prima della migrazione")
+        return
+
+    stats = {
+        'uploaded': 0,
+        'uploaded_bytes': 0,
+        'already_present': 0,
+        'skipped': 0,
+        'local_removed': 0,
+        'errors': []
+    }
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=older_than_days)
+
+    with app.app_context():
+        logging.info(f"Spostamento sullo storage a oggetti dei file creati prima del {cutoff:%Y-%m-%d}...")
+
+        paths = set()
+        for model in (Document, DocumentVersion):
+            rows = db.session.query(model.file_path).filter(model.created_at < cutoff).all()
+            paths.update(path for (path,) in rows if path)
+
+        # Un file ancora usato da un documento recente (es. blob condiviso) resta anche su disco
+        recent_paths = set()
+        for model in (Document, DocumentVersion):
+            rows = db.session.query(model.file_path).filter(model.created_at >= cutoff).all()
+            recent_paths.update(path for (path,) in rows if path)
+
+        logging.info(f"Trovati {len(paths)} file da spostare")
+        for path in sorted(paths):
+            try:
+                upload_path(remote, path, delete_local and path not in recent_paths, stats)
+            except Exception as e:
+                stats['errors'].append(f"{path}: {str(e)}")
+                logging.error(f"Errore durante il caricamento di {path}: {str(e)}")
+
+        report_file = create_migration_report(stats)
+
+        logging.info("==== Riepilogo Migrazione ====")
+        logging.info(f"File caricati: {stats['uploaded']}")
+        logging.info(f"Copie locali eliminate: {stats['local_removed']}")
+        logging.info(f"Report salvato in: {report_file}")
+
+if __name__ == "__main__":
+    main()
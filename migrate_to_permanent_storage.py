@@ -1,48 +1,44 @@
 """
 Script per migrare automaticamente tutti i documenti esistenti al nuovo sistema di storage permanente.
 Questo script deve essere eseguito una sola volta per trasferire tutti i documenti dal vecchio al nuovo sistema.
+
+La migrazione usa il runner di services/migration_runner.py: i documenti vengono
+copiati in parallelo e, se lo script viene interrotto, una nuova esecuzione
+riprende dall'ultimo blocco completato.
+
+Uso:
+    python migrate_to_permanent_storage.py [--workers N] [--batch-size N] [--max-mb-per-second N] [--restart]
 """
 
-import os
 import sys
-import datetime
+import argparse
 import logging
-import json
 from app import app, db
 from models import Document
+from services.migration_runner import (
+    run_migration,
+    write_migration_report,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_MAX_WORKERS
+)
 
 # Configura il logging
 logging.basicConfig(level=logging.INFO, 
                    format='%(asctime)s - %(levelname)s - %(message)s')
 
-def create_migration_report(report_data):
-    """Crea un report di migrazione e lo salva in un file"""
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    report_file = f"migration_report_{timestamp}.txt"
-    
-    with open(report_file, 'w') as f:
-        f.write(f"== Report di Migrazione allo Storage Permanente ==\n")
-        f.write(f"Data: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
-        
-        f.write(f"Totale documenti: {report_data['total']}\n")
-        f.write(f"Documenti migrati con successo: {report_data['migrated']}\n")
-        f.write(f"Documenti falliti: {report_data['failed']}\n\n")
-        
-        if report_data['failed'] > 0:
-            f.write("== Dettagli Errori ==\n")
-            for error in report_data['errors']:
-                if 'document_id' in error:
-                    f.write(f"Documento ID {error['document_id']}: {error['reason']}\n")
-                else:
-                    f.write(f"Errore generale: {error.get('general_error', 'Errore sconosciuto')}\n")
-        
-        f.write("\n== Fine Report ==\n")
-    
-    logging.info(f"Report di migrazione salvato in: {report_file}")
-    return report_file
-
 def main():
     """Funzione principale per avviare la migrazione"""
+    parser = argparse.ArgumentParser(description='Migra i documenti allo storage permanente')
+    parser.add_argument('--workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help='Thread di copia in parallelo')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Documenti per blocco (un checkpoint per blocco)')
+    parser.add_argument('--max-mb-per-second', type=float, default=None,
+                        help='Limite della velocità di copia')
+    parser.add_argument('--restart', action='store_true',
+                        help="Ignora la migrazione interrotta e riparte dall'inizio")
+    args = parser.parse_args()
+
     logging.info("Avvio migrazione allo storage permanente...")
     
     with app.app_context():
@@ -50,7 +46,6 @@ def main():
         try:
             from services.persistent_storage import (
                 ensure_storage_structure, 
-                batch_migrate_to_permanent_storage,
                 verify_storage_integrity
             )
         except ImportError:
@@ -65,53 +60,37 @@ def main():
         total_documents = Document.query.count()
         logging.info(f"Trovati {total_documents} documenti da migrare")
         
-        # Procedi automaticamente con la migrazione
-        logging.info(f"Procedo automaticamente con la migrazione di {total_documents} documenti allo storage permanente")
-        
-        # Esegui la migrazione in batch
-        batch_size = 100
-        num_batches = (total_documents + batch_size - 1) // batch_size
-        
-        overall_stats = {
-            'total': 0,
-            'migrated': 0,
-            'failed': 0,
-            'errors': []
-        }
-        
-        for i in range(num_batches):
-            offset = i * batch_size
-            logging.info(f"Elaborazione batch {i+1}/{num_batches} (documenti {offset+1}-{min(offset+batch_size, total_documents)})")
-            
-            # Migra il batch corrente
-            batch_stats = batch_migrate_to_permanent_storage(limit=batch_size)
-            
-            # Aggiorna le statistiche complessive
-            overall_stats['total'] += batch_stats['total']
-            overall_stats['migrated'] += batch_stats['migrated']
-            overall_stats['failed'] += batch_stats['failed']
-            overall_stats['errors'].extend(batch_stats['errors'])
-            
-            logging.info(f"Batch {i+1} completato: {batch_stats['migrated']}/{batch_stats['total']} documenti migrati")
+        # Esegui la migrazione (riprende automaticamente un'esecuzione interrotta)
+        run = run_migration(
+            'permanent',
+            restart=args.restart,
+            batch_size=args.batch_size,
+            max_workers=args.workers,
+            max_mb_per_second=args.max_mb_per_second
+        )
         
         # Verifica l'integrità dello storage
         logging.info("Verifica dell'integrità dello storage permanente...")
         integrity_stats = verify_storage_integrity()
         
         # Crea il report di migrazione
-        report_file = create_migration_report(overall_stats)
+        report_file = write_migration_report(run, "Report di Migrazione allo Storage Permanente")
         
         # Stampa un riepilogo
         logging.info("==== Riepilogo Migrazione ====")
-        logging.info(f"Totale documenti elaborati: {overall_stats['total']}")
-        logging.info(f"Documenti migrati con successo: {overall_stats['migrated']}")
-        logging.info(f"Documenti falliti: {overall_stats['failed']}")
+        logging.info(f"Esecuzione: #{run.id} ({run.status})")
+        logging.info(f"Totale documenti elaborati: {run.processed_count}")
+        logging.info(f"Documenti migrati con successo: {run.repaired_count} (già presenti: {run.ok_count})")
+        logging.info(f"Documenti falliti: {run.failed_count}")
+        logging.info(f"Throughput: {run.docs_per_second:.1f} documenti/s, {run.mb_per_second:.2f} MB/s")
         logging.info(f"Report salvato in: {report_file}")
         
-        if overall_stats['failed'] > 0:
+        if run.status != 'completed':
+            logging.warning("Migrazione non completata: rieseguire lo script per riprenderla.")
+        elif run.failed_count > 0:
             logging.warning("Alcuni documenti non sono stati migrati. Consulta il report per i dettagli.")
         else:
             logging.info("Migrazione completata con successo!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
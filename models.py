@@ -21,6 +21,18 @@ user_company = db.Table('user_company',
     db.Column('company_id', db.Integer, db.ForeignKey('company.id'))
 )
 
+# Caratteri del testo estratto conservati nel documento come estratto (liste, anteprime)
+CONTENT_PREVIEW_LENGTH = 500
+
+def make_content_preview(text):
+    """Estratto del testo: spazi compattati e troncato a CONTENT_PREVIEW_LENGTH caratteri"""
+    if text is None:
+        return None
+    preview = ' '.join(text.split())
+    if len(preview) > CONTENT_PREVIEW_LENGTH:
+        preview = preview[:CONTENT_PREVIEW_LENGTH - 1].rstrip() + '…'
+    return preview
+
 # Define access levels for permissions
 class AccessLevel:
     NONE = 0
@@ -169,7 +181,8 @@ class Document(db.Model):
     file_size = db.Column(db.Integer, nullable=False)  # Size in bytes
     title = db.Column(db.String(255))
     description = db.Column(db.Text)
-    content_text = db.Column(db.Text)  # Extracted text from OCR
+    content_preview = db.Column(db.String(CONTENT_PREVIEW_LENGTH))  # Estratto del testo (completo in DocumentContent)
+    content_hash = db.Column(db.String(64), index=True)  # SHA-256 del contenuto (vedi StorageBlob)
     classification = db.Column(db.String(100))  # AI-determined document type
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
@@ -193,6 +206,8 @@ class Document(db.Model):
     shared_with = relationship('User', secondary=document_user, back_populates='shared_documents')
     reminders = relationship('Reminder', back_populates='document', cascade='all, delete-orphan')
     activity_logs = relationship('ActivityLog', back_populates='document')
+    content = relationship('DocumentContent', back_populates='document', uselist=False,
+                           cascade='all, delete-orphan')
     
     # Allegati e documenti collegati
     attachments = relationship(
@@ -207,6 +222,21 @@ class Document(db.Model):
     expiry_date = db.Column(db.Date, nullable=True)  # For documents with expiration
     document_status = db.Column(db.String(50), default='active')  # active, expired, pending_review
     
+    @property
+    def content_text(self):
+        """Testo estratto completo, letto da document_content solo quando viene richiesto"""
+        return self.content.text if self.content is not None else None
+    
+    @content_text.setter
+    def content_text(self, value):
+        if value is None:
+            self.content = None
+        elif self.content is None:
+            self.content = DocumentContent(text=value)
+        else:
+            self.content.text = value
+        self.content_preview = make_content_preview(value)
+    
     @property
     def full_path(self):
         if self.folder:
@@ -268,12 +298,23 @@ class Document(db.Model):
     def __repr__(self):
         return f'<Document {self.title or self.original_filename}>'
 
+class DocumentContent(db.Model):
+    """Testo estratto di un documento, in una tabella separata così che le liste di documenti non lo carichino"""
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id', ondelete='CASCADE'), primary_key=True)
+    document = relationship('Document', back_populates='content')
+    text = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f'<DocumentContent {self.document_id} ({len(self.text or "")} caratteri)>'
+
 class DocumentVersion(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     document_id = db.Column(db.Integer, db.ForeignKey('document.id'))
     document = relationship('Document', back_populates='versions')
     filename = db.Column(db.String(255), nullable=False)
     file_path = db.Column(db.String(512), nullable=False)
+    content_hash = db.Column(db.String(64), index=True)  # SHA-256 del contenuto (vedi StorageBlob)
     version_number = db.Column(db.Integer, nullable=False)
     created_by_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     created_by = relationship('User')
@@ -283,6 +324,145 @@ class DocumentVersion(db.Model):
     def __repr__(self):
         return f'<DocumentVersion {self.document_id}-v{self.version_number}>'
 
+class StorageBlob(db.Model):
+    """Contenuto fisico deduplicato, indirizzato per SHA-256 e condiviso da documenti e versioni"""
+    content_hash = db.Column(db.String(64), primary_key=True)
+    file_path = db.Column(db.String(512), nullable=False)
+    file_size = db.Column(db.BigInteger, nullable=False)
+    mime_type = db.Column(db.String(128))  # Rilevato dai primi byte durante l'upload
+    ref_count = db.Column(db.Integer, default=0, nullable=False)  # Righe Document/DocumentVersion che lo referenziano
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    last_referenced_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    # Compressione dei blob poco usati (services/compression_tier.py)
+    compression = db.Column(db.String(16))  # zstd, gzip, none (valutato ma non conveniente) o NULL
+    stored_size = db.Column(db.BigInteger)  # Dimensione su disco dopo la compressione
+    compression_cpu_ms = db.Column(db.Float)  # Tempo CPU speso per comprimere
+    compressed_at = db.Column(db.DateTime)
+    # Versioni precedenti archiviate come delta (services/delta_store.py, compression = 'delta')
+    delta_base_hash = db.Column(db.String(64), index=True)  # Blob da cui il delta viene ricostruito
+    
+    def __repr__(self):
+        return f'<StorageBlob {self.content_hash[:12]} refs={self.ref_count}>'
+
+class MaintenanceRun(db.Model):
+    """Stato e checkpoint di un'operazione di manutenzione lunga (verifica storage, migrazioni)"""
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(50), nullable=False, index=True)  # storage_verify, migrate_central, migrate_permanent
+    status = db.Column(db.String(20), default='running', nullable=False)  # running, paused, completed, failed
+    cursor = db.Column(db.Integer, default=0, nullable=False)  # Ultimo ID elaborato (paginazione per chiave)
+    total_count = db.Column(db.Integer, default=0)
+    processed_count = db.Column(db.Integer, default=0)
+    ok_count = db.Column(db.Integer, default=0)
+    repaired_count = db.Column(db.Integer, default=0)
+    failed_count = db.Column(db.Integer, default=0)
+    bytes_processed = db.Column(db.BigInteger, default=0)
+    elapsed_seconds = db.Column(db.Float, default=0.0)  # Tempo di lavoro effettivo, escluse le pause
+    options = db.Column(db.Text)  # JSON con i parametri dell'esecuzione
+    errors = db.Column(db.Text)  # JSON con gli ultimi errori
+    started_by_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    started_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    @property
+    def docs_per_second(self):
+        return self.processed_count / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+    @property
+    def mb_per_second(self):
+        return (self.bytes_processed / (1024 * 1024)) / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'job_type': self.job_type,
+            'status': self.status,
+            'cursor': self.cursor,
+            'total_count': self.total_count,
+            'processed_count': self.processed_count,
+            'ok_count': self.ok_count,
+            'repaired_count': self.repaired_count,
+            'failed_count': self.failed_count,
+            'bytes_processed': self.bytes_processed,
+            'elapsed_seconds': round(self.elapsed_seconds or 0.0, 2),
+            'docs_per_second': round(self.docs_per_second, 1),
+            'mb_per_second': round(self.mb_per_second, 2),
+            'errors': json.loads(self.errors) if self.errors else [],
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+    def __repr__(self):
+        return f'<MaintenanceRun {self.job_type} #{self.id} {self.status}>'
+
+class StorageCounter(db.Model):
+    """Contatori dei documenti aggiornati in modo incrementale (services/storage_stats.py)"""
+    scope = db.Column(db.String(30), primary_key=True)  # total, company, file_type, area
+    key = db.Column(db.String(255), primary_key=True)
+    file_count = db.Column(db.BigInteger, default=0, nullable=False)
+    total_bytes = db.Column(db.BigInteger, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StorageCounter {self.scope}:{self.key} {self.file_count}>'
+
+class ReplicationTask(db.Model):
+    """Copia di replica di un file dello storage permanente e relativo stato (coda di replica)"""
+    id = db.Column(db.Integer, primary_key=True)
+    # Nessuna foreign key: la replica di un file sopravvive all'eliminazione del documento
+    document_id = db.Column(db.Integer, index=True)
+    storage_filename = db.Column(db.String(255), nullable=False, index=True)
+    source_path = db.Column(db.String(512), nullable=False)
+    target_path = db.Column(db.String(512), nullable=False)
+    status = db.Column(db.String(20), default='pending', nullable=False, index=True)  # pending, running, completed, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.Text)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    completed_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<ReplicationTask {self.storage_filename} -> {self.target_path} {self.status}>'
+
+class ProcessingJob(db.Model):
+    """Fase di elaborazione di un documento caricato (coda di elaborazione in background)"""
+    id = db.Column(db.Integer, primary_key=True)
+    # Nessuna foreign key: i job di un documento eliminato vengono annullati dal worker
+    document_id = db.Column(db.Integer, nullable=False, index=True)
+    job_type = db.Column(db.String(30), nullable=False)  # extract_text, metadata, thumbnail
+    priority = db.Column(db.Integer, default=5, nullable=False)  # 0 = massima priorità
+    status = db.Column(db.String(20), default='pending', nullable=False, index=True)  # pending, running, completed, failed, cancelled
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.Text)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # Utente che ha avviato l'elaborazione
+    worker = db.Column(db.String(100))  # host:pid del worker che ha eseguito l'ultimo tentativo
+    next_attempt_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    completed_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<ProcessingJob {self.job_type} doc={self.document_id} {self.status}>'
+
+class UploadSession(db.Model):
+    """Caricamento a blocchi riprendibile (services/chunked_upload.py)"""
+    id = db.Column(db.String(36), primary_key=True)  # UUID, usato anche nell'URL della sessione
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    upload_length = db.Column(db.BigInteger, nullable=False)  # Dimensione totale dichiarata
+    upload_offset = db.Column(db.BigInteger, default=0, nullable=False)  # Byte ricevuti e confermati
+    file_path = db.Column(db.String(512), nullable=False)  # File parziale in assemblaggio
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
+
+    @property
+    def is_complete(self):
+        return self.upload_offset == self.upload_length
+
+    def __repr__(self):
+        return f'<UploadSession {self.id} {self.upload_offset}/{self.upload_length}>'
+
 class DocumentMetadata(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     document_id = db.Column(db.Integer, db.ForeignKey('document.id'))
@@ -0,0 +1,106 @@
+"""
+Worker dell'elaborazione in background dei documenti, separati da gunicorn.
+
+Avvia un pool di processi che eseguono i job della coda di elaborazione
+(services/processing_queue.py) in ordine di priorità. Da usare con
+PROCESSING_QUEUE_MODE=external, così che il processo web si limiti ad accodare.
+SIGTERM o Ctrl+C arrestano i worker al termine del job in corso.
+
+Uso:
+    python process_documents.py [--workers N] [--max-jobs N] [--once] [--backfill] [--types T ...]
+"""
+
+import os
+import signal
+import argparse
+import logging
+import multiprocessing
+from app import app, db, scheduler
+from services.processing_queue import (
+    run_worker,
+    enqueue_unprocessed_documents,
+    PROCESSING_JOB_TYPES,
+    MAINTENANCE_JOB_TYPES,
+    PROCESSING_POLL_SECONDS
+)
+from services.ocr import enable_parallel_extraction
+
+# Configura il logging
+logging.basicConfig(level=logging.INFO,
+                   format='%(asctime)s - %(process)d - %(levelname)s - %(message)s')
+
+DEFAULT_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+def worker_main(stop_event, max_jobs, exit_when_idle, job_types):
+    """Processo worker: esegue i job finché non viene richiesto l'arresto."""
+    # Ctrl+C arriva a tutto il gruppo di processi: l'arresto è coordinato dal processo principale
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # Processo a thread singolo: l'estrazione dei PDF e l'OCR possono usare il pool di processi
+    enable_parallel_extraction()
+
+    with app.app_context():
+        # Le connessioni ereditate dal processo principale non vanno riutilizzate dopo il fork
+        db.engine.dispose(close=False)
+        run_worker(should_stop=stop_event.is_set, poll_seconds=PROCESSING_POLL_SECONDS,
+                   exit_when_idle=exit_when_idle, job_types=job_types, max_jobs=max_jobs)
+
+def main():
+    """Funzione principale per avviare i worker"""
+    parser = argparse.ArgumentParser(description='Esegue i job di elaborazione dei documenti')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Processi worker in parallelo')
+    parser.add_argument('--max-jobs', type=int, default=0,
+                        help='Job dopo i quali un worker viene sostituito (0 = nessun limite)')
+    parser.add_argument('--once', action='store_true',
+                        help='Termina quando la coda è vuota')
+    parser.add_argument('--backfill', action='store_true',
+                        help='Accoda (a bassa priorità) i documenti mai elaborati prima di avviare i worker')
+    parser.add_argument('--types', nargs='+', choices=PROCESSING_JOB_TYPES + MAINTENANCE_JOB_TYPES,
+                        help='Esegue solo le fasi indicate')
+    args = parser.parse_args()
+
+    # Lo scheduler resta nel processo web: i worker eseguono solo la coda
+    scheduler.shutdown(wait=False)
+
+    if args.backfill:
+        with app.app_context():
+            count = enqueue_unprocessed_documents()
+            logging.info(f"Documenti accodati per l'elaborazione: {count}")
+
+    context = multiprocessing.get_context('fork')
+    stop_event = context.Event()
+
+    def request_stop(signum, frame):
+        logging.info("Arresto richiesto: i worker terminano dopo il job in corso")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    def spawn():
+        process = context.Process(target=worker_main,
+                                  args=(stop_event, args.max_jobs, args.once, args.types))
+        process.start()
+        return process
+
+    workers = [spawn() for _ in range(max(1, args.workers))]
+    logging.info(f"Avviati {len(workers)} worker di elaborazione")
+
+    while workers:
+        for process in list(workers):
+            process.join(timeout=1)
+            if process.is_alive():
+                continue
+            workers.remove(process)
+            if process.exitcode != 0:
+                logging.error(f"Worker {process.pid} terminato con codice {process.exitcode}")
+            # Un worker che ha raggiunto --max-jobs (o è terminato in modo anomalo) viene sostituito
+            if not stop_event.is_set() and not args.once:
+                workers.append(spawn())
+
+    logging.info("Worker di elaborazione arrestati")
+
+if __name__ == "__main__":
+    main()
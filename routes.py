@@ -1,22 +1,29 @@
 import os
 import json
-import uuid
 import datetime
 from functools import wraps
-from flask import render_template, request, redirect, url_for, flash, jsonify, send_file, abort
+from flask import (render_template, request, redirect, url_for, flash, jsonify, send_file, abort,
+                   Response, stream_with_context)
 from flask_login import login_user, logout_user, login_required, current_user
+from markupsafe import escape
 from werkzeug.utils import secure_filename
 from app import app, db, EmptyForm, csrf
-from models import (User, Document, DocumentVersion, DocumentMetadata, Tag, 
+from models import (User, Document, DocumentVersion, Tag, 
                     Workflow, WorkflowTask, SearchHistory, Notification,
-                    Company, Folder, Permission, Reminder, ActivityLog, AccessLevel)
-from services.document_processor import (allowed_file, save_document, 
-                                        extract_document_metadata, get_document_preview)
+                    Company, Folder, Permission, Reminder, ActivityLog, AccessLevel,
+                    document_attachment)
+from services.document_processor import allowed_file, save_document, get_document_preview
 from services.ai_classifier import classify_document, extract_data_from_document
-from services.ocr import extract_text_from_document
+from services.extraction_cache import extract_document_content
 from services.search import search_documents
 from services.workflow import create_workflow, assign_workflow_task, complete_workflow_task
 from services.simple_document_storage import get_file_path, verify_document_file
+from services.blob_store import acquire_blob, release_blob
+from services.storage_layout import resolve_path, sharded_path
+from services.location_index import remove_location, find_paths_for_name
+from services.storage_backend import file_exists, delete_file, send_stored_file, is_range_continuation
+from services.thumbnails import get_thumbnail, can_thumbnail, THUMBNAIL_SIZES
+from services.processing_queue import enqueue_document_processing, get_processing_status, PRIORITY_HIGH, PRIORITY_LOW
 
 # Helper functions
 def admin_required(f):
@@ -205,6 +212,11 @@ def get_document_preview(document):
             </div>
         </div>
         
+        {f'''<div class="document-preview-excerpt mb-4">
+            <h5 class="mb-3">Estratto del contenuto</h5>
+            <div class="card card-body bg-light"><p class="mb-0 small">{escape(document.content_preview)}</p></div>
+        </div>''' if document.content_preview else ''}
+        
         <div class="document-preview-tags mb-4">
             <h5 class="mb-3">Tags</h5>
             <div>
@@ -301,24 +313,117 @@ def documents():
                           current_sort=sort_by,
                           current_order=sort_order)
 
+def _tus_response(body=None, status=204, upload=None):
+    """Risposta del protocollo di caricamento a blocchi, con le intestazioni tus"""
+    from services.chunked_upload import TUS_VERSION, UPLOAD_MAX_CHUNK_SIZE, expires_at
+    
+    response = jsonify(body) if body is not None else app.response_class(status=status)
+    response.status_code = status
+    response.headers['Tus-Resumable'] = TUS_VERSION
+    response.headers['Tus-Max-Chunk-Size'] = str(UPLOAD_MAX_CHUNK_SIZE)
+    response.headers['Cache-Control'] = 'no-store'
+    if upload is not None:
+        response.headers['Upload-Offset'] = str(upload.upload_offset)
+        response.headers['Upload-Length'] = str(upload.upload_length)
+        response.headers['Upload-Expires'] = expires_at(upload).strftime('%a, %d %b %Y %H:%M:%S GMT')
+    return response
+
+@app.route('/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    """Crea una sessione di caricamento a blocchi (Upload-Length, Upload-Metadata: filename <base64>)"""
+    from services.chunked_upload import create_upload_session, parse_metadata
+    
+    filename = parse_metadata(request.headers.get('Upload-Metadata')).get('filename', '')
+    try:
+        upload_length = int(request.headers.get('Upload-Length', ''))
+    except ValueError:
+        return _tus_response({'success': False, 'message': 'Upload-Length mancante o non valido'}, 400)
+    
+    if upload_length < 0 or not filename:
+        return _tus_response({'success': False, 'message': 'Dimensione o nome del file non validi'}, 400)
+    if not allowed_file(filename):
+        return _tus_response({'success': False, 'message': 'Tipo di file non consentito'}, 415)
+    
+    upload = create_upload_session(current_user.id, filename, upload_length)
+    response = _tus_response({'success': True, 'upload_id': upload.id}, 201, upload)
+    response.headers['Location'] = url_for('upload_session', upload_id=upload.id)
+    return response
+
+@app.route('/uploads/<upload_id>', methods=['HEAD', 'PATCH', 'DELETE'])
+@login_required
+def upload_session(upload_id):
+    """Stato (HEAD), invio di un blocco (PATCH) o annullamento (DELETE) di un caricamento a blocchi"""
+    from services.chunked_upload import get_upload_session, append_chunk, delete_upload_session
+    
+    upload = get_upload_session(upload_id, current_user.id)
+    if upload is None:
+        return _tus_response({'success': False, 'message': 'Sessione di caricamento non trovata o scaduta'}, 404)
+    
+    if request.method == 'HEAD':
+        return _tus_response(upload=upload, status=200)
+    
+    if request.method == 'DELETE':
+        delete_upload_session(upload)
+        return _tus_response()
+    
+    if request.mimetype != 'application/offset+octet-stream':
+        return _tus_response({'success': False, 'message': 'Content-Type non valido'}, 415, upload)
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return _tus_response({'success': False, 'message': 'Upload-Offset mancante o non valido'}, 400, upload)
+    
+    result = append_chunk(upload, offset, request.stream,
+                          content_length=request.content_length,
+                          checksum=request.headers.get('Upload-Checksum'))
+    if result['status'] == 'ok':
+        return _tus_response(upload=upload)
+    
+    status = {
+        'offset_mismatch': 409,
+        'locked': 423,
+        'too_large': 413,
+        'bad_checksum': 400,
+        'checksum_mismatch': 460,
+    }.get(result['status'], 500)
+    return _tus_response({'success': False, 'message': result['message']}, status, upload)
+
 @app.route('/documents/upload', methods=['GET', 'POST'])
 @login_required
 def upload_document():
     if request.method == 'POST':
-        # Check if the post request has the file part
-        if 'document' not in request.files:
-            flash('Nessun file incluso nella richiesta', 'danger')
-            return redirect(request.url)
-        
-        file = request.files['document']
-        if file.filename == '':
-            flash('Nessun file selezionato', 'danger')
-            return redirect(request.url)
-        
-        if file and allowed_file(file.filename):
-            # Utilizza il servizio semplificato di storage documenti
-            from services.simple_document_storage import save_document
-            document_data = save_document(file, current_user.id)
+        upload_id = request.form.get('upload_id')
+        if upload_id:
+            # File già trasferito a blocchi (caricamento riprendibile)
+            from services.chunked_upload import get_upload_session
+            upload = get_upload_session(upload_id, current_user.id)
+            if upload is None or not upload.is_complete:
+                flash('Caricamento non completato o scaduto. Riprova.', 'danger')
+                return redirect(request.url)
+            file = None
+            upload_filename = upload.filename
+        else:
+            # Check if the post request has the file part
+            if 'document' not in request.files:
+                flash('Nessun file incluso nella richiesta', 'danger')
+                return redirect(request.url)
+            
+            file = request.files['document']
+            if file.filename == '':
+                flash('Nessun file selezionato', 'danger')
+                return redirect(request.url)
+            upload_filename = file.filename
+        
+        if allowed_file(upload_filename):
+            if upload_id:
+                # Il file assemblato viene spostato nel blob store senza copie
+                from services.chunked_upload import finalize_upload_session
+                document_data = finalize_upload_session(upload, current_user.id)
+            else:
+                # Utilizza il servizio semplificato di storage documenti
+                from services.simple_document_storage import save_document
+                document_data = save_document(file, current_user.id)
             
             if not document_data:
                 flash('Errore durante il salvataggio del file. Riprova.', 'danger')
@@ -340,6 +445,7 @@ def upload_document():
                 file_path=file_path,
                 file_type=file_type,
                 file_size=file_size,
+                content_hash=document_data['content_hash'],
                 title=request.form.get('title', filename),
                 description=request.form.get('description', ''),
                 owner_id=current_user.id
@@ -426,30 +532,15 @@ def upload_document():
                     
                     flash('Documento caricato e promemoria creato con successo!', 'success')
             
-            # Process the document asynchronously (in a real app, this would be a background task)
+            # Estrazione del testo, metadati e miniatura vengono eseguiti in background
             try:
-                # Extract text with OCR if applicable
-                document.content_text = extract_text_from_document(file_path, file_type)
-                
-                # Imposta solo il tipo di file come classificazione
-                document.classification = f"File {file_type.upper()}"
-                
-                # Extract metadata from document
-                metadata_dict = extract_document_metadata(file_path, file_type)
-                for key, value in metadata_dict.items():
-                    metadata = DocumentMetadata(
-                        document_id=document.id,
-                        key=key,
-                        value=str(value)
-                    )
-                    db.session.add(metadata)
-                
-                db.session.commit()
+                enqueue_document_processing(document, user_id=current_user.id, priority=PRIORITY_HIGH)
                 if 'create_reminder' not in request.form:
-                    flash('Documento caricato ed elaborato con successo!', 'success')
+                    flash('Documento caricato con successo! L\'elaborazione del contenuto è in corso.', 'success')
             except Exception as e:
-                app.logger.error(f"Error processing document: {str(e)}")
-                flash(f'Document uploaded but processing failed: {str(e)}', 'warning')
+                db.session.rollback()
+                app.logger.error(f"Errore durante l'accodamento dell'elaborazione del documento {document.id}: {str(e)}")
+                flash('Documento caricato, ma non è stato possibile avviarne l\'elaborazione.', 'warning')
             
             return redirect(url_for('view_document', document_id=document.id))
         else:
@@ -565,6 +656,7 @@ def view_document(document_id):
     
     return render_template('view_document.html', 
                           document=document,
+                          processing_status=get_processing_status(document.id)['status'],
                           preview_html=preview_html,
                           versions=versions,
                           workflow_tasks=workflow_tasks,
@@ -595,11 +687,11 @@ def download_document(document_id):
             flash('Non hai i permessi per scaricare questo documento.', 'danger')
             return redirect(url_for('documents'))
     
-    # Verifica che il file esista
-    if not os.path.exists(document.file_path):
+    # Verifica che il file esista (su disco locale o nello storage a oggetti)
+    if not file_exists(document.file_path):
         # Tentativo semplice di recupero in base al filename
-        uploads_path = os.path.join(os.path.abspath('uploads'), document.filename)
-        if os.path.exists(uploads_path):
+        uploads_path = resolve_path(app.config['UPLOAD_FOLDER'], document.filename)
+        if uploads_path:
             # Aggiorna il percorso nel database
             document.file_path = uploads_path
             db.session.commit()
@@ -617,18 +709,79 @@ def download_document(document_id):
             )
             return redirect(url_for('view_document', document_id=document.id))
     
-    # Log del download per audit trail
-    log_activity(
-        user_id=current_user.id,
-        document_id=document_id,
-        action="download",
-        details="Download documento"
-    )
+    # Log del download per audit trail (una sola volta per download, non per ogni parte ripresa)
+    if not is_range_continuation():
+        log_activity(
+            user_id=current_user.id,
+            document_id=document_id,
+            action="download",
+            details="Download documento"
+        )
     
     # Se siamo qui, il file esiste e può essere scaricato
-    return send_file(document.file_path, 
-                    download_name=document.original_filename,
-                    as_attachment=True)
+    return send_stored_file(document.file_path,
+                            download_name=document.original_filename,
+                            as_attachment=True,
+                            etag=document.content_hash,
+                            last_modified=document.updated_at)
+
+@app.route('/documents/<int:document_id>/versions/<int:version_number>/download')
+@login_required
+def download_document_version(document_id, version_number):
+    """
+    Download di una versione precedente (ricostruita al volo se archiviata come delta)
+    """
+    document = Document.query.get_or_404(document_id)
+    version = DocumentVersion.query.filter_by(document_id=document.id, version_number=version_number).first_or_404()
+    
+    # Stessi permessi del download del documento
+    if document.owner_id != current_user.id and not current_user.is_admin() \
+            and current_user not in document.shared_with:
+        flash('Non hai i permessi per scaricare questo documento.', 'danger')
+        return redirect(url_for('documents'))
+    
+    if not file_exists(version.file_path):
+        flash('Il file di questa versione non è disponibile. Contatta l\'amministratore.', 'danger')
+        app.logger.error(f"File non trovato per la versione {version_number} del documento ID: {document_id}")
+        return redirect(url_for('view_document', document_id=document.id))
+    
+    if not is_range_continuation():
+        log_activity(
+            user_id=current_user.id,
+            document_id=document_id,
+            action="download_version",
+            details=f"Download versione {version_number}"
+        )
+    
+    name, ext = os.path.splitext(document.original_filename)
+    return send_stored_file(version.file_path,
+                            download_name=f"{name}_v{version_number}{ext}",
+                            as_attachment=True,
+                            etag=version.content_hash,
+                            last_modified=version.created_at)
+
+@app.route('/documents/<int:document_id>/thumbnail')
+@login_required
+def document_thumbnail(document_id):
+    """
+    Miniatura JPEG di un documento immagine (generata una sola volta e servita dalla cache degli artefatti)
+    """
+    document = Document.query.get_or_404(document_id)
+    
+    # Come per la visualizzazione del contenuto, tutti gli utenti possono vedere la miniatura
+    size = request.args.get('size', 'small')
+    if size not in THUMBNAIL_SIZES or not can_thumbnail(document):
+        abort(404)
+    
+    thumbnail = get_thumbnail(document, size)
+    if thumbnail is None:
+        abort(404)
+    
+    response = Response(thumbnail, mimetype='image/jpeg')
+    response.headers['Cache-Control'] = 'private, no-cache'
+    if document.content_hash:
+        response.set_etag(f"{document.content_hash}-{size}")
+    return response.make_conditional(request)
 
 @app.route('/documents/<int:document_id>/update', methods=['GET', 'POST'])
 @login_required
@@ -669,33 +822,54 @@ def update_document(document_id):
             document.expiry_date = None
         
         # Handle new version upload if file is provided
+        previous_content_hash = None
+        new_version_uploaded = False
         if 'document' in request.files and request.files['document'].filename:
             file = request.files['document']
             if allowed_file(file.filename):
-                # Save the new version
-                filename = secure_filename(file.filename)
-                unique_filename = f"{str(uuid.uuid4())}_{filename}"
-                # Usa percorso assoluto per garantire che il file sia persistente
-                file_path = os.path.abspath(os.path.join(app.config['UPLOAD_FOLDER'], unique_filename))
-                
-                # Assicurati che la directory upload esista
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                # Save the new version nel blob store (il riferimento acquisito è del documento)
+                document_data = save_document(file, current_user.id)
+                if not document_data:
+                    flash('Errore durante il salvataggio della nuova versione. Riprova.', 'danger')
+                    return redirect(request.url)
                 
-                # Salva il file
-                file.save(file_path)
+                unique_filename = document_data['filename']
+                file_path = document_data['file_path']
                 
                 # Log del percorso per debug
                 app.logger.info(f"Nuova versione del file salvata in: {file_path}")
                 
                 # Get latest version number
                 latest_version = DocumentVersion.query.filter_by(document_id=document.id).order_by(DocumentVersion.version_number.desc()).first()
-                version_number = 1 if not latest_version else latest_version.version_number + 1
                 
-                # Create new version record
+                if latest_version:
+                    # Il contenuto corrente è già conservato dall'ultima versione:
+                    # il documento rilascia il proprio riferimento
+                    release_blob(document.content_hash)
+                    version_number = latest_version.version_number + 1
+                else:
+                    # Prima modifica: il contenuto originale diventa la versione 1,
+                    # che eredita il riferimento al blob posseduto dal documento
+                    original_version = DocumentVersion(
+                        document_id=document.id,
+                        filename=document.filename,
+                        file_path=document.file_path,
+                        content_hash=document.content_hash,
+                        version_number=1,
+                        created_by_id=document.owner_id,
+                        created_at=document.created_at,
+                        change_summary='Versione originale'
+                    )
+                    db.session.add(original_version)
+                    version_number = 2
+                
+                # Create new version record (con un proprio riferimento al blob)
+                acquire_blob(document_data['content_hash'])
                 version = DocumentVersion(
                     document_id=document.id,
                     filename=unique_filename,
                     file_path=file_path,
+                    content_hash=document_data['content_hash'],
                     version_number=version_number,
                     created_by_id=current_user.id,
                     change_summary=request.form.get('change_summary', '')
@@ -703,39 +877,34 @@ def update_document(document_id):
                 db.session.add(version)
                 
                 # Update the main document record
+                previous_content_hash = document.content_hash
                 document.filename = unique_filename
                 document.file_path = file_path
-                document.file_type = filename.rsplit('.', 1)[1].lower()
-                document.file_size = os.path.getsize(file_path)
-                
-                # Process the new version (in a real app, this would be a background task)
-                try:
-                    # Extract text with OCR if applicable
-                    document.content_text = extract_text_from_document(file_path, document.file_type)
-                    
-                    # Imposta solo il tipo di file come classificazione
-                    document.classification = f"File {document.file_type.upper()}"
-                    
-                    # Extract and update metadata
-                    metadata_dict = extract_document_metadata(file_path, document.file_type)
-                    
-                    # First, remove existing metadata
-                    DocumentMetadata.query.filter_by(document_id=document.id).delete()
-                    
-                    # Add new metadata
-                    for key, value in metadata_dict.items():
-                        metadata = DocumentMetadata(
-                            document_id=document.id,
-                            key=key,
-                            value=str(value)
-                        )
-                        db.session.add(metadata)
-                except Exception as e:
-                    app.logger.error(f"Error processing document update: {str(e)}")
-                    flash(f'Document updated but processing failed: {str(e)}', 'warning')
+                document.content_hash = document_data['content_hash']
+                document.file_type = document_data['file_type']
+                document.file_size = document_data['file_size']
+                new_version_uploaded = True
         
         document.updated_at = datetime.datetime.utcnow()
         db.session.commit()
+        
+        # La nuova versione viene elaborata in background (testo, metadati, miniatura)
+        if new_version_uploaded:
+            try:
+                enqueue_document_processing(document, user_id=current_user.id, priority=PRIORITY_HIGH)
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Errore durante l'accodamento dell'elaborazione del documento {document.id}: {str(e)}")
+        
+        # La versione precedente viene archiviata come delta rispetto alla nuova, in background
+        if previous_content_hash:
+            try:
+                enqueue_document_processing(document, user_id=current_user.id, priority=PRIORITY_LOW,
+                                            job_types=('delta_versions',))
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Errore durante l'accodamento della codifica delta del documento {document.id}: {str(e)}")
+        
         flash('Document updated successfully!', 'success')
         return redirect(url_for('view_document', document_id=document.id))
     
@@ -822,38 +991,50 @@ def delete_document_file(document, log_prefix=""):
     """Funzione helper per eliminare i file fisici di un documento"""
     # Remove the file from disk
     file_path = document.file_path
+    # Documenti nel blob store: rilascia solo il riferimento, il contenuto
+    # condiviso con altri documenti resta su disco
+    if document.content_hash:
+        release_blob(document.content_hash)
+        app.logger.info(f"{log_prefix}Riferimento al blob rilasciato: {document.content_hash}")
     # Verifica percorso principale
-    if os.path.exists(file_path):
+    elif file_exists(file_path):
         try:
-            os.remove(file_path)
+            delete_file(file_path)
+            remove_location(file_path)
             app.logger.info(f"{log_prefix}File eliminato: {file_path}")
         except Exception as e:
             app.logger.error(f"{log_prefix}Errore durante l'eliminazione del file {file_path}: {str(e)}")
     else:
         # Prova un percorso alternativo
-        alternative_path = os.path.join(app.config['UPLOAD_FOLDER'], document.filename)
-        if os.path.exists(alternative_path):
+        alternative_path = resolve_path(app.config['UPLOAD_FOLDER'], document.filename)
+        if alternative_path:
             try:
                 os.remove(alternative_path)
+                remove_location(alternative_path)
                 app.logger.info(f"{log_prefix}File eliminato (percorso alternativo): {alternative_path}")
             except Exception as e:
                 app.logger.error(f"{log_prefix}Errore durante l'eliminazione del file (percorso alternativo) {alternative_path}: {str(e)}")
     
     # Remove document versions
     for version in document.versions:
+        # Versioni nel blob store
+        if version.content_hash:
+            release_blob(version.content_hash)
         # Verifica percorso principale della versione
-        if hasattr(version, 'file_path') and version.file_path and os.path.exists(version.file_path):
+        elif hasattr(version, 'file_path') and version.file_path and file_exists(version.file_path):
             try:
-                os.remove(version.file_path)
+                delete_file(version.file_path)
+                remove_location(version.file_path)
                 app.logger.info(f"{log_prefix}File versione eliminato: {version.file_path}")
             except Exception as e:
                 app.logger.error(f"{log_prefix}Errore durante l'eliminazione della versione {version.file_path}: {str(e)}")
         else:
             # Prova percorso alternativo
-            version_path = os.path.join(app.config['UPLOAD_FOLDER'], version.filename)
-            if os.path.exists(version_path):
+            version_path = resolve_path(app.config['UPLOAD_FOLDER'], version.filename)
+            if version_path:
                 try:
                     os.remove(version_path)
+                    remove_location(version_path)
                     app.logger.info(f"{log_prefix}File versione eliminato (percorso alternativo): {version_path}")
                 except Exception as e:
                     app.logger.error(f"{log_prefix}Errore durante l'eliminazione della versione (percorso alternativo) {version_path}: {str(e)}")
@@ -916,6 +1097,41 @@ def delete_document_permanently(document_id):
         return redirect(url_for('archived_documents'))
     return redirect(url_for('documents'))
 
+@app.route('/documents/download-zip', methods=['POST'])
+@login_required
+def download_documents_zip():
+    """Scarica i documenti selezionati come archivio ZIP (generato in streaming)"""
+    from services.zip_export import downloadable_documents, stream_zip
+
+    document_ids = [int(doc_id) for doc_id in request.form.getlist('document_ids') if doc_id.isdigit()]
+    if not document_ids:
+        flash('Nessun documento selezionato per il download.', 'warning')
+        return redirect(url_for('documents'))
+
+    # Solo i documenti che l'utente può scaricare, nell'ordine della selezione
+    allowed = {row.id for row in downloadable_documents(current_user).with_entities(Document.id).filter(
+        Document.id.in_(document_ids))}
+    documents = [(doc_id, '') for doc_id in dict.fromkeys(document_ids) if doc_id in allowed]
+    if not documents:
+        flash('Non hai i permessi per scaricare i documenti selezionati.', 'danger')
+        return redirect(url_for('documents'))
+
+    # Un'unica voce di audit per l'intera esportazione
+    log_activity(
+        user_id=current_user.id,
+        action="download_zip",
+        details=json.dumps({
+            "document_count": len(documents),
+            "document_ids": [doc_id for doc_id, _ in documents]
+        })
+    )
+
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    response = Response(stream_with_context(stream_zip(documents)), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=f"documenti_{timestamp}.zip")
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 # Multiple document deletion route
 @app.route('/documents/delete_multiple', methods=['POST'])
 @login_required
@@ -1511,6 +1727,18 @@ def api_document_preview(document_id):
     preview_html = get_document_preview(document)
     return jsonify({'preview_html': preview_html})
 
+@app.route('/api/documents/<int:document_id>/processing-status')
+@login_required
+def api_document_processing_status(document_id):
+    """Stato dell'elaborazione in background di un documento (interrogato periodicamente dalla pagina del documento)"""
+    document = Document.query.get_or_404(document_id)
+
+    # Stessi permessi della visualizzazione del documento
+    if document.owner_id != current_user.id and current_user not in document.shared_with and not current_user.is_admin():
+        return jsonify({'error': 'Permission denied'}), 403
+
+    return jsonify(get_processing_status(document.id))
+
 @app.route('/api/documents/extract-text', methods=['POST'])
 @login_required
 def api_extract_text():
@@ -1530,7 +1758,7 @@ def api_extract_text():
         try:
             # Extract text
             file_type = filename.rsplit('.', 1)[1].lower()
-            text = extract_text_from_document(temp_path, file_type)
+            text = extract_document_content(temp_path, file_type)['text']
             
             # Clean up temp file
             if os.path.exists(temp_path):
@@ -1829,7 +2057,7 @@ def validate_user_document(document_id):
         return redirect(url_for('documents'))
     
     # Verifica se il file esiste già
-    if os.path.exists(document.file_path):
+    if file_exists(document.file_path):
         flash('Il file è già disponibile, non è necessario il recupero.', 'info')
         return redirect(url_for('view_document', document_id=document.id))
     
@@ -1894,9 +2122,10 @@ def view_document_content(document_id):
     # Mantenere solo controlli per operazioni specifiche
     
     # Controlla che il file esista e cerca percorsi alternativi
-    if not os.path.exists(document.file_path):
+    if not file_exists(document.file_path):
         # Prova a ricostruire il percorso file in diversi modi
         alternatives = [
+            sharded_path(app.config['UPLOAD_FOLDER'], document.filename),
             os.path.join(app.config['UPLOAD_FOLDER'], document.filename),
             os.path.join('uploads', document.filename),
             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads', document.filename),
@@ -1915,18 +2144,14 @@ def view_document_content(document_id):
         ]
         alternatives.extend(attached_alternatives)
         
-        # Cerca in tutta la directory .
-        workspace_path = '.'
-        find_command = f"find {workspace_path} -name '{document.original_filename}' -o -name '{document.filename}' 2>/dev/null"
-        try:
-            import subprocess
-            result = subprocess.run(find_command, shell=True, capture_output=True, text=True)
-            if result.stdout.strip():
-                for found_path in result.stdout.strip().split('\n'):
-                    if found_path and found_path not in alternatives:
-                        alternatives.append(found_path)
-        except Exception as e:
-            app.logger.error(f"Errore durante la ricerca dei file: {str(e)}")
+        # Se nessun percorso noto esiste, interroga l'indice delle posizioni
+        # (nome su disco, UUID, nome originale o hash del contenuto)
+        if not any(os.path.exists(path) for path in alternatives):
+            for found_path in find_paths_for_name(document.filename,
+                                                  original_filename=document.original_filename,
+                                                  content_hash=document.content_hash):
+                if found_path not in alternatives:
+                    alternatives.append(found_path)
         
         file_found = False
         for alternative_path in alternatives:
@@ -1962,21 +2187,24 @@ def view_document_content(document_id):
     
     # Per immagini, PDF e altri tipi supportati dal browser, visualizzali direttamente
     if document.file_type in ['pdf', 'jpg', 'jpeg', 'png', 'gif', 'svg']:
-        # Log activity
-        from services.audit_service import AuditTrailService
-        AuditTrailService.log_activity(
-            user_id=current_user.id,
-            action="view_content",
-            document_id=document_id,
-            result="success",
-            details=json.dumps({"file_type": document.file_type})
-        )
+        # Log activity (i visualizzatori PDF caricano le pagine successive con richieste Range)
+        if not is_range_continuation():
+            from services.audit_service import AuditTrailService
+            AuditTrailService.log_activity(
+                user_id=current_user.id,
+                action="view_content",
+                document_id=document_id,
+                result="success",
+                details=json.dumps({"file_type": document.file_type})
+            )
         
         # Invia il file al browser (ma non come download)
-        return send_file(document.file_path,
-                         mimetype=f'application/{document.file_type}' if document.file_type == 'pdf' else f'image/{document.file_type}',
-                         as_attachment=False,
-                         download_name=document.original_filename)
+        return send_stored_file(document.file_path,
+                                mimetype=f'application/{document.file_type}' if document.file_type == 'pdf' else f'image/{document.file_type}',
+                                as_attachment=False,
+                                download_name=document.original_filename,
+                                etag=document.content_hash,
+                                last_modified=document.updated_at)
     
     # Per altri tipi, reindirizza al download
     flash(f'Visualizzazione diretta non supportata per i file {document.file_type.upper()}. Il file verrà scaricato.', 'info')
@@ -2146,28 +2374,26 @@ def upload_attachment(document_id):
     attachment_note = request.form.get('attachment_note', '')
     
     try:
-        # Salva il file
-        filename = secure_filename(file.filename)
-        timestamp = int(time.time())
-        unique_filename = f"{timestamp}_{filename}"
-        
-        # Crea directory se non esiste
-        upload_dir = os.path.join(app.root_path, 'uploads')
-        if not os.path.exists(upload_dir):
-            os.makedirs(upload_dir)
+        # Salva il file nel blob store: un allegato già presente nel sistema
+        # non occupa ulteriore spazio su disco
+        document_data = save_document(file, current_user.id)
+        if not document_data:
+            flash('Errore durante il salvataggio del file. Riprova.', 'danger')
+            return redirect(url_for('document_attachments', document_id=document_id))
         
-        file_path = os.path.join(upload_dir, unique_filename)
-        file.save(file_path)
+        filename = document_data['original_filename']
+        unique_filename = document_data['filename']
+        file_path = document_data['file_path']
+        file_size = document_data['file_size']
         
         # Crea nuovo documento
-        file_size = os.path.getsize(file_path)
-        
         new_attachment = Document(
             filename=unique_filename,
             original_filename=filename,
             file_path=file_path,
             file_type=file_ext,
             file_size=file_size,
+            content_hash=document_data['content_hash'],
             title=title if title else f"Allegato a {document.original_filename}",
             description=description,
             owner_id=current_user.id,
@@ -2207,29 +2433,14 @@ def upload_attachment(document_id):
                          "filename": new_attachment.original_filename
                      }))
         
-        flash(f'Documento allegato con successo.', 'success')
-        
-        # Elabora il documento in background
+        # Estrazione del testo, metadati e miniatura vengono eseguiti in background
         try:
-            # Estrai testo con OCR se applicabile
-            new_attachment.content_text = extract_text_from_document(file_path, file_ext)
-            
-            # Classifica il documento
-            new_attachment.classification = classify_document(new_attachment.content_text or '', file_ext)
-            
-            # Estrai metadati
-            metadata_dict = extract_document_metadata(file_path, file_ext)
-            for key, value in metadata_dict.items():
-                metadata = DocumentMetadata(
-                    document_id=new_attachment.id,
-                    key=key,
-                    value=str(value)
-                )
-                db.session.add(metadata)
-            
-            db.session.commit()
+            enqueue_document_processing(new_attachment, user_id=current_user.id, priority=PRIORITY_HIGH)
+            flash('Documento allegato con successo! L\'elaborazione del contenuto è in corso.', 'success')
         except Exception as e:
-            app.logger.error(f"Errore durante l'elaborazione dell'allegato: {str(e)}")
+            db.session.rollback()
+            app.logger.error(f"Errore durante l'accodamento dell'elaborazione dell'allegato {new_attachment.id}: {str(e)}")
+            flash('Documento allegato, ma non è stato possibile avviarne l\'elaborazione.', 'warning')
         
         return redirect(url_for('view_document', document_id=document_id))
     
@@ -8,7 +8,6 @@ from flask import (
 )
 from flask_login import login_required, current_user
 from sqlalchemy import func, desc
-import os
 import logging
 import datetime
 import json
@@ -19,12 +18,19 @@ from services.central_storage import (
     ensure_storage_directories, 
     get_storage_stats, 
     migrate_files_to_central_storage,
-    verify_and_repair_storage,
     validate_document_storage,
     cleanup_orphaned_files,
     get_file_from_storage,
     migrate_document_to_central_storage
 )
+from services.storage_verifier import (
+    start_background_verification,
+    stop_background_verification,
+    get_latest_run as get_latest_verification_run
+)
+from services.audit_service import log_activity
+from services.storage_backend import file_exists
+from services.compression_tier import get_compression_report
 from services.file_recovery import recover_missing_file
 from services.persistent_storage import (
     ensure_storage_structure as ensure_permanent_storage_structure,
@@ -65,9 +71,9 @@ def index():
     problem_documents = []
     
     try:
-        # La funzione file_exists potrebbe non esistere, utilizziamo un metodo manuale
+        # Verifica il file in tutti i backend di storage (locale e remoto)
         for doc in Document.query.all():
-            if doc.file_path and not os.path.exists(doc.file_path):
+            if doc.file_path and not file_exists(doc.file_path):
                 missing_files_count += 1
                 if len(problem_documents) < 10:
                     problem_documents.append(doc)
@@ -101,9 +107,9 @@ def central_storage():
     problem_docs = []
     
     try:
-        # La funzione file_exists potrebbe non esistere, utilizziamo un metodo manuale
+        # Verifica il file in tutti i backend di storage (locale e remoto)
         for doc in Document.query.all():
-            if doc.file_path and not os.path.exists(doc.file_path):
+            if doc.file_path and not file_exists(doc.file_path):
                 problem_docs.append(doc)
                 if len(problem_docs) >= 50:
                     break
@@ -113,11 +119,15 @@ def central_storage():
     # Query per documenti recenti
     recent_docs = Document.query.order_by(desc(Document.created_at)).limit(10).all()
     
+    # Ultima verifica dello storage (stato e throughput)
+    verification_run = get_latest_verification_run()
+
     return render_template(
         'admin/maintenance/central_storage.html',
         storage_stats=storage_stats,
         problem_docs=problem_docs,
-        recent_docs=recent_docs
+        recent_docs=recent_docs,
+        verification_run=verification_run
     )
 
 @maintenance_bp.route('/avvia-migrazione', methods=['POST'])
@@ -168,46 +178,59 @@ def start_migration():
 @login_required
 @admin_required
 def verify_repair_storage():
-    """Verifica e ripara eventuali problemi nello storage"""
+    """Avvia (o riprende) in background la verifica e riparazione dello storage"""
     try:
-        # Esegui la verifica e riparazione
-        repair_report = verify_and_repair_storage()
-        
-        flash(f"Verifica e riparazione completata! {repair_report['verified_ok']} documenti OK, "
-              f"{repair_report['files_restored']} file ripristinati.", 'success')
-        
-        # Registra l'attività
-        log_entry = ActivityLog(
-            user_id=current_user.id,
-            action_type="repair",
-            target_type="storage",
-            target_id=0,
-            details=f"Verifica e riparazione storage: {repair_report['verified_ok']} OK, "
-                   f"{repair_report['files_restored']} ripristinati",
-            result="success"
+        restart = request.form.get('restart') == 'true'
+        verify_checksums = request.form.get('checksums') == 'true'
+
+        started = start_background_verification(
+            current_app._get_current_object(),
+            restart=restart,
+            verify_checksums=verify_checksums,
+            user_id=current_user.id
         )
-        db.session.add(log_entry)
-        db.session.commit()
-        
+
+        if started:
+            flash("Verifica e riparazione dello storage avviata in background. "
+                  "Un'esecuzione interrotta riprende dall'ultimo checkpoint.", 'success')
+            log_activity(current_user.id, 'repair_storage', action_category='SYSTEM',
+                         details=f"Verifica e riparazione storage avviata (riavvio: {restart}, checksum: {verify_checksums})")
+        else:
+            flash("Una verifica dello storage è già in corso.", 'warning')
+
         return redirect(url_for('maintenance.central_storage'))
     except Exception as e:
-        flash(f"Errore durante la verifica e riparazione: {str(e)}", 'danger')
-        logging.error(f"Errore durante la verifica e riparazione: {str(e)}")
-        
-        # Registra l'errore
-        log_entry = ActivityLog(
-            user_id=current_user.id,
-            action_type="repair",
-            target_type="storage",
-            target_id=0,
-            details=f"Errore durante la verifica e riparazione: {str(e)}",
-            result="failure"
-        )
-        db.session.add(log_entry)
-        db.session.commit()
-        
+        flash(f"Errore durante l'avvio della verifica e riparazione: {str(e)}", 'danger')
+        logging.error(f"Errore durante l'avvio della verifica e riparazione: {str(e)}")
+        log_activity(current_user.id, 'repair_storage', action_category='SYSTEM',
+                     details=f"Errore durante la verifica e riparazione: {str(e)}", result="failure")
+
         return redirect(url_for('maintenance.central_storage'))
 
+@maintenance_bp.route('/verifica-ripara-storage/stato')
+@login_required
+@admin_required
+def verify_repair_storage_status():
+    """Stato e throughput dell'ultima verifica dello storage (JSON)"""
+    run = get_latest_verification_run()
+    return jsonify({'run': run.to_dict() if run else None})
+
+@maintenance_bp.route('/verifica-ripara-storage/interrompi', methods=['POST'])
+@login_required
+@admin_required
+def stop_verify_repair_storage():
+    """Mette in pausa la verifica in corso dopo il blocco corrente"""
+    stop_background_verification()
+    flash("La verifica verrà messa in pausa al termine del blocco corrente.", 'info')
+    return redirect(url_for('maintenance.central_storage'))
+
+@maintenance_bp.route('/compressione-storage/report')
+@login_required
+@admin_required
+def compression_report():
+    """Rapporto di compressione e costo CPU dello storage freddo per tipo di file (JSON)"""
+    return jsonify({'report': get_compression_report()})
+
 @maintenance_bp.route('/valida-documento/<int:doc_id>', methods=['GET', 'POST'])
 @login_required
 @admin_required
@@ -313,9 +336,9 @@ def permanent_storage():
     problem_docs = []
     
     try:
-        # Usa il metodo manuale per trovare documenti con problemi
+        # Verifica il file in tutti i backend di storage (locale e remoto)
         for doc in Document.query.all():
-            if doc.file_path and not os.path.exists(doc.file_path):
+            if doc.file_path and not file_exists(doc.file_path):
                 problem_docs.append(doc)
                 if len(problem_docs) >= 50:
                     break
@@ -0,0 +1,452 @@
+"""
+Cache degli artefatti derivati dai documenti (testo estratto, miniature,
+anteprime, conversioni in PDF) nella directory document_cache/artifacts.
+
+Ogni artefatto è identificato dallo SHA-256 del contenuto di origine, dal tipo
+di artefatto e da una variante opzionale (es. la dimensione di una miniatura):
+lo stesso contenuto, anche se caricato più volte o condiviso tra documenti,
+viene elaborato una sola volta. I file vengono scritti su un file temporaneo e
+pubblicati con una rename atomica; un lock tra processi (fcntl) per chiave
+evita che più worker gunicorn calcolino contemporaneamente lo stesso artefatto.
+
+L'indice (tabella artifacts nello stesso database SQLite di
+services/storage_index.py) registra dimensione, numero di accessi e ultimo
+accesso di ogni voce. Quando la cache supera ARTIFACT_CACHE_MAX_BYTES vengono
+eliminate le voci usate meno di recente (LRU) o meno usate in assoluto (LFU),
+fino a scendere sotto ARTIFACT_CACHE_LOW_WATERMARK. I contatori di hit, miss
+ed evizioni sono condivisi tra i processi (get_cache_stats).
+"""
+
+import os
+import re
+import time
+import uuid
+import fcntl
+import hashlib
+import logging
+import datetime
+from services.storage_index import get_connection, write_transaction
+from services.storage_layout import shard_subdir, iter_storage_files
+
+# Configurazione dei percorsi assoluti
+BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+ARTIFACT_CACHE_DIR = os.path.join(BASE_DIR, 'document_cache', 'artifacts')
+ARTIFACT_TMP_DIR = os.path.join(ARTIFACT_CACHE_DIR, 'tmp')
+ARTIFACT_LOCK_DIR = os.path.join(ARTIFACT_CACHE_DIR, 'locks')
+
+# Spazio massimo occupato dagli artefatti (in MB nella variabile d'ambiente)
+ARTIFACT_CACHE_MAX_BYTES = int(os.environ.get('ARTIFACT_CACHE_MAX_MB', '1024')) * 1024 * 1024
+
+# Dopo un'evizione la cache scende a questa frazione del limite, così che i
+# nuovi inserimenti non debbano eliminare voci ogni volta
+ARTIFACT_CACHE_LOW_WATERMARK = 0.9
+
+# Politica di evizione: 'lru' (ultimo accesso) o 'lfu' (numero di accessi, poi ultimo accesso)
+ARTIFACT_CACHE_POLICY = os.environ.get('ARTIFACT_CACHE_POLICY', 'lru').strip().lower()
+
+# Intervallo del riallineamento periodico tra indice e file su disco
+ARTIFACT_CACHE_RECONCILE_INTERVAL_HOURS = 6
+
+# Età minima dei file temporanei o non indicizzati rimossi dal riallineamento
+ARTIFACT_ORPHAN_GRACE_SECONDS = 3600
+
+# Numero di file di lock condivisi tra le chiavi (non crescono con la cache)
+ARTIFACT_LOCK_STRIPES = 256
+
+_HEX_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+_TYPE_RE = re.compile(r'^[a-z0-9_-]{1,32}$')
+_VARIANT_RE = re.compile(r'^[A-Za-z0-9_.-]{0,64}$')
+
+def artifact_path(content_hash, artifact_type, variant=''):
+    """
+    Calcola il percorso su disco di un artefatto. Gli artefatti dello stesso
+    contenuto condividono lo shard derivato dall'hash (artifacts/ab/cd/...).
+
+    Args:
+        content_hash: SHA-256 esadecimale del contenuto di origine
+        artifact_type: Tipo di artefatto (es. 'text', 'thumbnail', 'pdf')
+        variant: Variante opzionale (es. dimensione o versione dell'estrattore)
+
+    Returns:
+        str: Percorso completo del file dell'artefatto
+    """
+    if not content_hash or not _HEX_DIGEST_RE.match(content_hash):
+        raise ValueError(f"Hash del contenuto non valido: {content_hash}")
+    if not _TYPE_RE.match(artifact_type or ''):
+        raise ValueError(f"Tipo di artefatto non valido: {artifact_type}")
+    if not _VARIANT_RE.match(variant or ''):
+        raise ValueError(f"Variante dell'artefatto non valida: {variant}")
+
+    name = f"{content_hash}.{artifact_type}" + (f"~{variant}" if variant else '')
+    return os.path.join(ARTIFACT_CACHE_DIR, shard_subdir(content_hash), name)
+
+class _key_lock:
+    """Lock esclusivo tra processi (fcntl.flock) sulla chiave di un artefatto."""
+
+    def __init__(self, content_hash, artifact_type, variant):
+        digest = hashlib.md5(f"{content_hash}/{artifact_type}/{variant}".encode('utf-8')).hexdigest()
+        stripe = int(digest, 16) % ARTIFACT_LOCK_STRIPES
+        self.path = os.path.join(ARTIFACT_LOCK_DIR, f"{stripe:03d}.lock")
+
+    def __enter__(self):
+        os.makedirs(ARTIFACT_LOCK_DIR, exist_ok=True)
+        self.file = open(self.path, 'a+b')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        return False
+
+def _now():
+    return datetime.datetime.now().isoformat()
+
+def _add_stat(conn, key, amount=1):
+    conn.execute('UPDATE artifact_stats SET value = value + ? WHERE key = ?', (amount, key))
+
+def _delete_rows(conn, rows):
+    """Elimina le voci indicate aggiornando i totali (da chiamare in una transazione)."""
+    freed = 0
+    for row in rows:
+        conn.execute('DELETE FROM artifacts WHERE content_hash = ? AND artifact_type = ? AND variant = ?',
+                     (row['content_hash'], row['artifact_type'], row['variant']))
+        freed += row['size']
+    if rows:
+        _add_stat(conn, 'entries', -len(rows))
+        _add_stat(conn, 'bytes', -freed)
+    return freed
+
+def _row_path(row):
+    """Percorso del file di una voce (calcolato dalla chiave, non dal valore salvato)."""
+    return artifact_path(row['content_hash'], row['artifact_type'], row['variant'])
+
+def _unlink(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.warning(f"Impossibile eliminare l'artefatto {path}: {str(e)}")
+
+def _lookup(content_hash, artifact_type, variant, count):
+    """
+    Apre un artefatto presente in cache e ne aggiorna i dati di accesso.
+
+    Il file viene aperto prima di toccare l'indice: un'evizione concorrente
+    non invalida il descrittore già ottenuto.
+    """
+    path = artifact_path(content_hash, artifact_type, variant)
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        f = None
+
+    key = (content_hash, artifact_type, variant)
+    try:
+        with write_transaction() as conn:
+            row = conn.execute('SELECT * FROM artifacts WHERE content_hash = ? AND artifact_type = ? AND variant = ?',
+                               key).fetchone()
+            if f is None:
+                # Voce il cui file è stato rimosso dall'esterno
+                if row is not None:
+                    _delete_rows(conn, [row])
+                if count:
+                    _add_stat(conn, 'misses')
+            elif row is not None:
+                conn.execute('UPDATE artifacts SET hits = hits + 1, last_access_at = ? '
+                             'WHERE content_hash = ? AND artifact_type = ? AND variant = ?',
+                             (_now(),) + key)
+                if count:
+                    _add_stat(conn, 'hits')
+            else:
+                # File presente ma non indicizzato (es. indice ricreato): viene registrato
+                size = os.fstat(f.fileno()).st_size
+                conn.execute('INSERT INTO artifacts (content_hash, artifact_type, variant, path, size, hits, '
+                             'created_at, last_access_at) VALUES (?, ?, ?, ?, ?, 1, ?, ?)',
+                             key + (path, size, _now(), _now()))
+                _add_stat(conn, 'entries')
+                _add_stat(conn, 'bytes', size)
+                if count:
+                    _add_stat(conn, 'hits')
+    except Exception as e:
+        logging.warning(f"Indice della cache degli artefatti non disponibile: {str(e)}")
+    return f
+
+def _publish(temp_path, content_hash, artifact_type, variant):
+    """Sposta un artefatto completo nella posizione definitiva e lo registra nell'indice."""
+    path = artifact_path(content_hash, artifact_type, variant)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    size = os.path.getsize(temp_path)
+    os.replace(temp_path, path)
+
+    key = (content_hash, artifact_type, variant)
+    with write_transaction() as conn:
+        previous = conn.execute('SELECT size FROM artifacts WHERE content_hash = ? AND artifact_type = ? '
+                                'AND variant = ?', key).fetchone()
+        conn.execute('INSERT OR REPLACE INTO artifacts (content_hash, artifact_type, variant, path, size, hits, '
+                     'created_at, last_access_at) VALUES (?, ?, ?, ?, ?, 0, ?, ?)',
+                     key + (path, size, _now(), _now()))
+        if previous is None:
+            _add_stat(conn, 'entries')
+            _add_stat(conn, 'bytes', size)
+        else:
+            _add_stat(conn, 'bytes', size - previous['size'])
+    return path
+
+def _temp_path():
+    os.makedirs(ARTIFACT_TMP_DIR, exist_ok=True)
+    return os.path.join(ARTIFACT_TMP_DIR, f"{uuid.uuid4().hex}.tmp")
+
+def _enforce_budget():
+    """Avvia un'evizione se la cache ha superato lo spazio massimo."""
+    try:
+        row = get_connection().execute("SELECT value FROM artifact_stats WHERE key = 'bytes'").fetchone()
+        if row is not None and row['value'] > ARTIFACT_CACHE_MAX_BYTES:
+            evict()
+    except Exception as e:
+        logging.warning(f"Impossibile applicare il limite della cache degli artefatti: {str(e)}")
+
+def open_artifact(content_hash, artifact_type, variant=''):
+    """
+    Apre un artefatto se presente in cache.
+
+    Args:
+        content_hash: SHA-256 esadecimale del contenuto di origine
+        artifact_type: Tipo di artefatto
+        variant: Variante opzionale
+
+    Returns:
+        file: File aperto in lettura binaria, o None se l'artefatto non è in cache
+    """
+    return _lookup(content_hash, artifact_type, variant, count=True)
+
+def read_artifact(content_hash, artifact_type, variant=''):
+    """
+    Legge il contenuto di un artefatto se presente in cache.
+
+    Returns:
+        bytes: Contenuto dell'artefatto, o None se non è in cache
+    """
+    f = open_artifact(content_hash, artifact_type, variant)
+    if f is None:
+        return None
+    with f:
+        return f.read()
+
+def store_artifact(content_hash, artifact_type, data, variant=''):
+    """
+    Salva in cache un artefatto già calcolato.
+
+    Args:
+        content_hash: SHA-256 esadecimale del contenuto di origine
+        artifact_type: Tipo di artefatto
+        data: Contenuto dell'artefatto (bytes o str, salvata in UTF-8)
+        variant: Variante opzionale
+
+    Returns:
+        bool: True se l'artefatto è stato salvato
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    temp_path = _temp_path()
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        _publish(temp_path, content_hash, artifact_type, variant)
+    except Exception as e:
+        logging.warning(f"Impossibile salvare l'artefatto {artifact_type} di {content_hash} in cache: {str(e)}")
+        _unlink(temp_path)
+        return False
+
+    _enforce_budget()
+    return True
+
+def get_or_create_artifact(content_hash, artifact_type, producer, variant=''):
+    """
+    Restituisce un artefatto dalla cache o lo calcola una sola volta.
+
+    In caso di miss il calcolo avviene sotto un lock condiviso tra i processi:
+    i worker che richiedono la stessa chiave nel frattempo attendono e trovano
+    l'artefatto già pronto. Se la cache non è scrivibile, l'artefatto calcolato
+    viene comunque restituito.
+
+    Args:
+        content_hash: SHA-256 esadecimale del contenuto di origine
+        artifact_type: Tipo di artefatto
+        producer: Funzione che riceve il percorso di un file temporaneo e vi
+            scrive l'artefatto (se non crea il file, l'artefatto non è disponibile)
+        variant: Variante opzionale
+
+    Returns:
+        file: File aperto in lettura binaria, o None se il calcolo non è riuscito
+    """
+    f = _lookup(content_hash, artifact_type, variant, count=True)
+    if f is not None:
+        return f
+
+    with _key_lock(content_hash, artifact_type, variant):
+        # Un altro worker potrebbe averlo calcolato durante l'attesa del lock
+        f = _lookup(content_hash, artifact_type, variant, count=False)
+        if f is not None:
+            return f
+
+        temp_path = _temp_path()
+        try:
+            producer(temp_path)
+        except Exception as e:
+            logging.error(f"Errore durante il calcolo dell'artefatto {artifact_type} di {content_hash}: {str(e)}")
+            _unlink(temp_path)
+            return None
+        if not os.path.isfile(temp_path):
+            return None
+
+        # Il descrittore resta valido dopo la rename e anche dopo un'eventuale evizione
+        f = open(temp_path, 'rb')
+        try:
+            _publish(temp_path, content_hash, artifact_type, variant)
+        except Exception as e:
+            logging.warning(f"Impossibile salvare l'artefatto {artifact_type} di {content_hash} in cache: {str(e)}")
+            _unlink(temp_path)
+
+    _enforce_budget()
+    return f
+
+def evict(target_bytes=None):
+    """
+    Elimina le voci meno utili secondo ARTIFACT_CACHE_POLICY finché lo spazio
+    occupato non scende sotto target_bytes.
+
+    Args:
+        target_bytes: Spazio da raggiungere (default: ARTIFACT_CACHE_LOW_WATERMARK
+            del limite; 0 svuota la cache)
+
+    Returns:
+        dict: Numero di voci eliminate e byte liberati
+    """
+    if target_bytes is None:
+        target_bytes = int(ARTIFACT_CACHE_MAX_BYTES * ARTIFACT_CACHE_LOW_WATERMARK)
+    order = 'hits, last_access_at' if ARTIFACT_CACHE_POLICY == 'lfu' else 'last_access_at'
+
+    with write_transaction() as conn:
+        total = conn.execute("SELECT value FROM artifact_stats WHERE key = 'bytes'").fetchone()['value']
+        victims = []
+        if total > target_bytes:
+            cursor = conn.execute(f'SELECT * FROM artifacts ORDER BY {order}')
+            for row in cursor:
+                victims.append(row)
+                total -= row['size']
+                if total <= target_bytes:
+                    break
+            cursor.close()
+        freed = _delete_rows(conn, victims)
+        if victims:
+            _add_stat(conn, 'evictions', len(victims))
+
+    for row in victims:
+        _unlink(_row_path(row))
+
+    if victims:
+        logging.info(f"Cache degli artefatti: {len(victims)} voci eliminate, {freed} byte liberati")
+    return {'evicted': len(victims), 'freed_bytes': freed}
+
+def invalidate_artifacts(content_hash):
+    """
+    Elimina tutti gli artefatti derivati da un contenuto (es. quando il blob viene eliminato).
+
+    Args:
+        content_hash: SHA-256 esadecimale del contenuto di origine
+
+    Returns:
+        int: Numero di artefatti eliminati
+    """
+    if not content_hash:
+        return 0
+    try:
+        with write_transaction() as conn:
+            rows = conn.execute('SELECT * FROM artifacts WHERE content_hash = ?', (content_hash,)).fetchall()
+            _delete_rows(conn, rows)
+    except Exception as e:
+        logging.warning(f"Impossibile invalidare gli artefatti di {content_hash}: {str(e)}")
+        return 0
+
+    for row in rows:
+        _unlink(_row_path(row))
+    return len(rows)
+
+def reconcile_cache():
+    """
+    Riallinea indice e file su disco: rimuove le voci senza file, i file non
+    indicizzati e i temporanei abbandonati, ricalcola i totali e applica il limite.
+
+    Returns:
+        dict: Statistiche del riallineamento
+    """
+    stats = {'missing_entries': 0, 'orphan_files': 0, 'temp_files': 0}
+    threshold = time.time() - ARTIFACT_ORPHAN_GRACE_SECONDS
+
+    conn = get_connection()
+    indexed = set()
+    missing = []
+    for row in conn.execute('SELECT * FROM artifacts'):
+        path = _row_path(row)
+        if os.path.isfile(path):
+            indexed.add(path)
+        else:
+            missing.append(row)
+
+    if missing:
+        with write_transaction() as conn:
+            _delete_rows(conn, missing)
+        stats['missing_entries'] = len(missing)
+
+    for entry in iter_storage_files(ARTIFACT_CACHE_DIR):
+        if entry.path in indexed:
+            continue
+        try:
+            if entry.stat().st_mtime < threshold:
+                _unlink(entry.path)
+                stats['orphan_files'] += 1
+        except OSError:
+            continue
+
+    if os.path.isdir(ARTIFACT_TMP_DIR):
+        for entry in os.scandir(ARTIFACT_TMP_DIR):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < threshold:
+                    _unlink(entry.path)
+                    stats['temp_files'] += 1
+            except OSError:
+                continue
+
+    # I totali incrementali vengono riallineati con quelli reali dell'indice
+    with write_transaction() as conn:
+        totals = conn.execute('SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS bytes FROM artifacts').fetchone()
+        conn.execute("UPDATE artifact_stats SET value = ? WHERE key = 'entries'", (totals['entries'],))
+        conn.execute("UPDATE artifact_stats SET value = ? WHERE key = 'bytes'", (totals['bytes'],))
+
+    stats.update(evict() if totals['bytes'] > ARTIFACT_CACHE_MAX_BYTES else {'evicted': 0, 'freed_bytes': 0})
+    logging.info(f"Riallineamento della cache degli artefatti completato: {stats}")
+    return stats
+
+def get_cache_stats():
+    """
+    Restituisce occupazione e metriche della cache (condivise tra i processi).
+
+    Returns:
+        dict: Voci, byte occupati, limite, politica, hit, miss, evizioni,
+            percentuale di hit e ripartizione per tipo di artefatto
+    """
+    conn = get_connection()
+    stats = {row['key']: row['value'] for row in conn.execute('SELECT key, value FROM artifact_stats')}
+    lookups = stats.get('hits', 0) + stats.get('misses', 0)
+    stats['hit_ratio'] = round(stats.get('hits', 0) / lookups, 4) if lookups else None
+    stats['max_bytes'] = ARTIFACT_CACHE_MAX_BYTES
+    stats['policy'] = ARTIFACT_CACHE_POLICY
+    stats['by_type'] = {
+        row['artifact_type']: {'entries': row['entries'], 'bytes': row['bytes']}
+        for row in conn.execute('SELECT artifact_type, COUNT(*) AS entries, COALESCE(SUM(size), 0) AS bytes '
+                                'FROM artifacts GROUP BY artifact_type')
+    }
+    return stats
@@ -0,0 +1,426 @@
+"""
+Blob store indirizzato per contenuto (content-addressable storage).
+
+Ogni file caricato viene memorizzato una sola volta, usando lo SHA-256 del suo
+contenuto come chiave. Le righe Document e DocumentVersion referenziano il blob
+tramite la colonna content_hash e il conteggio dei riferimenti è mantenuto nella
+tabella StorageBlob: l'eliminazione di un documento rilascia solo il riferimento,
+mentre il file fisico viene rimosso quando non è più referenziato da nessuna riga,
+solo dopo la commit della transazione che ha eliminato la riga StorageBlob.
+
+Registrazione ed eliminazione di uno stesso contenuto si escludono con un lock
+tra processi (fcntl) per hash: al rilascio i file del blob vengono rinominati in
+file .released univoci, eliminati dopo la commit (o ripristinati dopo un
+rollback), così un nuovo caricamento dello stesso contenuto scrive sempre un
+file proprio che l'eliminazione non tocca.
+"""
+
+import os
+import logging
+import datetime
+import hashlib
+import uuid
+import fcntl
+from sqlalchemy import event, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app import db
+from models import StorageBlob
+from services.storage_layout import sharded_path
+from services.stream_writer import open_source, write_stream, detect_mime_type, MIME_SNIFF_BYTES
+from services.location_index import record_location, remove_location
+from services.storage_backend import delete_remote_file
+from services.compression import compressed_variant, COMPRESSED_SUFFIXES
+from services.checksum_cache import remember_checksums
+from services.artifact_cache import invalidate_artifacts
+
+# Configurazione delle directory del blob store - usa percorsi assoluti
+BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+BLOB_STORE_DIR = os.path.join(BASE_DIR, 'uploads', 'blobs')
+
+# Directory per i file temporanei (stesso filesystem dei blob, per rinomine atomiche)
+BLOB_TMP_DIR = os.path.join(BLOB_STORE_DIR, 'tmp')
+
+# Directory dei lock tra processi sui blob
+BLOB_LOCK_DIR = os.path.join(BLOB_STORE_DIR, 'locks')
+
+# Numero di file di lock condivisi tra gli hash (non crescono con il blob store)
+BLOB_LOCK_STRIPES = 256
+
+# Suffisso dei file dei blob rilasciati in attesa della commit
+RELEASED_SUFFIX = '.released'
+
+# Dimensione dei blocchi di lettura per il calcolo degli hash
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Chiave di Session.info con i blob rilasciati da eliminare fisicamente dopo la commit
+PENDING_DELETIONS_KEY = 'blob_store_pending_deletions'
+
+def _pending_deletions(session):
+    """Blob rilasciati nella transazione corrente: hash -> (percorso, file messi da parte)."""
+    return session.info.setdefault(PENDING_DELETIONS_KEY, {})
+
+class _blob_lock:
+    """Lock esclusivo tra processi (fcntl.flock) sul contenuto di un blob."""
+
+    def __init__(self, content_hash):
+        stripe = int(content_hash[:8], 16) % BLOB_LOCK_STRIPES
+        self.path = os.path.join(BLOB_LOCK_DIR, f"{stripe:03d}.lock")
+
+    def __enter__(self):
+        os.makedirs(BLOB_LOCK_DIR, exist_ok=True)
+        self.file = open(self.path, 'a+b')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        return False
+
+def _set_aside(file_path):
+    """
+    Rinomina i file locali di un blob (anche le varianti compresse) in file .released
+    univoci nella stessa directory. Da chiamare con il lock del blob.
+
+    Returns:
+        list: Coppie (percorso originale, percorso .released)
+    """
+    moved = []
+    for suffix in [''] + list(COMPRESSED_SUFFIXES.values()):
+        original = file_path + suffix
+        released = f"{original}.{uuid.uuid4().hex}{RELEASED_SUFFIX}"
+        try:
+            os.rename(original, released)
+        except FileNotFoundError:
+            continue
+        moved.append((original, released))
+    return moved
+
+def _restore(file_path, moved):
+    """
+    Riporta al loro posto i file messi da parte; se nel frattempo il blob è stato
+    scritto di nuovo, le copie messe da parte vengono eliminate. Da chiamare con il lock del blob.
+    """
+    rewritten = os.path.exists(file_path)
+    for original, released in moved:
+        try:
+            if rewritten or os.path.exists(original):
+                os.remove(released)
+            else:
+                os.rename(released, original)
+        except OSError as e:
+            logging.error(f"Errore durante il ripristino del file del blob {original}: {str(e)}")
+
+@event.listens_for(Session, 'after_commit')
+def _delete_released_blobs(session):
+    """Elimina i file dei blob rilasciati, ora che la rimozione delle righe è confermata."""
+    # Anche la commit di un savepoint genera l'evento: si attende quella esterna
+    if session.in_nested_transaction() or not session.info.get(PENDING_DELETIONS_KEY):
+        return
+    pending = session.info.pop(PENDING_DELETIONS_KEY)
+
+    # Un altro worker potrebbe aver registrato di nuovo lo stesso contenuto
+    try:
+        with db.engine.connect() as connection:
+            recreated = set(connection.execute(
+                select(StorageBlob.content_hash).where(StorageBlob.content_hash.in_(list(pending)))
+            ).scalars())
+    except Exception as e:
+        logging.error(f"Impossibile verificare i blob rilasciati, eliminazione dallo storage remoto rinviata: {str(e)}")
+        recreated = set(pending)
+
+    for content_hash, (file_path, moved) in pending.items():
+        try:
+            with _blob_lock(content_hash):
+                # Solo i file messi da parte al rilascio: un nuovo caricamento scrive un file proprio
+                for _, released in moved:
+                    try:
+                        os.remove(released)
+                    except FileNotFoundError:
+                        pass
+                if content_hash in recreated or os.path.exists(file_path):
+                    continue
+                delete_remote_file(file_path)
+            remove_location(file_path)
+            for original, _ in moved:
+                if original != file_path:
+                    remove_location(original)
+            invalidate_artifacts(content_hash)
+            logging.info(f"Blob eliminato (nessun riferimento residuo): {content_hash}")
+        except Exception as e:
+            # I file .released residui verranno rimossi dal garbage collector dello storage
+            logging.error(f"Errore durante l'eliminazione del file del blob {content_hash}: {str(e)}")
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_released_blobs(session):
+    """Ripristina i file dei blob rilasciati: le righe StorageBlob non sono state rimosse."""
+    # Anche il rollback di un savepoint li ripristina: nel dubbio il file resta al garbage collector
+    pending = session.info.pop(PENDING_DELETIONS_KEY, None)
+    for content_hash, (file_path, moved) in (pending or {}).items():
+        with _blob_lock(content_hash):
+            _restore(file_path, moved)
+
+def ensure_blob_store():
+    """
+    Assicura che le directory del blob store esistano.
+    """
+    os.makedirs(BLOB_STORE_DIR, exist_ok=True)
+    os.makedirs(BLOB_TMP_DIR, exist_ok=True)
+    return True
+
+def compute_sha256(file_path):
+    """
+    Calcola lo SHA-256 di un file leggendolo a blocchi.
+
+    Args:
+        file_path: Percorso del file
+
+    Returns:
+        str: Digest esadecimale del contenuto
+    """
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def get_blob_path(content_hash):
+    """
+    Restituisce il percorso fisico di un blob dato il suo hash, nel layout
+    partizionato per prefisso dell'hash (blobs/ab/cd/<hash>).
+
+    Args:
+        content_hash: SHA-256 esadecimale del contenuto
+
+    Returns:
+        str: Percorso assoluto del blob
+    """
+    return sharded_path(BLOB_STORE_DIR, content_hash)
+
+def _new_temp_path():
+    """Genera un percorso temporaneo univoco all'interno del blob store."""
+    ensure_blob_store()
+    return os.path.join(BLOB_TMP_DIR, f"{uuid.uuid4()}.part")
+
+def _register_blob(temp_path, content_hash, file_size, mime_type=None):
+    """
+    Sposta un file temporaneo nel blob store (se il contenuto non è già presente)
+    e incrementa il conteggio dei riferimenti del blob.
+
+    Returns:
+        StorageBlob: Il blob registrato, con il riferimento già acquisito
+    """
+    blob_path = get_blob_path(content_hash)
+
+    rewarmed = False
+    with _blob_lock(content_hash):
+        if db.session.get(StorageBlob, content_hash) is not None and os.path.exists(blob_path):
+            # Contenuto già presente: il file temporaneo è un duplicato
+            os.remove(temp_path)
+            logging.info(f"Contenuto duplicato, riutilizzo del blob esistente: {content_hash}")
+        else:
+            # Senza una riga registrata un file già presente può essere in corso di
+            # eliminazione: lo si sostituisce con il file temporaneo
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(temp_path, blob_path)
+            record_location(blob_path, content_hash=content_hash, size=file_size)
+            remember_checksums(blob_path, {'sha256': content_hash})
+
+            # Blob compresso dallo storage freddo e di nuovo in uso: torna non compresso
+            variant = compressed_variant(blob_path)
+            if variant:
+                # Vale anche per i delta: il contenuto completo torna disponibile
+                os.remove(variant[0])
+                remove_location(variant[0])
+                rewarmed = True
+                logging.info(f"Blob compresso ripristinato non compresso: {blob_path}")
+            else:
+                logging.info(f"Nuovo blob memorizzato: {blob_path}")
+
+    blob = acquire_blob(content_hash, file_size=file_size, mime_type=mime_type)
+    if rewarmed and blob is not None:
+        if blob.delta_base_hash:
+            from services.delta_store import undeltify_blob
+            undeltify_blob(blob)
+        blob.compression = None
+        blob.stored_size = None
+        blob.compressed_at = None
+    return blob
+
+def store_blob(file_obj=None, file_path=None):
+    """
+    Memorizza un contenuto nel blob store e acquisisce un riferimento su di esso.
+
+    Il contenuto viene letto una sola volta: hash, dimensione e tipo MIME sono
+    calcolati durante la scrittura del file temporaneo.
+
+    Il chiamante è responsabile di salvare il content_hash restituito sulla riga
+    Document o DocumentVersion che possiede il riferimento.
+
+    Args:
+        file_obj: Oggetto file Flask da salvare (opzionale)
+        file_path: Percorso di un file esistente da importare (opzionale)
+
+    Returns:
+        StorageBlob: Il blob memorizzato o None in caso di errore
+    """
+    temp_path = None
+    try:
+        source, close_source = open_source(file_obj=file_obj, file_path=file_path)
+        temp_path = _new_temp_path()
+
+        try:
+            result = write_stream(source, [temp_path])
+        finally:
+            if close_source:
+                source.close()
+
+        return _register_blob(temp_path, result['sha256'], result['size'], result['mime_type'])
+    except Exception as e:
+        logging.error(f"Errore durante la memorizzazione del blob: {str(e)}")
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+
+def store_temp_file(temp_path):
+    """
+    Memorizza nel blob store un file già scritto in BLOB_TMP_DIR (ad esempio un
+    caricamento a blocchi assemblato), spostandolo invece di copiarlo.
+
+    Il file viene letto una sola volta per calcolarne hash e tipo MIME; se il
+    contenuto è già presente il file temporaneo viene eliminato.
+
+    Args:
+        temp_path: Percorso del file nella directory temporanea del blob store
+
+    Returns:
+        StorageBlob: Il blob memorizzato o None in caso di errore
+    """
+    try:
+        hasher = hashlib.sha256()
+        with open(temp_path, 'rb') as f:
+            header = f.read(MIME_SNIFF_BYTES)
+            hasher.update(header)
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+
+        return _register_blob(temp_path, hasher.hexdigest(), os.path.getsize(temp_path),
+                              detect_mime_type(header))
+    except Exception as e:
+        logging.error(f"Errore durante la memorizzazione del file temporaneo {temp_path}: {str(e)}")
+        return None
+
+def acquire_blob(content_hash, file_size=None, mime_type=None):
+    """
+    Incrementa il conteggio dei riferimenti di un blob, creandone la riga se necessario.
+
+    Args:
+        content_hash: SHA-256 esadecimale del contenuto
+        file_size: Dimensione del contenuto (necessaria solo alla creazione)
+        mime_type: Tipo MIME del contenuto (usato solo alla creazione)
+
+    Returns:
+        StorageBlob: Il blob aggiornato o None se content_hash è vuoto
+    """
+    if not content_hash:
+        return None
+
+    # Contenuto rilasciato e riacquisito nella stessa transazione: il file resta
+    released = _pending_deletions(db.session).pop(content_hash, None)
+    if released:
+        with _blob_lock(content_hash):
+            _restore(*released)
+
+    now = datetime.datetime.utcnow()
+    blob = db.session.get(StorageBlob, content_hash)
+
+    if blob is None:
+        if file_size is None:
+            file_size = os.path.getsize(get_blob_path(content_hash))
+        try:
+            # Savepoint: un altro worker potrebbe aver registrato lo stesso contenuto
+            with db.session.begin_nested():
+                blob = StorageBlob(
+                    content_hash=content_hash,
+                    file_path=get_blob_path(content_hash),
+                    file_size=file_size,
+                    mime_type=mime_type,
+                    ref_count=1,
+                    last_referenced_at=now
+                )
+                db.session.add(blob)
+            return blob
+        except IntegrityError:
+            blob = db.session.get(StorageBlob, content_hash)
+
+    # Incremento atomico lato database, sicuro con più worker concorrenti
+    StorageBlob.query.filter_by(content_hash=content_hash).update({
+        StorageBlob.ref_count: StorageBlob.ref_count + 1,
+        StorageBlob.last_referenced_at: now
+    }, synchronize_session=False)
+    db.session.refresh(blob)
+    return blob
+
+def release_blob(content_hash):
+    """
+    Rilascia un riferimento a un blob. Quando il conteggio arriva a zero la riga
+    StorageBlob viene eliminata e il file fisico viene rimosso dopo la commit.
+
+    Args:
+        content_hash: SHA-256 esadecimale del contenuto
+
+    Returns:
+        bool: True se il blob è stato eliminato, False altrimenti
+    """
+    if not content_hash:
+        return False
+
+    try:
+        StorageBlob.query.filter_by(content_hash=content_hash).update({
+            StorageBlob.ref_count: StorageBlob.ref_count - 1
+        }, synchronize_session=False)
+
+        blob = db.session.get(StorageBlob, content_hash)
+        if blob is None:
+            return False
+        db.session.refresh(blob)
+
+        if blob.ref_count > 0:
+            logging.info(f"Riferimento rilasciato per il blob {content_hash} ({blob.ref_count} rimanenti)")
+            return False
+
+        # Nessun riferimento residuo: il contenuto fisico (da disco e storage a oggetti)
+        # e gli artefatti derivati vengono eliminati solo dopo la commit
+        db.session.delete(blob)
+        db.session.flush()
+        with _blob_lock(content_hash):
+            moved = _set_aside(blob.file_path)
+        _pending_deletions(db.session)[content_hash] = (blob.file_path, moved)
+        logging.info(f"Blob rilasciato, eliminazione dopo la commit: {content_hash}")
+
+        # Un delta tiene un riferimento sul proprio blob di base
+        if blob.delta_base_hash:
+            release_blob(blob.delta_base_hash)
+        return True
+    except Exception as e:
+        logging.error(f"Errore durante il rilascio del blob {content_hash}: {str(e)}")
+        return False
+
+def release_document_blobs(document):
+    """
+    Rilascia i riferimenti ai blob di un documento e di tutte le sue versioni.
+
+    Args:
+        document: Oggetto Document in fase di eliminazione
+
+    Returns:
+        int: Numero di blob eliminati
+    """
+    removed = 0
+    if release_blob(document.content_hash):
+        removed += 1
+    for version in document.versions:
+        if release_blob(version.content_hash):
+            removed += 1
+    return removed
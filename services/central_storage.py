@@ -7,14 +7,19 @@ con funzioni per salvare, recuperare e verificare i file.
 
 import os
 import logging
-import shutil
 import datetime
 import uuid
 import json
 from flask import current_app
 from werkzeug.utils import secure_filename
 from app import db
-from models import Document
+from models import Document, Company
+from services.storage_layout import sharded_path, resolve_path
+from services.stream_writer import open_source, stream_to_files
+from services.replica_copy import copy_file, replicate_file
+from services.location_index import record_location, find_paths_for_name, get_root_stats
+from services.storage_stats import get_document_counters
+from services.storage_gc import collect_garbage
 
 # Configurazione delle directory di storage - usa percorsi assoluti
 BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
@@ -89,27 +94,34 @@ def save_file_to_central_storage(file_obj=None, file_path=None, original_filenam
         # Genera un nome file unico
         unique_filename = generate_unique_filename(original_filename)
         
-        # Percorsi di destinazione
-        destination_path = os.path.join(ORIGINAL_FILES_DIR, unique_filename)
-        backup_path = os.path.join(BACKUP_FILES_DIR, unique_filename) if create_backup else None
-        
         # Assicurati che le directory esistano
         ensure_storage_directories()
         
-        # Salva o sposta il file nella directory principale
-        if file_obj:
-            file_obj.save(destination_path)
-        elif file_path and os.path.exists(file_path):
-            shutil.copy2(file_path, destination_path)
-        else:
-            raise FileNotFoundError(f"Il file {file_path} non esiste")
+        # Percorsi di destinazione nel layout partizionato (originals/ab/cd/<file>)
+        destination_path = sharded_path(ORIGINAL_FILES_DIR, unique_filename, create_dirs=True)
+        backup_path = sharded_path(BACKUP_FILES_DIR, unique_filename, create_dirs=True) if create_backup else None
         
-        # Crea una copia di backup se richiesto
-        if create_backup and os.path.exists(destination_path):
-            shutil.copy2(destination_path, backup_path)
+        # Salva il file nella directory principale con un'unica lettura del contenuto
+        destinations = [destination_path] + ([backup_path] if backup_path else [])
+        source, close_source = open_source(file_obj=file_obj, file_path=file_path)
+        try:
+            result = stream_to_files(source, [destination_path])
+        finally:
+            if close_source:
+                source.close()
+
+        # Il backup è una replica del file principale (reflink o copia nel kernel, se possibile)
+        if backup_path:
+            try:
+                replicate_file(destination_path, [backup_path])
+            except OSError:
+                os.remove(destination_path)
+                raise
         
         # Ottieni la dimensione del file
-        file_size = os.path.getsize(destination_path)
+        file_size = result['size']
+        for path in destinations:
+            record_location(path, content_hash=result['sha256'], size=file_size)
         
         # Registra l'operazione
         logging.info(f"File salvato nel repository centralizzato: {destination_path}")
@@ -122,6 +134,8 @@ def save_file_to_central_storage(file_obj=None, file_path=None, original_filenam
             'file_path': destination_path,
             'backup_path': backup_path,
             'file_size': file_size,
+            'mime_type': result['mime_type'],
+            'content_hash': result['sha256'],
             'timestamp': datetime.datetime.now().isoformat()
         }
     except Exception as e:
@@ -144,28 +158,29 @@ def get_file_from_storage(filename, document_id=None):
             logging.warning("Richiesto recupero file con nome vuoto")
             return None
             
-        # Controlla se il file esiste nella directory principale
-        main_path = os.path.join(ORIGINAL_FILES_DIR, filename)
-        if os.path.exists(main_path):
-            logging.debug(f"File trovato nel percorso principale: {main_path}")
-            return main_path
+        # Controlla se il file esiste nella directory principale (il percorso si calcola dal nome)
+        existing_path = resolve_path(ORIGINAL_FILES_DIR, filename)
+        if existing_path:
+            logging.debug(f"File trovato nel percorso principale: {existing_path}")
+            return existing_path
+        
+        # Posizioni di destinazione nel layout partizionato per gli eventuali ripristini
+        main_path = sharded_path(ORIGINAL_FILES_DIR, filename, create_dirs=True)
+        backup_path = sharded_path(BACKUP_FILES_DIR, filename, create_dirs=True)
         
         # Se non esiste nella directory principale, controlla il backup
-        backup_path = os.path.join(BACKUP_FILES_DIR, filename)
-        if os.path.exists(backup_path):
+        existing_backup = resolve_path(BACKUP_FILES_DIR, filename)
+        if existing_backup:
             # Se esiste nel backup, ripristinalo nella directory principale
             try:
-                # Assicurati che la directory principale esista
-                os.makedirs(ORIGINAL_FILES_DIR, exist_ok=True)
-                
                 # Copia il file dal backup alla directory principale
-                shutil.copy2(backup_path, main_path)
+                copy_file(existing_backup, main_path)
                 logging.info(f"File ripristinato dal backup: {main_path}")
                 return main_path
             except Exception as e:
                 logging.error(f"Errore durante il ripristino del file dal backup: {str(e)}")
                 # Restituisci il percorso del backup se non è possibile ripristinare
-                return backup_path
+                return existing_backup
         
         # Se abbiamo l'ID del documento, prova a cercarlo nel database
         if document_id:
@@ -179,10 +194,10 @@ def get_file_from_storage(filename, document_id=None):
                         # Migra il file al sistema centralizzato
                         try:
                             # Se il file esiste nel percorso registrato, copialo nel sistema centralizzato
-                            shutil.copy2(doc.file_path, main_path)
+                            copy_file(doc.file_path, main_path)
                             
                             # Crea anche un backup
-                            shutil.copy2(doc.file_path, backup_path)
+                            copy_file(doc.file_path, backup_path)
                             
                             # Aggiorna il percorso nel database solo se necessario
                             if doc.file_path != main_path:
@@ -205,18 +220,10 @@ def get_file_from_storage(filename, document_id=None):
                             # Aggiungi più percorsi se necessario
                         ]
                         
-                        # UUID dal nome del file
-                        uuid_part = None
-                        if filename and "_" in filename:
-                            uuid_part = filename.split("_", 1)[0]
-                        
-                        # Cerca anche per modelli simili con lo stesso UUID
-                        if uuid_part:
-                            for folder in ['uploads', 'document_cache', 'attached_assets']:
-                                if os.path.exists(folder):
-                                    for file in os.listdir(folder):
-                                        if file.startswith(uuid_part):
-                                            alternative_paths.append(os.path.join(folder, file))
+                        # Cerca anche file con lo stesso UUID o lo stesso contenuto nell'indice delle posizioni
+                        alternative_paths.extend(find_paths_for_name(
+                            filename, original_filename=doc.original_filename, content_hash=doc.content_hash
+                        ))
                         
                         for alt_path in alternative_paths:
                             if os.path.exists(alt_path):
@@ -224,10 +231,10 @@ def get_file_from_storage(filename, document_id=None):
                                 
                                 try:
                                     # Copia il file nel sistema centralizzato
-                                    shutil.copy2(alt_path, main_path)
+                                    copy_file(alt_path, main_path)
                                     
                                     # Crea anche un backup
-                                    shutil.copy2(alt_path, backup_path)
+                                    copy_file(alt_path, backup_path)
                                     
                                     # Aggiorna il percorso nel database
                                     doc.file_path = main_path
@@ -242,42 +249,35 @@ def get_file_from_storage(filename, document_id=None):
             except Exception as e:
                 logging.error(f"Errore durante la ricerca del documento nel database: {str(e)}")
         
-        # 3. Ulteriore verifica manuale in tutte le directory di archiviazione
-        # Cerca per nome file originale o per UUID
-        uuid_part = None
-        if filename and "_" in filename:
-            uuid_part = filename.split("_", 1)[0]
+        # 3. Ulteriore verifica in tutte le directory di archiviazione tramite l'indice delle posizioni
+        # Cerca per nome file, UUID o nome originale
+        for found_path in find_paths_for_name(filename)[:1]:
+            logging.info(f"File trovato in ricerca approfondita: {found_path}")
             
-        if uuid_part:
-            for folder in ['uploads', 'document_cache', 'attached_assets', 'document_storage', 'document_storage/originals', 'document_storage/backup']:
-                if os.path.exists(folder):
-                    for file in os.listdir(folder):
-                        if file.startswith(uuid_part) or (filename and file == filename):
-                            found_path = os.path.join(folder, file)
-                            logging.info(f"File trovato in ricerca approfondita: {found_path}")
-                            
-                            try:
-                                # Copia il file nel sistema centralizzato
-                                shutil.copy2(found_path, main_path)
-                                
-                                # Crea anche un backup
-                                shutil.copy2(found_path, backup_path)
-                                
-                                # Aggiorna il documento nel database se possibile
-                                if document_id:
-                                    try:
-                                        doc = Document.query.get(document_id)
-                                        if doc:
-                                            doc.file_path = main_path
-                                            db.session.commit()
-                                    except Exception as e:
-                                        logging.error(f"Errore durante l'aggiornamento del database: {str(e)}")
-                                
-                                logging.info(f"File recuperato da ricerca approfondita: {found_path}")
-                                return main_path
-                            except Exception as e:
-                                logging.error(f"Errore durante il recupero da ricerca approfondita: {str(e)}")
-                                return found_path
+            try:
+                # Copia il file nel sistema centralizzato
+                copy_file(found_path, main_path)
+                
+                # Crea anche un backup
+                copy_file(found_path, backup_path)
+                record_location(main_path)
+                record_location(backup_path)
+                
+                # Aggiorna il documento nel database se possibile
+                if document_id:
+                    try:
+                        doc = Document.query.get(document_id)
+                        if doc:
+                            doc.file_path = main_path
+                            db.session.commit()
+                    except Exception as e:
+                        logging.error(f"Errore durante l'aggiornamento del database: {str(e)}")
+                
+                logging.info(f"File recuperato da ricerca approfondita: {found_path}")
+                return main_path
+            except Exception as e:
+                logging.error(f"Errore durante il recupero da ricerca approfondita: {str(e)}")
+                return found_path
         
         # Se non trovato in nessuna posizione, restituisci None
         logging.warning(f"File non trovato in nessuna posizione conosciuta: {filename}")
@@ -319,14 +319,14 @@ def verify_and_repair_storage():
                     
                     # Prova a recuperare il file dal backup
                     if doc.filename:
-                        backup_path = os.path.join(BACKUP_FILES_DIR, doc.filename)
-                        if os.path.exists(backup_path):
+                        backup_path = resolve_path(BACKUP_FILES_DIR, doc.filename)
+                        if backup_path:
                             # Crea la directory di destinazione se non esiste
                             destination_dir = os.path.dirname(doc.file_path)
                             os.makedirs(destination_dir, exist_ok=True)
                             
                             # Ripristina il file dal backup
-                            shutil.copy2(backup_path, doc.file_path)
+                            copy_file(backup_path, doc.file_path)
                             report['files_restored'] += 1
                             logging.info(f"File ripristinato per documento ID {doc.id}: {doc.file_path}")
                         else:
@@ -370,8 +370,8 @@ def validate_document_storage(document):
         
         # Controlla se il file è già nel sistema centralizzato
         if document.filename:
-            central_path = os.path.join(ORIGINAL_FILES_DIR, document.filename)
-            if os.path.exists(central_path):
+            central_path = resolve_path(ORIGINAL_FILES_DIR, document.filename)
+            if central_path:
                 # Aggiorna il percorso nel database
                 document.file_path = central_path
                 db.session.commit()
@@ -382,11 +382,11 @@ def validate_document_storage(document):
                 }
             
             # Controlla se esiste nel backup
-            backup_path = os.path.join(BACKUP_FILES_DIR, document.filename)
-            if os.path.exists(backup_path):
+            backup_path = resolve_path(BACKUP_FILES_DIR, document.filename)
+            if backup_path:
                 # Ripristina il file dal backup
-                destination_path = os.path.join(ORIGINAL_FILES_DIR, document.filename)
-                shutil.copy2(backup_path, destination_path)
+                destination_path = sharded_path(ORIGINAL_FILES_DIR, document.filename, create_dirs=True)
+                copy_file(backup_path, destination_path)
                 
                 # Aggiorna il percorso nel database
                 document.file_path = destination_path
@@ -535,6 +535,8 @@ def migrate_document_to_central_storage(document):
 def migrate_files_to_central_storage(update_database=True):
     """
     Migra tutti i file dei documenti al sistema di storage centralizzato.
+    Usa il runner riprendibile e parallelo di services/migration_runner.py:
+    una migrazione interrotta riprende dall'ultimo blocco completato.
     
     Args:
         update_database: Se True, aggiorna i percorsi nel database
@@ -542,6 +544,8 @@ def migrate_files_to_central_storage(update_database=True):
     Returns:
         dict: Report della migrazione
     """
+    from services.migration_runner import run_migration
+    
     report = {
         'total_documents': 0,
         'migrated_successfully': 0,
@@ -554,36 +558,13 @@ def migrate_files_to_central_storage(update_database=True):
         # Assicurati che le directory esistano
         ensure_storage_directories()
         
-        # Ottieni tutti i documenti dal database (ignorando l'attributo is_deleted che potrebbe non esistere)
-        documents = Document.query.all()
-        report['total_documents'] = len(documents)
-        
-        for doc in documents:
-            try:
-                # Controlla se il documento è già nel sistema centralizzato
-                if doc.file_path and doc.file_path.startswith(ORIGINAL_FILES_DIR):
-                    report['already_migrated'] += 1
-                    continue
-                
-                # Migra il documento
-                migration_result = migrate_document_to_central_storage(doc)
-                
-                if migration_result and migration_result.get('status') == 'migrated':
-                    report['migrated_successfully'] += 1
-                    logging.info(f"Documento ID {doc.id} migrato con successo")
-                elif migration_result and migration_result.get('status') == 'already_migrated':
-                    report['already_migrated'] += 1
-                else:
-                    report['migration_failed'] += 1
-                    error_msg = f"Documento ID {doc.id}: {migration_result.get('message', 'Errore sconosciuto')}"
-                    report['errors'].append(error_msg)
-                    logging.warning(error_msg)
-            except Exception as e:
-                report['migration_failed'] += 1
-                error_msg = f"Errore durante la migrazione del documento ID {doc.id}: {str(e)}"
-                report['errors'].append(error_msg)
-                logging.error(error_msg)
-        
+        run = run_migration('central')
+        report['total_documents'] = run.total_count
+        report['migrated_successfully'] = run.repaired_count
+        report['already_migrated'] = run.ok_count
+        report['migration_failed'] = run.failed_count
+        report['errors'] = json.loads(run.errors) if run.errors else []
+        report['run_id'] = run.id
         return report
     except Exception as e:
         error_msg = f"Errore durante la migrazione dei file: {str(e)}"
@@ -595,6 +576,10 @@ def get_storage_stats():
     """
     Ottiene statistiche sullo storage centralizzato.
     
+    I valori provengono da contatori aggiornati in modo incrementale (vedi
+    services/storage_stats.py e i totali dell'indice delle posizioni): nessuna
+    scansione delle directory o della tabella dei documenti.
+    
     Returns:
         dict: Statistiche sullo storage
     """
@@ -607,56 +592,44 @@ def get_storage_stats():
         'files_with_backup': 0,
         'avg_file_size': 0,
         'original_dir': ORIGINAL_FILES_DIR,
-        'backup_dir': BACKUP_FILES_DIR
+        'backup_dir': BACKUP_FILES_DIR,
+        'by_company': [],
+        'by_file_type': [],
+        'by_area': []
     }
     
     try:
-        # Assicurati che le directory esistano
-        ensure_storage_directories()
-        
-        # Conteggio totale documenti
-        stats['total_documents'] = Document.query.count()
-        
-        # Conteggio documenti migrati
-        try:
-            stats['migrated_documents'] = Document.query.filter(
-                Document.file_path.like(f"{ORIGINAL_FILES_DIR}%")
-            ).count()
-        except Exception as e:
-            logging.error(f"Errore durante il conteggio dei documenti migrati: {str(e)}")
-            # Conteggio manuale in caso di errore
-            migrated_count = 0
-            for doc in Document.query.all():
-                if doc.file_path and doc.file_path.startswith(ORIGINAL_FILES_DIR):
-                    migrated_count += 1
-            stats['migrated_documents'] = migrated_count
-        
-        # Conteggio e dimensione file nel repository principale
-        original_files = []
-        if os.path.exists(ORIGINAL_FILES_DIR):
-            original_files = [f for f in os.listdir(ORIGINAL_FILES_DIR) if os.path.isfile(os.path.join(ORIGINAL_FILES_DIR, f))]
-            stats['original_files'] = len(original_files)
-            
-            # Calcola la dimensione totale
-            for filename in original_files:
-                file_path = os.path.join(ORIGINAL_FILES_DIR, filename)
-                stats['total_size'] += os.path.getsize(file_path)
-        
-        # Conteggio file nel repository di backup
-        backup_files = []
-        if os.path.exists(BACKUP_FILES_DIR):
-            backup_files = [f for f in os.listdir(BACKUP_FILES_DIR) if os.path.isfile(os.path.join(BACKUP_FILES_DIR, f))]
-            stats['backup_files'] = len(backup_files)
-        
-        # Conteggio file con backup
-        for filename in original_files:
-            if filename in backup_files:
-                stats['files_with_backup'] += 1
+        # Contatori dei documenti
+        counters = get_document_counters()
+        stats['total_documents'] = counters.get('total', {}).get('all', {}).get('count', 0)
+        stats['migrated_documents'] = counters.get('area', {}).get('central', {}).get('count', 0)
+        
+        # Totali dei file su disco dall'indice delle posizioni
+        originals = get_root_stats(ORIGINAL_FILES_DIR)
+        backups = get_root_stats(BACKUP_FILES_DIR)
+        stats['total_size'] = originals['bytes']
+        stats['original_files'] = originals['files']
+        stats['backup_files'] = backups['files']
+        stats['files_with_backup'] = originals['with_backup']
         
         # Dimensione media file
         if stats['original_files'] > 0:
             stats['avg_file_size'] = stats['total_size'] / stats['original_files']
         
+        # Ripartizioni per azienda, tipo di file e area di storage
+        company_counters = counters.get('company', {})
+        company_ids = [int(key) for key in company_counters if key != 'none']
+        company_names = {str(company.id): company.name
+                         for company in Company.query.filter(Company.id.in_(company_ids)).all()} if company_ids else {}
+        for key, values in company_counters.items():
+            stats['by_company'].append({'name': company_names.get(key, 'Nessuna azienda'), **values})
+        for scope, target in (('file_type', 'by_file_type'), ('area', 'by_area')):
+            for key, values in counters.get(scope, {}).items():
+                stats[target].append({'name': key, **values})
+        for target in ('by_company', 'by_file_type', 'by_area'):
+            stats[target] = sorted((item for item in stats[target] if item['count'] > 0),
+                                   key=lambda item: item['bytes'], reverse=True)
+        
         return stats
     except Exception as e:
         logging.error(f"Errore durante il recupero delle statistiche dello storage: {str(e)}")
@@ -665,6 +638,8 @@ def get_storage_stats():
 def cleanup_orphaned_files(commit=False):
     """
     Pulisce i file orfani che non sono collegati a nessun documento nel database.
+    Usa il garbage collector di services/storage_gc.py su tutte le radici di storage
+    (con periodo di grazia e limite di velocità delle eliminazioni).
     
     Args:
         commit: Se True, elimina effettivamente i file, altrimenti fa solo una simulazione
@@ -672,58 +647,5 @@ def cleanup_orphaned_files(commit=False):
     Returns:
         dict: Report della pulizia
     """
-    report = {
-        'identified': 0,
-        'removed': 0,
-        'errors': []
-    }
-    
-    try:
-        # Assicurati che le directory esistano
-        ensure_storage_directories()
-        
-        # Ottieni tutti i nomi file registrati nel database
-        db_filenames = [doc.filename for doc in Document.query.all() if doc.filename]
-        
-        # Controlla i file nella directory principale
-        orphaned_files = []
-        if os.path.exists(ORIGINAL_FILES_DIR):
-            for filename in os.listdir(ORIGINAL_FILES_DIR):
-                if os.path.isfile(os.path.join(ORIGINAL_FILES_DIR, filename)) and filename not in db_filenames:
-                    orphaned_files.append({
-                        'filename': filename,
-                        'path': os.path.join(ORIGINAL_FILES_DIR, filename),
-                        'size': os.path.getsize(os.path.join(ORIGINAL_FILES_DIR, filename)),
-                        'directory': 'originals'
-                    })
-        
-        # Controlla i file nella directory di backup
-        if os.path.exists(BACKUP_FILES_DIR):
-            for filename in os.listdir(BACKUP_FILES_DIR):
-                if os.path.isfile(os.path.join(BACKUP_FILES_DIR, filename)) and filename not in db_filenames:
-                    orphaned_files.append({
-                        'filename': filename,
-                        'path': os.path.join(BACKUP_FILES_DIR, filename),
-                        'size': os.path.getsize(os.path.join(BACKUP_FILES_DIR, filename)),
-                        'directory': 'backup'
-                    })
-        
-        report['identified'] = len(orphaned_files)
-        
-        # Se richiesto, elimina i file orfani
-        if commit and len(orphaned_files) > 0:
-            for file_info in orphaned_files:
-                try:
-                    os.remove(file_info['path'])
-                    report['removed'] += 1
-                except Exception as e:
-                    error_msg = f"Errore durante la rimozione del file {file_info['path']}: {str(e)}"
-                    report['errors'].append(error_msg)
-                    logging.error(error_msg)
-        
-        return report
-    except Exception as e:
-        error_msg = f"Errore durante la pulizia dei file orfani: {str(e)}"
-        report['errors'].append(error_msg)
-        logging.error(error_msg)
-        return report
\ No newline at end of file
+    ensure_storage_directories()
+    return collect_garbage(commit=commit)
\ No newline at end of file
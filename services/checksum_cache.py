@@ -0,0 +1,222 @@
+"""
+Cache persistente dei checksum dei file.
+
+I checksum sono salvati nella tabella checksums dell'indice dello storage
+(permanent_storage/storage_index.db) con chiave (device, inode) e restano validi
+finché dimensione e mtime_ns del file non cambiano: una verifica completa
+ricalcola solo i file effettivamente modificati. Le voci più vecchie di
+CHECKSUM_MAX_AGE_DAYS vengono comunque ricalcolate, per intercettare la
+corruzione silenziosa del contenuto (che non modifica mtime).
+
+Algoritmi supportati (calcolati in un'unica lettura del file):
+- 'sha256': integrità del contenuto (blob store, verifiche)
+- 'md5': checksum storico dell'indice dello storage permanente
+- 'fast': hash non crittografico per rilevare le modifiche
+  (xxhash o BLAKE3 se disponibili, altrimenti blake2b)
+"""
+
+import os
+import hashlib
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from services.storage_index import get_connection, write_transaction
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# Algoritmo usato per l'hash veloce, in ordine di preferenza
+if xxhash is not None:
+    FAST_ALGORITHM = 'xxh3_128'
+elif blake3 is not None:
+    FAST_ALGORITHM = 'blake3'
+else:
+    FAST_ALGORITHM = 'blake2b'
+
+SUPPORTED_ALGORITHMS = ('sha256', 'md5', 'fast')
+
+# Età massima di una voce della cache prima del ricalcolo
+CHECKSUM_MAX_AGE_DAYS = 30
+
+# Dimensione dei blocchi di lettura
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+# Thread usati per i calcoli in parallelo (hashlib rilascia il GIL sui blocchi grandi)
+DEFAULT_CHECKSUM_WORKERS = min(8, (os.cpu_count() or 2) * 2)
+
+def _new_hasher(algorithm):
+    """Crea l'oggetto di hashing per un algoritmo."""
+    if algorithm == 'fast':
+        if FAST_ALGORITHM == 'xxh3_128':
+            return xxhash.xxh3_128()
+        if FAST_ALGORITHM == 'blake3':
+            return blake3.blake3()
+        return hashlib.blake2b(digest_size=16)
+    if algorithm in ('sha256', 'md5'):
+        return hashlib.new(algorithm)
+    raise ValueError(f"Algoritmo di checksum non supportato: {algorithm}")
+
+def _signed64(value):
+    """Converte device e inode (interi senza segno a 64 bit) nel range degli INTEGER SQLite."""
+    return value - 2 ** 64 if value >= 2 ** 63 else value
+
+def _signature(stat):
+    """Chiave e firma di un file: (device, inode, dimensione, mtime_ns)."""
+    return _signed64(stat.st_dev), _signed64(stat.st_ino), stat.st_size, stat.st_mtime_ns
+
+def _column(algorithm):
+    return 'fast_hash' if algorithm == 'fast' else algorithm
+
+def _cached(signature, algorithms):
+    """Restituisce i checksum validi presenti in cache per la firma indicata."""
+    device, inode, size, mtime_ns = signature
+    row = get_connection().execute(
+        'SELECT * FROM checksums WHERE device = ? AND inode = ?', (device, inode)
+    ).fetchone()
+    if row is None or row['size'] != size or row['mtime_ns'] != mtime_ns:
+        return {}
+
+    threshold = datetime.datetime.now() - datetime.timedelta(days=CHECKSUM_MAX_AGE_DAYS)
+    if not row['computed_at'] or row['computed_at'] < threshold.isoformat():
+        return {}
+
+    checksums = {}
+    for algorithm in algorithms:
+        if algorithm == 'fast' and row['fast_algorithm'] != FAST_ALGORITHM:
+            continue
+        if row[_column(algorithm)]:
+            checksums[algorithm] = row[_column(algorithm)]
+    return checksums
+
+def _store(path, signature, checksums, keep_existing):
+    """Salva i checksum calcolati nella cache."""
+    device, inode, size, mtime_ns = signature
+    values = {_column(algorithm): value for algorithm, value in checksums.items()}
+    if 'fast' in checksums:
+        values['fast_algorithm'] = FAST_ALGORITHM
+
+    with write_transaction() as conn:
+        # Un percorso ha una sola voce: quelle di file sostituiti (altro inode) vengono rimosse
+        conn.execute('DELETE FROM checksums WHERE path = ? AND NOT (device = ? AND inode = ?)',
+                     (path, device, inode))
+        if keep_existing:
+            assignments = ', '.join(f"{column} = ?" for column in values)
+            conn.execute(f"UPDATE checksums SET {assignments}, path = ? WHERE device = ? AND inode = ?",
+                         list(values.values()) + [path, device, inode])
+        else:
+            columns = ['device', 'inode', 'size', 'mtime_ns', 'path', 'computed_at'] + list(values)
+            conn.execute(
+                f"INSERT OR REPLACE INTO checksums ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' for _ in columns)})",
+                [device, inode, size, mtime_ns, path, datetime.datetime.now().isoformat()]
+                + list(values.values())
+            )
+
+def get_checksums(path, algorithms=('sha256',)):
+    """
+    Restituisce i checksum di un file, calcolando (in un'unica lettura) solo
+    quelli non presenti in cache o non più validi.
+
+    Args:
+        path: Percorso del file
+        algorithms: Algoritmi richiesti ('sha256', 'md5', 'fast')
+
+    Returns:
+        dict: Algoritmo -> digest esadecimale, o None se il file non è leggibile
+    """
+    try:
+        path = os.path.abspath(path)
+        signature = _signature(os.stat(path))
+    except OSError:
+        return None
+
+    try:
+        checksums = _cached(signature, algorithms)
+    except Exception as e:
+        logging.warning(f"Cache dei checksum non disponibile per {path}: {str(e)}")
+        checksums = {}
+
+    missing = [algorithm for algorithm in algorithms if algorithm not in checksums]
+    if not missing:
+        return checksums
+
+    hashers = {algorithm: _new_hasher(algorithm) for algorithm in missing}
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b''):
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+        after = _signature(os.stat(path))
+    except OSError as e:
+        logging.error(f"Errore durante il calcolo del checksum di {path}: {str(e)}")
+        return None
+
+    computed = {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+    checksums.update(computed)
+
+    # Un file modificato durante la lettura non viene messo in cache
+    if after == signature:
+        try:
+            _store(path, signature, computed, keep_existing=len(checksums) > len(computed))
+        except Exception as e:
+            logging.warning(f"Impossibile salvare il checksum di {path} in cache: {str(e)}")
+    return checksums
+
+def file_checksum(path, algorithm='sha256'):
+    """
+    Restituisce un singolo checksum di un file (dalla cache se valido).
+
+    Args:
+        path: Percorso del file
+        algorithm: 'sha256', 'md5' o 'fast'
+
+    Returns:
+        str: Digest esadecimale o None se il file non è leggibile
+    """
+    checksums = get_checksums(path, (algorithm,))
+    return checksums.get(algorithm) if checksums else None
+
+def compute_checksums(paths, algorithms=('sha256',), max_workers=DEFAULT_CHECKSUM_WORKERS):
+    """
+    Calcola i checksum di più file in parallelo; i file non modificati usano la cache.
+
+    Args:
+        paths: Percorsi dei file
+        algorithms: Algoritmi richiesti
+        max_workers: Numero di thread
+
+    Returns:
+        dict: Percorso -> checksum (come get_checksums)
+    """
+    paths = list(dict.fromkeys(paths))
+    if len(paths) <= 1 or max_workers <= 1:
+        return {path: get_checksums(path, algorithms) for path in paths}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(paths, executor.map(lambda path: get_checksums(path, algorithms), paths)))
+
+def remember_checksums(path, checksums):
+    """
+    Registra in cache checksum già noti (es. calcolati durante la scrittura del file).
+
+    Args:
+        path: Percorso del file appena scritto
+        checksums: Algoritmo -> digest esadecimale
+
+    Returns:
+        bool: True se la registrazione è riuscita
+    """
+    try:
+        path = os.path.abspath(path)
+        _store(path, _signature(os.stat(path)), checksums, keep_existing=False)
+        return True
+    except Exception as e:
+        logging.warning(f"Impossibile registrare il checksum di {path} in cache: {str(e)}")
+        return False
@@ -0,0 +1,293 @@
+"""
+Caricamento a blocchi riprendibile per file di grandi dimensioni (protocollo in stile tus).
+
+Il client crea una sessione dichiarando la dimensione totale, poi invia il file
+a blocchi con richieste PATCH che indicano l'offset di partenza (Upload-Offset)
+e, opzionalmente, il checksum del blocco (Upload-Checksum: sha256 <base64>).
+I blocchi vengono scritti direttamente nel file parziale della sessione, nella
+directory temporanea del blob store: una connessione interrotta fa perdere al
+massimo il blocco in corso e il client riprende dall'offset confermato.
+
+A caricamento completato il modulo di upload viene inviato con l'ID della
+sessione al posto del file e il documento viene creato dal percorso normale
+(upload_document): il file assemblato viene spostato nel blob store senza copie.
+
+Le sessioni inattive da più di UPLOAD_SESSION_EXPIRY_HOURS vengono eliminate
+dal job schedulato expire_upload_sessions insieme ai file parziali.
+"""
+
+import os
+import uuid
+import base64
+import hashlib
+import logging
+import datetime
+from app import db
+from models import UploadSession
+from services.blob_store import BLOB_TMP_DIR, ensure_blob_store
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Versione del protocollo tus implementata
+TUS_VERSION = '1.0.0'
+
+# Dimensione massima di un singolo blocco (PATCH)
+UPLOAD_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Dimensione dei blocchi letti dal corpo della richiesta
+UPLOAD_READ_SIZE = 1024 * 1024
+
+# Ore di inattività dopo cui una sessione abbandonata viene eliminata
+UPLOAD_SESSION_EXPIRY_HOURS = 24
+
+# Intervallo del job di pulizia delle sessioni scadute
+UPLOAD_CLEANUP_INTERVAL_HOURS = 1
+
+# Algoritmi accettati per i checksum dei blocchi (estensione checksum di tus)
+CHECKSUM_ALGORITHMS = ('sha256', 'sha1', 'md5')
+
+def _part_path(upload_id):
+    """Percorso del file parziale di una sessione."""
+    return os.path.join(BLOB_TMP_DIR, f"upload-{upload_id}.part")
+
+def expires_at(upload):
+    """Momento in cui la sessione scade se non riceve altri blocchi."""
+    return (upload.updated_at or upload.created_at) + datetime.timedelta(hours=UPLOAD_SESSION_EXPIRY_HOURS)
+
+def parse_metadata(header):
+    """
+    Decodifica l'intestazione Upload-Metadata (coppie "chiave valore-base64" separate da virgole).
+
+    Returns:
+        dict: Metadati decodificati
+    """
+    metadata = {}
+    for pair in (header or '').split(','):
+        parts = pair.strip().split(' ', 1)
+        if not parts[0]:
+            continue
+        try:
+            metadata[parts[0]] = base64.b64decode(parts[1]).decode('utf-8') if len(parts) > 1 else ''
+        except (ValueError, UnicodeDecodeError):
+            metadata[parts[0]] = ''
+    return metadata
+
+def create_upload_session(user_id, filename, upload_length):
+    """
+    Crea una sessione di caricamento e il relativo file parziale vuoto.
+
+    Args:
+        user_id: ID dell'utente che carica il file
+        filename: Nome originale del file
+        upload_length: Dimensione totale del file in byte
+
+    Returns:
+        UploadSession: La sessione creata
+    """
+    ensure_blob_store()
+    upload_id = str(uuid.uuid4())
+    file_path = _part_path(upload_id)
+    open(file_path, 'wb').close()
+
+    upload = UploadSession(
+        id=upload_id,
+        user_id=user_id,
+        filename=filename,
+        upload_length=upload_length,
+        upload_offset=0,
+        file_path=file_path
+    )
+    db.session.add(upload)
+    db.session.commit()
+
+    logging.info(f"Sessione di caricamento {upload_id} creata: {filename} ({upload_length} byte)")
+    return upload
+
+def get_upload_session(upload_id, user_id):
+    """
+    Restituisce una sessione di caricamento dell'utente, se esiste e non è scaduta.
+
+    Args:
+        upload_id: ID della sessione
+        user_id: ID dell'utente proprietario
+
+    Returns:
+        UploadSession: La sessione o None
+    """
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None or upload.user_id != user_id:
+        return None
+    if expires_at(upload) < datetime.datetime.utcnow():
+        return None
+    return upload
+
+def append_chunk(upload, offset, stream, content_length=None, checksum=None):
+    """
+    Scrive un blocco nel file parziale della sessione a partire dall'offset indicato.
+
+    Senza checksum, i byte ricevuti prima di un'interruzione vengono conservati
+    (il client riprende da lì); con il checksum un blocco incompleto o non
+    corrispondente viene scartato per intero.
+
+    Args:
+        upload: Sessione di caricamento
+        offset: Offset dichiarato dal client (deve coincidere con quello confermato)
+        stream: Corpo della richiesta
+        content_length: Dimensione dichiarata del blocco (opzionale)
+        checksum: Valore di Upload-Checksum ("algoritmo digest-base64", opzionale)
+
+    Returns:
+        dict: {'status': 'ok'|'offset_mismatch'|'too_large'|'bad_checksum'|'checksum_mismatch'|'locked'|'error',
+               'offset': offset confermato, 'message': descrizione dell'errore}
+    """
+    if offset != upload.upload_offset:
+        return {'status': 'offset_mismatch', 'offset': upload.upload_offset,
+                'message': f"Offset {offset} non valido, atteso {upload.upload_offset}"}
+
+    remaining = upload.upload_length - offset
+    if content_length is not None and (content_length > UPLOAD_MAX_CHUNK_SIZE or content_length > remaining):
+        return {'status': 'too_large', 'offset': offset,
+                'message': f"Blocco troppo grande: massimo {min(UPLOAD_MAX_CHUNK_SIZE, remaining)} byte"}
+
+    hasher = expected = None
+    if checksum:
+        algorithm, _, digest = checksum.partition(' ')
+        if algorithm not in CHECKSUM_ALGORITHMS:
+            return {'status': 'bad_checksum', 'offset': offset,
+                    'message': f"Algoritmo di checksum non supportato: {algorithm}"}
+        try:
+            expected = base64.b64decode(digest.strip(), validate=True)
+        except ValueError:
+            return {'status': 'bad_checksum', 'offset': offset, 'message': "Checksum non valido"}
+        hasher = hashlib.new(algorithm)
+
+    limit = min(UPLOAD_MAX_CHUNK_SIZE, remaining)
+    written = 0
+    interrupted = None
+
+    with open(upload.file_path, 'r+b') as f:
+        # Un solo blocco alla volta per sessione, anche tra worker diversi
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return {'status': 'locked', 'offset': offset,
+                        'message': "Un altro blocco di questa sessione è in corso di scrittura"}
+
+        # L'offset può essere avanzato da un'altra richiesta mentre attendevamo
+        db.session.refresh(upload)
+        if offset != upload.upload_offset:
+            return {'status': 'offset_mismatch', 'offset': upload.upload_offset,
+                    'message': f"Offset {offset} non valido, atteso {upload.upload_offset}"}
+
+        f.seek(offset)
+        f.truncate()
+        try:
+            while written <= limit:
+                data = stream.read(min(UPLOAD_READ_SIZE, limit - written + 1))
+                if not data:
+                    break
+                if written + len(data) > limit:
+                    f.truncate(offset)
+                    return {'status': 'too_large', 'offset': offset,
+                            'message': f"Blocco troppo grande: massimo {limit} byte"}
+                f.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+                written += len(data)
+        except Exception as e:
+            # Connessione interrotta durante il blocco
+            interrupted = e
+
+        if hasher is not None and (interrupted is not None or hasher.digest() != expected):
+            f.truncate(offset)
+            if interrupted is not None:
+                logging.warning(f"Sessione di caricamento {upload.id}: blocco interrotto e scartato: {str(interrupted)}")
+                return {'status': 'error', 'offset': offset, 'message': "Blocco interrotto"}
+            return {'status': 'checksum_mismatch', 'offset': offset,
+                    'message': "Il checksum del blocco non corrisponde"}
+
+        f.flush()
+        os.fsync(f.fileno())
+        upload.upload_offset = offset + written
+        upload.updated_at = datetime.datetime.utcnow()
+        db.session.commit()
+
+    if interrupted is not None:
+        logging.warning(f"Sessione di caricamento {upload.id}: blocco interrotto dopo {written} byte: {str(interrupted)}")
+        return {'status': 'error', 'offset': upload.upload_offset, 'message': "Blocco interrotto"}
+    return {'status': 'ok', 'offset': upload.upload_offset}
+
+def finalize_upload_session(upload, owner_id):
+    """
+    Sposta il file assemblato nel blob store e chiude la sessione.
+
+    La rimozione della sessione viene salvata con la commit del chiamante,
+    insieme al documento creato.
+
+    Args:
+        upload: Sessione di caricamento completata
+        owner_id: ID dell'utente proprietario del documento
+
+    Returns:
+        dict: Metadati del file salvato (come save_document) o None in caso di errore
+    """
+    from services.simple_document_storage import save_assembled_document
+
+    if not upload.is_complete:
+        return None
+
+    document_data = save_assembled_document(upload.file_path, upload.filename, owner_id)
+    if document_data is not None:
+        db.session.delete(upload)
+    return document_data
+
+def delete_upload_session(upload):
+    """Annulla una sessione di caricamento ed elimina il file parziale."""
+    if os.path.exists(upload.file_path):
+        os.remove(upload.file_path)
+    db.session.delete(upload)
+    db.session.commit()
+    logging.info(f"Sessione di caricamento {upload.id} annullata")
+
+def expire_upload_sessions(expiry_hours=UPLOAD_SESSION_EXPIRY_HOURS):
+    """
+    Elimina le sessioni di caricamento abbandonate e i file parziali rimasti senza sessione.
+
+    Args:
+        expiry_hours: Ore di inattività dopo cui una sessione è considerata abbandonata
+
+    Returns:
+        dict: Numero di sessioni eliminate e byte liberati
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=expiry_hours)
+    report = {'expired': 0, 'bytes_freed': 0}
+
+    for upload in UploadSession.query.filter(UploadSession.updated_at < cutoff).all():
+        if os.path.exists(upload.file_path):
+            report['bytes_freed'] += os.path.getsize(upload.file_path)
+            os.remove(upload.file_path)
+        db.session.delete(upload)
+        report['expired'] += 1
+    db.session.commit()
+
+    # File parziali la cui sessione non esiste più (ad esempio dopo un errore in fase di creazione)
+    if os.path.isdir(BLOB_TMP_DIR):
+        active = {upload_id for (upload_id,) in db.session.query(UploadSession.id)}
+        for entry in os.scandir(BLOB_TMP_DIR):
+            if not (entry.name.startswith('upload-') and entry.name.endswith('.part')):
+                continue
+            if entry.name[len('upload-'):-len('.part')] in active:
+                continue
+            st = entry.stat()
+            if datetime.datetime.utcfromtimestamp(st.st_mtime) < cutoff:
+                report['bytes_freed'] += st.st_size
+                os.remove(entry.path)
+
+    if report['expired']:
+        logging.info(f"Sessioni di caricamento scadute eliminate: {report['expired']} "
+                     f"({report['bytes_freed'] / (1024 * 1024):.1f} MB liberati)")
+    return report
@@ -0,0 +1,151 @@
+"""
+Compressione trasparente dei file nello storage.
+
+Un file compresso viene salvato accanto al percorso originale con il suffisso
+del codec (<percorso>.zst o <percorso>.gz) e il percorso originale scompare:
+i backend di storage (services/storage_backend.py) riconoscono la variante
+compressa e la decomprimono al volo in lettura, senza file temporanei.
+
+Usa zstd se il pacchetto zstandard è disponibile, altrimenti gzip.
+"""
+
+import os
+import gzip
+import struct
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Suffisso dei file compressi per ogni codec
+COMPRESSED_SUFFIXES = {
+    'zstd': '.zst',
+    'gzip': '.gz',
+    'delta': '.delta'  # Versioni precedenti come delta binari (services/delta_store.py)
+}
+
+# Livelli di compressione (lo storage freddo privilegia il rapporto di compressione)
+ZSTD_LEVEL = 19
+GZIP_LEVEL = 9
+
+# Dimensione dei blocchi per la compressione in streaming
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+
+def default_codec():
+    """Codec usato per le nuove compressioni: zstd se disponibile, altrimenti gzip."""
+    return 'zstd' if zstandard is not None else 'gzip'
+
+def compressed_variant(path):
+    """
+    Cerca la variante compressa di un file.
+
+    Args:
+        path: Percorso del file non compresso
+
+    Returns:
+        tuple: (percorso compresso, codec) o None se non esiste
+    """
+    for codec, suffix in COMPRESSED_SUFFIXES.items():
+        candidate = path + suffix
+        if os.path.isfile(candidate):
+            return candidate, codec
+    return None
+
+def compress_file(src, dst, codec):
+    """
+    Comprime un file in streaming.
+
+    Args:
+        src: Percorso del file da comprimere
+        dst: Percorso del file compresso
+        codec: 'zstd' o 'gzip'
+
+    Returns:
+        int: Dimensione del file compresso
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if codec == 'zstd':
+            if zstandard is None:
+                raise RuntimeError("Il codec zstd richiede il pacchetto zstandard")
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, write_content_size=True)
+            compressor.copy_stream(fsrc, fdst, size=os.path.getsize(src),
+                                   read_size=COMPRESSION_CHUNK_SIZE, write_size=COMPRESSION_CHUNK_SIZE)
+        elif codec == 'gzip':
+            with gzip.GzipFile(fileobj=fdst, mode='wb', compresslevel=GZIP_LEVEL, mtime=0) as gz:
+                while True:
+                    chunk = fsrc.read(COMPRESSION_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    gz.write(chunk)
+        else:
+            raise ValueError(f"Codec non supportato: {codec}")
+    return os.path.getsize(dst)
+
+def open_decompressed(path, codec):
+    """
+    Apre un file compresso restituendo uno stream del contenuto decompresso.
+
+    Args:
+        path: Percorso del file compresso
+        codec: 'zstd' o 'gzip'
+
+    Returns:
+        Oggetto file in lettura (metodi read e close)
+    """
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Il codec zstd richiede il pacchetto zstandard")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    if codec == 'gzip':
+        return gzip.open(path, 'rb')
+    if codec == 'delta':
+        from services.delta_store import open_delta
+        return open_delta(path)
+    raise ValueError(f"Codec non supportato: {codec}")
+
+def original_size(path, codec):
+    """
+    Legge la dimensione del contenuto decompresso dall'intestazione del file compresso.
+
+    Args:
+        path: Percorso del file compresso
+        codec: 'zstd' o 'gzip'
+
+    Returns:
+        int: Dimensione originale o None se non registrata nel file
+    """
+    try:
+        with open(path, 'rb') as f:
+            if codec == 'zstd' and zstandard is not None:
+                size = zstandard.frame_content_size(f.read(18))
+                return size if size >= 0 else None
+            if codec == 'delta':
+                from services.delta_store import read_delta_header
+                return read_delta_header(path)[1]
+            if codec == 'gzip':
+                # ISIZE: dimensione originale modulo 2^32, negli ultimi 4 byte
+                f.seek(-4, os.SEEK_END)
+                return struct.unpack('<I', f.read(4))[0]
+    except Exception as e:
+        logging.warning(f"Impossibile leggere la dimensione originale di {path}: {str(e)}")
+    return None
+
+def decompress_file(path, codec, dst):
+    """
+    Ripristina la versione non compressa di un file.
+
+    Args:
+        path: Percorso del file compresso
+        codec: 'zstd' o 'gzip'
+        dst: Percorso del file decompresso
+    """
+    temp_path = f"{dst}.part"
+    with open_decompressed(path, codec) as fsrc, open(temp_path, 'wb') as fdst:
+        while True:
+            chunk = fsrc.read(COMPRESSION_CHUNK_SIZE)
+            if not chunk:
+                break
+            fdst.write(chunk)
+    os.replace(temp_path, dst)
@@ -0,0 +1,221 @@
+"""
+Compressione in background dei blob poco usati (storage freddo).
+
+Un blob è considerato freddo quando nessun documento o versione che lo usa è
+stato modificato, creato o consultato (ActivityLog) negli ultimi
+COLD_AFTER_DAYS giorni. Il job comprime i blob freddi con zstd (o gzip) e
+mantiene la compressione solo se fa risparmiare almeno MIN_COMPRESSION_SAVING
+dello spazio; per ogni blob registra dimensione compressa e tempo CPU, da cui
+get_compression_report ricava rapporto di compressione e costo per tipo di file.
+
+La lettura resta trasparente: i backend di storage decomprimono al volo.
+"""
+
+import os
+import time
+import logging
+import datetime
+from sqlalchemy import func, case
+from sqlalchemy.orm import aliased
+from app import db
+from models import StorageBlob, Document, DocumentVersion, ActivityLog
+from services.compression import COMPRESSED_SUFFIXES, compress_file, default_codec
+from services.location_index import record_location, remove_location
+
+# Giorni senza modifiche né accessi dopo i quali un blob viene compresso
+COLD_AFTER_DAYS = 90
+
+# Blob elaborati per ogni esecuzione del job
+COMPRESSION_BATCH_SIZE = 200
+
+# Frazione minima di spazio risparmiato perché la compressione venga mantenuta
+MIN_COMPRESSION_SAVING = 0.10
+
+# I file più piccoli non vengono compressi (risparmio trascurabile)
+MIN_COMPRESSIBLE_SIZE = 4096
+
+# gzip registra la dimensione originale modulo 2^32: oltre questo limite serve zstd
+GZIP_MAX_SIZE = 2 ** 32 - 1
+
+# Intervallo del job dello scheduler
+COMPRESSION_INTERVAL_HOURS = 24
+
+def find_cold_blobs(cutoff, limit=COMPRESSION_BATCH_SIZE):
+    """
+    Restituisce i blob non ancora valutati e non usati dopo la data indicata.
+
+    Args:
+        cutoff: Data oltre la quale un uso rende il blob "caldo"
+        limit: Numero massimo di blob
+
+    Returns:
+        list: Righe StorageBlob da comprimere, le meno recenti per prime
+    """
+    recently_updated = db.session.query(Document.content_hash).filter(
+        Document.content_hash.isnot(None),
+        Document.updated_at >= cutoff
+    )
+    recently_accessed = db.session.query(Document.content_hash).join(
+        ActivityLog, ActivityLog.document_id == Document.id
+    ).filter(
+        Document.content_hash.isnot(None),
+        ActivityLog.created_at >= cutoff
+    )
+    recent_versions = db.session.query(DocumentVersion.content_hash).filter(
+        DocumentVersion.content_hash.isnot(None),
+        DocumentVersion.created_at >= cutoff
+    )
+    # Le basi dei delta restano non compresse: la ricostruzione richiede accesso casuale
+    delta_base = aliased(StorageBlob)
+    delta_bases = db.session.query(delta_base.delta_base_hash).filter(delta_base.delta_base_hash.isnot(None))
+
+    return StorageBlob.query.filter(
+        StorageBlob.compression.is_(None),
+        StorageBlob.ref_count > 0,
+        StorageBlob.file_size >= MIN_COMPRESSIBLE_SIZE,
+        StorageBlob.created_at < cutoff,
+        StorageBlob.last_referenced_at < cutoff,
+        ~StorageBlob.content_hash.in_(recently_updated),
+        ~StorageBlob.content_hash.in_(recently_accessed),
+        ~StorageBlob.content_hash.in_(recent_versions),
+        ~StorageBlob.content_hash.in_(delta_bases)
+    ).order_by(StorageBlob.last_referenced_at).limit(limit).all()
+
+def compress_blob(blob, codec=None):
+    """
+    Comprime il file di un blob e aggiorna la riga StorageBlob.
+
+    Args:
+        blob: Riga StorageBlob
+        codec: 'zstd' o 'gzip' (default: il migliore disponibile)
+
+    Returns:
+        str: Codec applicato, 'none' se la compressione non conviene, None se il file non è su disco
+    """
+    path = blob.file_path
+    if not os.path.isfile(path):
+        return None
+
+    codec = codec or default_codec()
+    now = datetime.datetime.utcnow()
+    if codec == 'gzip' and blob.file_size > GZIP_MAX_SIZE:
+        blob.compression = 'none'
+        blob.stored_size = blob.file_size
+        blob.compressed_at = now
+        return 'none'
+
+    compressed_path = path + COMPRESSED_SUFFIXES[codec]
+    temp_path = f"{compressed_path}.part"
+
+    started = time.process_time()
+    try:
+        stored_size = compress_file(path, temp_path, codec)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    cpu_ms = (time.process_time() - started) * 1000
+
+    blob.compression_cpu_ms = cpu_ms
+    blob.compressed_at = now
+
+    if stored_size > blob.file_size * (1 - MIN_COMPRESSION_SAVING):
+        # Contenuto già compresso (JPEG, ZIP, DOCX...): si mantiene il file originale
+        os.remove(temp_path)
+        blob.compression = 'none'
+        blob.stored_size = blob.file_size
+        return 'none'
+
+    os.replace(temp_path, compressed_path)
+    os.remove(path)
+    remove_location(path)
+    record_location(compressed_path, content_hash=blob.content_hash, size=stored_size)
+
+    blob.compression = codec
+    blob.stored_size = stored_size
+    return codec
+
+def run_compression_tier(limit=COMPRESSION_BATCH_SIZE, cold_after_days=COLD_AFTER_DAYS, codec=None):
+    """
+    Comprime un blocco di blob freddi.
+
+    Args:
+        limit: Numero massimo di blob da elaborare
+        cold_after_days: Giorni senza uso dopo i quali un blob è freddo
+        codec: Codec da usare (default: zstd se disponibile, altrimenti gzip)
+
+    Returns:
+        dict: Statistiche dell'esecuzione
+    """
+    stats = {
+        'processed': 0,
+        'compressed': 0,
+        'not_worth_it': 0,
+        'bytes_before': 0,
+        'bytes_after': 0,
+        'errors': []
+    }
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=cold_after_days)
+    for blob in find_cold_blobs(cutoff, limit):
+        try:
+            result = compress_blob(blob, codec)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            error_msg = f"Errore durante la compressione del blob {blob.content_hash}: {str(e)}"
+            stats['errors'].append(error_msg)
+            logging.error(error_msg)
+            continue
+
+        if result is None:
+            continue
+        stats['processed'] += 1
+        if result == 'none':
+            stats['not_worth_it'] += 1
+        else:
+            stats['compressed'] += 1
+            stats['bytes_before'] += blob.file_size
+            stats['bytes_after'] += blob.stored_size
+
+    logging.info(f"Compressione storage freddo: {stats['compressed']} blob compressi, "
+                 f"{stats['bytes_before'] - stats['bytes_after']} byte risparmiati")
+    return stats
+
+def get_compression_report():
+    """
+    Rapporto di compressione e costo CPU per tipo di file (tipo MIME del blob).
+
+    Returns:
+        list: Una voce per tipo con blob valutati, compressi, byte prima/dopo,
+              rapporto di compressione e millisecondi CPU per MB
+    """
+    rows = db.session.query(
+        StorageBlob.mime_type,
+        func.count(StorageBlob.content_hash),
+        func.sum(case((StorageBlob.compression != 'none', 1), else_=0)),
+        func.sum(StorageBlob.file_size),
+        func.sum(StorageBlob.stored_size),
+        func.sum(StorageBlob.compression_cpu_ms)
+    ).filter(
+        StorageBlob.compression.isnot(None),
+        StorageBlob.compression != 'delta'
+    ).group_by(StorageBlob.mime_type).all()
+
+    report = []
+    for mime_type, evaluated, compressed, original_bytes, stored_bytes, cpu_ms in rows:
+        original_bytes = int(original_bytes or 0)
+        stored_bytes = int(stored_bytes or 0)
+        megabytes = original_bytes / (1024 * 1024)
+        report.append({
+            'file_type': mime_type or 'sconosciuto',
+            'evaluated': evaluated,
+            'compressed': int(compressed or 0),
+            'original_bytes': original_bytes,
+            'stored_bytes': stored_bytes,
+            'ratio': round(original_bytes / stored_bytes, 2) if stored_bytes else None,
+            'cpu_ms_per_mb': round((cpu_ms or 0) / megabytes, 1) if megabytes else None
+        })
+
+    report.sort(key=lambda item: item['original_bytes'] - item['stored_bytes'], reverse=True)
+    return report
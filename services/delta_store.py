@@ -0,0 +1,546 @@
+"""
+Archiviazione delle versioni precedenti dei documenti come delta binari.
+
+Il contenuto corrente di un documento resta sempre completo. Quando arriva una
+nuova versione, il blob della versione precedente viene sostituito da un delta
+rispetto al contenuto più recente (delta inverso, come nei sistemi di controllo
+di versione): il file <blob>.delta contiene solo le istruzioni per ricostruirlo,
+cioè copie di intervalli del blob di base e dati letterali compressi con zlib.
+
+Il delta è una variante del blob come quelle compresse (services/compression.py):
+i backend di storage lo ricostruiscono al volo in lettura, in streaming e con
+accesso casuale (Range), senza file temporanei. Il blob delta mantiene un
+riferimento sul blob di base (StorageBlob.delta_base_hash), che quindi non può
+essere eliminato finché un delta dipende da esso.
+
+La catena di delta da applicare per ricostruire una versione è limitata a
+MAX_DELTA_CHAIN: oltre il limite la versione resta completa e fa da nuovo punto
+di partenza per le versioni più vecchie.
+
+Formato del file .delta:
+    intestazione: DELTA_MAGIC, SHA-256 del blob di base (64 byte ASCII),
+                  dimensione ricostruita (uint64), numero di operazioni (uint32)
+    operazioni:   b'C' offset nella base (uint64), lunghezza (uint64)
+                  b'I' lunghezza (uint64), lunghezza compressa (uint32), dati zlib
+"""
+
+import io
+import os
+import zlib
+import bisect
+import struct
+import hashlib
+import uuid
+import logging
+from sqlalchemy import or_
+from app import db
+from models import StorageBlob, Document, DocumentVersion
+from services.blob_store import get_blob_path, release_blob
+from services.location_index import record_location, remove_location
+
+# Identificativo del formato dei file delta
+DELTA_MAGIC = b'DMSDLT01'
+
+# Estensione dei file delta (variante del blob, come .zst e .gz)
+DELTA_SUFFIX = '.delta'
+
+# Numero massimo di delta da applicare per ricostruire una versione
+MAX_DELTA_CHAIN = 8
+
+# Dimensione dei blocchi confrontati tra la versione e la base
+DELTA_BLOCK_SIZE = 16 * 1024
+
+# I file più grandi non vengono codificati (la codifica li tiene in memoria)
+DELTA_MAX_FILE_SIZE = 256 * 1024 * 1024
+
+# I file più piccoli non vengono codificati (risparmio trascurabile)
+DELTA_MIN_FILE_SIZE = 64 * 1024
+
+# Frazione minima di spazio risparmiato perché il delta venga mantenuto
+MIN_DELTA_SAVING = 0.25
+
+# Dimensione massima di un blocco di dati letterali (granularità dell'accesso casuale)
+LITERAL_CHUNK_SIZE = 1024 * 1024
+
+# Risincronizzazione dopo una differenza: blocchi della base cercati e distanza massima
+RESYNC_CANDIDATES = 8
+RESYNC_WINDOW = 8 * 1024 * 1024
+RESYNC_PROBE_SIZE = 32
+RESYNC_MAX_PROBES = 64
+
+_HEADER = struct.Struct('<8s64sQI')
+_COPY = struct.Struct('<QQ')
+_INSERT = struct.Struct('<QI')
+
+def _block_key(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def compute_delta(target, base, block_size=DELTA_BLOCK_SIZE, max_literal=None):
+    """
+    Calcola le operazioni che ricostruiscono target a partire da base.
+
+    I blocchi allineati di base vengono indicizzati per hash e target viene
+    percorso a blocchi. Dopo una differenza la corrispondenza viene ritrovata
+    cercando i byte correnti di target nella base (prima vicino alla posizione
+    attesa, poi in tutto il file) oppure cercando in target i blocchi della base
+    successivi all'ultima copia: si gestiscono così modifiche, inserimenti,
+    eliminazioni e spostamenti di dati. Le ricerche avvengono con bytes.find,
+    senza scorrere il contenuto byte per byte in Python.
+
+    Args:
+        target: Contenuto da codificare (bytes)
+        base: Contenuto di riferimento (bytes)
+        block_size: Dimensione dei blocchi confrontati
+        max_literal: Byte letterali oltre i quali la codifica viene abbandonata
+
+    Returns:
+        list: Operazioni ('C', offset nella base, lunghezza) e ('I', dati letterali),
+              o None se i dati letterali superano max_literal
+    """
+    blocks = {}
+    for k in range(len(base) // block_size):
+        blocks.setdefault(_block_key(base[k * block_size:(k + 1) * block_size]), k)
+
+    n = len(target)
+    ops = []
+    literal_start = 0
+    literal_total = 0
+    expected = 0  # Offset nella base in cui dovrebbe proseguire l'ultima copia
+    located = {}  # Blocco della base -> (posizione in target, limite già esplorato)
+    search_from = 0  # Ricerche nella base rimandate fino a questa posizione di target
+    search_backoff = block_size
+
+    def block_at(k):
+        return base[k * block_size:(k + 1) * block_size]
+
+    def matches(p, b):
+        return target[p:p + block_size] == base[b:b + block_size]
+
+    def find_in_base(p, start, stop):
+        """Offset della base in cui compaiono i byte di target da p, cercando in [start, stop)."""
+        probe = target[p:p + RESYNC_PROBE_SIZE]
+        position = max(0, start)
+        for _ in range(RESYNC_MAX_PROBES):
+            position = base.find(probe, position, stop)
+            if position < 0:
+                return None
+            if matches(p, position):
+                return position
+            position += 1
+        return None
+
+    def locate(k, start):
+        """Prima posizione >= start in cui il blocco k della base compare in target."""
+        cached = located.get(k)
+        if cached is not None and (cached[0] >= start or cached[1] + RESYNC_WINDOW >= start):
+            return cached[0] if cached[0] >= start else None
+        block = block_at(k)
+        probe = block[:RESYNC_PROBE_SIZE]
+        limit = min(n, start + RESYNC_WINDOW + block_size)
+        position = start
+        for _ in range(RESYNC_MAX_PROBES):
+            position = target.find(probe, position, limit)
+            if position < 0:
+                break
+            if target[position:position + block_size] == block:
+                located[k] = (position, position)
+                return position
+            position += 1
+        located[k] = (-1, start)
+        return None
+
+    def emit_literal(end):
+        for offset in range(literal_start, end, LITERAL_CHUNK_SIZE):
+            ops.append(('I', target[offset:min(end, offset + LITERAL_CHUNK_SIZE)]))
+
+    p = 0
+    while p + block_size <= n:
+        window = target[p:p + block_size]
+        k = blocks.get(_block_key(window))
+        base_offset = k * block_size if k is not None and block_at(k) == window else None
+
+        # Differenza: i byte correnti compaiono nella base vicino alla posizione attesa
+        # o altrove (dati spostati)? Se non si trovano, le ricerche diventano sempre più rade
+        if base_offset is None and p >= search_from:
+            base_offset = find_in_base(p, expected - RESYNC_WINDOW, expected + RESYNC_WINDOW + block_size)
+            if base_offset is None:
+                base_offset = find_in_base(p, 0, len(base))
+            if base_offset is None:
+                search_from = p + search_backoff
+                search_backoff *= 2
+
+        if base_offset is not None:
+            search_backoff = block_size
+            length = block_size
+            # Estende la copia a blocchi e poi a intervalli sempre più piccoli
+            step = block_size
+            while step:
+                while (p + length + step <= n and base_offset + length + step <= len(base) and
+                       target[p + length:p + length + step] == base[base_offset + length:base_offset + length + step]):
+                    length += step
+                step //= 2
+            emit_literal(p)
+            if ops and ops[-1][0] == 'C' and ops[-1][1] + ops[-1][2] == base_offset:
+                ops[-1] = ('C', ops[-1][1], ops[-1][2] + length)
+            else:
+                ops.append(('C', base_offset, length))
+            p += length
+            literal_start = p
+            expected = base_offset + length
+            continue
+
+        # ...oppure cerca in target dove riprendono i blocchi della base successivi all'ultima copia
+        next_block = -(-expected // block_size)
+        candidates = [next_block + i for i in range(RESYNC_CANDIDATES) if (next_block + i + 1) * block_size <= len(base)]
+        positions = [q for q in (locate(k, p + 1) for k in candidates) if q is not None]
+        advance = min(positions) if positions else p + block_size
+        literal_total += advance - p
+        p = advance
+        if max_literal is not None and literal_total > max_literal:
+            return None
+
+    emit_literal(n)
+    return ops
+
+def write_delta(path, ops, base_hash, target_size):
+    """
+    Scrive un file delta.
+
+    Returns:
+        int: Dimensione del file scritto
+    """
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(DELTA_MAGIC, base_hash.encode('ascii'), target_size, len(ops)))
+        for op in ops:
+            if op[0] == 'C':
+                f.write(b'C' + _COPY.pack(op[1], op[2]))
+            else:
+                data = zlib.compress(op[1], 6)
+                f.write(b'I' + _INSERT.pack(len(op[1]), len(data)) + data)
+    return os.path.getsize(path)
+
+def read_delta_header(path):
+    """
+    Legge l'intestazione di un file delta.
+
+    Returns:
+        tuple: (SHA-256 del blob di base, dimensione ricostruita)
+    """
+    with open(path, 'rb') as f:
+        magic, base_hash, target_size, _ = _HEADER.unpack(f.read(_HEADER.size))
+    if magic != DELTA_MAGIC:
+        raise ValueError(f"File delta non valido: {path}")
+    return base_hash.decode('ascii'), target_size
+
+def open_blob_file(path):
+    """
+    Apre in lettura il contenuto di un blob, qualunque sia la sua forma su disco
+    (file completo, variante compressa o delta).
+
+    Returns:
+        Oggetto file in lettura
+    """
+    from services.compression import compressed_variant, open_decompressed
+
+    if os.path.isfile(path):
+        return open(path, 'rb')
+    variant = compressed_variant(path)
+    if variant is None:
+        raise FileNotFoundError(path)
+    return open_decompressed(*variant)
+
+class DeltaReader(io.RawIOBase):
+    """Ricostruisce al volo il contenuto di un file delta, con accesso casuale."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.file = open(path, 'rb')
+        magic, base_hash, self.size, count = _HEADER.unpack(self.file.read(_HEADER.size))
+        if magic != DELTA_MAGIC:
+            self.file.close()
+            raise ValueError(f"File delta non valido: {path}")
+
+        # Indice delle operazioni: offset ricostruito -> (tipo, argomento, lunghezza)
+        self.offsets = []
+        self.ops = []
+        position = 0
+        for _ in range(count):
+            kind = self.file.read(1)
+            if kind == b'C':
+                base_offset, length = _COPY.unpack(self.file.read(_COPY.size))
+                self.ops.append(('C', base_offset, length))
+            else:
+                length, compressed_length = _INSERT.unpack(self.file.read(_INSERT.size))
+                self.ops.append(('I', (self.file.tell(), compressed_length), length))
+                self.file.seek(compressed_length, os.SEEK_CUR)
+            self.offsets.append(position)
+            position += length
+        if position != self.size:
+            self.file.close()
+            raise ValueError(f"File delta incoerente: {path}")
+
+        self.base = open_blob_file(get_blob_path(base_hash.decode('ascii')))
+        if not self.base.seekable():
+            self.base.close()
+            self.file.close()
+            raise ValueError(f"Il blob di base del delta {path} non consente l'accesso casuale")
+        self.position = 0
+        self.literal = (None, b'')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or not len(buffer):
+            return 0
+        index = bisect.bisect_right(self.offsets, self.position) - 1
+        kind, argument, length = self.ops[index]
+        start = self.position - self.offsets[index]
+        count = min(len(buffer), length - start)
+
+        if kind == 'C':
+            self.base.seek(argument + start)
+            data = self.base.read(count)
+            if len(data) != count:
+                raise IOError("Blob di base del delta troncato")
+        else:
+            # Ultimo blocco letterale decompresso tenuto in memoria (letture sequenziali)
+            if self.literal[0] != index:
+                self.file.seek(argument[0])
+                self.literal = (index, zlib.decompress(self.file.read(argument[1])))
+            data = self.literal[1][start:start + count]
+
+        buffer[:count] = data
+        self.position += count
+        return count
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+            self.base.close()
+        super().close()
+
+def open_delta(path):
+    """Apre un file delta restituendo uno stream (bufferizzato) del contenuto ricostruito."""
+    return io.BufferedReader(DeltaReader(path), buffer_size=256 * 1024)
+
+def chain_length(blob):
+    """Numero di delta da applicare per ricostruire il blob (0 se completo)."""
+    length = 0
+    while blob is not None and blob.delta_base_hash and length <= MAX_DELTA_CHAIN:
+        length += 1
+        blob = db.session.get(StorageBlob, blob.delta_base_hash)
+    return length
+
+def _dependent_depth(content_hash):
+    """Lunghezza massima delle catene di delta che passano per il blob indicato."""
+    depth = 0
+    level = [content_hash]
+    while level and depth <= MAX_DELTA_CHAIN:
+        level = [h for (h,) in db.session.query(StorageBlob.content_hash).filter(
+            StorageBlob.delta_base_hash.in_(level))]
+        if level:
+            depth += 1
+    return depth
+
+def deltify_blob(content_hash, base_hash):
+    """
+    Sostituisce un blob completo con un delta rispetto a un altro blob, se conviene.
+
+    Il blob non viene codificato se è il contenuto corrente di un documento, se è
+    già compresso o codificato, se il delta allungherebbe una catena oltre
+    MAX_DELTA_CHAIN o se il risparmio è inferiore a MIN_DELTA_SAVING.
+
+    Il delta viene registrato nel database con un commit (che include le altre
+    modifiche in sospeso della sessione) prima di eliminare il file completo.
+
+    Args:
+        content_hash: Blob da codificare (versione precedente)
+        base_hash: Blob di riferimento (versione successiva)
+
+    Returns:
+        str: 'delta', 'skipped' o 'not_worth_it'
+    """
+    if not content_hash or not base_hash or content_hash == base_hash:
+        return 'skipped'
+
+    blob = db.session.get(StorageBlob, content_hash)
+    base = db.session.get(StorageBlob, base_hash)
+    if blob is None or base is None or blob.compression not in (None, 'none') or blob.delta_base_hash:
+        return 'skipped'
+    if not (DELTA_MIN_FILE_SIZE <= blob.file_size <= DELTA_MAX_FILE_SIZE) or base.file_size > DELTA_MAX_FILE_SIZE:
+        return 'skipped'
+    if not os.path.isfile(blob.file_path) or not os.path.isfile(base.file_path):
+        return 'skipped'
+
+    # Il contenuto corrente dei documenti resta sempre completo
+    if db.session.query(Document.id).filter(Document.content_hash == content_hash).first():
+        return 'skipped'
+
+    # Nessun ciclo: la base non può dipendere (direttamente o no) dal blob da codificare
+    ancestor = base
+    while ancestor is not None and ancestor.delta_base_hash:
+        if ancestor.delta_base_hash == content_hash:
+            return 'skipped'
+        ancestor = db.session.get(StorageBlob, ancestor.delta_base_hash)
+
+    if chain_length(base) + 1 + _dependent_depth(content_hash) > MAX_DELTA_CHAIN:
+        return 'skipped'
+
+    with open(blob.file_path, 'rb') as f:
+        target = f.read()
+    with open_blob_file(base.file_path) as f:
+        base_content = f.read()
+
+    ops = compute_delta(target, base_content, max_literal=int(blob.file_size * (1 - MIN_DELTA_SAVING)))
+    if ops is None:
+        return 'not_worth_it'
+    delta_path = blob.file_path + DELTA_SUFFIX
+    # Nome univoco: più job possono codificare lo stesso blob contemporaneamente
+    temp_path = f"{delta_path}.{uuid.uuid4().hex}.part"
+    try:
+        stored_size = write_delta(temp_path, ops, base_hash, len(target))
+
+        if stored_size > blob.file_size * (1 - MIN_DELTA_SAVING):
+            os.remove(temp_path)
+            return 'not_worth_it'
+
+        # Verifica della ricostruzione prima di eliminare il file completo
+        hasher = hashlib.sha256()
+        with open_delta(temp_path) as reader:
+            for chunk in iter(lambda: reader.read(1024 * 1024), b''):
+                hasher.update(chunk)
+        if hasher.hexdigest() != content_hash:
+            raise ValueError("la ricostruzione del delta non corrisponde al contenuto originale")
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    # Aggiornamento condizionale: un altro job (o deltify_version_history.py) potrebbe
+    # aver codificato lo stesso blob nel frattempo; la riga resta bloccata fino al commit
+    replaced = False
+    try:
+        claimed = StorageBlob.query.filter(
+            StorageBlob.content_hash == content_hash,
+            StorageBlob.delta_base_hash.is_(None),
+            or_(StorageBlob.compression.is_(None), StorageBlob.compression == 'none')
+        ).update({
+            StorageBlob.delta_base_hash: base_hash,
+            StorageBlob.compression: 'delta',
+            StorageBlob.stored_size: stored_size
+        }, synchronize_session=False)
+        if not claimed:
+            os.remove(temp_path)
+            return 'skipped'
+
+        # Il delta tiene in vita la propria base
+        StorageBlob.query.filter_by(content_hash=base_hash).update({
+            StorageBlob.ref_count: StorageBlob.ref_count + 1
+        }, synchronize_session=False)
+
+        # Il file completo resta su disco finché il database non registra il delta e
+        # il riferimento sulla base: un commit fallito non lascia un delta senza base
+        os.replace(temp_path, delta_path)
+        replaced = True
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        os.remove(delta_path if replaced else temp_path)
+        raise
+
+    os.remove(blob.file_path)
+    remove_location(blob.file_path)
+    record_location(delta_path, content_hash=content_hash, size=stored_size)
+
+    logging.info(f"Blob {content_hash} archiviato come delta di {base_hash}: "
+                 f"{blob.file_size} -> {stored_size} byte")
+    return 'delta'
+
+def undeltify_blob(blob):
+    """
+    Rimuove il legame di un blob con la propria base dopo che il contenuto completo
+    è stato ripristinato (ad esempio caricando di nuovo una versione precedente).
+
+    Args:
+        blob: Riga StorageBlob
+    """
+    if blob is not None and blob.delta_base_hash:
+        base_hash = blob.delta_base_hash
+        blob.delta_base_hash = None
+        release_blob(base_hash)
+
+def deltify_document_history(document):
+    """
+    Codifica come delta le versioni precedenti di un documento, ciascuna rispetto
+    alla versione successiva. Il contenuto corrente resta completo.
+
+    Args:
+        document: Documento con la cronologia delle versioni
+
+    Returns:
+        dict: Conteggio dei blob codificati, saltati e non convenienti
+    """
+    result = {'delta': 0, 'skipped': 0, 'not_worth_it': 0}
+    versions = DocumentVersion.query.filter_by(document_id=document.id).order_by(
+        DocumentVersion.version_number.desc()).all()
+
+    newer_hash = document.content_hash
+    for version in versions:
+        if version.content_hash and version.content_hash != newer_hash:
+            try:
+                outcome = deltify_blob(version.content_hash, newer_hash)
+            except Exception as e:
+                logging.error(f"Errore durante la codifica delta della versione {version.version_number} "
+                              f"del documento ID {document.id}: {str(e)}")
+                outcome = 'skipped'
+            result[outcome] += 1
+        newer_hash = version.content_hash or newer_hash
+    return result
+
+def deltify_versions_since(document, from_version):
+    """
+    Codifica come delta le versioni di un documento a partire da from_version,
+    ciascuna rispetto alla successiva, dalla più vecchia: la base di ogni delta
+    è ancora completa quando viene letta (come avviene codificando ogni versione
+    subito dopo il caricamento della successiva).
+
+    Args:
+        document: Documento con la cronologia delle versioni
+        from_version: Numero della prima versione da codificare
+
+    Returns:
+        dict: Conteggio dei blob codificati, saltati e non convenienti
+    """
+    result = {'delta': 0, 'skipped': 0, 'not_worth_it': 0}
+    versions = DocumentVersion.query.filter(
+        DocumentVersion.document_id == document.id,
+        DocumentVersion.version_number >= from_version
+    ).order_by(DocumentVersion.version_number).all()
+
+    for index, version in enumerate(versions):
+        newer_hash = versions[index + 1].content_hash if index + 1 < len(versions) else document.content_hash
+        if not version.content_hash or not newer_hash or version.content_hash == newer_hash:
+            continue
+        try:
+            outcome = deltify_blob(version.content_hash, newer_hash)
+        except Exception as e:
+            logging.error(f"Errore durante la codifica delta della versione {version.version_number} "
+                          f"del documento ID {document.id}: {str(e)}")
+            outcome = 'skipped'
+        result[outcome] += 1
+    return result
@@ -0,0 +1,104 @@
+"""
+Cache dei risultati dell'estrazione dei documenti (testo, numero di pagine, metadati).
+
+Il risultato viene salvato come artefatto JSON nella cache degli artefatti
+(services/artifact_cache.py), identificato dallo SHA-256 del contenuto del
+file, dal tipo di file e dalla versione dell'estrattore: lo stesso file
+caricato di nuovo, una nuova versione con contenuto identico, un allegato
+duplicato in un'altra azienda o una rielaborazione massiva non vengono
+analizzati una seconda volta.
+
+Incrementando EXTRACTOR_VERSION (o cambiando le lingue dell'OCR) cambia la
+variante dell'artefatto: i risultati precedenti non vengono più letti e
+lasciano la cache con l'evizione. Le estrazioni incomplete (errori, limite di
+tempo, OCR non disponibile) non vengono salvate.
+"""
+
+import re
+import json
+import logging
+from services.artifact_cache import open_artifact, get_or_create_artifact
+from services.blob_store import compute_sha256
+from services.ocr import extract_text_from_document, is_complete_extraction, ocr_cache_variant
+from services.simple_document_storage import extract_document_metadata
+
+# Versione dell'estrattore: va incrementata quando cambia il testo o i metadati
+# estratti a parità di file (nuovi formati, correzioni degli estrattori)
+EXTRACTOR_VERSION = 1
+
+def _variant(file_type):
+    """Variante dell'artefatto: tipo di file, versione dell'estrattore e dell'OCR."""
+    file_type = re.sub(r'[^a-z0-9]', '', (file_type or '').lower())
+    return f"{file_type}.v{EXTRACTOR_VERSION}.{ocr_cache_variant()}"
+
+def _load(f):
+    with f:
+        return json.loads(f.read().decode('utf-8'))
+
+def get_cached_extraction(content_hash, file_type):
+    """
+    Restituisce il risultato dell'estrazione di un contenuto se presente in cache.
+
+    Args:
+        content_hash: SHA-256 esadecimale del contenuto del file
+        file_type: Estensione del file
+
+    Returns:
+        dict: Risultato come extract_document_content, o None se non è in cache
+    """
+    if not content_hash:
+        return None
+    try:
+        f = open_artifact(content_hash, 'extraction', _variant(file_type))
+        return _load(f) if f is not None else None
+    except Exception as e:
+        logging.warning(f"Impossibile leggere l'estrazione di {content_hash} dalla cache: {str(e)}")
+        return None
+
+def extract_document_content(file_path, file_type, content_hash=None):
+    """
+    Estrae testo e metadati (compreso il numero di pagine) di un file, dalla
+    cache se lo stesso contenuto è già stato elaborato. Più processi che
+    elaborano lo stesso contenuto nello stesso momento lo analizzano una volta.
+
+    Args:
+        file_path: Percorso locale del file
+        file_type: Estensione del file
+        content_hash: SHA-256 del contenuto, se già noto (altrimenti viene calcolato)
+
+    Returns:
+        dict: {'text': testo estratto, 'metadata': metadati del file}
+    """
+    if not content_hash:
+        content_hash = compute_sha256(file_path)
+
+    computed = {}
+
+    def produce(temp_path):
+        text = extract_text_from_document(file_path, file_type)
+        if text and '\x00' in text:
+            text = text.replace('\x00', ' ')
+        computed['result'] = {
+            'text': text,
+            'metadata': extract_document_metadata(file_path, file_type)
+        }
+        if not is_complete_extraction(text):
+            # Senza file l'artefatto non viene salvato: il prossimo tentativo ripete l'estrazione
+            logging.info(f"Estrazione incompleta di {content_hash}: risultato non salvato in cache")
+            return
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(computed['result'], f, ensure_ascii=False, default=str)
+
+    f = get_or_create_artifact(content_hash, 'extraction', produce, variant=_variant(file_type))
+    if 'result' in computed:
+        if f is not None:
+            f.close()
+        return computed['result']
+    if f is not None:
+        return _load(f)
+
+    # La cache non è utilizzabile: estrazione senza cache
+    return {
+        'text': extract_text_from_document(file_path, file_type),
+        'metadata': extract_document_metadata(file_path, file_type)
+    }
@@ -1,8 +1,10 @@
 import os
-import shutil
 import logging
 from flask import current_app
 from models import Document, db
+from services.storage_layout import sharded_path, resolve_path
+from services.replica_copy import copy_file
+from services.location_index import parse_storage_name, find_paths_for_name, record_location
 
 logger = logging.getLogger(__name__)
 
@@ -31,49 +33,27 @@ def find_file_alternative_paths(filename):
     """
     found_paths = []
     
-    # Extract the UUID prefix if present
-    uuid_part = None
-    if '-' in filename:
-        parts = filename.split('_', 1)
-        if len(parts) > 1 and '-' in parts[0]:
-            uuid_part = parts[0]
-    
-    # Original filename without UUID prefix
-    original_name = filename
-    if uuid_part and '_' in filename:
-        original_name = filename.split('_', 1)[1] if '_' in filename else filename
+    # Extract the UUID prefix and the original filename if present
+    uuid_part, original_name, _ = parse_storage_name(filename)
     
     logger.info(f"Cercando file alternativo per: {filename}")
     logger.info(f"UUID part: {uuid_part}, Nome originale: {original_name}")
     
+    # Look for exact matches: the path is computed from the name (sharded or flat layout)
     for directory in SEARCH_DIRECTORIES:
-        # Le directory ora sono già percorsi assoluti
-        if not os.path.exists(directory):
-            continue
-            
-        # Look for exact matches
-        full_path = os.path.join(directory, filename)
-        if os.path.exists(full_path):
+        full_path = resolve_path(directory, filename)
+        if full_path:
             found_paths.append(full_path)
             logger.info(f"Trovato file esatto: {full_path}")
-            
-        # Look for files with the same original filename (without UUID)
-        if uuid_part:
-            for file in os.listdir(directory):
-                if file.endswith(original_name) or original_name in file:
-                    full_path = os.path.join(directory, file)
-                    if full_path not in found_paths:
-                        found_paths.append(full_path)
-                        logger.info(f"Trovato file con nome originale: {full_path}")
-                        
-        # Look for files with the same UUID prefix
-        if uuid_part:
-            for file in os.listdir(directory):
-                if file.startswith(uuid_part):
-                    full_path = os.path.join(directory, file)
-                    if full_path not in found_paths:
-                        found_paths.append(full_path)
-                        logger.info(f"Trovato file con UUID uguale: {full_path}")
+    
+    if found_paths:
+        return found_paths
+    
+    # Look for files with the same UUID prefix or original filename in the location index
+    for full_path in find_paths_for_name(filename):
+        if full_path not in found_paths:
+            found_paths.append(full_path)
+            logger.info(f"Trovato file nell'indice delle posizioni: {full_path}")
     
     return found_paths
 
@@ -117,17 +97,19 @@ def recover_missing_file(document):
         
         # Copy the file to the central storage directory
         filename = os.path.basename(new_path)
-        destination = os.path.join(ORIGINAL_FILES_DIR, filename)
+        destination = sharded_path(ORIGINAL_FILES_DIR, filename, create_dirs=True)
         
         logger.info(f"Copiando file da {new_path} a {destination}")
         try:
-            shutil.copy2(new_path, destination)
+            copy_file(new_path, destination)
             new_path = destination
+            record_location(destination)
             
             # Crea anche un backup
             from services.central_storage import BACKUP_FILES_DIR
-            backup_destination = os.path.join(BACKUP_FILES_DIR, filename)
-            shutil.copy2(new_path, backup_destination)
+            backup_destination = sharded_path(BACKUP_FILES_DIR, filename, create_dirs=True)
+            copy_file(new_path, backup_destination)
+            record_location(backup_destination)
             logger.info(f"Creato backup del file in: {backup_destination}")
         except Exception as e:
             logger.error(f"Errore durante la copia del file: {e}")
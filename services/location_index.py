@@ -0,0 +1,368 @@
+"""
+Indice delle posizioni fisiche dei file in tutte le directory di storage.
+
+Ogni file presente nelle directory note è registrato con il nome su disco, il
+prefisso UUID, il nome originale e (quando noto) lo SHA-256 del contenuto.
+La ricerca di un file mancante diventa così una query su indice invece di una
+scansione delle directory o di un `find` sul filesystem.
+
+L'indice è mantenuto aggiornato dagli hook di upload, eliminazione e migrazione
+e viene riallineato periodicamente da rescan() (job dello scheduler in app.py).
+Le tabelle risiedono nello stesso database SQLite di services/storage_index.py.
+"""
+
+import os
+import re
+import uuid
+import logging
+import datetime
+from werkzeug.utils import secure_filename
+from services.storage_index import get_connection, write_transaction
+from services.storage_layout import iter_storage_files
+
+# Configurazione dei percorsi assoluti
+BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+# Tutte le directory di storage coperte dall'indice
+LOCATION_ROOTS = [
+    os.path.join(BASE_DIR, 'uploads', 'blobs'),
+    os.path.join(BASE_DIR, 'uploads'),
+    os.path.join(BASE_DIR, 'document_storage', 'originals'),
+    os.path.join(BASE_DIR, 'document_storage', 'backup'),
+    os.path.join(BASE_DIR, 'permanent_storage', 'originals'),
+    os.path.join(BASE_DIR, 'permanent_storage', 'backup'),
+    os.path.join(BASE_DIR, 'document_cache'),
+    os.path.join(BASE_DIR, 'attached_assets'),
+    os.path.join(BASE_DIR, 'exports')
+]
+
+# Intervallo tra due riallineamenti completi dell'indice
+RESCAN_INTERVAL_HOURS = 6
+
+# Numero di righe scritte per transazione durante il riallineamento
+RESCAN_BATCH_SIZE = 1000
+
+_HEX_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+_UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+_SHORT_UUID_TIMESTAMP_RE = re.compile(r'^([0-9a-f]{8})_(\d{14})_(.+)$')
+
+def parse_storage_name(filename):
+    """
+    Estrae prefisso UUID, nome originale e hash dal nome di un file su disco.
+
+    Riconosce i formati usati dai servizi di storage:
+    <sha256> (blob store), <uuid8>_<timestamp>_<nome> (upload) e <uuid>_<nome>
+    (storage centralizzato e permanente).
+
+    Args:
+        filename: Nome del file su disco
+
+    Returns:
+        tuple: (uuid_prefix, original_name, content_hash)
+    """
+    if _HEX_DIGEST_RE.match(filename):
+        return None, None, filename
+
+    match = _SHORT_UUID_TIMESTAMP_RE.match(filename)
+    if match:
+        return match.group(1), match.group(3), None
+
+    if '_' in filename:
+        prefix, rest = filename.split('_', 1)
+        if _UUID_RE.match(prefix):
+            return prefix, rest, None
+
+    return None, filename, None
+
+def _root_for(path):
+    """Restituisce la directory di storage che contiene il percorso (la più specifica)."""
+    matches = [root for root in LOCATION_ROOTS if path.startswith(root + os.sep)]
+    return max(matches, key=len) if matches else None
+
+def _location_row(path, content_hash=None, size=None, scan_id=None, now=None):
+    """Prepara i valori di una riga dell'indice per un percorso."""
+    filename = os.path.basename(path)
+    uuid_prefix, original_name, name_hash = parse_storage_name(filename)
+    return (
+        path,
+        _root_for(path),
+        filename,
+        uuid_prefix,
+        original_name,
+        content_hash or name_hash,
+        size,
+        scan_id,
+        now or datetime.datetime.now().isoformat()
+    )
+
+_UPSERT = """
+INSERT INTO locations (path, root, filename, uuid_prefix, original_name, content_hash, size, scan_id, indexed_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(path) DO UPDATE SET
+    root = excluded.root,
+    filename = excluded.filename,
+    uuid_prefix = excluded.uuid_prefix,
+    original_name = excluded.original_name,
+    content_hash = COALESCE(excluded.content_hash, locations.content_hash),
+    size = COALESCE(excluded.size, locations.size),
+    scan_id = excluded.scan_id,
+    indexed_at = excluded.indexed_at
+"""
+
+def record_location(path, content_hash=None, size=None):
+    """
+    Registra (o aggiorna) la posizione di un file nell'indice.
+    Gli errori vengono solo registrati: l'indice non deve mai bloccare un upload.
+
+    Args:
+        path: Percorso del file
+        content_hash: SHA-256 del contenuto, se noto
+        size: Dimensione del file, se nota
+
+    Returns:
+        bool: True se la registrazione è riuscita
+    """
+    try:
+        path = os.path.abspath(path)
+        if size is None and os.path.isfile(path):
+            size = os.path.getsize(path)
+        with write_transaction() as conn:
+            conn.execute(_UPSERT, _location_row(path, content_hash, size))
+        return True
+    except Exception as e:
+        logging.error(f"Errore durante la registrazione della posizione {path}: {str(e)}")
+        return False
+
+def remove_location(path):
+    """
+    Rimuove la posizione di un file eliminato dall'indice.
+
+    Args:
+        path: Percorso del file
+
+    Returns:
+        bool: True se l'operazione è riuscita
+    """
+    try:
+        with write_transaction() as conn:
+            conn.execute('DELETE FROM locations WHERE path = ?', (os.path.abspath(path),))
+            conn.execute('DELETE FROM checksums WHERE path = ?', (os.path.abspath(path),))
+        return True
+    except Exception as e:
+        logging.error(f"Errore durante la rimozione della posizione {path}: {str(e)}")
+        return False
+
+def update_paths(moves):
+    """
+    Aggiorna l'indice dopo lo spostamento di file (es. migrazioni).
+
+    Args:
+        moves: Dizionario vecchio percorso -> nuovo percorso
+
+    Returns:
+        int: Numero di posizioni aggiornate
+    """
+    now = datetime.datetime.now().isoformat()
+    with write_transaction() as conn:
+        for old_path, new_path in moves.items():
+            row = conn.execute('SELECT content_hash, size FROM locations WHERE path = ?', (old_path,)).fetchone()
+            conn.execute('DELETE FROM locations WHERE path = ?', (old_path,))
+            content_hash = row['content_hash'] if row else None
+            size = row['size'] if row else None
+            conn.execute(_UPSERT, _location_row(new_path, content_hash, size, now=now))
+    return len(moves)
+
+def find_paths(filename=None, uuid_prefix=None, original_name=None, content_hash=None, limit=20):
+    """
+    Cerca nell'indice i file corrispondenti ai criteri forniti.
+
+    I risultati sono ordinati per affidabilità della corrispondenza (nome esatto,
+    prefisso UUID, nome originale, hash del contenuto). Le voci il cui file non
+    esiste più vengono rimosse dall'indice.
+
+    Args:
+        filename: Nome esatto del file su disco
+        uuid_prefix: Prefisso UUID del nome
+        original_name: Nome originale del file
+        content_hash: SHA-256 del contenuto
+        limit: Numero massimo di risultati per criterio
+
+    Returns:
+        list: Percorsi esistenti trovati
+    """
+    criteria = [
+        ('filename', filename),
+        ('uuid_prefix', uuid_prefix),
+        ('original_name', original_name),
+        ('content_hash', content_hash)
+    ]
+
+    found_paths = []
+    stale_paths = []
+    try:
+        conn = get_connection()
+        for column, value in criteria:
+            if not value:
+                continue
+            rows = conn.execute(f'SELECT path FROM locations WHERE {column} = ? LIMIT ?',
+                                (value, limit)).fetchall()
+            for row in rows:
+                path = row['path']
+                if path in found_paths or path in stale_paths:
+                    continue
+                if os.path.isfile(path):
+                    found_paths.append(path)
+                else:
+                    stale_paths.append(path)
+
+        if stale_paths:
+            with write_transaction() as conn:
+                conn.executemany('DELETE FROM locations WHERE path = ?', [(path,) for path in stale_paths])
+    except Exception as e:
+        logging.error(f"Errore durante la ricerca nell'indice delle posizioni: {str(e)}")
+
+    return found_paths
+
+def find_paths_for_name(filename, original_filename=None, content_hash=None):
+    """
+    Cerca le posizioni di un file a partire dal suo nome su disco.
+
+    Args:
+        filename: Nome del file su disco
+        original_filename: Nome originale del documento (opzionale)
+        content_hash: SHA-256 del contenuto (opzionale)
+
+    Returns:
+        list: Percorsi esistenti trovati
+    """
+    uuid_prefix, original_name, name_hash = parse_storage_name(filename) if filename else (None, None, None)
+    paths = find_paths(filename=filename, uuid_prefix=uuid_prefix, original_name=original_name,
+                       content_hash=content_hash or name_hash)
+
+    if original_filename:
+        # Il nome su disco è passato da secure_filename: prova entrambe le varianti
+        for name in (original_filename, secure_filename(original_filename)):
+            for path in find_paths(original_name=name):
+                if path not in paths:
+                    paths.append(path)
+
+    return paths
+
+def get_root_stats(root):
+    """
+    Restituisce i totali di una directory di storage, mantenuti dai trigger dell'indice.
+
+    Args:
+        root: Directory di storage (una delle LOCATION_ROOTS)
+
+    Returns:
+        dict: files, bytes e with_backup (file con copia nella directory di backup corrispondente)
+    """
+    row = get_connection().execute('SELECT files, bytes, with_backup FROM location_stats WHERE root = ?',
+                                   (root,)).fetchone()
+    if row is None:
+        return {'files': 0, 'bytes': 0, 'with_backup': 0}
+    return {'files': row['files'], 'bytes': row['bytes'], 'with_backup': row['with_backup']}
+
+def reconcile_stats():
+    """
+    Ricalcola i totali per directory dall'indice delle posizioni (nessun accesso al filesystem).
+    """
+    with write_transaction() as conn:
+        conn.execute('DELETE FROM location_stats')
+        conn.execute(
+            'INSERT INTO location_stats (root, files, bytes) '
+            'SELECT root, COUNT(*), COALESCE(SUM(size), 0) FROM locations WHERE root IS NOT NULL GROUP BY root'
+        )
+        conn.execute(
+            "UPDATE location_stats SET with_backup = ("
+            "    SELECT COUNT(*) FROM locations o JOIN locations b"
+            "    ON b.filename = o.filename AND b.root = substr(o.root, 1, length(o.root) - 9) || 'backup'"
+            "    WHERE o.root = location_stats.root"
+            ") WHERE root LIKE '%/originals'"
+        )
+
+def claim_rescan(max_age_hours=RESCAN_INTERVAL_HOURS):
+    """
+    Prenota un riallineamento se l'indice non è mai stato riallineato o se l'ultimo
+    riallineamento (completato o avviato) è più vecchio di max_age_hours. Tra più
+    processi avviati insieme la prenotazione riesce a uno solo.
+
+    Returns:
+        bool: True se il chiamante deve eseguire rescan()
+    """
+    now = datetime.datetime.now()
+    cutoff = (now - datetime.timedelta(hours=max_age_hours)).isoformat()
+    with write_transaction() as conn:
+        row = conn.execute('SELECT started_at, finished_at FROM location_rescan WHERE id = 1').fetchone()
+        if row is not None and max(row['started_at'] or '', row['finished_at'] or '') >= cutoff:
+            return False
+        conn.execute('INSERT INTO location_rescan (id, started_at) VALUES (1, ?) '
+                     'ON CONFLICT (id) DO UPDATE SET started_at = excluded.started_at', (now.isoformat(),))
+    return True
+
+def rescan(roots=None):
+    """
+    Riallinea l'indice con il contenuto reale delle directory di storage.
+    Le voci dei file non più presenti vengono rimosse.
+
+    Args:
+        roots: Directory da riscansionare (default: tutte le LOCATION_ROOTS)
+
+    Returns:
+        dict: Statistiche del riallineamento
+    """
+    stats = {
+        'scanned': 0,
+        'removed': 0,
+        'errors': []
+    }
+    scan_id = uuid.uuid4().hex
+    started_at = datetime.datetime.now().isoformat()
+
+    for root in roots or LOCATION_ROOTS:
+        try:
+            batch = []
+            for entry in iter_storage_files(root):
+                batch.append(_location_row(os.path.abspath(entry.path),
+                                           size=entry.stat(follow_symlinks=False).st_size,
+                                           scan_id=scan_id))
+                if len(batch) >= RESCAN_BATCH_SIZE:
+                    with write_transaction() as conn:
+                        conn.executemany(_UPSERT, batch)
+                    stats['scanned'] += len(batch)
+                    batch = []
+            if batch:
+                with write_transaction() as conn:
+                    conn.executemany(_UPSERT, batch)
+                stats['scanned'] += len(batch)
+
+            # Le voci non viste in questa scansione (e non registrate nel frattempo) sono obsolete
+            with write_transaction() as conn:
+                cursor = conn.execute(
+                    'DELETE FROM locations WHERE root = ? AND (scan_id IS NULL OR scan_id != ?) AND indexed_at < ?',
+                    (root, scan_id, started_at)
+                )
+                stats['removed'] += cursor.rowcount
+        except Exception as e:
+            error_msg = f"Errore durante la scansione di {root}: {str(e)}"
+            stats['errors'].append(error_msg)
+            logging.error(error_msg)
+
+    try:
+        reconcile_stats()
+    except Exception as e:
+        error_msg = f"Errore durante il ricalcolo dei totali dell'indice: {str(e)}"
+        stats['errors'].append(error_msg)
+        logging.error(error_msg)
+
+    try:
+        with write_transaction() as conn:
+            conn.execute('INSERT INTO location_rescan (id, started_at, finished_at) VALUES (1, ?, ?) '
+                         'ON CONFLICT (id) DO UPDATE SET finished_at = excluded.finished_at',
+                         (started_at, datetime.datetime.now().isoformat()))
+    except Exception as e:
+        logging.error(f"Errore durante la registrazione del riallineamento dell'indice: {str(e)}")
+
+    logging.info(f"Indice delle posizioni riallineato: {stats['scanned']} file, {stats['removed']} voci rimosse")
+    return stats
@@ -0,0 +1,306 @@
+"""
+Esecuzione riprendibile e parallela delle migrazioni dello storage dei documenti.
+
+Lo spazio degli ID dei documenti viene percorso a blocchi (paginazione per
+chiave) e i documenti di ogni blocco sono ripartiti tra un pool di thread, che
+copiano i file nella destinazione. Gli aggiornamenti dei documenti e il
+checkpoint (MaintenanceRun.cursor) vengono salvati con un'unica commit per
+blocco: un'esecuzione interrotta riprende dal primo blocco non completato.
+Un limite opzionale in MB/s rallenta le copie per non saturare i dischi.
+
+Destinazioni disponibili (MIGRATION_TARGETS):
+- 'central': storage centralizzato (services/central_storage.py)
+- 'permanent': storage permanente (services/persistent_storage.py)
+
+Per le migrazioni, i contatori del MaintenanceRun indicano: ok_count i documenti
+già nella destinazione, repaired_count quelli migrati, failed_count i falliti.
+"""
+
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from app import db
+from models import Document, MaintenanceRun
+from services.blob_store import BLOB_STORE_DIR
+from services.location_index import find_paths_for_name
+
+# Documenti per blocco (un checkpoint per blocco)
+DEFAULT_BATCH_SIZE = 200
+
+# Thread di copia in parallelo
+DEFAULT_MAX_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+
+# Numero massimo di errori conservati nel MaintenanceRun
+MAX_STORED_ERRORS = 100
+
+class IOThrottle:
+    """Limita la velocità complessiva di copia (MB/s) condivisa tra i thread."""
+
+    def __init__(self, mb_per_second):
+        self.bytes_per_second = mb_per_second * 1024 * 1024 if mb_per_second else None
+        self.started = time.monotonic()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        if not self.bytes_per_second or not nbytes:
+            return
+        with self.lock:
+            self.total += nbytes
+            wait = self.total / self.bytes_per_second - (time.monotonic() - self.started)
+        if wait > 0:
+            time.sleep(wait)
+
+def _source_path(doc):
+    """Percorso del file da migrare: quello registrato o una copia trovata nell'indice delle posizioni."""
+    if doc['file_path'] and os.path.isfile(doc['file_path']):
+        return doc['file_path']
+    candidates = find_paths_for_name(doc['filename'] or '', original_filename=doc['original_filename'],
+                                     content_hash=doc['content_hash'])
+    return candidates[0] if candidates else None
+
+def _migrate_to_central(doc):
+    """Copia il file di un documento nello storage centralizzato."""
+    from services.central_storage import ORIGINAL_FILES_DIR, save_file_to_central_storage
+
+    if doc['file_path'] and doc['file_path'].startswith(ORIGINAL_FILES_DIR + os.sep):
+        return {'status': 'ok'}
+    source = _source_path(doc)
+    if source is None:
+        return {'status': 'failed', 'error': f"Documento ID {doc['id']}: file non trovato"}
+
+    stored = save_file_to_central_storage(file_path=source, original_filename=doc['original_filename'],
+                                          create_backup=True)
+    if not stored:
+        return {'status': 'failed', 'error': f"Documento ID {doc['id']}: copia nello storage centralizzato fallita"}
+    return {
+        'status': 'migrated',
+        'bytes': stored['file_size'],
+        'updates': {'filename': stored['filename'], 'file_path': stored['file_path']}
+    }
+
+def _migrate_to_permanent(doc):
+    """Copia il file di un documento nello storage permanente."""
+    from services.persistent_storage import PERMANENT_ORIGINALS_DIR, store_permanent_file
+
+    if doc['file_path'] and doc['file_path'].startswith(PERMANENT_ORIGINALS_DIR + os.sep):
+        return {'status': 'ok'}
+    source = _source_path(doc)
+    if source is None:
+        return {'status': 'failed', 'error': f"Documento ID {doc['id']}: file non trovato"}
+
+    stored = store_permanent_file(file_path=source, original_filename=doc['original_filename'],
+                                  document_id=doc['id'])
+    if not stored:
+        return {'status': 'failed', 'error': f"Documento ID {doc['id']}: copia nello storage permanente fallita"}
+    return {
+        'status': 'migrated',
+        'bytes': stored['file_size'],
+        'updates': {'filename': stored['filename'], 'file_path': stored['file_path']}
+    }
+
+# Destinazione -> funzione di migrazione di un documento (solo filesystem e indice delle posizioni)
+MIGRATION_TARGETS = {
+    'central': _migrate_to_central,
+    'permanent': _migrate_to_permanent
+}
+
+def job_type_for(target):
+    """Tipo di MaintenanceRun usato per una destinazione."""
+    return f"migrate_{target}"
+
+def get_resumable_migration(target):
+    """Restituisce l'ultima migrazione interrotta o in pausa verso la destinazione, se esiste."""
+    return MaintenanceRun.query.filter(
+        MaintenanceRun.job_type == job_type_for(target),
+        MaintenanceRun.status.in_(['running', 'paused'])
+    ).order_by(MaintenanceRun.id.desc()).first()
+
+def _process(app, migrate, doc, throttle):
+    """Migra un documento in un thread del pool, con un proprio contesto applicativo."""
+    with app.app_context():
+        try:
+            # I documenti nel blob store sono già in uno storage gestito e deduplicato
+            if doc['content_hash'] and doc['file_path'] and doc['file_path'].startswith(BLOB_STORE_DIR + os.sep):
+                result = {'status': 'ok'}
+            else:
+                result = migrate(doc)
+        except Exception as e:
+            result = {'status': 'failed', 'error': f"Errore durante la migrazione del documento ID {doc['id']}: {str(e)}"}
+        finally:
+            db.session.remove()
+
+    result['id'] = doc['id']
+    throttle.consume(result.get('bytes', 0))
+    return result
+
+def run_migration(target, restart=False, batch_size=DEFAULT_BATCH_SIZE, max_workers=DEFAULT_MAX_WORKERS,
+                  max_mb_per_second=None, max_seconds=None, max_batches=None, stop_event=None, user_id=None):
+    """
+    Esegue (o riprende) la migrazione di tutti i documenti verso una destinazione.
+
+    Args:
+        target: Destinazione ('central' o 'permanent')
+        restart: Se True, annulla la migrazione interrotta e riparte dall'inizio
+        batch_size: Documenti per blocco (e per checkpoint)
+        max_workers: Thread di copia in parallelo
+        max_mb_per_second: Limite della velocità di copia (None = nessun limite)
+        max_seconds: Durata massima; allo scadere l'esecuzione viene messa in pausa
+        max_batches: Numero massimo di blocchi; raggiunto il limite l'esecuzione viene messa in pausa
+        stop_event: threading.Event che, se impostato, mette in pausa l'esecuzione
+        user_id: Utente che ha avviato l'operazione
+
+    Returns:
+        MaintenanceRun: Lo stato finale dell'esecuzione
+    """
+    migrate = MIGRATION_TARGETS[target]
+    app = current_app._get_current_object()
+
+    run = get_resumable_migration(target)
+    if run is not None and restart:
+        run.status = 'cancelled'
+        run.finished_at = datetime.datetime.utcnow()
+        db.session.commit()
+        run = None
+
+    if run is None:
+        run = MaintenanceRun(
+            job_type=job_type_for(target),
+            status='running',
+            cursor=0,
+            processed_count=0,
+            ok_count=0,
+            repaired_count=0,
+            failed_count=0,
+            bytes_processed=0,
+            elapsed_seconds=0.0,
+            options=json.dumps({'batch_size': batch_size, 'max_workers': max_workers,
+                                'max_mb_per_second': max_mb_per_second}),
+            started_by_id=user_id
+        )
+        db.session.add(run)
+    else:
+        logging.info(f"Ripresa della migrazione #{run.id} verso '{target}' dal documento ID {run.cursor}")
+
+    run.status = 'running'
+    run.total_count = Document.query.count()
+    db.session.commit()
+
+    errors = json.loads(run.errors) if run.errors else []
+    base_elapsed = run.elapsed_seconds or 0.0
+    started = time.monotonic()
+    throttle = IOThrottle(max_mb_per_second)
+    batches = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                rows = db.session.query(
+                    Document.id, Document.file_path, Document.filename,
+                    Document.original_filename, Document.content_hash
+                ).filter(Document.id > run.cursor).order_by(Document.id).limit(batch_size).all()
+
+                if not rows:
+                    run.status = 'completed'
+                    run.finished_at = datetime.datetime.utcnow()
+                    break
+
+                docs = [row._asdict() for row in rows]
+                results = list(executor.map(lambda doc: _process(app, migrate, doc, throttle), docs))
+
+                # Aggiornamenti dei documenti e checkpoint salvati con la stessa commit; le
+                # modifiche passano dall'ORM così che gli eventi aggiornino i contatori per area
+                updates = {r['id']: r['updates'] for r in results if r.get('updates')}
+                if updates:
+                    for document in Document.query.filter(Document.id.in_(list(updates))).all():
+                        for name, value in updates[document.id].items():
+                            setattr(document, name, value)
+
+                for r in results:
+                    run.processed_count += 1
+                    run.bytes_processed += r.get('bytes', 0)
+                    if r['status'] == 'ok':
+                        run.ok_count += 1
+                    elif r['status'] == 'migrated':
+                        run.repaired_count += 1
+                    else:
+                        run.failed_count += 1
+                        errors.append(r['error'])
+                        logging.warning(r['error'])
+
+                run.cursor = rows[-1].id
+                run.elapsed_seconds = base_elapsed + (time.monotonic() - started)
+                run.errors = json.dumps(errors[-MAX_STORED_ERRORS:])
+                db.session.commit()
+                batches += 1
+
+                logging.info(f"Migrazione #{run.id} verso '{target}': {run.processed_count}/{run.total_count} documenti, "
+                             f"{run.docs_per_second:.1f} doc/s, {run.mb_per_second:.2f} MB/s")
+
+                if (stop_event is not None and stop_event.is_set()) or \
+                        (max_seconds is not None and time.monotonic() - started >= max_seconds) or \
+                        (max_batches is not None and batches >= max_batches):
+                    run.status = 'paused'
+                    break
+    except Exception as e:
+        db.session.rollback()
+        run.status = 'failed'
+        run.finished_at = datetime.datetime.utcnow()
+        errors.append(f"Errore durante la migrazione: {str(e)}")
+        run.errors = json.dumps(errors[-MAX_STORED_ERRORS:])
+        logging.error(f"Errore durante la migrazione verso '{target}': {str(e)}")
+
+    run.elapsed_seconds = base_elapsed + (time.monotonic() - started)
+    db.session.commit()
+    return run
+
+def write_migration_report(run, title):
+    """
+    Crea un report di migrazione (con tempi e throughput) e lo salva in un file.
+
+    Args:
+        run: MaintenanceRun della migrazione
+        title: Titolo del report
+
+    Returns:
+        str: Nome del file del report
+    """
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_file = f"migration_report_{timestamp}.txt"
+    errors = json.loads(run.errors) if run.errors else []
+
+    with open(report_file, 'w') as f:
+        f.write(f"== {title} ==\n")
+        f.write(f"Data: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        f.write(f"Esecuzione: #{run.id} ({run.status})\n\n")
+
+        f.write(f"Totale documenti: {run.total_count}\n")
+        f.write(f"Documenti elaborati: {run.processed_count}\n")
+        f.write(f"Documenti migrati con successo: {run.repaired_count}\n")
+        f.write(f"Documenti già nella destinazione: {run.ok_count}\n")
+        f.write(f"Documenti falliti: {run.failed_count}\n\n")
+
+        f.write("== Tempi e Throughput ==\n")
+        f.write(f"Avvio: {run.started_at:%Y-%m-%d %H:%M:%S}\n")
+        if run.finished_at:
+            f.write(f"Fine: {run.finished_at:%Y-%m-%d %H:%M:%S}\n")
+        else:
+            f.write(f"Ultimo documento elaborato: ID {run.cursor} (l'esecuzione riprende da qui)\n")
+        f.write(f"Tempo di lavoro: {run.elapsed_seconds:.1f} s\n")
+        f.write(f"Dati copiati: {run.bytes_processed / (1024 * 1024):.1f} MB\n")
+        f.write(f"Throughput: {run.docs_per_second:.1f} documenti/s, {run.mb_per_second:.2f} MB/s\n\n")
+
+        if errors:
+            f.write(f"== Dettagli Errori (ultimi {len(errors)}) ==\n")
+            for error in errors:
+                f.write(f"{error}\n")
+
+        f.write("\n== Fine Report ==\n")
+
+    logging.info(f"Report di migrazione salvato in: {report_file}")
+    return report_file
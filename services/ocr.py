@@ -1,14 +1,92 @@
+import io
 import os
 import re
+import mmap
+import time
+import hashlib
 import tempfile
 import logging
-from PIL import Image
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from PIL import Image, ImageOps, ImageSequence
 import PyPDF2
+import pytesseract
 from docx import Document as DocxDocument
 from flask import current_app
+from services.artifact_cache import read_artifact, store_artifact
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 logger = logging.getLogger(__name__)
 
+# Pages with less extracted text than this are treated as (possibly) scanned
+SCANNED_PAGE_MIN_CHARS = 50
+
+# Page-sharded PDF extraction: PDFs with at least this many pages are split into
+# page ranges extracted in parallel by a process pool
+PDF_PARALLEL_MIN_PAGES = 40
+PDF_MIN_PAGES_PER_TASK = 25
+
+# Page ranges per worker: a few tasks each, so that a slow range does not leave
+# the other workers idle, without reopening the PDF for every small range
+PDF_TASKS_PER_WORKER = 3
+
+# The process pools (page ranges and OCR) are created with fork, which is only
+# safe in a single-threaded process: extraction is serial by default (web
+# requests and scheduler jobs run next to other threads) and the workers of
+# process_documents.py enable the pools with enable_parallel_extraction()
+PDF_PARALLEL_WORKERS = max(1, min(4, os.cpu_count() or 1))
+PDF_EXTRACTION_WORKERS = 1
+
+# Time limit for the text extraction of a whole PDF; remaining pages are skipped
+PDF_EXTRACTION_TIMEOUT_SECONDS = 300
+
+# Extra time granted to the workers before they are terminated
+PDF_EXTRACTION_KILL_GRACE_SECONDS = 10
+
+# Memory each extraction worker may allocate on top of the address space inherited
+# from the parent (MemoryError on the page instead of exhausting the host); the
+# memory-mapped PDF counts towards the limit
+PDF_WORKER_MEMORY_LIMIT_MB = 1024
+
+# OCR (tesseract) of images and of the scanned pages of PDFs
+OCR_ENABLED = os.environ.get('OCR_ENABLED', 'true').strip().lower() not in ('0', 'false', 'no')
+OCR_LANGUAGES = os.environ.get('OCR_LANGUAGES', 'ita+eng')
+if os.environ.get('TESSERACT_CMD'):
+    pytesseract.pytesseract.tesseract_cmd = os.environ['TESSERACT_CMD']
+
+# Images are scaled so that their longest side falls in this range (about
+# 300 DPI for an A4 page): larger scans only slow tesseract down, smaller ones
+# have characters too small to be recognized
+OCR_MAX_SIDE = 3500
+OCR_MIN_SIDE = 1000
+
+# Images smaller than this on both sides (logos, bullets) are not worth OCR
+OCR_MIN_IMAGE_SIDE = 100
+
+# Time limit for the OCR of a single image
+OCR_PAGE_TIMEOUT_SECONDS = 120
+
+# Scanned pages recognized per PDF; the following ones keep the placeholder
+OCR_MAX_PAGES = 500
+
+# Recognized text is cached per page in the artifact cache; bump the version
+# when the preprocessing changes to ignore the previous results
+OCR_CACHE_VERSION = '1'
+
+def enable_parallel_extraction(workers=PDF_PARALLEL_WORKERS):
+    """
+    Enable the process pools of the PDF extraction and OCR in the current
+    process. Only for single-threaded processes, such as the document
+    processing workers of process_documents.py.
+    """
+    global PDF_EXTRACTION_WORKERS
+    PDF_EXTRACTION_WORKERS = max(1, workers)
+
 def extract_text_from_document(file_path, file_type):
     """
     Extract text from a document using text extraction libraries
@@ -22,10 +100,9 @@ def extract_text_from_document(file_path, file_type):
         Extracted text content as a string
     """
     try:
-        # For image files - OCR disabled temporarily
+        # For image files
         if file_type.lower() in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff']:
-            logger.info("Image text extraction (OCR) is currently disabled")
-            return "Image text extraction not available in this version"
+            return extract_text_from_image(file_path)
         
         # For PDF files
         elif file_type.lower() == 'pdf':
@@ -48,49 +125,463 @@ def extract_text_from_document(file_path, file_type):
         logger.error(f"Text extraction failed: {str(e)}")
         return f"Error extracting text: {str(e)}"
 
+# Tesseract availability, checked once per process
+_tesseract = {}
+
+def ocr_available():
+    """
+    Return True if OCR is enabled and the tesseract executable can be run.
+    """
+    if not OCR_ENABLED:
+        return False
+    if 'available' not in _tesseract:
+        try:
+            version = pytesseract.get_tesseract_version()
+            logger.info(f"OCR enabled: tesseract {version}, languages {OCR_LANGUAGES}")
+            _tesseract['available'] = True
+        except Exception as e:
+            logger.warning(f"OCR not available, tesseract cannot be run: {str(e)}")
+            _tesseract['available'] = False
+    return _tesseract['available']
+
+def _otsu_threshold(histogram):
+    """
+    Gray level that best separates text and background (Otsu's method).
+    """
+    total = sum(histogram)
+    sum_all = sum(level * count for level, count in enumerate(histogram))
+    sum_background = weight_background = 0
+    best_variance, threshold = 0, 127
+    for level, count in enumerate(histogram):
+        weight_background += count
+        if not weight_background:
+            continue
+        weight_foreground = total - weight_background
+        if not weight_foreground:
+            break
+        sum_background += level * count
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_all - sum_background) / weight_foreground
+        variance = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_variance, threshold = variance, level
+    return threshold
+
+def preprocess_for_ocr(image):
+    """
+    Prepare an image for tesseract: grayscale, scaled to OCR_MIN_SIDE-OCR_MAX_SIDE
+    on the longest side and binarized.
+    
+    Args:
+        image: PIL image
+        
+    Returns:
+        PIL image in mode 'L' with black text on white background
+    """
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        # Transparent areas become white instead of black
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    image = image.convert('L')
+    
+    longest = max(image.size)
+    if longest > OCR_MAX_SIDE or longest < OCR_MIN_SIDE:
+        scale = (OCR_MAX_SIDE if longest > OCR_MAX_SIDE else OCR_MIN_SIDE) / longest
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS if scale < 1 else Image.BICUBIC)
+    
+    image = ImageOps.autocontrast(image)
+    threshold = _otsu_threshold(image.histogram())
+    image = image.point([255 if level > threshold else 0 for level in range(256)])
+    
+    # Light text on a dark background: tesseract expects dark text
+    if image.histogram()[0] > image.width * image.height / 2:
+        image = ImageOps.invert(image)
+    return image
+
+def _ocr_image(image, timeout=OCR_PAGE_TIMEOUT_SECONDS):
+    """
+    Run tesseract on a PIL image after preprocessing.
+    """
+    if max(image.size) < OCR_MIN_IMAGE_SIDE:
+        return ""
+    text = pytesseract.image_to_string(preprocess_for_ocr(image), lang=OCR_LANGUAGES,
+                                       timeout=max(1, timeout))
+    return text.replace('\x00', ' ').strip()
+
+def ocr_cache_variant(page_num=None):
+    """
+    Variant of the OCR artifact: languages, cache version and page of the PDF.
+    """
+    variant = f"{re.sub(r'[^A-Za-z0-9_]', '-', OCR_LANGUAGES)}.v{OCR_CACHE_VERSION}"
+    return variant if page_num is None else f"{variant}.p{page_num+1}"
+
+def _file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def _read_cached_ocr(content_hash, variant):
+    try:
+        data = read_artifact(content_hash, 'ocr', variant)
+    except Exception as e:
+        logger.warning(f"OCR cache lookup failed: {str(e)}")
+        return None
+    return None if data is None else data.decode('utf-8')
+
 def extract_text_from_image(image_path):
     """
-    Extract text from an image file.
-    OCR functionality is disabled in this version.
+    Extract text from an image file with tesseract (every frame of
+    multi-page TIFFs). The result is cached by content hash.
+    
+    Args:
+        image_path: Path to the image file
+        
+    Returns:
+        Recognized text (empty if the image contains no text)
+    """
+    if not ocr_available():
+        return "Image text extraction not available in this version"
+    
+    content_hash = _file_sha256(image_path)
+    variant = ocr_cache_variant()
+    cached = _read_cached_ocr(content_hash, variant)
+    if cached is not None:
+        return cached
+    
+    started = time.time()
+    deadline = started + PDF_EXTRACTION_TIMEOUT_SECONDS
+    texts = []
+    complete = True
+    with Image.open(image_path) as image:
+        for index, frame in enumerate(ImageSequence.Iterator(image)):
+            if index >= OCR_MAX_PAGES or time.time() > deadline:
+                logger.warning(f"OCR of {image_path} stopped after {index} frames")
+                complete = False
+                break
+            texts.append(_ocr_image(frame.copy(), min(OCR_PAGE_TIMEOUT_SECONDS, deadline - time.time())))
+    
+    text = "\n\n".join(text for text in texts if text)
+    if complete:
+        store_artifact(content_hash, 'ocr', text, variant)
+    logger.info(f"OCR of {len(texts)} image frames in {time.time() - started:.2f} s")
+    return text
+
+def _page_images(page):
+    """
+    Decode the images drawn on a PDF page (for scanned pages, the scan itself).
     """
-    return "OCR text extraction is not available in this version"
+    try:
+        files = page.images
+    except Exception as e:
+        logger.warning(f"Unable to read the images of the PDF page: {str(e)}")
+        return []
+    
+    images = []
+    for file in files:
+        try:
+            image = Image.open(io.BytesIO(file.data))
+            image.load()
+            images.append(image)
+        except Exception as e:
+            logger.warning(f"Unable to decode the PDF image {file.name}: {str(e)}")
+    return images
 
-def extract_text_from_pdf(pdf_path):
+def _ocr_pdf_page(pdf_reader, page_num, deadline):
     """
-    Extract text from a PDF file using PyPDF2.
-    OCR for scanned pages is disabled in this version.
+    OCR of a scanned PDF page: the images of the page are recognized in order.
+    """
+    texts = []
+    for image in _page_images(pdf_reader.pages[page_num]):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutError("extraction time limit reached")
+        texts.append(_ocr_image(image, min(OCR_PAGE_TIMEOUT_SECONDS, remaining)))
+    return "\n".join(text for text in texts if text)
+
+def _init_ocr_worker(memory_limit_mb):
+    """
+    Process pool initializer for the OCR workers: memory limit and one thread
+    per tesseract process, the parallelism comes from the pool.
+    """
+    _init_pdf_worker(memory_limit_mb)
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+
+def _ocr_pdf_page_task(pdf_path, page_num, deadline):
+    """
+    Worker task: OCR of one page of a PDF opened independently by the worker.
+    """
+    return _ocr_pdf_page(_worker_reader(pdf_path), page_num, deadline)
+
+def _ocr_pdf_pages(pdf_path, pdf_reader, page_numbers, workers, deadline):
+    """
+    OCR of the scanned pages of a PDF. Cached pages are read from the artifact
+    cache, the others are recognized by a process pool (or serially with a
+    single worker) and cached.
+    
+    Returns:
+        dict: Recognized text by page number (pages that failed or timed out are missing)
+    """
+    started = time.time()
+    content_hash = _file_sha256(pdf_path)
+    recognized = {}
+    pending = []
+    for page_num in page_numbers[:OCR_MAX_PAGES]:
+        cached = _read_cached_ocr(content_hash, ocr_cache_variant(page_num))
+        if cached is None:
+            pending.append(page_num)
+        else:
+            recognized[page_num] = cached
+    cached_count = len(recognized)
+    
+    def page_done(page_num, text):
+        recognized[page_num] = text
+        store_artifact(content_hash, 'ocr', text, ocr_cache_variant(page_num))
+    
+    if workers > 1 and len(pending) > 1:
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(pending)),
+                                       mp_context=multiprocessing.get_context('fork'),
+                                       initializer=_init_ocr_worker,
+                                       initargs=(PDF_WORKER_MEMORY_LIMIT_MB,))
+        not_done = set()
+        try:
+            futures = {executor.submit(_ocr_pdf_page_task, pdf_path, page_num, deadline): page_num
+                       for page_num in pending}
+            timeout = max(0, deadline - time.time()) + PDF_EXTRACTION_KILL_GRACE_SECONDS
+            done, not_done = wait(futures, timeout=timeout)
+            for future in done:
+                try:
+                    page_done(futures[future], future.result())
+                except Exception as e:
+                    logger.warning(f"OCR of page {futures[future]+1} failed: {type(e).__name__}: {str(e)}")
+            if not_done:
+                logger.warning(f"OCR of {len(not_done)} pages did not finish within the time limit")
+        finally:
+            _shutdown_pool(executor, kill=bool(not_done))
+    else:
+        for page_num in pending:
+            try:
+                page_done(page_num, _ocr_pdf_page(pdf_reader, page_num, deadline))
+            except Exception as e:
+                logger.warning(f"OCR of page {page_num+1} failed: {type(e).__name__}: {str(e)}")
+    
+    elapsed = time.time() - started
+    ocr_count = len(recognized) - cached_count
+    logger.info(f"OCR of {len(page_numbers)} scanned pages: {cached_count} from cache, "
+                f"{ocr_count} recognized in {elapsed:.2f} s "
+                f"({ocr_count / elapsed if elapsed > 0 else 0:.2f} pages/s)")
+    return recognized
+
+def _extract_page_text(pdf_reader, page_num):
+    """
+    Extract the text of a single PDF page. Returns None for pages that look
+    scanned (left to the OCR) and a placeholder for pages that cannot be read.
+    """
+    try:
+        page_text = pdf_reader.pages[page_num].extract_text()
+        
+        # Rimpiazza eventuali caratteri NULL con spazi
+        if page_text:
+            page_text = page_text.replace('\x00', ' ').strip()
+        
+        # If page has no text (possibly a scanned image)
+        if not page_text or len(page_text) < SCANNED_PAGE_MIN_CHARS:
+            logger.info(f"Page {page_num+1} appears to be a scanned image")
+            return None
+        
+        return page_text
+    except Exception as page_error:
+        logger.warning(f"Error extracting text from page {page_num+1}: {str(page_error)}")
+        return f"[Error extracting text from page {page_num+1}]"
+
+def _scanned_placeholder(page_num):
+    return f"[Page {page_num+1} may contain scanned content. Text extraction limited.]"
+
+def _timeout_placeholder(page_num):
+    return f"[Page {page_num+1} skipped: extraction time limit reached]"
+
+# Placeholders of failed or partial extractions
+_INCOMPLETE_EXTRACTION_MARKERS = (
+    'Error extracting text',
+    'extraction failed:',
+    'extraction time limit reached',
+    'not available in this version',
+)
+
+def is_complete_extraction(text):
+    """
+    Return False if the extracted text contains the placeholders of errors,
+    time limits or unavailable OCR, i.e. a new extraction could give a
+    different result (such results are not cached).
+    """
+    if not text:
+        return True
+    if any(marker in text for marker in _INCOMPLETE_EXTRACTION_MARKERS):
+        return False
+    return ocr_available() or 'may contain scanned content' not in text
+
+def _init_pdf_worker(memory_limit_mb):
+    """
+    Process pool initializer: caps the address space of the extraction worker.
+    """
+    if not memory_limit_mb or resource is None:
+        return
+    try:
+        with open('/proc/self/statm') as statm:
+            inherited = int(statm.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        inherited = 0
+    limit = inherited + memory_limit_mb * 1024 * 1024
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ValueError, OSError) as e:
+        logger.warning(f"Unable to set the memory limit of the PDF extraction worker: {str(e)}")
+
+# PDF opened by the current worker process, reused by its following tasks
+_worker_pdf = {}
+
+def _worker_reader(pdf_path):
+    """
+    Return the reader of the PDF in the current worker, opening it on first use.
+    The file is memory-mapped, so the pages are read from the page cache
+    instead of being copied into each worker.
+    """
+    if _worker_pdf.get('path') != pdf_path:
+        _worker_pdf.clear()
+        with open(pdf_path, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        _worker_pdf.update(path=pdf_path, data=data, reader=PyPDF2.PdfReader(data))
+    return _worker_pdf['reader']
+
+def _extract_page_range(pdf_path, start, stop, deadline):
+    """
+    Worker task: extract the pages in [start, stop) of a PDF opened independently by the worker.
+    """
+    pdf_reader = _worker_reader(pdf_path)
+    texts = []
+    for page_num in range(start, stop):
+        if time.time() > deadline:
+            texts.append(_timeout_placeholder(page_num))
+        else:
+            texts.append(_extract_page_text(pdf_reader, page_num))
+    return texts
+
+def _shutdown_pool(executor, kill=False):
+    """
+    Shut down an extraction process pool; with kill, the workers still running
+    (stuck on a single page, so not checking the deadline) are terminated.
+    """
+    if kill:
+        for process in list((getattr(executor, '_processes', None) or {}).values()):
+            process.terminate()
+    executor.shutdown(wait=not kill, cancel_futures=True)
+
+def _extract_pdf_pages_parallel(pdf_path, page_count, workers, deadline):
+    """
+    Extract the pages of a PDF in parallel, one task per page range, and
+    reassemble the results in page order.
+    """
+    pages_per_task = max(PDF_MIN_PAGES_PER_TASK, -(-page_count // (workers * PDF_TASKS_PER_WORKER)))
+    ranges = [(start, min(start + pages_per_task, page_count))
+              for start in range(0, page_count, pages_per_task)]
+    results = [None] * len(ranges)
+    
+    # fork: the workers only run PyPDF2 code, while spawn/forkserver would
+    # re-import the main module (the app and its scheduler) in every worker;
+    # extract_text_from_pdf only gets here from a single-threaded process
+    executor = ProcessPoolExecutor(max_workers=min(workers, len(ranges)),
+                                   mp_context=multiprocessing.get_context('fork'),
+                                   initializer=_init_pdf_worker,
+                                   initargs=(PDF_WORKER_MEMORY_LIMIT_MB,))
+    futures = {}
+    not_done = set()
+    try:
+        for index, (start, stop) in enumerate(ranges):
+            futures[executor.submit(_extract_page_range, pdf_path, start, stop, deadline)] = index
+        
+        timeout = max(0, deadline - time.time()) + PDF_EXTRACTION_KILL_GRACE_SECONDS
+        done, not_done = wait(futures, timeout=timeout)
+        
+        for future in done:
+            index = futures[future]
+            start, stop = ranges[index]
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                # Worker crashed (e.g. killed after exceeding the memory limit)
+                logger.warning(f"PDF extraction of pages {start+1}-{stop} failed: {type(e).__name__}: {str(e)}")
+                results[index] = [f"[Error extracting text from page {page_num+1}]" for page_num in range(start, stop)]
+        
+        for future in not_done:
+            start, stop = ranges[futures[future]]
+            logger.warning(f"PDF extraction of pages {start+1}-{stop} did not finish within the time limit")
+            results[futures[future]] = [_timeout_placeholder(page_num) for page_num in range(start, stop)]
+    finally:
+        _shutdown_pool(executor, kill=bool(not_done))
+    
+    return [text for chunk in results for text in chunk]
+
+def extract_text_from_pdf(pdf_path, workers=None, timeout=PDF_EXTRACTION_TIMEOUT_SECONDS):
+    """
+    Extract text from a PDF file using PyPDF2, with OCR of the scanned pages
+    (less than SCANNED_PAGE_MIN_CHARS characters of text).
+    
+    Large PDFs (at least PDF_PARALLEL_MIN_PAGES pages) are split into page
+    ranges extracted in parallel by a process pool; pages not extracted within
+    the timeout are replaced by a placeholder.
+    
+    Args:
+        pdf_path: Path to the PDF file
+        workers: Number of worker processes (default: PDF_EXTRACTION_WORKERS, 1 = serial;
+                 serial anyway in a multi-threaded process)
+        timeout: Time limit in seconds for the whole document
     """
     extracted_text = []
+    workers = PDF_EXTRACTION_WORKERS if workers is None else workers
+    if workers > 1 and threading.active_count() > 1:
+        # Forking a multi-threaded process can deadlock on locks held by the other threads
+        logger.warning("PDF extraction pool not used in a multi-threaded process, extracting serially")
+        workers = 1
+    deadline = time.time() + timeout
     
     try:
         with open(pdf_path, 'rb') as file:
             pdf_reader = PyPDF2.PdfReader(file)
+            page_count = len(pdf_reader.pages)
             
-            # Extract text from each page
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                try:
-                    page_text = page.extract_text()
-                    
-                    # Rimpiazza eventuali caratteri NULL con spazi
-                    if page_text:
-                        page_text = page_text.replace('\x00', ' ').strip()
-                    
-                    # If page has no text (possibly a scanned image)
-                    if not page_text or len(page_text) < 50:
-                        logger.info(f"Page {page_num+1} appears to be a scanned image. OCR is not available.")
-                        page_text = f"[Page {page_num+1} may contain scanned content. Text extraction limited.]"
-                    
-                    if page_text:
-                        extracted_text.append(page_text)
-                except Exception as page_error:
-                    logger.warning(f"Error extracting text from page {page_num+1}: {str(page_error)}")
-                    extracted_text.append(f"[Error extracting text from page {page_num+1}]")
+            if workers > 1 and page_count >= PDF_PARALLEL_MIN_PAGES:
+                extracted_text = _extract_pdf_pages_parallel(pdf_path, page_count, workers, deadline)
+            else:
+                # Extract text from each page
+                for page_num in range(page_count):
+                    if time.time() > deadline:
+                        extracted_text.append(_timeout_placeholder(page_num))
+                    else:
+                        extracted_text.append(_extract_page_text(pdf_reader, page_num))
+            
+            scanned = [page_num for page_num, text in enumerate(extracted_text) if text is None]
+            if scanned and ocr_available():
+                recognized = _ocr_pdf_pages(pdf_path, pdf_reader, scanned, workers, deadline)
+                for page_num in scanned[:OCR_MAX_PAGES]:
+                    if page_num not in recognized:
+                        # OCR failed or interrupted: not a page without text
+                        extracted_text[page_num] = (_timeout_placeholder(page_num) if time.time() > deadline
+                                                    else f"[Error extracting text from page {page_num+1}]")
+                    elif recognized[page_num]:
+                        extracted_text[page_num] = recognized[page_num]
     
     except Exception as e:
         logger.error(f"PDF text extraction failed: {str(e)}")
         extracted_text.append(f"PDF text extraction failed: {str(e)}")
     
+    # Scanned pages without recognized text keep a placeholder
+    extracted_text = [_scanned_placeholder(page_num) if text is None else text
+                      for page_num, text in enumerate(extracted_text)]
+    
     # Assicuriamoci che non ci siano caratteri NULL nel testo finale
     final_text = "\n\n".join(extracted_text)
     if '\x00' in final_text:
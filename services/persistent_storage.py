@@ -8,7 +8,6 @@ e recupero automatico per assicurare che nessun file venga mai perso.
 
 import os
 import logging
-import shutil
 import datetime
 import json
 import uuid
@@ -16,6 +15,13 @@ import base64
 from flask import current_app
 from werkzeug.utils import secure_filename
 from models import Document, db
+from services.storage_layout import sharded_path, resolve_path
+from services.stream_writer import open_source, stream_to_files
+from services.replica_copy import copy_file, replicate_file
+from services.replication_queue import enqueue_replicas, get_completed_replicas
+from services import storage_index
+from services.location_index import record_location, find_paths, find_paths_for_name
+from services.checksum_cache import file_checksum, compute_checksums, remember_checksums
 
 # Configurazione dei percorsi assoluti per lo storage
 BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
@@ -33,12 +39,13 @@ SECONDARY_STORAGE_DIRS = [
     os.path.join(BASE_DIR, 'document_cache')
 ]
 
-# File di indice per il monitoraggio dei file
+# Vecchio file di indice JSON (sostituito da services/storage_index.py, vedi migrate_storage_index.py)
 STORAGE_INDEX_FILE = os.path.join(PERMANENT_STORAGE_ROOT, 'storage_index.json')
 
 def ensure_storage_structure():
     """
-    Crea tutte le directory necessarie per lo storage permanente e inizializza l'indice.
+    Crea tutte le directory necessarie per lo storage permanente.
+    L'indice SQLite viene inizializzato alla prima connessione.
     """
     # Crea le directory principali di storage permanente
     os.makedirs(PERMANENT_ORIGINALS_DIR, exist_ok=True)
@@ -48,18 +55,6 @@ def ensure_storage_structure():
     for directory in SECONDARY_STORAGE_DIRS:
         os.makedirs(directory, exist_ok=True)
     
-    # Verifica e inizializza il file di indice se non esiste
-    if not os.path.exists(STORAGE_INDEX_FILE):
-        with open(STORAGE_INDEX_FILE, 'w') as f:
-            json.dump({
-                'files': {},
-                'last_updated': datetime.datetime.now().isoformat(),
-                'stats': {
-                    'total_files': 0,
-                    'total_size': 0
-                }
-            }, f, indent=2)
-    
     logging.info(f"Sistema di storage permanente inizializzato in: {PERMANENT_STORAGE_ROOT}")
     return True
 
@@ -74,35 +69,8 @@ def update_storage_index(filename, file_info):
     Returns:
         bool: True se l'aggiornamento è riuscito, False altrimenti
     """
-    try:
-        # Assicurati che l'indice esista
-        ensure_storage_structure()
-        
-        # Leggi l'indice attuale
-        with open(STORAGE_INDEX_FILE, 'r') as f:
-            index = json.load(f)
-        
-        # Aggiungi o aggiorna le informazioni sul file
-        index['files'][filename] = file_info
-        
-        # Aggiorna le statistiche
-        index['last_updated'] = datetime.datetime.now().isoformat()
-        index['stats']['total_files'] = len(index['files'])
-        
-        # Calcola la dimensione totale
-        total_size = 0
-        for file_data in index['files'].values():
-            total_size += file_data.get('size', 0)
-        index['stats']['total_size'] = total_size
-        
-        # Salva l'indice aggiornato
-        with open(STORAGE_INDEX_FILE, 'w') as f:
-            json.dump(index, f, indent=2)
-        
-        return True
-    except Exception as e:
-        logging.error(f"Errore durante l'aggiornamento dell'indice di storage: {str(e)}")
-        return False
+    # Inserimento di una singola riga; i totali sono aggiornati in modo incrementale
+    return storage_index.put_file(filename, file_info)
 
 def get_file_info_from_index(filename):
     """
@@ -114,17 +82,7 @@ def get_file_info_from_index(filename):
     Returns:
         dict: Le informazioni sul file o None se non trovato
     """
-    try:
-        if not os.path.exists(STORAGE_INDEX_FILE):
-            return None
-        
-        with open(STORAGE_INDEX_FILE, 'r') as f:
-            index = json.load(f)
-        
-        return index['files'].get(filename)
-    except Exception as e:
-        logging.error(f"Errore durante la lettura dell'indice di storage: {str(e)}")
-        return None
+    return storage_index.get_file(filename)
 
 def generate_unique_filename(original_filename):
     """
@@ -184,43 +142,44 @@ def store_permanent_file(file_obj=None, file_path=None, original_filename=None,
         # Assicura che la struttura di storage esista
         ensure_storage_structure()
         
-        # Percorsi per lo storage del file
-        primary_path = os.path.join(PERMANENT_ORIGINALS_DIR, unique_filename)
-        backup_path = os.path.join(PERMANENT_BACKUP_DIR, unique_filename)
-        
-        # Archivia il file nella posizione primaria
-        if file_obj:
-            file_obj.save(primary_path)
-        elif file_path and os.path.exists(file_path):
-            shutil.copy2(file_path, primary_path)
-        else:
-            raise FileNotFoundError(f"Il file {file_path} non esiste")
-        
-        # Verifica che il file sia stato salvato correttamente
-        if not os.path.exists(primary_path):
-            raise IOError(f"Il file non è stato salvato correttamente in {primary_path}")
-        
-        # Ottieni informazioni sul file
-        file_size = os.path.getsize(primary_path)
-        file_type = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else 'unknown'
-        
-        # Crea copie di backup in tutte le posizioni secondarie
-        backup_copies = []
-        
-        # Prima copia nella directory di backup principale
-        shutil.copy2(primary_path, backup_path)
-        backup_copies.append(backup_path)
+        # Percorsi per lo storage del file (layout partizionato originals/ab/cd/<file>)
+        primary_path = sharded_path(PERMANENT_ORIGINALS_DIR, unique_filename, create_dirs=True)
+        backup_path = sharded_path(PERMANENT_BACKUP_DIR, unique_filename, create_dirs=True)
         
         # Copie aggiuntive nelle directory secondarie
+        secondary_paths = []
         for dir_path in SECONDARY_STORAGE_DIRS:
             if os.path.exists(dir_path):
-                secondary_path = os.path.join(dir_path, unique_filename)
                 try:
-                    shutil.copy2(primary_path, secondary_path)
-                    backup_copies.append(secondary_path)
+                    secondary_paths.append(sharded_path(dir_path, unique_filename, create_dirs=True))
                 except Exception as e:
                     logging.warning(f"Impossibile creare copia in {dir_path}: {str(e)}")
         
+        # Archivia il file nella posizione primaria leggendo il contenuto una sola volta
+        source, close_source = open_source(file_obj=file_obj, file_path=file_path)
+        try:
+            result = stream_to_files(source, [primary_path])
+        finally:
+            if close_source:
+                source.close()
+        
+        # Il backup principale (obbligatorio) è una replica sincrona del file primario
+        # (reflink o copia nel kernel, se possibile)
+        try:
+            replicate_file(primary_path, [backup_path])
+        except OSError:
+            os.remove(primary_path)
+            raise
+        
+        # Le copie secondarie vengono accodate e scritte in background
+        secondary_copies = enqueue_replicas(primary_path, secondary_paths, unique_filename,
+                                            document_id=document_id)
+        
+        # Ottieni informazioni sul file
+        file_size = result['size']
+        file_type = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else 'unknown'
+        backup_copies = [backup_path] + secondary_copies
+        
         # Prepara i dettagli del file per l'indice
         file_details = {
             'original_filename': original_filename,
@@ -229,16 +188,21 @@ def store_permanent_file(file_obj=None, file_path=None, original_filename=None,
             'backup_paths': backup_copies,
             'size': file_size,
             'type': file_type,
+            'mime_type': result['mime_type'],
             'document_id': document_id,
             'created_at': datetime.datetime.now().isoformat(),
-            'checksum': calculate_file_checksum(primary_path)
+            'checksum': result['md5']
         }
+        remember_checksums(primary_path, {'sha256': result['sha256'], 'md5': result['md5']})
         
-        # Aggiorna l'indice di storage
+        # Aggiorna l'indice di storage e l'indice delle posizioni
         update_storage_index(unique_filename, file_details)
+        for path in [primary_path] + backup_copies:
+            record_location(path, content_hash=result['sha256'], size=file_size)
         
         # Log del salvataggio
-        logging.info(f"File archiviato permanentemente: {unique_filename} ({len(backup_copies)} copie di backup)")
+        logging.info(f"File archiviato permanentemente: {unique_filename} ({len(backup_copies)} copie di backup, "
+                     f"{len(secondary_paths) - len(secondary_copies)} repliche in coda)")
         
         return {
             'filename': unique_filename,
@@ -246,6 +210,8 @@ def store_permanent_file(file_obj=None, file_path=None, original_filename=None,
             'file_path': primary_path,
             'file_type': file_type,
             'file_size': file_size,
+            'mime_type': result['mime_type'],
+            'content_hash': result['sha256'],
             'backup_paths': backup_copies
         }
     except Exception as e:
@@ -254,7 +220,8 @@ def store_permanent_file(file_obj=None, file_path=None, original_filename=None,
 
 def calculate_file_checksum(file_path):
     """
-    Calcola un checksum semplice per un file.
+    Calcola il checksum MD5 di un file, riusando quello in cache se il file
+    non è cambiato (vedi services/checksum_cache.py).
     
     Args:
         file_path: Percorso del file
@@ -263,14 +230,7 @@ def calculate_file_checksum(file_path):
         str: Checksum del file
     """
     try:
-        import hashlib
-        hasher = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            buf = f.read(65536)  # Leggi in blocchi da 64k
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = f.read(65536)
-        return hasher.hexdigest()
+        return file_checksum(file_path, 'md5')
     except Exception as e:
         logging.error(f"Errore durante il calcolo del checksum: {str(e)}")
         return None
@@ -301,23 +261,26 @@ def get_permanent_file(filename=None, document_id=None):
         # Assicurati che la struttura di storage esista
         ensure_storage_structure()
         
-        # 1. Prova nel percorso principale
-        primary_path = os.path.join(PERMANENT_ORIGINALS_DIR, filename)
-        if os.path.exists(primary_path) and os.path.isfile(primary_path):
-            logging.debug(f"File trovato nel percorso principale: {primary_path}")
+        # 1. Prova nel percorso principale (calcolato dal nome, senza scansioni)
+        existing_path = resolve_path(PERMANENT_ORIGINALS_DIR, filename)
+        if existing_path:
+            logging.debug(f"File trovato nel percorso principale: {existing_path}")
             
             # Verifica integrità tramite checksum
             file_info = get_file_info_from_index(filename)
             if file_info and file_info.get('checksum'):
-                current_checksum = calculate_file_checksum(primary_path)
+                current_checksum = calculate_file_checksum(existing_path)
                 if current_checksum != file_info['checksum']:
                     logging.warning(f"Checksum non corrispondente per {filename}. Tentativo di ripristino...")
                     # Se il checksum non corrisponde, prova a ripristinare da un backup
-                    primary_path = restore_from_backup(filename)
+                    existing_path = restore_from_backup(filename)
             
             # Se il file esiste e passa i controlli, restituisci il percorso
-            if os.path.exists(primary_path):
-                return primary_path
+            if existing_path and os.path.exists(existing_path):
+                return existing_path
+        
+        # Posizione di destinazione per i ripristini
+        primary_path = sharded_path(PERMANENT_ORIGINALS_DIR, filename, create_dirs=True)
         
         # 2. Se non trovato nel percorso principale, prova a ripristinarlo dai backup
         restored_path = restore_from_backup(filename)
@@ -331,7 +294,7 @@ def get_permanent_file(filename=None, document_id=None):
             logging.info(f"File trovato in percorso alternativo: {search_result}")
             # Ripristina il file nel percorso principale e aggiorna l'indice
             try:
-                shutil.copy2(search_result, primary_path)
+                copy_file(search_result, primary_path)
                 
                 # Aggiorna l'indice di storage
                 file_details = {
@@ -363,7 +326,7 @@ def get_permanent_file(filename=None, document_id=None):
                 
                 # Copialo nel sistema permanente
                 try:
-                    shutil.copy2(document.file_path, primary_path)
+                    copy_file(document.file_path, primary_path)
                     file_details = {
                         'original_filename': document.original_filename,
                         'storage_filename': filename,
@@ -389,18 +352,21 @@ def get_permanent_file(filename=None, document_id=None):
                     # Se il ripristino fallisce, restituisci comunque il percorso originale
                     return document.file_path
         
-        # 5. Se tutte le strategie falliscono, cerca in tutto il filesystem
-        find_command = f"find {BASE_DIR} -name '{filename}' 2>/dev/null"
+        # 5. Se tutte le strategie falliscono, cerca una copia con lo stesso contenuto
+        #    nell'indice delle posizioni (nessuna scansione del filesystem)
         try:
-            import subprocess
-            result = subprocess.run(find_command, shell=True, capture_output=True, text=True)
-            if result.stdout.strip():
-                found_path = result.stdout.strip().split('\n')[0]  # Prendi solo il primo risultato
-                logging.info(f"File trovato con ricerca nel filesystem: {found_path}")
+            content_hash = None
+            if document_id:
+                document = Document.query.get(document_id)
+                content_hash = document.content_hash if document else None
+            found = find_paths(content_hash=content_hash) if content_hash else []
+            if found:
+                found_path = found[0]  # Prendi solo il primo risultato
+                logging.info(f"File trovato nell'indice delle posizioni: {found_path}")
                 
                 # Ripristina il file nel percorso principale
                 try:
-                    shutil.copy2(found_path, primary_path)
+                    copy_file(found_path, primary_path)
                     file_details = {
                         'original_filename': os.path.basename(found_path),
                         'storage_filename': filename,
@@ -428,7 +394,7 @@ def get_permanent_file(filename=None, document_id=None):
                     # Se il ripristino fallisce, restituisci comunque il percorso trovato
                     return found_path
         except Exception as e:
-            logging.error(f"Errore durante la ricerca nel filesystem: {str(e)}")
+            logging.error(f"Errore durante la ricerca nell'indice delle posizioni: {str(e)}")
         
         # File non trovato con nessun metodo
         logging.warning(f"File non trovato in nessuna posizione: {filename}")
@@ -448,13 +414,14 @@ def restore_from_backup(filename):
         str: Percorso al file ripristinato o None se non trovato
     """
     # Percorso nella directory principale
-    primary_path = os.path.join(PERMANENT_ORIGINALS_DIR, filename)
+    primary_path = sharded_path(PERMANENT_ORIGINALS_DIR, filename, create_dirs=True)
     
     # 1. Prima prova nella directory di backup principale
-    backup_path = os.path.join(PERMANENT_BACKUP_DIR, filename)
-    if os.path.exists(backup_path) and os.path.isfile(backup_path):
+    backup_path = resolve_path(PERMANENT_BACKUP_DIR, filename)
+    if backup_path:
         try:
-            shutil.copy2(backup_path, primary_path)
+            copy_file(backup_path, primary_path)
+            record_location(primary_path)
             logging.info(f"File ripristinato dalla directory di backup principale: {backup_path}")
             return primary_path
         except Exception as e:
@@ -462,10 +429,11 @@ def restore_from_backup(filename):
     
     # 2. Prova nelle directory secondarie
     for dir_path in SECONDARY_STORAGE_DIRS:
-        secondary_path = os.path.join(dir_path, filename)
-        if os.path.exists(secondary_path) and os.path.isfile(secondary_path):
+        secondary_path = resolve_path(dir_path, filename)
+        if secondary_path:
             try:
-                shutil.copy2(secondary_path, primary_path)
+                copy_file(secondary_path, primary_path)
+                record_location(primary_path)
                 logging.info(f"File ripristinato dalla directory secondaria: {secondary_path}")
                 return primary_path
             except Exception as e:
@@ -477,12 +445,24 @@ def restore_from_backup(filename):
         for backup_path in file_info['backup_paths']:
             if os.path.exists(backup_path) and os.path.isfile(backup_path):
                 try:
-                    shutil.copy2(backup_path, primary_path)
+                    copy_file(backup_path, primary_path)
+                    record_location(primary_path)
                     logging.info(f"File ripristinato dal percorso registrato nell'indice: {backup_path}")
                     return primary_path
                 except Exception as e:
                     logging.error(f"Errore durante il ripristino dal percorso nell'indice: {str(e)}")
     
+    # 4. Usa una qualsiasi replica completata dalla coda di replica
+    for replica_path in get_completed_replicas(filename):
+        if os.path.isfile(replica_path):
+            try:
+                copy_file(replica_path, primary_path)
+                record_location(primary_path)
+                logging.info(f"File ripristinato da una replica completata: {replica_path}")
+                return primary_path
+            except Exception as e:
+                logging.error(f"Errore durante il ripristino dalla replica: {str(e)}")
+    
     return None
 
 def search_file_in_all_paths(filename):
@@ -506,30 +486,16 @@ def search_file_in_all_paths(filename):
         os.path.join(BASE_DIR, 'exports')
     ]
     
-    # Cerca il file esatto
+    # Cerca il file esatto (percorso calcolato dal nome, senza scansioni)
     for dir_path in all_paths:
-        if os.path.exists(dir_path):
-            full_path = os.path.join(dir_path, filename)
-            if os.path.exists(full_path) and os.path.isfile(full_path):
-                return full_path
-    
-    # Cerca file con parti del nome (UUID o nome originale)
-    uuid_part = None
-    if '_' in filename:
-        uuid_part = filename.split('_', 1)[0]
-    
-    original_name = None
-    if '_' in filename:
-        original_name = filename.split('_', 1)[1]
+        full_path = resolve_path(dir_path, filename)
+        if full_path:
+            return full_path
     
-    if uuid_part or original_name:
-        for dir_path in all_paths:
-            if os.path.exists(dir_path):
-                for file in os.listdir(dir_path):
-                    if uuid_part and file.startswith(uuid_part):
-                        return os.path.join(dir_path, file)
-                    elif original_name and original_name in file:
-                        return os.path.join(dir_path, file)
+    # Cerca file con parti del nome (UUID o nome originale) nell'indice delle posizioni
+    found_paths = find_paths_for_name(filename)
+    if found_paths:
+        return found_paths[0]
     
     return None
 
@@ -657,7 +623,8 @@ def migrate_document_to_permanent_storage(document):
 
 def batch_migrate_to_permanent_storage(limit=100):
     """
-    Migra in batch tutti i documenti al sistema di storage permanente.
+    Migra un blocco di documenti al sistema di storage permanente.
+    Ogni chiamata prosegue dal checkpoint della precedente (services/migration_runner.py).
     
     Args:
         limit: Numero massimo di documenti da migrare
@@ -665,6 +632,8 @@ def batch_migrate_to_permanent_storage(limit=100):
     Returns:
         dict: Statistiche sull'operazione di migrazione
     """
+    from services.migration_runner import run_migration, get_resumable_migration
+    
     stats = {
         'total': 0,
         'migrated': 0,
@@ -673,29 +642,17 @@ def batch_migrate_to_permanent_storage(limit=100):
     }
     
     try:
-        # Recupera tutti i documenti dal database (con limite)
-        documents = Document.query.limit(limit).all()
-        stats['total'] = len(documents)
-        
-        for doc in documents:
-            try:
-                # Tenta di migrare il documento
-                result = migrate_document_to_permanent_storage(doc)
-                
-                if result['status'] in ['migrated', 'ok', 'restored']:
-                    stats['migrated'] += 1
-                else:
-                    stats['failed'] += 1
-                    stats['errors'].append({
-                        'document_id': doc.id,
-                        'reason': result['message']
-                    })
-            except Exception as e:
-                stats['failed'] += 1
-                stats['errors'].append({
-                    'document_id': doc.id,
-                    'reason': str(e)
-                })
+        run = get_resumable_migration('permanent')
+        before = (run.processed_count, run.ok_count + run.repaired_count, run.failed_count) if run else (0, 0, 0)
+        
+        run = run_migration('permanent', batch_size=limit, max_batches=1)
+        stats['total'] = run.processed_count - before[0]
+        stats['migrated'] = run.ok_count + run.repaired_count - before[1]
+        stats['failed'] = run.failed_count - before[2]
+        stats['completed'] = run.status == 'completed'
+        if stats['failed']:
+            stats['errors'] = [{'general_error': error}
+                               for error in (json.loads(run.errors) if run.errors else [])[-stats['failed']:]]
         
         return stats
     except Exception as e:
@@ -722,25 +679,24 @@ def verify_storage_integrity(limit=100):
     }
     
     try:
-        # Leggi l'indice di storage
-        if not os.path.exists(STORAGE_INDEX_FILE):
-            return {'status': 'error', 'message': 'Indice di storage non trovato'}
-        
-        with open(STORAGE_INDEX_FILE, 'r') as f:
-            index = json.load(f)
-        
-        # Verifica un numero limitato di file
-        files_to_check = list(index['files'].keys())[:limit]
+        # Verifica un numero limitato di file dell'indice
+        files_to_check = list(storage_index.iter_files(limit=limit))
         stats['total'] = len(files_to_check)
         
-        for filename in files_to_check:
-            file_info = index['files'][filename]
+        # Checksum calcolati in parallelo: i file non modificati usano la cache
+        checksums = compute_checksums(
+            [file_info['primary_path'] for _, file_info in files_to_check
+             if file_info.get('primary_path') and 'checksum' in file_info],
+            algorithms=('md5',)
+        )
+        
+        for filename, file_info in files_to_check:
             primary_path = file_info.get('primary_path')
             
             # Verifica se il file principale esiste e ha il checksum corretto
             if primary_path and os.path.exists(primary_path):
                 if 'checksum' in file_info:
-                    current_checksum = calculate_file_checksum(primary_path)
+                    current_checksum = (checksums.get(primary_path) or {}).get('md5')
                     if current_checksum == file_info['checksum']:
                         stats['ok'] += 1
                     else:
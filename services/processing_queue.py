@@ -0,0 +1,486 @@
+"""
+Coda persistente per l'elaborazione in background dei documenti caricati.
+
+Gli upload salvano il file e creano il documento, poi accodano le fasi di
+elaborazione come righe ProcessingJob invece di eseguirle nella richiesta:
+- extract_text: testo estratto (usato dalla ricerca) e classificazione per tipo di file
+  (per gli allegati, con il classificatore di services/ai_classifier.py)
+- metadata: metadati estratti dal file
+- thumbnail: miniatura delle immagini (cache degli artefatti)
+Con la stessa coda vengono eseguiti i job di manutenzione (MAINTENANCE_JOB_TYPES),
+come la codifica delta delle versioni precedenti dopo il caricamento di una nuova versione.
+
+I job vengono prenotati in ordine di priorità (0 = massima) con un aggiornamento
+condizionale per riga, sicuro tra più processi, ed eseguiti con tentativi
+ripetuti e attesa esponenziale. Il calcolo avviene senza transazioni aperte
+sul database; il risultato viene applicato solo se il contenuto del documento
+non è cambiato nel frattempo (altrimenti se ne occupa il job più recente).
+
+Esecuzione:
+- PROCESSING_QUEUE_MODE=scheduler (default): job dello scheduler nel processo web (app.py)
+- PROCESSING_QUEUE_MODE=external: pool di worker separato da gunicorn (process_documents.py)
+
+get_processing_status riassume lo stato delle fasi di un documento per l'interfaccia.
+"""
+
+import os
+import time
+import socket
+import shutil
+import logging
+import datetime
+import tempfile
+from collections import namedtuple
+from sqlalchemy import func
+from contextlib import contextmanager
+from app import db
+from models import Document, DocumentVersion, DocumentMetadata, ProcessingJob
+from services.extraction_cache import get_cached_extraction, extract_document_content
+from services.delta_store import deltify_versions_since
+from services.storage_backend import get_storage_backend, key_for_path
+from services.thumbnails import get_thumbnail, can_thumbnail
+from services.ai_classifier import classify_document
+
+# Dove vengono eseguiti i job: 'scheduler' (processo web) o 'external' (process_documents.py)
+PROCESSING_QUEUE_MODE = os.environ.get('PROCESSING_QUEUE_MODE', 'scheduler').strip().lower()
+
+# Fasi di elaborazione di un documento, nell'ordine in cui vengono accodate
+PROCESSING_JOB_TYPES = ('extract_text', 'metadata', 'thumbnail')
+
+# Job di manutenzione dello storage, accodati a parte e non mostrati nello stato dell'elaborazione:
+# - delta_versions: archiviazione come delta delle versioni precedenti (services/delta_store.py)
+MAINTENANCE_JOB_TYPES = ('delta_versions',)
+
+# Priorità: upload interattivi prima delle rielaborazioni massive
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 9
+
+# Intervallo del job dello scheduler e job eseguiti per ogni esecuzione
+PROCESSING_INTERVAL_SECONDS = 10
+PROCESSING_BATCH_SIZE = 10
+
+# Attesa di un worker esterno quando la coda è vuota
+PROCESSING_POLL_SECONDS = 2
+
+# Tentativi massimi e attesa iniziale (raddoppiata ad ogni tentativo fallito)
+PROCESSING_MAX_ATTEMPTS = 3
+PROCESSING_RETRY_BASE_SECONDS = 30
+
+# Un job "running" non aggiornato da più di questi minuti viene rimesso in coda (worker terminato)
+PROCESSING_STALE_MINUTES = 30
+
+# Giorni di conservazione dei job conclusi
+PROCESSING_JOB_RETENTION_DAYS = 7
+
+# Dati del documento letti prima del calcolo, senza tenere aperta la sessione
+_DocumentSnapshot = namedtuple('_DocumentSnapshot', 'id file_path file_type content_hash is_attachment')
+
+def _worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def enqueue_document_processing(document, user_id=None, priority=PRIORITY_NORMAL, job_types=PROCESSING_JOB_TYPES):
+    """
+    Accoda le fasi di elaborazione di un documento (da chiamare dopo il commit del documento).
+
+    Una fase già in attesa per lo stesso documento non viene duplicata: il job
+    elaborerà il contenuto presente al momento dell'esecuzione.
+
+    Args:
+        document: Documento da elaborare
+        user_id: Utente che ha avviato l'elaborazione (opzionale)
+        priority: Priorità dei job (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+        job_types: Fasi da eseguire
+
+    Returns:
+        list: Job creati
+    """
+    pending = {
+        job_type for (job_type,) in db.session.query(ProcessingJob.job_type).filter(
+            ProcessingJob.document_id == document.id,
+            ProcessingJob.status == 'pending'
+        )
+    }
+
+    jobs = []
+    for job_type in job_types:
+        if job_type in pending:
+            continue
+        if job_type == 'thumbnail' and not can_thumbnail(document):
+            continue
+        job = ProcessingJob(
+            document_id=document.id,
+            job_type=job_type,
+            priority=priority,
+            user_id=user_id,
+            status='pending',
+            next_attempt_at=datetime.datetime.utcnow()
+        )
+        db.session.add(job)
+        jobs.append(job)
+
+    db.session.commit()
+    return jobs
+
+def get_processing_status(document_id):
+    """
+    Riassume lo stato dell'elaborazione di un documento.
+
+    Args:
+        document_id: ID del documento
+
+    Returns:
+        dict: status ('pending', 'processing', 'completed', 'failed' o None se il
+            documento non ha job) e stato di ciascuna fase
+    """
+    jobs = ProcessingJob.query.filter(
+        ProcessingJob.document_id == document_id,
+        ProcessingJob.job_type.notin_(MAINTENANCE_JOB_TYPES)
+    ).order_by(ProcessingJob.id).all()
+
+    # Per ogni fase conta il job più recente
+    stages = {}
+    for job in jobs:
+        stages[job.job_type] = {
+            'status': job.status,
+            'attempts': job.attempts,
+            'last_error': job.last_error,
+            'completed_at': job.completed_at.isoformat() if job.completed_at else None
+        }
+
+    statuses = {stage['status'] for stage in stages.values()}
+    if not statuses:
+        status = None
+    elif 'running' in statuses:
+        status = 'processing'
+    elif 'pending' in statuses:
+        status = 'pending'
+    elif 'failed' in statuses:
+        status = 'failed'
+    else:
+        status = 'completed'
+
+    return {'document_id': document_id, 'status': status, 'stages': stages}
+
+def _claim_jobs(limit, now, job_types=None):
+    """Prenota i job da eseguire (un aggiornamento condizionale per riga, sicuro tra più processi)."""
+    # Job di worker terminati (crash, memoria esaurita): rimessi in coda finché restano
+    # tentativi, altrimenti falliti, così un documento che termina il worker non torna in coda per sempre
+    stale_before = now - datetime.timedelta(minutes=PROCESSING_STALE_MINUTES)
+    stale = ProcessingJob.query.filter(
+        ProcessingJob.status == 'running',
+        ProcessingJob.updated_at < stale_before
+    )
+    failed = stale.filter(ProcessingJob.attempts >= PROCESSING_MAX_ATTEMPTS).update({
+        'status': 'failed',
+        'last_error': f"Worker terminato durante l'elaborazione (tentativi esauriti: {PROCESSING_MAX_ATTEMPTS})",
+        'updated_at': now
+    }, synchronize_session=False)
+    if failed:
+        logging.error(f"{failed} job di elaborazione falliti: worker terminato all'ultimo tentativo")
+    stale.filter(ProcessingJob.attempts < PROCESSING_MAX_ATTEMPTS) \
+        .update({'status': 'pending'}, synchronize_session=False)
+
+    query = db.session.query(ProcessingJob.id).filter(
+        ProcessingJob.status == 'pending',
+        ProcessingJob.next_attempt_at <= now
+    )
+    if job_types:
+        query = query.filter(ProcessingJob.job_type.in_(job_types))
+    # Più candidati del necessario: quelli prenotati da un altro worker vengono saltati
+    candidates = query.order_by(ProcessingJob.priority, ProcessingJob.next_attempt_at, ProcessingJob.id) \
+        .limit(limit * 4).all()
+
+    claimed = []
+    for (job_id,) in candidates:
+        updated = ProcessingJob.query.filter_by(id=job_id, status='pending').update({
+            'status': 'running',
+            'attempts': ProcessingJob.attempts + 1,
+            'worker': _worker_name(),
+            'updated_at': now
+        }, synchronize_session=False)
+        if updated:
+            claimed.append(job_id)
+            if len(claimed) >= limit:
+                break
+    db.session.commit()
+    return claimed
+
+@contextmanager
+def _local_source(file_path, file_type):
+    """
+    Percorso locale leggibile dagli estrattori: il file stesso se presente su disco,
+    altrimenti una copia temporanea letta dal backend (blob compressi, delta, storage a oggetti).
+    """
+    if os.path.isfile(file_path):
+        yield file_path
+        return
+
+    backend = get_storage_backend()
+    key = key_for_path(file_path)
+    if not backend.exists(key):
+        raise FileNotFoundError(file_path)
+
+    fd, temp_path = tempfile.mkstemp(suffix=f".{file_type}" if file_type else '')
+    try:
+        with os.fdopen(fd, 'wb') as target:
+            source = backend.open(key)
+            try:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            finally:
+                source.close()
+        yield temp_path
+    finally:
+        os.remove(temp_path)
+
+def _run_stage(job_type, snapshot):
+    """Esegue il calcolo di una fase (senza accesso al database) e ne restituisce il risultato."""
+    if job_type == 'thumbnail':
+        if get_thumbnail(snapshot, 'small') is None:
+            raise RuntimeError("Generazione della miniatura non riuscita")
+        return None
+
+    if job_type not in ('extract_text', 'metadata'):
+        raise ValueError(f"Tipo di job di elaborazione sconosciuto: {job_type}")
+
+    # Testo e metadati vengono estratti insieme e messi in cache per contenuto:
+    # la seconda fase (o lo stesso file in un altro documento) non rianalizza il file
+    extraction = get_cached_extraction(snapshot.content_hash, snapshot.file_type)
+    if extraction is None:
+        with _local_source(snapshot.file_path, snapshot.file_type) as path:
+            extraction = extract_document_content(path, snapshot.file_type, snapshot.content_hash)
+    if job_type == 'metadata':
+        return extraction['metadata']
+
+    # Gli allegati mantengono la classificazione del classificatore, gli altri documenti il tipo di file
+    if snapshot.is_attachment:
+        classification = classify_document(extraction['text'] or '', snapshot.file_type)
+    else:
+        classification = f"File {(snapshot.file_type or '').upper()}"
+    return {'text': extraction['text'], 'classification': classification}
+
+def _apply_stage(job, document, result):
+    """Salva nel documento il risultato di una fase."""
+    if job.job_type == 'extract_text':
+        document.content_text = result['text']
+        document.classification = result['classification']
+    elif job.job_type == 'metadata':
+        # Sostituisce solo le chiavi estratte dal file, senza toccare i metadati inseriti a mano
+        DocumentMetadata.query.filter(
+            DocumentMetadata.document_id == document.id,
+            DocumentMetadata.key.in_(list(result.keys()))
+        ).delete(synchronize_session=False)
+        for key, value in result.items():
+            db.session.add(DocumentMetadata(
+                document_id=document.id,
+                key=key,
+                value=str(value),
+                modified_by_id=job.user_id
+            ))
+
+def _finish(job, error):
+    """Registra l'esito di un tentativo, pianificando un nuovo tentativo se necessario."""
+    now = datetime.datetime.utcnow()
+    if error is None:
+        job.status = 'completed'
+        job.completed_at = now
+        job.last_error = None
+    elif job.attempts >= PROCESSING_MAX_ATTEMPTS:
+        job.status = 'failed'
+        job.last_error = error
+        logging.error(f"Elaborazione {job.job_type} del documento {job.document_id} fallita "
+                      f"dopo {job.attempts} tentativi: {error}")
+    else:
+        job.status = 'pending'
+        job.last_error = error
+        delay = PROCESSING_RETRY_BASE_SECONDS * (2 ** (job.attempts - 1))
+        job.next_attempt_at = now + datetime.timedelta(seconds=delay)
+        logging.warning(f"Elaborazione {job.job_type} del documento {job.document_id} non riuscita "
+                        f"(tentativo {job.attempts}), nuovo tentativo tra {delay} s: {error}")
+    db.session.commit()
+    return job.status
+
+def _run_delta_versions(job, document):
+    """
+    Archivia come delta le versioni precedenti rese codificabili dai caricamenti
+    successivi all'ultimo job delta_versions completato (senza job precedenti,
+    dal caricamento che ha accodato il job): un job che ha assorbito più
+    caricamenti ravvicinati li elabora tutti, senza rivalutare la cronologia più vecchia.
+
+    Ogni versione contiene il contenuto caricato: la versione N-1 diventa
+    codificabile quando il caricamento della versione N la sostituisce.
+    """
+    previous = ProcessingJob.query.filter(
+        ProcessingJob.document_id == document.id,
+        ProcessingJob.job_type == 'delta_versions',
+        ProcessingJob.status == 'completed',
+        ProcessingJob.id < job.id
+    ).order_by(ProcessingJob.id.desc()).first()
+    if previous is not None:
+        # Prima versione caricata dopo l'accodamento del job precedente
+        first_new = db.session.query(func.min(DocumentVersion.version_number)).filter(
+            DocumentVersion.document_id == document.id,
+            DocumentVersion.created_at >= previous.created_at
+        ).scalar()
+    else:
+        # Versione caricata dalla richiesta che ha accodato il job
+        first_new = db.session.query(func.max(DocumentVersion.version_number)).filter(
+            DocumentVersion.document_id == document.id,
+            DocumentVersion.created_at <= job.created_at
+        ).scalar()
+    if first_new is None:
+        return _finish(job, None)
+
+    started = time.monotonic()
+    try:
+        result = deltify_versions_since(document, first_new - 1)
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(ProcessingJob, job.id)
+        return _finish(job, f"{type(e).__name__}: {str(e)}")
+
+    logging.info(f"Codifica delta delle versioni del documento {document.id} completata "
+                 f"in {time.monotonic() - started:.2f} s: {result}")
+    return _finish(job, None)
+
+def process_job(job_id):
+    """
+    Esegue un job già prenotato.
+
+    Args:
+        job_id: ID del job (in stato running)
+
+    Returns:
+        str: Stato finale del job ('completed', 'pending' se verrà ritentato, 'failed', 'cancelled')
+    """
+    job = db.session.get(ProcessingJob, job_id)
+    document = db.session.get(Document, job.document_id)
+    if document is None:
+        job.status = 'cancelled'
+        job.last_error = 'Documento eliminato'
+        db.session.commit()
+        return job.status
+
+    if job.job_type == 'delta_versions':
+        return _run_delta_versions(job, document)
+
+    snapshot = _DocumentSnapshot(document.id, document.file_path, document.file_type, document.content_hash,
+                                 document.attached_to.count() > 0)
+    # Nessuna transazione resta aperta durante il calcolo
+    db.session.commit()
+
+    started = time.monotonic()
+    try:
+        result = _run_stage(job.job_type, snapshot)
+    except Exception as e:
+        return _finish(job, f"{type(e).__name__}: {str(e)}")
+
+    try:
+        document = db.session.get(Document, snapshot.id)
+        if document is None:
+            job.status = 'cancelled'
+            job.last_error = 'Documento eliminato'
+            db.session.commit()
+            return job.status
+        if document.content_hash != snapshot.content_hash or document.file_path != snapshot.file_path:
+            # Nuova versione caricata durante il calcolo: il risultato è già superato
+            logging.info(f"Elaborazione {job.job_type} del documento {document.id} superata da una nuova versione")
+            job.status = 'cancelled'
+            job.last_error = 'Contenuto modificato durante l\'elaborazione'
+            db.session.commit()
+            return job.status
+        _apply_stage(job, document, result)
+        status = _finish(job, None)
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(ProcessingJob, job_id)
+        return _finish(job, f"{type(e).__name__}: {str(e)}")
+
+    logging.info(f"Elaborazione {job.job_type} del documento {snapshot.id} completata "
+                 f"in {time.monotonic() - started:.2f} s")
+    return status
+
+def process_processing_queue(limit=PROCESSING_BATCH_SIZE, job_types=None):
+    """
+    Esegue i job in attesa il cui prossimo tentativo è scaduto, in ordine di priorità.
+
+    Args:
+        limit: Numero massimo di job da eseguire
+        job_types: Limita l'esecuzione ad alcune fasi (opzionale)
+
+    Returns:
+        dict: Statistiche dell'esecuzione
+    """
+    stats = {'processed': 0, 'completed': 0, 'retried': 0, 'failed': 0, 'cancelled': 0}
+
+    job_ids = _claim_jobs(limit, datetime.datetime.utcnow(), job_types)
+    for job_id in job_ids:
+        status = process_job(job_id)
+        stats['processed'] += 1
+        stats[{'pending': 'retried'}.get(status, status)] += 1
+
+    if job_ids:
+        logging.info(f"Coda di elaborazione: {stats['completed']} completati, {stats['retried']} da ritentare, "
+                     f"{stats['failed']} falliti, {stats['cancelled']} annullati")
+    return stats
+
+def run_worker(should_stop=lambda: False, poll_seconds=PROCESSING_POLL_SECONDS, exit_when_idle=False,
+               job_types=None, max_jobs=0):
+    """
+    Ciclo di un worker: esegue un job alla volta finché should_stop() non restituisce True.
+
+    Args:
+        should_stop: Funzione che segnala la richiesta di arresto (controllata tra un job e l'altro)
+        poll_seconds: Attesa quando la coda è vuota
+        exit_when_idle: Se True, termina quando non ci sono job eseguibili
+        job_types: Limita il worker ad alcune fasi (opzionale)
+        max_jobs: Termina dopo questo numero di job (0 = nessun limite)
+
+    Returns:
+        int: Numero di job eseguiti
+    """
+    processed = 0
+    while not should_stop() and not (max_jobs and processed >= max_jobs):
+        try:
+            stats = process_processing_queue(limit=1, job_types=job_types)
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Errore del worker di elaborazione {_worker_name()}: {str(e)}")
+            stats = {'processed': 0}
+
+        processed += stats['processed']
+        if stats['processed'] == 0:
+            if exit_when_idle:
+                break
+            time.sleep(poll_seconds)
+    return processed
+
+def enqueue_unprocessed_documents(priority=PRIORITY_LOW):
+    """
+    Accoda l'elaborazione dei documenti senza testo estratto e senza job (es. caricati prima della coda).
+
+    Returns:
+        int: Numero di documenti accodati
+    """
+    with_jobs = db.session.query(ProcessingJob.document_id)
+    documents = Document.query.filter(~Document.content.has(), Document.id.notin_(with_jobs)).all()
+    for document in documents:
+        enqueue_document_processing(document, priority=priority)
+    return len(documents)
+
+def purge_finished_jobs(retention_days=PROCESSING_JOB_RETENTION_DAYS):
+    """
+    Elimina i job conclusi più vecchi del periodo di conservazione.
+
+    Returns:
+        int: Numero di job eliminati
+    """
+    threshold = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+    deleted = ProcessingJob.query.filter(
+        ProcessingJob.status.in_(['completed', 'cancelled', 'failed']),
+        ProcessingJob.updated_at < threshold
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    if deleted:
+        logging.info(f"Eliminati {deleted} job di elaborazione conclusi")
+    return deleted
@@ -0,0 +1,293 @@
+"""
+Copia delle repliche (backup) con il meccanismo più economico disponibile.
+
+Per ogni coppia di filesystem (sorgente, destinazione) viene usata la prima
+strategia supportata tra:
+  - reflink (ioctl FICLONE): la copia condivide i blocchi con l'originale
+    (copy-on-write) e non scrive dati;
+  - os.copy_file_range: copia nel kernel, eventualmente delegata al server
+    (NFS) o al filesystem;
+  - os.sendfile: copia nel kernel senza passare dallo spazio utente;
+  - copia bufferizzata, sempre disponibile.
+
+Le strategie non supportate da una coppia di filesystem vengono ricordate e
+non più tentate. La strategia può essere fissata per directory di storage
+(REPLICA_STRATEGIES o variabile d'ambiente STORAGE_REPLICA_STRATEGIES, nel
+formato "percorso=strategia;percorso=strategia"). 'hardlink' è ammesso solo se
+configurato esplicitamente: un hardlink non protegge dalla corruzione del
+file, quindi non è mai scelto in automatico.
+"""
+
+import os
+import time
+import uuid
+import errno
+import shutil
+import logging
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Richiesta ioctl FICLONE di Linux (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+# Dimensione dei blocchi per sendfile e per la copia bufferizzata
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Ordine di preferenza delle strategie in modalità 'auto'
+AUTO_STRATEGIES = ['reflink', 'copy_file_range', 'sendfile', 'buffered']
+
+# Strategie configurabili esplicitamente
+VALID_STRATEGIES = ['auto', 'hardlink'] + AUTO_STRATEGIES
+
+# Errori che indicano una strategia non supportata (e non un problema del file)
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL,
+    errno.ENOSYS, errno.ENOTTY, errno.EPERM, errno.EBADF
+}
+
+def _parse_strategy_config(value):
+    """Interpreta la configurazione "percorso=strategia;percorso=strategia"."""
+    strategies = {}
+    for item in value.split(';'):
+        if '=' not in item:
+            continue
+        root, strategy = item.rsplit('=', 1)
+        strategy = strategy.strip()
+        if strategy not in VALID_STRATEGIES:
+            logging.warning(f"Strategia di replica non valida per {root}: {strategy}")
+            continue
+        strategies[os.path.abspath(root.strip())] = strategy
+    return strategies
+
+# Strategia predefinita e strategie per directory di storage
+DEFAULT_REPLICA_STRATEGY = os.environ.get('STORAGE_REPLICA_STRATEGY', 'auto')
+REPLICA_STRATEGIES = _parse_strategy_config(os.environ.get('STORAGE_REPLICA_STRATEGIES', ''))
+
+# Strategie risultate non supportate per coppia di dispositivi (st_dev sorgente, st_dev destinazione)
+_unsupported = {}
+_unsupported_lock = threading.Lock()
+
+def _clone(src_fd, dst_fd, size):
+    """Reflink dell'intero file (nessun dato copiato)."""
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "fcntl non disponibile")
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+def _copy_range(src_fd, dst_fd, size):
+    """Copia nel kernel con copy_file_range."""
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, "copy_file_range non disponibile")
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(src_fd, dst_fd, min(size - copied, 1 << 30))
+        if count == 0:
+            if copied == 0:
+                # Alcuni filesystem virtuali restituiscono 0 invece di un errore
+                raise OSError(errno.EINVAL, "copy_file_range non ha copiato dati")
+            break
+        copied += count
+
+def _sendfile(src_fd, dst_fd, size):
+    """Copia nel kernel con sendfile."""
+    if not hasattr(os, 'sendfile'):
+        raise OSError(errno.ENOSYS, "sendfile non disponibile")
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(dst_fd, src_fd, offset, min(size - offset, COPY_CHUNK_SIZE * 64))
+        if sent == 0:
+            break
+        offset += sent
+
+def _buffered(src_fd, dst_fd, size):
+    """Copia bufferizzata nello spazio utente."""
+    while True:
+        chunk = os.read(src_fd, COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        view = memoryview(chunk)
+        while view:
+            written = os.write(dst_fd, view)
+            view = view[written:]
+
+_COPY_FUNCTIONS = {
+    'reflink': _clone,
+    'copy_file_range': _copy_range,
+    'sendfile': _sendfile,
+    'buffered': _buffered
+}
+
+def get_replica_strategy(path):
+    """
+    Restituisce la strategia configurata per la directory che contiene il percorso.
+
+    Args:
+        path: Percorso di destinazione
+
+    Returns:
+        str: Nome della strategia ('auto' se non configurata)
+    """
+    path = os.path.abspath(path)
+    matches = [root for root in REPLICA_STRATEGIES if path.startswith(root + os.sep)]
+    if matches:
+        return REPLICA_STRATEGIES[max(matches, key=len)]
+    return DEFAULT_REPLICA_STRATEGY
+
+def _device_pair(src, dst):
+    """Coppia di dispositivi (sorgente, directory di destinazione)."""
+    return os.stat(src).st_dev, os.stat(os.path.dirname(dst) or '.').st_dev
+
+def _candidates(strategy, devices):
+    """Strategie da tentare, escluse quelle già risultate non supportate."""
+    if strategy in ('auto', 'hardlink'):
+        names = list(AUTO_STRATEGIES)
+    else:
+        names = [strategy, 'buffered'] if strategy != 'buffered' else ['buffered']
+    with _unsupported_lock:
+        skipped = _unsupported.get(devices, set())
+    return [name for name in names if name not in skipped or name == 'buffered']
+
+def _mark_unsupported(devices, strategy):
+    with _unsupported_lock:
+        _unsupported.setdefault(devices, set()).add(strategy)
+
+def copy_file(src, dst, strategy=None):
+    """
+    Copia un file sulla destinazione con la strategia più economica disponibile.
+    La destinazione viene scritta su un file temporaneo e rinominata atomicamente.
+
+    Args:
+        src: Percorso del file sorgente
+        dst: Percorso di destinazione
+        strategy: Strategia da usare (default: quella configurata per la destinazione)
+
+    Returns:
+        str: Strategia effettivamente usata
+    """
+    strategy = strategy or get_replica_strategy(dst)
+    devices = _device_pair(src, dst)
+    temp_path = f"{dst}.{uuid.uuid4().hex[:8]}.part"
+
+    if strategy == 'hardlink':
+        try:
+            os.link(src, temp_path)
+            os.replace(temp_path, dst)
+            return 'hardlink'
+        except OSError as e:
+            _remove_quietly(temp_path)
+            logging.warning(f"Hardlink non riuscito per {dst}, uso la copia: {str(e)}")
+
+    size = os.path.getsize(src)
+    used = None
+    try:
+        for name in _candidates(strategy, devices):
+            try:
+                with open(src, 'rb') as fsrc, open(temp_path, 'wb') as fdst:
+                    _COPY_FUNCTIONS[name](fsrc.fileno(), fdst.fileno(), size)
+                used = name
+                break
+            except OSError as e:
+                if name == 'buffered' or e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                _mark_unsupported(devices, name)
+                logging.debug(f"Strategia di copia {name} non supportata per {dst}: {str(e)}")
+
+        shutil.copystat(src, temp_path)
+        os.replace(temp_path, dst)
+    except Exception:
+        _remove_quietly(temp_path)
+        raise
+
+    return used
+
+def replicate_file(src, destinations, required=True):
+    """
+    Crea le repliche di un file appena scritto.
+
+    Args:
+        src: Percorso del file da replicare
+        destinations: Percorsi delle repliche
+        required: Se True, un errore interrompe l'operazione; altrimenti la replica viene saltata
+
+    Returns:
+        list: Percorsi delle repliche create
+    """
+    written = []
+    for destination in destinations:
+        try:
+            copy_file(src, destination)
+            written.append(destination)
+        except OSError as e:
+            if required:
+                raise
+            logging.warning(f"Impossibile creare la replica {destination}: {str(e)}")
+    return written
+
+def benchmark_strategies(directory, size_mb=64, rounds=3):
+    """
+    Misura il tempo di copia di ogni strategia rispetto a shutil.copy2.
+
+    Args:
+        directory: Directory in cui creare i file di prova (il filesystem da misurare)
+        size_mb: Dimensione del file di prova in MB
+        rounds: Numero di ripetizioni per strategia
+
+    Returns:
+        dict: Per ogni strategia, secondi medi e MB/s (None se non supportata)
+    """
+    os.makedirs(directory, exist_ok=True)
+    results = {}
+    fd, src = tempfile.mkstemp(dir=directory, suffix='.bench')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            block = os.urandom(COPY_CHUNK_SIZE)
+            for _ in range(size_mb):
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+
+        dst = os.path.join(directory, f"{uuid.uuid4().hex}.bench")
+        methods = [('shutil.copy2', lambda: shutil.copy2(src, dst))]
+        for name in AUTO_STRATEGIES:
+            methods.append((name, lambda name=name: _run_single_strategy(src, dst, name)))
+
+        for name, method in methods:
+            timings = []
+            try:
+                for _ in range(rounds):
+                    started = time.perf_counter()
+                    method()
+                    with open(dst, 'rb') as f:
+                        os.fsync(f.fileno())
+                    timings.append(time.perf_counter() - started)
+                    _remove_quietly(dst)
+            except OSError as e:
+                results[name] = {'seconds': None, 'mb_per_second': None, 'error': str(e)}
+                _remove_quietly(dst)
+                continue
+            seconds = sum(timings) / len(timings)
+            results[name] = {
+                'seconds': round(seconds, 4),
+                'mb_per_second': round(size_mb / seconds, 1) if seconds > 0 else None,
+                'error': None
+            }
+    finally:
+        _remove_quietly(src)
+
+    return results
+
+def _run_single_strategy(src, dst, name):
+    """Copia con una sola strategia, senza fallback (per il benchmark)."""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        _COPY_FUNCTIONS[name](fsrc.fileno(), fdst.fileno(), os.path.getsize(src))
+
+def _remove_quietly(path):
+    """Rimuove un file ignorando gli errori."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
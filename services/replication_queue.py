@@ -0,0 +1,210 @@
+"""
+Coda persistente per la replica asincrona dei file dello storage permanente.
+
+store_permanent_file scrive in modo sincrono solo la copia primaria e il backup
+principale; le copie nelle directory secondarie vengono accodate come righe
+ReplicationTask ed eseguite in background dal job dello scheduler (app.py),
+con tentativi ripetuti e attesa esponenziale tra un tentativo e l'altro.
+
+Ogni riga registra lo stato di una singola replica: i lettori possono usare
+qualsiasi replica completata (get_completed_replicas) se la copia primaria e
+il backup non sono disponibili.
+
+Contropressione: se la coda supera REPLICATION_QUEUE_LIMIT, le nuove repliche
+vengono scritte subito (in modo sincrono) invece di allungare ulteriormente la coda.
+"""
+
+import os
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from app import db
+from models import ReplicationTask
+from services.replica_copy import copy_file
+from services import storage_index
+from services.location_index import record_location
+
+# Intervallo del job dello scheduler che svuota la coda
+REPLICATION_INTERVAL_SECONDS = 30
+
+# Repliche elaborate per ogni esecuzione del job e thread di copia in parallelo
+REPLICATION_BATCH_SIZE = 100
+REPLICATION_WORKERS = 4
+
+# Tentativi massimi e attesa iniziale (raddoppiata ad ogni tentativo fallito)
+REPLICATION_MAX_ATTEMPTS = 6
+REPLICATION_RETRY_BASE_SECONDS = 30
+
+# Repliche in attesa oltre le quali le nuove vengono scritte in modo sincrono
+REPLICATION_QUEUE_LIMIT = 1000
+
+# Una replica "running" non aggiornata da più di questi minuti viene rimessa in coda
+REPLICATION_STALE_MINUTES = 15
+
+def get_queue_depth():
+    """Numero di repliche in attesa o in esecuzione."""
+    return ReplicationTask.query.filter(ReplicationTask.status.in_(['pending', 'running'])).count()
+
+def enqueue_replicas(source_path, target_paths, storage_filename, document_id=None):
+    """
+    Accoda la replica di un file verso le destinazioni indicate.
+
+    Args:
+        source_path: Percorso della copia da replicare
+        target_paths: Percorsi delle repliche
+        storage_filename: Nome del file nello storage permanente
+        document_id: ID del documento (opzionale)
+
+    Returns:
+        list: Percorsi delle repliche già completate (scritte in modo sincrono per contropressione)
+    """
+    if not target_paths:
+        return []
+
+    synchronous = get_queue_depth() >= REPLICATION_QUEUE_LIMIT
+    if synchronous:
+        logging.warning(f"Coda di replica piena: repliche di {storage_filename} scritte in modo sincrono")
+
+    completed = []
+    now = datetime.datetime.utcnow()
+    for target_path in target_paths:
+        task = ReplicationTask(
+            document_id=document_id,
+            storage_filename=storage_filename,
+            source_path=source_path,
+            target_path=target_path,
+            status='pending',
+            next_attempt_at=now
+        )
+        if synchronous:
+            task.attempts = 1
+            error = _copy_replica(source_path, target_path)
+            if error is None:
+                task.status = 'completed'
+                task.completed_at = now
+                record_location(target_path)
+                completed.append(target_path)
+            else:
+                task.last_error = error
+                task.next_attempt_at = now + datetime.timedelta(seconds=REPLICATION_RETRY_BASE_SECONDS)
+        db.session.add(task)
+
+    db.session.commit()
+    return completed
+
+def get_completed_replicas(storage_filename):
+    """
+    Restituisce le repliche completate di un file, le più recenti per prime.
+
+    Args:
+        storage_filename: Nome del file nello storage permanente
+
+    Returns:
+        list: Percorsi delle repliche completate
+    """
+    tasks = ReplicationTask.query.filter_by(storage_filename=storage_filename, status='completed') \
+        .order_by(ReplicationTask.completed_at.desc()).all()
+    return [task.target_path for task in tasks]
+
+def _copy_replica(source_path, target_path):
+    """Copia una replica (senza accesso al database). Restituisce None o il messaggio di errore."""
+    try:
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        copy_file(source_path, target_path)
+        return None
+    except Exception as e:
+        return str(e)
+
+def _claim_tasks(limit, now):
+    """Prenota le repliche da eseguire (un aggiornamento condizionale per riga, sicuro tra più processi)."""
+    stale_before = now - datetime.timedelta(minutes=REPLICATION_STALE_MINUTES)
+    ReplicationTask.query.filter(
+        ReplicationTask.status == 'running',
+        ReplicationTask.updated_at < stale_before
+    ).update({'status': 'pending'}, synchronize_session=False)
+
+    candidates = db.session.query(ReplicationTask.id).filter(
+        ReplicationTask.status == 'pending',
+        ReplicationTask.next_attempt_at <= now
+    ).order_by(ReplicationTask.next_attempt_at).limit(limit).all()
+
+    claimed = []
+    for (task_id,) in candidates:
+        updated = ReplicationTask.query.filter_by(id=task_id, status='pending').update({
+            'status': 'running',
+            'attempts': ReplicationTask.attempts + 1,
+            'updated_at': now
+        }, synchronize_session=False)
+        if updated:
+            claimed.append(task_id)
+    db.session.commit()
+
+    if not claimed:
+        return []
+    return ReplicationTask.query.filter(ReplicationTask.id.in_(claimed)).all()
+
+def _add_backup_path_to_index(storage_filename, target_path):
+    """Aggiunge una replica completata ai percorsi di backup dell'indice di storage."""
+    file_info = storage_index.get_file(storage_filename)
+    if file_info is None:
+        return
+    backup_paths = file_info.get('backup_paths') or []
+    if target_path not in backup_paths:
+        file_info['backup_paths'] = backup_paths + [target_path]
+        storage_index.put_file(storage_filename, file_info)
+
+def process_replication_queue(limit=REPLICATION_BATCH_SIZE, max_workers=REPLICATION_WORKERS):
+    """
+    Esegue le repliche in attesa il cui prossimo tentativo è scaduto.
+
+    Args:
+        limit: Numero massimo di repliche da eseguire
+        max_workers: Thread di copia in parallelo
+
+    Returns:
+        dict: Statistiche dell'esecuzione
+    """
+    stats = {
+        'processed': 0,
+        'completed': 0,
+        'retried': 0,
+        'failed': 0
+    }
+
+    now = datetime.datetime.utcnow()
+    tasks = _claim_tasks(limit, now)
+    if not tasks:
+        return stats
+
+    jobs = [(task.source_path, task.target_path) for task in tasks]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        errors = list(executor.map(lambda job: _copy_replica(*job), jobs))
+
+    finished_at = datetime.datetime.utcnow()
+    for task, error in zip(tasks, errors):
+        stats['processed'] += 1
+        if error is None:
+            task.status = 'completed'
+            task.completed_at = finished_at
+            task.last_error = None
+            record_location(task.target_path)
+            _add_backup_path_to_index(task.storage_filename, task.target_path)
+            stats['completed'] += 1
+        elif task.attempts >= REPLICATION_MAX_ATTEMPTS:
+            task.status = 'failed'
+            task.last_error = error
+            stats['failed'] += 1
+            logging.error(f"Replica {task.target_path} fallita dopo {task.attempts} tentativi: {error}")
+        else:
+            task.status = 'pending'
+            task.last_error = error
+            delay = REPLICATION_RETRY_BASE_SECONDS * (2 ** (task.attempts - 1))
+            task.next_attempt_at = finished_at + datetime.timedelta(seconds=delay)
+            stats['retried'] += 1
+            logging.warning(f"Replica {task.target_path} non riuscita (tentativo {task.attempts}), "
+                            f"nuovo tentativo tra {delay} s: {error}")
+
+    db.session.commit()
+    logging.info(f"Coda di replica: {stats['completed']} completate, {stats['retried']} da ritentare, "
+                 f"{stats['failed']} fallite")
+    return stats
@@ -1,7 +1,7 @@
 import datetime
 from sqlalchemy import or_, and_
 from flask import current_app
-from models import Document, Tag, User
+from models import Document, DocumentContent, Tag, User
 
 def search_documents(query, user_id, doc_type=None, from_date=None, to_date=None, tags=None):
     """
@@ -51,7 +51,7 @@ def search_documents(query, user_id, doc_type=None, from_date=None, to_date=None
             or_(
                 Document.title.ilike(search_query),
                 Document.description.ilike(search_query),
-                Document.content_text.ilike(search_query),
+                Document.content.has(DocumentContent.text.ilike(search_query)),
                 Document.original_filename.ilike(search_query)
             )
         )
@@ -82,7 +82,7 @@ def search_document_content(text_query):
     search_query = f"%{text_query}%"
     
     results = Document.query.filter(
-        Document.content_text.ilike(search_query)
+        Document.content.has(DocumentContent.text.ilike(search_query))
     ).order_by(Document.updated_at.desc()).all()
     
     return results
@@ -106,7 +106,7 @@ def advanced_search(criteria):
             or_(
                 Document.title.ilike(search_text),
                 Document.description.ilike(search_text),
-                Document.content_text.ilike(search_text),
+                Document.content.has(DocumentContent.text.ilike(search_text)),
                 Document.original_filename.ilike(search_text)
             )
         )
@@ -10,9 +10,13 @@ import logging
 import datetime
 import uuid
 import shutil
+import PyPDF2
+from docx import Document as DocxDocument
 from werkzeug.utils import secure_filename
 from flask import current_app
 from app import db
+from services.blob_store import store_blob, store_temp_file
+from services.storage_layout import resolve_path
 
 # Configurazione directory di upload
 UPLOADS_DIR = 'uploads'
@@ -38,7 +42,8 @@ def allowed_file(filename, allowed_extensions=None):
 def save_document(file, owner_id):
     """
     Versione semplificata per salvare un documento.
-    Sostituisce l'implementazione complessa precedente.
+    Il contenuto viene memorizzato nel blob store indirizzato per contenuto:
+    file identici caricati più volte occupano spazio su disco una sola volta.
     
     Args:
         file: L'oggetto file da salvare
@@ -48,39 +53,70 @@ def save_document(file, owner_id):
         dict: Dizionario con i metadati del file salvato
     """
     try:
-        # Genera un nome file unico ma leggibile
+        # Genera un nome file unico ma leggibile (nome logico del documento)
         original_filename = secure_filename(file.filename)
         unique_id = str(uuid.uuid4())[:8]  # Usa solo i primi 8 caratteri dell'UUID
         timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
         unique_filename = f"{unique_id}_{timestamp}_{original_filename}"
         
-        # Crea path assoluto per il file
-        upload_dir = os.path.abspath(UPLOADS_DIR)
-        file_path = os.path.join(upload_dir, unique_filename)
+        # Salva il contenuto nel blob store (acquisisce un riferimento per il nuovo documento)
+        blob = store_blob(file_obj=file)
+        if blob is None:
+            return None
         
-        # Assicurati che la directory esista
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        
-        # Salva il file
-        file.save(file_path)
-        
-        # Ottieni dimensione e tipo
-        file_size = os.path.getsize(file_path)
         file_type = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else 'unknown'
         
-        logging.info(f"File salvato: {file_path}")
+        logging.info(f"File salvato: {blob.file_path} (documento {unique_filename})")
         
         return {
             'filename': unique_filename,
             'original_filename': original_filename,
-            'file_path': file_path,
+            'file_path': blob.file_path,
             'file_type': file_type,
-            'file_size': file_size
+            'file_size': blob.file_size,
+            'mime_type': blob.mime_type,
+            'content_hash': blob.content_hash
         }
     except Exception as e:
         logging.error(f"Errore durante il salvataggio del documento: {str(e)}")
         return None
 
+def save_assembled_document(temp_path, filename, owner_id):
+    """
+    Salva come documento un file già assemblato nella directory temporanea del
+    blob store (caricamento a blocchi), spostandolo senza copiarlo.
+    
+    Args:
+        temp_path: Percorso del file assemblato
+        filename: Nome originale del file
+        owner_id: ID dell'utente proprietario
+        
+    Returns:
+        dict: Dizionario con i metadati del file salvato (come save_document)
+    """
+    original_filename = secure_filename(filename)
+    unique_id = str(uuid.uuid4())[:8]
+    timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    unique_filename = f"{unique_id}_{timestamp}_{original_filename}"
+    
+    blob = store_temp_file(temp_path)
+    if blob is None:
+        return None
+    
+    file_type = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else 'unknown'
+    
+    logging.info(f"File assemblato salvato: {blob.file_path} (documento {unique_filename})")
+    
+    return {
+        'filename': unique_filename,
+        'original_filename': original_filename,
+        'file_path': blob.file_path,
+        'file_type': file_type,
+        'file_size': blob.file_size,
+        'mime_type': blob.mime_type,
+        'content_hash': blob.content_hash
+    }
+
 def get_file_path(filename):
     """
     Ottiene il percorso assoluto di un file.
@@ -92,12 +128,8 @@ def get_file_path(filename):
     if os.path.exists(filename) and os.path.isabs(filename):
         return filename
     
-    # Altrimenti cerca nella directory uploads
-    file_path = os.path.join(os.path.abspath(UPLOADS_DIR), filename)
-    if os.path.exists(file_path):
-        return file_path
-    
-    return None
+    # Altrimenti cerca nella directory uploads (layout partizionato o piatto)
+    return resolve_path(os.path.abspath(UPLOADS_DIR), filename)
 
 def verify_document_file(document):
     """
@@ -122,8 +154,8 @@ def verify_document_file(document):
     
     # Prova a cercare nella directory uploads usando il filename
     if document.filename:
-        alt_path = os.path.join(os.path.abspath(UPLOADS_DIR), document.filename)
-        if os.path.exists(alt_path):
+        alt_path = resolve_path(os.path.abspath(UPLOADS_DIR), document.filename)
+        if alt_path:
             # Aggiorna il percorso nel database
             old_path = document.file_path
             document.file_path = alt_path
@@ -144,12 +176,15 @@ def verify_document_file(document):
         'path': document.file_path
     }
 
+def _isoformat(value):
+    return value.isoformat() if isinstance(value, (datetime.date, datetime.datetime)) else value
+
 def extract_document_metadata(file_path, file_type):
     """
-    Estrae metadati di base dal documento.
-    Versione semplificata che restituisce solo il tipo di file.
+    Estrae metadati di base dal documento: tipo di file e, per PDF e documenti
+    Word, numero di pagine, autore e date dalle proprietà del file.
     """
-    return {
+    metadata = {
         'content_type': file_type,
         'page_count': None,
         'created_date': None,
@@ -157,6 +192,26 @@ def extract_document_metadata(file_path, file_type):
         'author': None
     }
 
+    try:
+        if file_type.lower() == 'pdf':
+            with open(file_path, 'rb') as f:
+                reader = PyPDF2.PdfReader(f)
+                metadata['page_count'] = len(reader.pages)
+                info = reader.metadata
+                if info:
+                    metadata['author'] = info.author
+                    metadata['created_date'] = _isoformat(info.creation_date)
+                    metadata['modified_date'] = _isoformat(info.modification_date)
+        elif file_type.lower() == 'docx':
+            properties = DocxDocument(file_path).core_properties
+            metadata['author'] = properties.author or None
+            metadata['created_date'] = _isoformat(properties.created)
+            metadata['modified_date'] = _isoformat(properties.modified)
+    except Exception as e:
+        logging.warning(f"Impossibile leggere i metadati del file {file_path}: {str(e)}")
+
+    return metadata
+
 def get_document_preview(file_path, file_type):
     """
     Genera un'anteprima per il documento.
@@ -11,6 +11,7 @@ import datetime
 import uuid
 from werkzeug.utils import secure_filename
 from flask import current_app
+from services.storage_layout import resolve_path
 
 # Configurazione della directory di storage principale
 UPLOAD_FOLDER = 'uploads'
@@ -77,12 +78,7 @@ def get_file_path(filename):
     if not filename:
         return None
     
-    file_path = os.path.join(os.path.abspath(UPLOAD_FOLDER), filename)
-    
-    if os.path.exists(file_path):
-        return file_path
-    
-    return None
+    return resolve_path(os.path.abspath(UPLOAD_FOLDER), filename)
 
 def file_exists(filename):
     """
@@ -97,8 +93,7 @@ def file_exists(filename):
     if not filename:
         return False
     
-    file_path = os.path.join(os.path.abspath(UPLOAD_FOLDER), filename)
-    return os.path.exists(file_path)
+    return resolve_path(os.path.abspath(UPLOAD_FOLDER), filename) is not None
 
 def delete_file(filename):
     """
@@ -114,9 +109,9 @@ def delete_file(filename):
         if not filename:
             return False
         
-        file_path = os.path.join(os.path.abspath(UPLOAD_FOLDER), filename)
+        file_path = resolve_path(os.path.abspath(UPLOAD_FOLDER), filename)
         
-        if os.path.exists(file_path):
+        if file_path:
             os.remove(file_path)
             logging.info(f"File eliminato: {file_path}")
             return True
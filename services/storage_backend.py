@@ -0,0 +1,634 @@
+"""
+Interfaccia unica per l'accesso ai file dei documenti (backend di storage).
+
+I file sono identificati da una chiave: il percorso relativo alla directory
+dell'applicazione con separatori "/" (es. uploads/blobs/ab/cd/<sha256>). I
+percorsi assoluti già salvati nel database vengono convertiti con key_for_path.
+
+Driver disponibili:
+  - LocalStorageBackend: filesystem locale (predefinito); i file compressi dal
+    job di compressione (services/compression_tier.py) sono decompressi al volo;
+  - S3StorageBackend: storage a oggetti compatibile S3 (AWS, MinIO, Ceph...),
+    richiede boto3.
+
+Con STORAGE_BACKEND=s3 il backend restituito da get_storage_backend legge
+prima dal disco locale (dati recenti) e poi dallo storage a oggetti (dati
+spostati con migrate_to_object_storage.py); le eliminazioni valgono per entrambi.
+
+Configurazione (variabili d'ambiente): STORAGE_BACKEND, S3_BUCKET,
+S3_ENDPOINT_URL, S3_ACCESS_KEY_ID, S3_SECRET_ACCESS_KEY, S3_REGION, S3_PREFIX;
+per l'invio dei file tramite il proxy: DOWNLOAD_OFFLOAD, DOWNLOAD_OFFLOAD_PREFIX.
+"""
+
+import os
+import stat
+import logging
+import mimetypes
+import uuid
+import datetime
+import threading
+from urllib.parse import quote
+from flask import send_file, request, Response, stream_with_context
+from services.compression import COMPRESSED_SUFFIXES, compressed_variant, open_decompressed, original_size
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+    ClientError = Exception
+
+# Configurazione dei percorsi assoluti
+BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+# Dimensione dei blocchi restituiti da stream()
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Numero massimo di intervalli in una richiesta Range (oltre, si invia il file intero)
+MAX_RANGES = 32
+
+# Invio dei file delegato al proxy: 'nginx' (X-Accel-Redirect), 'sendfile' (X-Sendfile,
+# Apache/lighttpd) o vuoto (i byte passano dal worker Python)
+DOWNLOAD_OFFLOAD = os.environ.get('DOWNLOAD_OFFLOAD', '').strip().lower()
+
+# Location interna di nginx che corrisponde alla directory dell'applicazione (vedi deploy/nginx.conf)
+DOWNLOAD_OFFLOAD_PREFIX = os.environ.get('DOWNLOAD_OFFLOAD_PREFIX', '/_protected/')
+
+def key_for_path(path):
+    """
+    Converte un percorso su disco nella chiave usata dai backend.
+
+    Args:
+        path: Percorso assoluto o relativo alla directory dell'applicazione
+
+    Returns:
+        str: Chiave relativa (o il percorso assoluto, se fuori dalla directory dell'applicazione)
+    """
+    abs_path = os.path.abspath(path if os.path.isabs(path) else os.path.join(BASE_DIR, path))
+    if abs_path.startswith(BASE_DIR + os.sep):
+        return os.path.relpath(abs_path, BASE_DIR).replace(os.sep, '/')
+    return abs_path
+
+class StorageBackend:
+    """Operazioni comuni a tutti i backend di storage."""
+
+    name = 'base'
+
+    def open(self, key):
+        """Apre il file in lettura binaria (oggetto con read() e close())."""
+        raise NotImplementedError
+
+    def stream(self, key, chunk_size=STREAM_CHUNK_SIZE):
+        """Restituisce il contenuto a blocchi."""
+        f = self.open(key)
+        try:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+
+    def stream_range(self, key, start, stop, chunk_size=STREAM_CHUNK_SIZE):
+        """Restituisce a blocchi i byte da start (incluso) a stop (escluso)."""
+        f = self.open(key)
+        try:
+            if start:
+                if getattr(f, 'seekable', lambda: False)():
+                    f.seek(start)
+                else:
+                    # Stream non posizionabile (es. decompressione zstd): i byte iniziali vengono scartati
+                    skip = start
+                    while skip > 0:
+                        chunk = f.read(min(chunk_size, skip))
+                        if not chunk:
+                            return
+                        skip -= len(chunk)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+
+    def put(self, key, source):
+        """Salva il contenuto di uno stream (o di un percorso locale) sulla chiave."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Elimina la chiave; restituisce True se esisteva."""
+        raise NotImplementedError
+
+    def stat(self, key):
+        """Restituisce size e mtime (e, se disponibile, etag) o None se la chiave non esiste."""
+        raise NotImplementedError
+
+    def list(self, prefix=''):
+        """Itera sulle chiavi che iniziano con il prefisso."""
+        raise NotImplementedError
+
+    def exists(self, key):
+        return self.stat(key) is not None
+
+    def local_path(self, key):
+        """Percorso locale del file, se il backend lo conserva su disco (altrimenti None)."""
+        return None
+
+class LocalStorageBackend(StorageBackend):
+    """Backend sul filesystem locale."""
+
+    name = 'local'
+
+    def __init__(self, root=BASE_DIR):
+        self.root = os.path.abspath(root)
+
+    def _path(self, key):
+        if os.path.isabs(key):
+            return key
+        return os.path.join(self.root, *key.split('/'))
+
+    def open(self, key):
+        path = self._path(key)
+        if not os.path.isfile(path):
+            # File compresso dal job di compressione: decompressione al volo
+            variant = compressed_variant(path)
+            if variant:
+                return open_decompressed(*variant)
+        return open(path, 'rb')
+
+    def put(self, key, source):
+        from services.stream_writer import stream_to_files
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                result = stream_to_files(f, [path])
+        else:
+            result = stream_to_files(source, [path])
+        return {'size': result['size']}
+
+    def delete(self, key):
+        path = self._path(key)
+        deleted = False
+        for candidate in [path] + [path + suffix for suffix in COMPRESSED_SUFFIXES.values()]:
+            try:
+                os.remove(candidate)
+                deleted = True
+            except FileNotFoundError:
+                pass
+        return deleted
+
+    def stat(self, key):
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+        except OSError:
+            variant = compressed_variant(path)
+            if variant is None:
+                return None
+            return {'size': original_size(*variant), 'mtime': os.path.getmtime(variant[0]),
+                    'compression': variant[1]}
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return {'size': st.st_size, 'mtime': st.st_mtime}
+
+    def list(self, prefix=''):
+        base = self._path(prefix) if prefix else self.root
+        for dirpath, _, filenames in os.walk(base):
+            for filename in filenames:
+                yield os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/')
+
+    def local_path(self, key):
+        path = self._path(key)
+        return path if os.path.isfile(path) else None
+
+class S3StorageBackend(StorageBackend):
+    """Backend su storage a oggetti compatibile S3."""
+
+    name = 's3'
+
+    def __init__(self, bucket, endpoint_url=None, access_key_id=None, secret_access_key=None,
+                 region=None, prefix=''):
+        if boto3 is None:
+            raise RuntimeError("Il backend S3 richiede il pacchetto boto3")
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+            region_name=region
+        )
+
+    def _object_key(self, key):
+        key = key.lstrip('/')
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def open(self, key):
+        response = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))
+        return response['Body']
+
+    def stream(self, key, chunk_size=STREAM_CHUNK_SIZE):
+        body = self.open(key)
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                yield chunk
+        finally:
+            body.close()
+
+    def stream_range(self, key, start, stop, chunk_size=STREAM_CHUNK_SIZE):
+        response = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key),
+                                          Range=f"bytes={start}-{stop - 1}")
+        body = response['Body']
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                yield chunk
+        finally:
+            body.close()
+
+    def put(self, key, source):
+        object_key = self._object_key(key)
+        if isinstance(source, str):
+            self.client.upload_file(source, self.bucket, object_key)
+        else:
+            self.client.upload_fileobj(source, self.bucket, object_key)
+        return {'size': self.stat(key)['size']}
+
+    def delete(self, key):
+        existed = self.exists(key)
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+        return existed
+
+    def stat(self, key):
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return {
+            'size': response['ContentLength'],
+            'mtime': response['LastModified'].timestamp(),
+            'etag': response.get('ETag', '').strip('"')
+        }
+
+    def list(self, prefix=''):
+        paginator = self.client.get_paginator('list_objects_v2')
+        strip = len(self.prefix) + 1 if self.prefix else 0
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._object_key(prefix)):
+            for item in page.get('Contents', []):
+                yield item['Key'][strip:]
+
+class ChainedStorageBackend(StorageBackend):
+    """
+    Legge dal primo backend che contiene la chiave (es. disco locale, poi S3).
+    Le scritture vanno al backend di destinazione, le eliminazioni a tutti.
+    """
+
+    name = 'chained'
+
+    def __init__(self, backends, write_backend):
+        self.backends = backends
+        self.write_backend = write_backend
+
+    def _find(self, key):
+        for backend in self.backends:
+            if backend.exists(key):
+                return backend
+        return None
+
+    def open(self, key):
+        backend = self._find(key)
+        if backend is None:
+            raise FileNotFoundError(key)
+        return backend.open(key)
+
+    def stream(self, key, chunk_size=STREAM_CHUNK_SIZE):
+        backend = self._find(key)
+        if backend is None:
+            raise FileNotFoundError(key)
+        return backend.stream(key, chunk_size)
+
+    def stream_range(self, key, start, stop, chunk_size=STREAM_CHUNK_SIZE):
+        backend = self._find(key)
+        if backend is None:
+            raise FileNotFoundError(key)
+        return backend.stream_range(key, start, stop, chunk_size)
+
+    def put(self, key, source):
+        return self.write_backend.put(key, source)
+
+    def delete(self, key):
+        deleted = False
+        for backend in self.backends:
+            try:
+                deleted = backend.delete(key) or deleted
+            except Exception as e:
+                logging.error(f"Errore durante l'eliminazione di {key} dal backend {backend.name}: {str(e)}")
+        return deleted
+
+    def stat(self, key):
+        for backend in self.backends:
+            info = backend.stat(key)
+            if info is not None:
+                return info
+        return None
+
+    def list(self, prefix=''):
+        seen = set()
+        for backend in self.backends:
+            for key in backend.list(prefix):
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def local_path(self, key):
+        for backend in self.backends:
+            path = backend.local_path(key)
+            if path:
+                return path
+        return None
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_object_storage_backend():
+    """
+    Restituisce il backend S3 configurato tramite variabili d'ambiente.
+
+    Returns:
+        S3StorageBackend: Il backend o None se S3_BUCKET non è impostato
+    """
+    bucket = os.environ.get('S3_BUCKET')
+    if not bucket:
+        return None
+    return S3StorageBackend(
+        bucket,
+        endpoint_url=os.environ.get('S3_ENDPOINT_URL'),
+        access_key_id=os.environ.get('S3_ACCESS_KEY_ID'),
+        secret_access_key=os.environ.get('S3_SECRET_ACCESS_KEY'),
+        region=os.environ.get('S3_REGION'),
+        prefix=os.environ.get('S3_PREFIX', '')
+    )
+
+def get_storage_backend():
+    """
+    Restituisce il backend di storage configurato (creato una sola volta per processo).
+
+    Returns:
+        StorageBackend: Il backend di storage
+    """
+    global _backend
+
+    if _backend is not None:
+        return _backend
+
+    with _backend_lock:
+        if _backend is None:
+            local = LocalStorageBackend()
+            backend_name = os.environ.get('STORAGE_BACKEND', 'local')
+            if backend_name == 's3':
+                try:
+                    remote = get_object_storage_backend()
+                    if remote is None:
+                        raise RuntimeError("S3_BUCKET non impostato")
+                    _backend = ChainedStorageBackend([local, remote], write_backend=remote)
+                except Exception as e:
+                    logging.error(f"Backend S3 non disponibile, uso il disco locale: {str(e)}")
+                    _backend = local
+            else:
+                _backend = local
+    return _backend
+
+def file_exists(path):
+    """
+    Verifica se il file di un documento è disponibile in uno dei backend.
+
+    Args:
+        path: Percorso del file registrato nel database
+
+    Returns:
+        bool: True se il file esiste
+    """
+    if not path:
+        return False
+    try:
+        return get_storage_backend().exists(key_for_path(path))
+    except Exception as e:
+        logging.error(f"Errore durante la verifica del file {path}: {str(e)}")
+        return False
+
+def delete_file(path):
+    """
+    Elimina il file di un documento da tutti i backend.
+
+    Args:
+        path: Percorso del file registrato nel database
+
+    Returns:
+        bool: True se il file esisteva
+    """
+    return get_storage_backend().delete(key_for_path(path))
+
+def delete_remote_file(path):
+    """
+    Elimina il file di un documento dai soli backend remoti (storage a oggetti),
+    lasciando intatto il disco locale.
+
+    Args:
+        path: Percorso del file registrato nel database
+
+    Returns:
+        bool: True se il file esisteva in almeno un backend remoto
+    """
+    backend = get_storage_backend()
+    key = key_for_path(path)
+    deleted = False
+    for remote in getattr(backend, 'backends', [backend]):
+        if isinstance(remote, LocalStorageBackend):
+            continue
+        try:
+            deleted = remote.delete(key) or deleted
+        except Exception as e:
+            logging.error(f"Errore durante l'eliminazione di {key} dal backend {remote.name}: {str(e)}")
+    return deleted
+
+def _resolve_ranges(byte_range, length):
+    """
+    Converte gli intervalli richiesti in coppie (inizio, fine esclusa) valide per la lunghezza.
+
+    Returns:
+        list: Intervalli soddisfacibili, nell'ordine richiesto
+    """
+    ranges = []
+    for start, stop in byte_range.ranges:
+        if start < 0:
+            start, stop = max(0, length + start), length
+        else:
+            stop = length if stop is None else min(stop, length)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+def _range_allowed(etag, last_modified):
+    """Verifica la condizione If-Range: gli intervalli valgono solo se il file non è cambiato."""
+    if_range = request.if_range
+    if if_range.etag:
+        return etag is not None and if_range.etag == etag
+    if if_range.date:
+        return last_modified is not None and last_modified.replace(microsecond=0) <= if_range.date.replace(tzinfo=None)
+    return True
+
+def _not_modified(etag, last_modified):
+    """Verifica le condizioni If-None-Match / If-Modified-Since (risposta 304)."""
+    if request.if_none_match:
+        return etag is not None and request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+def is_range_continuation():
+    """
+    Indica se la richiesta corrente chiede una parte successiva del file (es. PDF.js
+    che carica le pagine a richiesta o un download ripreso), non una nuova apertura.
+    """
+    byte_range = request.range
+    return byte_range is not None and bool(byte_range.ranges) and byte_range.ranges[0][0] != 0
+
+def offload_header(local_path, mode=None):
+    """
+    Intestazione con cui il proxy invia direttamente un file locale (DOWNLOAD_OFFLOAD).
+
+    Args:
+        local_path: Percorso del file su disco
+        mode: 'nginx' o 'sendfile' (default: DOWNLOAD_OFFLOAD)
+
+    Returns:
+        tuple: (nome, valore) dell'intestazione, o None se l'offload non è attivo o applicabile
+    """
+    mode = DOWNLOAD_OFFLOAD if mode is None else mode
+    if mode == 'sendfile':
+        return 'X-Sendfile', local_path
+    if mode == 'nginx':
+        # La location interna di nginx espone solo la directory dell'applicazione
+        key = key_for_path(local_path)
+        if os.path.isabs(key):
+            return None
+        return 'X-Accel-Redirect', DOWNLOAD_OFFLOAD_PREFIX.rstrip('/') + '/' + quote(key)
+    return None
+
+def send_stored_file(path, download_name=None, as_attachment=False, mimetype=None, etag=None,
+                     last_modified=None):
+    """
+    Invia al client il file di un documento, da disco locale o dallo storage a oggetti.
+
+    Gestisce le richieste condizionali (If-None-Match, If-Modified-Since -> 304) e
+    quelle parziali (Range, anche con più intervalli, e If-Range -> 206), leggendo
+    dal backend solo i byte richiesti. Con DOWNLOAD_OFFLOAD attivo, i file su disco
+    vengono inviati dal proxy (X-Accel-Redirect / X-Sendfile) senza occupare il worker.
+
+    Args:
+        path: Percorso del file registrato nel database
+        download_name: Nome del file proposto al client
+        as_attachment: Se True, forza il download
+        mimetype: Tipo MIME della risposta (opzionale)
+        etag: ETag stabile del contenuto, es. lo SHA-256 (default: derivato da dimensione e data)
+        last_modified: Data di ultima modifica (datetime UTC; default: data del file)
+
+    Returns:
+        Response: Risposta Flask
+    """
+    backend = get_storage_backend()
+    key = key_for_path(path)
+
+    info = backend.stat(key)
+    if info is None:
+        raise FileNotFoundError(path)
+
+    length = info.get('size')
+    if last_modified is None and info.get('mtime'):
+        last_modified = datetime.datetime.utcfromtimestamp(info['mtime'])
+    if etag is None and length is not None and info.get('mtime'):
+        etag = f"{length:x}-{int(info['mtime'] * 1000):x}"
+
+    if mimetype is None and download_name:
+        mimetype = mimetypes.guess_type(download_name)[0]
+    mimetype = mimetype or 'application/octet-stream'
+
+    def finish(response):
+        if etag:
+            response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified
+        # Documenti riservati: nessuna cache condivisa, sempre rivalidati dal browser
+        response.headers['Cache-Control'] = 'private, no-cache'
+        if length is not None:
+            response.headers['Accept-Ranges'] = 'bytes'
+        if download_name:
+            disposition = 'attachment' if as_attachment else 'inline'
+            response.headers.set('Content-Disposition', disposition, filename=download_name)
+        return response
+
+    if _not_modified(etag, last_modified):
+        return finish(Response(status=304))
+
+    # Offload: autorizzazione e audit restano all'applicazione, i byte (e le richieste Range) al proxy
+    local_path = backend.local_path(key)
+    offload = offload_header(local_path) if local_path else None
+    if offload:
+        response = Response(mimetype=mimetype)
+        response.headers[offload[0]] = offload[1]
+        return finish(response)
+
+    byte_range = request.range
+    if byte_range is not None and length is not None and byte_range.units == 'bytes' \
+            and len(byte_range.ranges) <= MAX_RANGES and _range_allowed(etag, last_modified):
+        ranges = _resolve_ranges(byte_range, length)
+        if not ranges:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f"bytes */{length}"
+            return finish(response)
+
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            response = Response(stream_with_context(backend.stream_range(key, start, stop)),
+                                status=206, mimetype=mimetype)
+            response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{length}"
+            response.headers['Content-Length'] = str(stop - start)
+            return finish(response)
+
+        # Più intervalli: risposta multipart/byteranges
+        boundary = uuid.uuid4().hex
+        parts = [(f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+                  f"Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n").encode('latin-1')
+                 for start, stop in ranges]
+        closing = f"--{boundary}--\r\n".encode('latin-1')
+
+        def generate():
+            for part_header, (start, stop) in zip(parts, ranges):
+                yield part_header
+                for chunk in backend.stream_range(key, start, stop):
+                    yield chunk
+                yield b"\r\n"
+            yield closing
+
+        response = Response(stream_with_context(generate()), status=206,
+                            mimetype=f"multipart/byteranges; boundary={boundary}")
+        response.headers['Content-Length'] = str(
+            sum(len(part) + (stop - start) + 2 for part, (start, stop) in zip(parts, ranges)) + len(closing))
+        return finish(response)
+
+    # File intero: dal disco con send_file (sendfile del server WSGI), altrimenti in streaming
+    if local_path:
+        response = send_file(local_path, mimetype=mimetype, conditional=False, etag=False)
+    else:
+        response = Response(stream_with_context(backend.stream(key)), mimetype=mimetype)
+        if length is not None:
+            response.headers['Content-Length'] = str(length)
+    return finish(response)
@@ -0,0 +1,283 @@
+"""
+Garbage collector dei file orfani dello storage (mark-and-sweep).
+
+Fase mark: i riferimenti del database (nomi e percorsi dei documenti e delle
+versioni, hash dei blob, repliche in coda) vengono letti a blocchi e scritti in
+un database SQLite temporaneo su disco, così la memoria resta limitata anche
+con milioni di righe. Fase sweep: ogni radice di storage viene percorsa con
+os.scandir e i file vengono confrontati con i riferimenti a blocchi.
+
+Un file è orfano se nessun riferimento ne cita il nome (le varianti compresse
+.zst/.gz contano come il file originale) ed è più vecchio del periodo di grazia,
+così gli upload in corso non vengono mai toccati. Prima dell'eliminazione i
+candidati vengono ricontrollati sul database; le eliminazioni sono limitate per
+numero e per secondo. Senza commit viene prodotto solo il report (dry run).
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import datetime
+from app import db
+from models import Document, DocumentVersion, StorageBlob, ReplicationTask
+from services.storage_layout import iter_storage_files
+from services.compression import COMPRESSED_SUFFIXES
+from services.location_index import remove_location
+
+# Configurazione dei percorsi assoluti
+BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+# Radici di storage percorse dal collector
+GC_ROOTS = [
+    ('central_originals', os.path.join(BASE_DIR, 'document_storage', 'originals')),
+    ('central_backup', os.path.join(BASE_DIR, 'document_storage', 'backup')),
+    ('permanent_originals', os.path.join(BASE_DIR, 'permanent_storage', 'originals')),
+    ('permanent_backup', os.path.join(BASE_DIR, 'permanent_storage', 'backup')),
+    ('blobs', os.path.join(BASE_DIR, 'uploads', 'blobs')),
+    ('blob_tmp', os.path.join(BASE_DIR, 'uploads', 'blobs', 'tmp')),
+    ('uploads', os.path.join(BASE_DIR, 'uploads'))
+]
+
+# I file modificati o creati più di recente non vengono mai eliminati
+GC_GRACE_HOURS = 24
+
+# Limiti delle eliminazioni per esecuzione
+GC_MAX_DELETIONS = 10000
+GC_DELETIONS_PER_SECOND = 100
+
+# Righe lette dal database / file confrontati per ogni blocco
+GC_BATCH_SIZE = 1000
+
+# Numero massimo di file orfani elencati nel report
+GC_REPORT_SAMPLE_SIZE = 200
+
+def _reference_name(name):
+    """Nome del file di riferimento per un nome su disco (senza suffisso di compressione)."""
+    for suffix in COMPRESSED_SUFFIXES.values():
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def _iter_reference_names():
+    """Genera i nomi di file referenziati dal database, leggendo a blocchi."""
+    queries = [
+        db.session.query(Document.filename, Document.file_path, Document.content_hash),
+        db.session.query(DocumentVersion.filename, DocumentVersion.file_path, DocumentVersion.content_hash),
+        db.session.query(StorageBlob.content_hash, StorageBlob.file_path, StorageBlob.content_hash)
+            .filter(StorageBlob.ref_count > 0),
+        db.session.query(ReplicationTask.storage_filename, ReplicationTask.target_path, ReplicationTask.source_path)
+            .filter(ReplicationTask.status != 'completed')
+    ]
+    for query in queries:
+        for row in query.yield_per(GC_BATCH_SIZE):
+            for value in row:
+                if value:
+                    yield os.path.basename(value)
+
+def _mark(connection):
+    """Scrive i riferimenti nel database temporaneo e restituisce quanti nomi distinti contiene."""
+    connection.execute("CREATE TABLE refs (name TEXT PRIMARY KEY) WITHOUT ROWID")
+    for batch in _batches((name,) for name in _iter_reference_names()):
+        connection.executemany("INSERT OR IGNORE INTO refs (name) VALUES (?)", batch)
+    connection.commit()
+    return connection.execute("SELECT COUNT(*) FROM refs").fetchone()[0]
+
+def _unreferenced(connection, entries):
+    """Filtra le voci il cui nome non compare tra i riferimenti."""
+    names = list({_reference_name(entry.name) for entry in entries})
+    placeholders = ','.join('?' * len(names))
+    found = {name for (name,) in connection.execute(
+        f"SELECT name FROM refs WHERE name IN ({placeholders})", names)}
+    return [entry for entry in entries if _reference_name(entry.name) not in found]
+
+def _still_unreferenced(candidates):
+    """
+    Ricontrolla i candidati sul database subito prima dell'eliminazione
+    (un documento può essere stato creato dopo la fase mark).
+    """
+    names = list({_reference_name(os.path.basename(path)) for path, _ in candidates})
+    paths = [path for path, _ in candidates] + [_reference_name(path) for path, _ in candidates]
+
+    referenced = set()
+    for model in (Document, DocumentVersion):
+        rows = db.session.query(model.filename, model.file_path, model.content_hash).filter(
+            model.filename.in_(names) | model.file_path.in_(paths) | model.content_hash.in_(names)
+        ).all()
+        for row in rows:
+            referenced.update(os.path.basename(value) for value in row if value)
+    rows = db.session.query(StorageBlob.content_hash).filter(
+        StorageBlob.content_hash.in_(names), StorageBlob.ref_count > 0
+    ).all()
+    referenced.update(content_hash for (content_hash,) in rows)
+
+    return [(path, size) for path, size in candidates
+            if _reference_name(os.path.basename(path)) not in referenced]
+
+def _batches(iterable, size=GC_BATCH_SIZE):
+    """Raggruppa gli elementi di un iterabile in liste di al più size elementi."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _is_recent(entry, cutoff):
+    """Verifica se un file è stato creato, rinominato o modificato dopo il limite di grazia."""
+    stat = entry.stat(follow_symlinks=False)
+    return max(stat.st_mtime, stat.st_ctime) >= cutoff
+
+def collect_garbage(commit=False, grace_hours=GC_GRACE_HOURS, max_deletions=GC_MAX_DELETIONS,
+                    deletions_per_second=GC_DELETIONS_PER_SECOND, roots=None):
+    """
+    Individua (ed eventualmente elimina) i file orfani in tutte le radici di storage.
+
+    Args:
+        commit: Se True elimina i file orfani, altrimenti produce solo il report
+        grace_hours: Età minima (in ore) di un file per poter essere eliminato
+        max_deletions: Numero massimo di file eliminati nell'esecuzione
+        deletions_per_second: Limite di velocità delle eliminazioni
+        roots: Lista di (etichetta, directory) da percorrere (default: GC_ROOTS)
+
+    Returns:
+        dict: Report con riferimenti, file esaminati, orfani e byte per radice,
+              eliminazioni, un campione dei file orfani e gli errori
+    """
+    report = {
+        'dry_run': not commit,
+        'references': 0,
+        'scanned': 0,
+        'skipped_recent': 0,
+        'identified': 0,
+        'identified_bytes': 0,
+        'removed': 0,
+        'removed_bytes': 0,
+        'by_root': {},
+        'sample': [],
+        'errors': [],
+        'elapsed_seconds': 0
+    }
+
+    started = time.monotonic()
+    cutoff = time.time() - grace_hours * 3600
+    min_interval = 1.0 / deletions_per_second if deletions_per_second else 0
+    last_deletion = 0.0
+
+    # Database temporaneo su disco (stringa vuota): la memoria non cresce con i riferimenti
+    connection = sqlite3.connect('')
+    try:
+        report['references'] = _mark(connection)
+        logging.info(f"Garbage collector: {report['references']} riferimenti registrati")
+
+        seen_dirs = set()
+        for label, root in roots or GC_ROOTS:
+            root = os.path.abspath(root)
+            if root in seen_dirs:
+                continue
+            seen_dirs.add(root)
+            root_stats = report['by_root'].setdefault(label, {'scanned': 0, 'orphaned': 0, 'bytes': 0})
+
+            for batch in _batches(entry for entry in iter_storage_files(root) if not entry.name.startswith('.')):
+                root_stats['scanned'] += len(batch)
+                report['scanned'] += len(batch)
+
+                candidates = []
+                for orphan in _unreferenced(connection, batch):
+                    try:
+                        if _is_recent(orphan, cutoff):
+                            report['skipped_recent'] += 1
+                            continue
+                        size = orphan.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        # Il file è scomparso durante la scansione
+                        continue
+                    candidates.append((orphan.path, size))
+
+                if candidates and commit:
+                    candidates = _still_unreferenced(candidates)
+
+                for path, size in candidates:
+                    root_stats['orphaned'] += 1
+                    root_stats['bytes'] += size
+                    report['identified'] += 1
+                    report['identified_bytes'] += size
+                    if len(report['sample']) < GC_REPORT_SAMPLE_SIZE:
+                        report['sample'].append({'path': path, 'size': size, 'root': label})
+
+                    if not commit or report['removed'] >= max_deletions:
+                        continue
+
+                    wait = last_deletion + min_interval - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                    last_deletion = time.monotonic()
+                    try:
+                        os.remove(path)
+                        remove_location(path)
+                        report['removed'] += 1
+                        report['removed_bytes'] += size
+                    except FileNotFoundError:
+                        pass
+                    except Exception as e:
+                        error_msg = f"Errore durante la rimozione del file {path}: {str(e)}"
+                        report['errors'].append(error_msg)
+                        logging.error(error_msg)
+    except Exception as e:
+        error_msg = f"Errore durante la raccolta dei file orfani: {str(e)}"
+        report['errors'].append(error_msg)
+        logging.error(error_msg)
+    finally:
+        connection.close()
+
+    report['elapsed_seconds'] = round(time.monotonic() - started, 1)
+    logging.info(f"Garbage collector: {report['scanned']} file esaminati, {report['identified']} orfani "
+                 f"({report['identified_bytes']} byte), {report['removed']} eliminati")
+    return report
+
+def write_gc_report(report, report_file=None):
+    """
+    Salva il report del garbage collector in un file di testo.
+
+    Args:
+        report: Report restituito da collect_garbage
+        report_file: Percorso del file (default: gc_report_<timestamp>.txt)
+
+    Returns:
+        str: Percorso del file salvato
+    """
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_file = report_file or f"gc_report_{timestamp}.txt"
+
+    with open(report_file, 'w') as f:
+        f.write("== Report Garbage Collector dello Storage ==\n")
+        f.write(f"Data: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        f.write(f"Modalità: {'simulazione (dry run)' if report['dry_run'] else 'eliminazione'}\n\n")
+
+        f.write(f"Riferimenti nel database: {report['references']}\n")
+        f.write(f"File esaminati: {report['scanned']}\n")
+        f.write(f"File recenti esclusi (periodo di grazia): {report['skipped_recent']}\n")
+        f.write(f"File orfani: {report['identified']} ({report['identified_bytes']} byte)\n")
+        f.write(f"File eliminati: {report['removed']} ({report['removed_bytes']} byte)\n")
+        f.write(f"Durata: {report['elapsed_seconds']} s\n\n")
+
+        f.write("== Dettaglio per Radice ==\n")
+        for label, stats in report['by_root'].items():
+            f.write(f"{label}: {stats['scanned']} esaminati, {stats['orphaned']} orfani ({stats['bytes']} byte)\n")
+
+        if report['sample']:
+            f.write(f"\n== File Orfani (primi {len(report['sample'])}) ==\n")
+            for item in report['sample']:
+                f.write(f"{item['path']} ({item['size']} byte)\n")
+
+        if report['errors']:
+            f.write("\n== Dettagli Errori ==\n")
+            for error in report['errors']:
+                f.write(f"{error}\n")
+
+        f.write("\n== Fine Report ==\n")
+
+    logging.info(f"Report del garbage collector salvato in: {report_file}")
+    return report_file
@@ -0,0 +1,370 @@
+"""
+Indice dello storage permanente su SQLite (modalità WAL).
+
+Sostituisce storage_index.json: ogni inserimento o ricerca tocca una sola riga,
+i totali (numero di file e dimensione complessiva) sono aggiornati in modo
+incrementale nella stessa transazione e SQLite garantisce la sicurezza con più
+worker gunicorn concorrenti e in caso di crash durante una scrittura.
+"""
+
+import os
+import json
+import sqlite3
+import logging
+import datetime
+import threading
+
+# Configurazione dei percorsi assoluti
+BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+STORAGE_INDEX_DB = os.path.join(BASE_DIR, 'permanent_storage', 'storage_index.db')
+
+# Attesa massima (in millisecondi) quando un altro processo sta scrivendo
+BUSY_TIMEOUT_MS = 10000
+
+# Campi dell'indice salvati in colonne dedicate; gli altri finiscono in extra (JSON)
+INDEX_COLUMNS = [
+    'original_filename',
+    'storage_filename',
+    'primary_path',
+    'backup_paths',
+    'size',
+    'type',
+    'mime_type',
+    'document_id',
+    'checksum',
+    'created_at'
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    filename TEXT PRIMARY KEY,
+    original_filename TEXT,
+    storage_filename TEXT,
+    primary_path TEXT,
+    backup_paths TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    type TEXT,
+    mime_type TEXT,
+    document_id INTEGER,
+    checksum TEXT,
+    created_at TEXT,
+    extra TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_files_document_id ON files (document_id);
+CREATE TABLE IF NOT EXISTS stats (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO stats (key, value) VALUES ('total_files', 0);
+INSERT OR IGNORE INTO stats (key, value) VALUES ('total_size', 0);
+-- Posizioni fisiche dei file in tutte le directory di storage (services/location_index.py)
+CREATE TABLE IF NOT EXISTS locations (
+    path TEXT PRIMARY KEY,
+    root TEXT,
+    filename TEXT NOT NULL,
+    uuid_prefix TEXT,
+    original_name TEXT,
+    content_hash TEXT,
+    size INTEGER,
+    scan_id TEXT,
+    indexed_at TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_locations_filename ON locations (filename);
+CREATE INDEX IF NOT EXISTS ix_locations_uuid_prefix ON locations (uuid_prefix);
+CREATE INDEX IF NOT EXISTS ix_locations_original_name ON locations (original_name);
+CREATE INDEX IF NOT EXISTS ix_locations_content_hash ON locations (content_hash);
+CREATE INDEX IF NOT EXISTS ix_locations_root ON locations (root, scan_id);
+-- Ultimo riallineamento completo dell'indice delle posizioni (riga unica)
+CREATE TABLE IF NOT EXISTS location_rescan (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    started_at TEXT,
+    finished_at TEXT
+);
+-- Totali per directory di storage, aggiornati dai trigger sulle posizioni.
+-- with_backup (solo per le directory .../originals): file presenti anche nella .../backup corrispondente
+CREATE TABLE IF NOT EXISTS location_stats (
+    root TEXT PRIMARY KEY,
+    files INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    with_backup INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS tr_locations_insert AFTER INSERT ON locations WHEN NEW.root IS NOT NULL
+BEGIN
+    INSERT OR IGNORE INTO location_stats (root) VALUES (NEW.root);
+    UPDATE location_stats SET files = files + 1, bytes = bytes + COALESCE(NEW.size, 0) WHERE root = NEW.root;
+    UPDATE location_stats SET with_backup = with_backup + 1
+        WHERE NEW.root LIKE '%/originals' AND root = NEW.root
+        AND EXISTS (SELECT 1 FROM locations WHERE filename = NEW.filename
+                    AND root = substr(NEW.root, 1, length(NEW.root) - 9) || 'backup');
+    UPDATE location_stats SET with_backup = with_backup + 1
+        WHERE NEW.root LIKE '%/backup' AND root = substr(NEW.root, 1, length(NEW.root) - 6) || 'originals'
+        AND EXISTS (SELECT 1 FROM locations WHERE filename = NEW.filename AND root = location_stats.root);
+END;
+CREATE TRIGGER IF NOT EXISTS tr_locations_delete AFTER DELETE ON locations WHEN OLD.root IS NOT NULL
+BEGIN
+    UPDATE location_stats SET files = files - 1, bytes = bytes - COALESCE(OLD.size, 0) WHERE root = OLD.root;
+    UPDATE location_stats SET with_backup = with_backup - 1
+        WHERE OLD.root LIKE '%/originals' AND root = OLD.root
+        AND EXISTS (SELECT 1 FROM locations WHERE filename = OLD.filename
+                    AND root = substr(OLD.root, 1, length(OLD.root) - 9) || 'backup');
+    UPDATE location_stats SET with_backup = with_backup - 1
+        WHERE OLD.root LIKE '%/backup' AND root = substr(OLD.root, 1, length(OLD.root) - 6) || 'originals'
+        AND EXISTS (SELECT 1 FROM locations WHERE filename = OLD.filename AND root = location_stats.root);
+END;
+CREATE TRIGGER IF NOT EXISTS tr_locations_update AFTER UPDATE OF size ON locations
+    WHEN NEW.root IS NOT NULL AND NEW.root IS OLD.root
+BEGIN
+    UPDATE location_stats SET bytes = bytes + COALESCE(NEW.size, 0) - COALESCE(OLD.size, 0) WHERE root = NEW.root;
+END;
+-- Cache dei checksum dei file (services/checksum_cache.py), valida finché il file
+-- identificato da (device, inode) mantiene la stessa dimensione e mtime_ns
+CREATE TABLE IF NOT EXISTS checksums (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    path TEXT,
+    sha256 TEXT,
+    md5 TEXT,
+    fast_hash TEXT,
+    fast_algorithm TEXT,
+    computed_at TEXT,
+    PRIMARY KEY (device, inode)
+);
+CREATE INDEX IF NOT EXISTS ix_checksums_path ON checksums (path);
+-- Cache degli artefatti derivati (services/artifact_cache.py): un file per
+-- (hash del contenuto, tipo di artefatto, variante), con i dati per l'evizione
+CREATE TABLE IF NOT EXISTS artifacts (
+    content_hash TEXT NOT NULL,
+    artifact_type TEXT NOT NULL,
+    variant TEXT NOT NULL DEFAULT '',
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT,
+    last_access_at TEXT,
+    PRIMARY KEY (content_hash, artifact_type, variant)
+);
+CREATE INDEX IF NOT EXISTS ix_artifacts_last_access ON artifacts (last_access_at);
+CREATE TABLE IF NOT EXISTS artifact_stats (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO artifact_stats (key, value) VALUES ('entries', 0);
+INSERT OR IGNORE INTO artifact_stats (key, value) VALUES ('bytes', 0);
+INSERT OR IGNORE INTO artifact_stats (key, value) VALUES ('hits', 0);
+INSERT OR IGNORE INTO artifact_stats (key, value) VALUES ('misses', 0);
+INSERT OR IGNORE INTO artifact_stats (key, value) VALUES ('evictions', 0);
+"""
+
+_local = threading.local()
+
+def get_connection():
+    """
+    Restituisce la connessione SQLite del thread corrente, creandola se necessario.
+    Le connessioni non vengono condivise tra processi (es. dopo il fork di gunicorn).
+
+    Returns:
+        sqlite3.Connection: Connessione all'indice
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and getattr(_local, 'pid', None) == os.getpid():
+        return conn
+
+    os.makedirs(os.path.dirname(STORAGE_INDEX_DB), exist_ok=True)
+    conn = sqlite3.connect(STORAGE_INDEX_DB, timeout=BUSY_TIMEOUT_MS / 1000.0,
+                           isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    conn.executescript(_SCHEMA)
+
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+class write_transaction:
+    """Transazione di scrittura (BEGIN IMMEDIATE) con commit o rollback automatico."""
+
+    def __enter__(self):
+        self.conn = get_connection()
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
+
+def _row_to_info(row):
+    """Converte una riga dell'indice nel dizionario usato da persistent_storage."""
+    info = json.loads(row['extra']) if row['extra'] else {}
+    for column in INDEX_COLUMNS:
+        if row[column] is not None:
+            info[column] = row[column]
+    info['backup_paths'] = json.loads(row['backup_paths']) if row['backup_paths'] else []
+    return info
+
+def _put(conn, filename, file_info):
+    """Inserisce o aggiorna una voce e aggiorna i totali (da chiamare in una transazione)."""
+    previous = conn.execute('SELECT size FROM files WHERE filename = ?', (filename,)).fetchone()
+
+    values = {column: file_info.get(column) for column in INDEX_COLUMNS}
+    values['backup_paths'] = json.dumps(file_info.get('backup_paths') or [])
+    values['size'] = int(file_info.get('size') or 0)
+    extra = {key: value for key, value in file_info.items() if key not in INDEX_COLUMNS}
+
+    conn.execute(
+        f"INSERT OR REPLACE INTO files (filename, {', '.join(INDEX_COLUMNS)}, extra, updated_at) "
+        f"VALUES (?, {', '.join('?' for _ in INDEX_COLUMNS)}, ?, ?)",
+        [filename] + [values[column] for column in INDEX_COLUMNS]
+        + [json.dumps(extra) if extra else None, datetime.datetime.now().isoformat()]
+    )
+
+    if previous is None:
+        conn.execute("UPDATE stats SET value = value + 1 WHERE key = 'total_files'")
+        conn.execute("UPDATE stats SET value = value + ? WHERE key = 'total_size'", (values['size'],))
+    else:
+        conn.execute("UPDATE stats SET value = value + ? WHERE key = 'total_size'",
+                     (values['size'] - previous['size'],))
+
+def put_file(filename, file_info):
+    """
+    Inserisce o aggiorna le informazioni di un file nell'indice.
+
+    Args:
+        filename: Nome del file nello storage
+        file_info: Dizionario con le informazioni sul file
+
+    Returns:
+        bool: True se l'operazione è riuscita, False altrimenti
+    """
+    try:
+        with write_transaction() as conn:
+            _put(conn, filename, file_info)
+        return True
+    except Exception as e:
+        logging.error(f"Errore durante l'aggiornamento dell'indice di storage: {str(e)}")
+        return False
+
+def get_file(filename):
+    """
+    Restituisce le informazioni di un file dall'indice.
+
+    Args:
+        filename: Nome del file nello storage
+
+    Returns:
+        dict: Informazioni sul file o None se non presente
+    """
+    try:
+        row = get_connection().execute('SELECT * FROM files WHERE filename = ?', (filename,)).fetchone()
+        return _row_to_info(row) if row else None
+    except Exception as e:
+        logging.error(f"Errore durante la lettura dell'indice di storage: {str(e)}")
+        return None
+
+def remove_file(filename):
+    """
+    Rimuove un file dall'indice aggiornando i totali.
+
+    Args:
+        filename: Nome del file nello storage
+
+    Returns:
+        bool: True se la voce esisteva ed è stata rimossa
+    """
+    try:
+        with write_transaction() as conn:
+            previous = conn.execute('SELECT size FROM files WHERE filename = ?', (filename,)).fetchone()
+            if previous is None:
+                return False
+            conn.execute('DELETE FROM files WHERE filename = ?', (filename,))
+            conn.execute("UPDATE stats SET value = value - 1 WHERE key = 'total_files'")
+            conn.execute("UPDATE stats SET value = value - ? WHERE key = 'total_size'", (previous['size'],))
+        return True
+    except Exception as e:
+        logging.error(f"Errore durante la rimozione dall'indice di storage: {str(e)}")
+        return False
+
+def get_stats():
+    """
+    Restituisce i totali dell'indice, mantenuti in modo incrementale.
+
+    Returns:
+        dict: total_files e total_size
+    """
+    rows = get_connection().execute('SELECT key, value FROM stats').fetchall()
+    return {row['key']: row['value'] for row in rows}
+
+def iter_files(limit=None, after=None):
+    """
+    Itera sulle voci dell'indice in ordine di nome file.
+
+    Args:
+        limit: Numero massimo di voci da restituire
+        after: Restituisce solo i nomi successivi a questo (paginazione)
+
+    Yields:
+        tuple: (filename, file_info)
+    """
+    query = 'SELECT * FROM files'
+    params = []
+    if after is not None:
+        query += ' WHERE filename > ?'
+        params.append(after)
+    query += ' ORDER BY filename'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+
+    for row in get_connection().execute(query, params).fetchall():
+        yield row['filename'], _row_to_info(row)
+
+def update_paths(moves):
+    """
+    Sostituisce i percorsi (primario e di backup) registrati nell'indice.
+
+    Args:
+        moves: Dizionario vecchio percorso -> nuovo percorso
+
+    Returns:
+        int: Numero di voci aggiornate
+    """
+    updated = 0
+    with write_transaction() as conn:
+        rows = conn.execute('SELECT filename, primary_path, backup_paths FROM files').fetchall()
+        for row in rows:
+            backup_paths = json.loads(row['backup_paths']) if row['backup_paths'] else []
+            new_primary = moves.get(row['primary_path'], row['primary_path'])
+            new_backups = [moves.get(path, path) for path in backup_paths]
+            if new_primary != row['primary_path'] or new_backups != backup_paths:
+                conn.execute('UPDATE files SET primary_path = ?, backup_paths = ? WHERE filename = ?',
+                             (new_primary, json.dumps(new_backups), row['filename']))
+                updated += 1
+    return updated
+
+def import_json_index(json_path):
+    """
+    Importa in un'unica transazione le voci di un vecchio storage_index.json.
+
+    Args:
+        json_path: Percorso del file JSON
+
+    Returns:
+        int: Numero di voci importate
+    """
+    with open(json_path, 'r') as f:
+        index = json.load(f)
+
+    files = index.get('files', {})
+    with write_transaction() as conn:
+        for filename, file_info in files.items():
+            _put(conn, filename, file_info)
+
+    logging.info(f"Importate {len(files)} voci da {json_path}")
+    return len(files)
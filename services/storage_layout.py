@@ -0,0 +1,173 @@
+"""
+Layout su disco partizionato (sharded) per le directory di storage.
+
+Invece di salvare tutti i file in un'unica directory piatta, ogni file viene
+collocato in due livelli di sottodirectory derivati da un hash del nome
+(es. originals/ab/cd/<nome_file>). In questo modo nessuna directory cresce oltre
+qualche migliaio di voci e il percorso di un file si calcola direttamente dal
+suo nome, senza dover mai scansionare una directory.
+
+I file ancora presenti nel vecchio layout piatto vengono comunque trovati da
+resolve_path; migrate_sharded_layout.py li sposta nella nuova posizione.
+"""
+
+import os
+import re
+import hashlib
+import logging
+
+# Numero di caratteri esadecimali per ciascun livello di sharding (ab/cd/...)
+SHARD_WIDTH = 2
+SHARD_DEPTH = 2
+
+# Nomi già costituiti da un digest SHA-256 (blob store): lo sharding usa il nome stesso
+_HEX_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+def shard_key(name):
+    """
+    Restituisce la chiave esadecimale usata per calcolare lo shard di un file.
+
+    Args:
+        name: Nome del file (senza directory)
+
+    Returns:
+        str: Stringa esadecimale da cui derivano i livelli di sharding
+    """
+    if _HEX_DIGEST_RE.match(name):
+        return name
+    return hashlib.md5(name.encode('utf-8')).hexdigest()
+
+def shard_subdir(name):
+    """
+    Restituisce il percorso relativo dello shard di un file (es. 'ab/cd').
+
+    Args:
+        name: Nome del file (senza directory)
+
+    Returns:
+        str: Percorso relativo della sottodirectory di shard
+    """
+    key = shard_key(name)
+    parts = [key[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH)]
+    return os.path.join(*parts)
+
+def sharded_path(root, name, create_dirs=False):
+    """
+    Calcola il percorso di un file nel layout partizionato.
+
+    Args:
+        root: Directory radice dello storage
+        name: Nome del file (senza directory)
+        create_dirs: Se True, crea le sottodirectory di shard
+
+    Returns:
+        str: Percorso completo del file (root/ab/cd/name)
+    """
+    directory = os.path.join(root, shard_subdir(name))
+    if create_dirs:
+        os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
+def resolve_path(root, name):
+    """
+    Risolve la posizione di un file in una directory di storage senza scansioni:
+    controlla prima il layout partizionato e poi il vecchio layout piatto.
+
+    Args:
+        root: Directory radice dello storage
+        name: Nome del file (senza directory)
+
+    Returns:
+        str: Percorso del file se esiste, altrimenti None
+    """
+    if not name:
+        return None
+
+    candidate = sharded_path(root, name)
+    if os.path.isfile(candidate):
+        return candidate
+
+    # Vecchio layout piatto (file non ancora migrati)
+    legacy = os.path.join(root, name)
+    if os.path.isfile(legacy):
+        return legacy
+
+    return None
+
+def is_shard_dir_name(name):
+    """Verifica se il nome di una directory corrisponde a un livello di shard."""
+    return len(name) == SHARD_WIDTH and all(c in '0123456789abcdef' for c in name)
+
+def iter_storage_files(root):
+    """
+    Itera su tutti i file di una directory di storage, sia nel layout piatto
+    che nelle sottodirectory di shard, usando os.scandir.
+
+    Args:
+        root: Directory radice dello storage
+
+    Yields:
+        os.DirEntry: Voce di ciascun file trovato
+    """
+    if not os.path.isdir(root):
+        return
+
+    stack = [(root, 0)]
+    while stack:
+        directory, depth = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        yield entry
+                    elif (depth < SHARD_DEPTH and is_shard_dir_name(entry.name)
+                          and entry.is_dir(follow_symlinks=False)):
+                        stack.append((entry.path, depth + 1))
+        except OSError as e:
+            logging.error(f"Errore durante la lettura della directory {directory}: {str(e)}")
+
+def migrate_directory(root, dry_run=False):
+    """
+    Sposta i file del vecchio layout piatto nella posizione partizionata.
+    Lo spostamento avviene con os.replace all'interno dello stesso filesystem.
+
+    Args:
+        root: Directory radice dello storage
+        dry_run: Se True, calcola solo gli spostamenti senza eseguirli
+
+    Returns:
+        dict: Report con i file spostati, saltati, gli errori e la mappa
+              vecchio percorso -> nuovo percorso
+    """
+    report = {
+        'directory': root,
+        'moved': 0,
+        'skipped': 0,
+        'errors': [],
+        'moves': {}
+    }
+
+    if not os.path.isdir(root):
+        return report
+
+    with os.scandir(root) as entries:
+        flat_files = [entry for entry in entries if entry.is_file(follow_symlinks=False)]
+
+    for entry in flat_files:
+        destination = sharded_path(root, entry.name)
+        if os.path.exists(destination):
+            # Esiste già una copia nella posizione partizionata
+            report['skipped'] += 1
+            continue
+        try:
+            if not dry_run:
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                os.replace(entry.path, destination)
+            report['moves'][entry.path] = destination
+            report['moved'] += 1
+        except OSError as e:
+            error_msg = f"Errore durante lo spostamento di {entry.path}: {str(e)}"
+            report['errors'].append(error_msg)
+            logging.error(error_msg)
+
+    return report
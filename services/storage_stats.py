@@ -0,0 +1,198 @@
+"""
+Statistiche dello storage aggiornate in modo incrementale.
+
+I contatori dei documenti (totale, per azienda, per tipo di file e per area di
+storage) sono mantenuti nella tabella StorageCounter dagli eventi SQLAlchemy di
+inserimento, modifica ed eliminazione di Document, nella stessa transazione
+della modifica. I contatori dei file su disco (numero, byte e copertura dei
+backup per directory) sono mantenuti da trigger sull'indice delle posizioni
+(services/location_index.py).
+
+La lettura delle statistiche non scansiona né il filesystem né la tabella dei
+documenti; reconcile_document_counters (job dello scheduler) ricalcola i
+contatori con query aggregate per correggere eventuali scostamenti.
+"""
+
+import os
+import logging
+import datetime
+from sqlalchemy import event, func, case, inspect
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from app import db
+from models import Document, StorageCounter
+
+# Configurazione dei percorsi assoluti
+BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+# Aree di storage riconosciute dal percorso del file (il prefisso più specifico vince)
+STORAGE_AREAS = [
+    ('blob', os.path.join(BASE_DIR, 'uploads', 'blobs')),
+    ('central', os.path.join(BASE_DIR, 'document_storage', 'originals')),
+    ('permanent', os.path.join(BASE_DIR, 'permanent_storage', 'originals')),
+    ('uploads', os.path.join(BASE_DIR, 'uploads'))
+]
+
+# Intervallo del job di riallineamento dei contatori
+STATS_RECONCILE_INTERVAL_HOURS = 6
+
+# Colonne di Document che influenzano i contatori
+_TRACKED_ATTRIBUTES = ('file_path', 'file_size', 'company_id', 'file_type')
+
+def storage_area(file_path):
+    """
+    Restituisce l'area di storage di un percorso.
+
+    Args:
+        file_path: Percorso del file
+
+    Returns:
+        str: Nome dell'area ('other' se il percorso non appartiene a nessuna)
+    """
+    if file_path:
+        for name, prefix in sorted(STORAGE_AREAS, key=lambda area: len(area[1]), reverse=True):
+            if file_path.startswith(prefix + os.sep):
+                return name
+    return 'other'
+
+def _counter_keys(file_path, company_id, file_type):
+    """Contatori a cui contribuisce un documento."""
+    return [
+        ('total', 'all'),
+        ('company', str(company_id) if company_id else 'none'),
+        ('file_type', (file_type or 'unknown').lower()),
+        ('area', storage_area(file_path))
+    ]
+
+def _apply_deltas(connection, deltas):
+    """Applica le variazioni ai contatori con un upsert atomico (nella transazione corrente)."""
+    table = StorageCounter.__table__
+    now = datetime.datetime.utcnow()
+    dialect = connection.dialect.name
+
+    for (scope, key), (count, size) in deltas.items():
+        if count == 0 and size == 0:
+            continue
+
+        if dialect in ('sqlite', 'postgresql'):
+            insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+            stmt = insert(table).values(scope=scope, key=key, file_count=count, total_bytes=size, updated_at=now)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['scope', 'key'],
+                set_={
+                    'file_count': table.c.file_count + count,
+                    'total_bytes': table.c.total_bytes + size,
+                    'updated_at': now
+                }
+            )
+            connection.execute(stmt)
+        else:
+            result = connection.execute(
+                table.update().where(table.c.scope == scope, table.c.key == key).values(
+                    file_count=table.c.file_count + count,
+                    total_bytes=table.c.total_bytes + size,
+                    updated_at=now
+                )
+            )
+            if result.rowcount == 0:
+                connection.execute(table.insert().values(scope=scope, key=key, file_count=count,
+                                                         total_bytes=size, updated_at=now))
+
+def _add(deltas, keys, count, size):
+    for key in keys:
+        current = deltas.get(key, (0, 0))
+        deltas[key] = (current[0] + count, current[1] + size)
+
+@event.listens_for(Document, 'after_insert')
+def _document_inserted(mapper, connection, target):
+    deltas = {}
+    _add(deltas, _counter_keys(target.file_path, target.company_id, target.file_type), 1, target.file_size or 0)
+    _apply_deltas(connection, deltas)
+
+@event.listens_for(Document, 'after_delete')
+def _document_deleted(mapper, connection, target):
+    deltas = {}
+    _add(deltas, _counter_keys(target.file_path, target.company_id, target.file_type), -1, -(target.file_size or 0))
+    _apply_deltas(connection, deltas)
+
+@event.listens_for(Document, 'after_update')
+def _document_updated(mapper, connection, target):
+    state = inspect(target)
+    if not any(state.attrs[name].history.has_changes() for name in _TRACKED_ATTRIBUTES):
+        return
+
+    def previous(name):
+        history = state.attrs[name].history
+        return history.deleted[0] if history.deleted else getattr(target, name)
+
+    deltas = {}
+    _add(deltas, _counter_keys(previous('file_path'), previous('company_id'), previous('file_type')),
+         -1, -(previous('file_size') or 0))
+    _add(deltas, _counter_keys(target.file_path, target.company_id, target.file_type), 1, target.file_size or 0)
+    _apply_deltas(connection, deltas)
+
+def has_document_counters():
+    """Verifica se i contatori dei documenti sono già stati calcolati almeno una volta."""
+    return db.session.query(StorageCounter.scope).first() is not None
+
+def get_document_counters():
+    """
+    Restituisce i contatori dei documenti raggruppati per ambito.
+
+    Returns:
+        dict: Ambito -> {chiave: {'count': n, 'bytes': n}}
+    """
+    counters = {}
+    for counter in StorageCounter.query.all():
+        counters.setdefault(counter.scope, {})[counter.key] = {
+            'count': counter.file_count,
+            'bytes': counter.total_bytes
+        }
+    return counters
+
+def reconcile_document_counters():
+    """
+    Ricalcola i contatori dei documenti con query aggregate e corregge quelli divergenti.
+
+    Returns:
+        int: Numero di contatori corretti
+    """
+    area_case = case(
+        *[(Document.file_path.like(f"{prefix}{os.sep}%"), name)
+          for name, prefix in sorted(STORAGE_AREAS, key=lambda area: len(area[1]), reverse=True)],
+        else_='other'
+    )
+    groupings = [
+        ('total', None),
+        ('company', Document.company_id),
+        ('file_type', func.lower(Document.file_type)),
+        ('area', area_case)
+    ]
+
+    expected = {}
+    for scope, column in groupings:
+        if column is None:
+            rows = db.session.query(func.count(Document.id), func.sum(Document.file_size)).all()
+            rows = [('all', count, size) for count, size in rows]
+        else:
+            rows = db.session.query(column, func.count(Document.id), func.sum(Document.file_size)) \
+                .group_by(column).all()
+        for key, count, size in rows:
+            if scope == 'company':
+                key = str(key) if key else 'none'
+            expected[(scope, key or 'unknown')] = (count or 0, int(size or 0))
+
+    corrected = 0
+    for counter in StorageCounter.query.all():
+        values = expected.pop((counter.scope, counter.key), (0, 0))
+        if (counter.file_count, counter.total_bytes) != values:
+            counter.file_count, counter.total_bytes = values
+            corrected += 1
+    for (scope, key), (count, size) in expected.items():
+        db.session.add(StorageCounter(scope=scope, key=key, file_count=count, total_bytes=size))
+        corrected += 1
+
+    db.session.commit()
+    if corrected:
+        logging.info(f"Contatori dello storage riallineati: {corrected} corretti")
+    return corrected
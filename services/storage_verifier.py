@@ -0,0 +1,305 @@
+"""
+Motore parallelo di verifica e riparazione dello storage dei documenti.
+
+Scorre l'intera tabella Document a blocchi (paginazione per chiave sull'ID),
+verifica i file su un pool limitato di thread e raccoglie gli aggiornamenti del
+database in un'unica commit per blocco. Ogni commit salva anche il checkpoint
+(MaintenanceRun.cursor), quindi un'esecuzione interrotta riprende dall'ultimo
+blocco completato. Il MaintenanceRun registra anche il throughput (documenti/s, MB/s).
+
+I thread di verifica lavorano solo sul filesystem: tutte le operazioni sul
+database avvengono nel thread che coordina l'esecuzione.
+"""
+
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app import db
+from models import Document, MaintenanceRun
+from services.blob_store import get_blob_path
+from services.checksum_cache import file_checksum
+from services.central_storage import ORIGINAL_FILES_DIR, BACKUP_FILES_DIR
+from services.storage_layout import sharded_path, resolve_path
+from services.replica_copy import copy_file
+from services.storage_backend import get_storage_backend, key_for_path
+from services.location_index import find_paths_for_name, record_location
+
+JOB_TYPE = 'storage_verify'
+
+# Documenti letti dal database e verificati per ogni blocco (un checkpoint per blocco)
+DEFAULT_BATCH_SIZE = 500
+
+# Thread di verifica: il lavoro è dominato dall'I/O, quindi più thread dei core
+DEFAULT_MAX_WORKERS = min(16, (os.cpu_count() or 1) * 4)
+
+# Un'esecuzione "running" non aggiornata da più di questi minuti è considerata interrotta
+STALE_RUN_MINUTES = 10
+
+# Numero massimo di errori conservati nel MaintenanceRun
+MAX_STORED_ERRORS = 100
+
+def _find_candidate(doc):
+    """Cerca una copia esistente del file di un documento (blob, storage centralizzato, indice)."""
+    if doc['content_hash']:
+        blob_path = get_blob_path(doc['content_hash'])
+        if os.path.isfile(blob_path):
+            return blob_path
+
+    if doc['filename']:
+        for root in (ORIGINAL_FILES_DIR, BACKUP_FILES_DIR):
+            path = resolve_path(root, doc['filename'])
+            if path:
+                return path
+
+    candidates = find_paths_for_name(doc['filename'] or '', original_filename=doc['original_filename'],
+                                     content_hash=doc['content_hash'])
+    return candidates[0] if candidates else None
+
+def _find_verified_copy(doc, exclude_path):
+    """Cerca una copia del contenuto il cui SHA-256 corrisponda a quello del documento."""
+    candidates = [get_blob_path(doc['content_hash'])] + find_paths_for_name(
+        None, content_hash=doc['content_hash'])
+    for path in candidates:
+        if path != exclude_path and os.path.isfile(path) and file_checksum(path) == doc['content_hash']:
+            return path
+    return None
+
+def check_document_file(doc, verify_checksums=False):
+    """
+    Verifica (ed eventualmente ripara) il file di un singolo documento.
+    Non accede al database: può essere eseguita in parallelo su più thread.
+
+    Args:
+        doc: Dizionario con id, file_path, filename, original_filename, content_hash
+        verify_checksums: Se True, confronta anche lo SHA-256 del contenuto
+
+    Returns:
+        dict: Esito con stato (ok, repaired, failed), nuovo percorso, byte verificati ed eventuale errore
+    """
+    result = {'id': doc['id'], 'status': 'ok', 'path': None, 'bytes': 0, 'error': None}
+    path = doc['file_path']
+
+    try:
+        if path and os.path.isfile(path):
+            result['bytes'] = os.path.getsize(path)
+            if not (verify_checksums and doc['content_hash']):
+                return result
+
+            if file_checksum(path) == doc['content_hash']:
+                return result
+
+            # Contenuto corrotto: ripristina da una copia con hash corretto
+            good_copy = _find_verified_copy(doc, exclude_path=path)
+            if good_copy is None:
+                result['status'] = 'failed'
+                result['error'] = f"Documento ID {doc['id']}: checksum non corrispondente e nessuna copia valida"
+                return result
+            copy_file(good_copy, path)
+            result['status'] = 'repaired'
+            return result
+
+        # File spostato sullo storage a oggetti: non è mancante
+        if path:
+            remote_info = get_storage_backend().stat(key_for_path(path))
+            if remote_info is not None:
+                result['bytes'] = remote_info['size']
+                return result
+
+        # File mancante: cerca una copia nelle posizioni note
+        candidate = _find_candidate(doc)
+        if candidate is None:
+            result['status'] = 'failed'
+            result['error'] = f"Documento ID {doc['id']}: File non trovato in nessuna posizione"
+            return result
+
+        # Una copia trovata solo nel backup viene ripristinata nella directory principale
+        if candidate.startswith(BACKUP_FILES_DIR + os.sep):
+            restored = sharded_path(ORIGINAL_FILES_DIR, os.path.basename(candidate), create_dirs=True)
+            copy_file(candidate, restored)
+            record_location(restored)
+            candidate = restored
+
+        result['status'] = 'repaired'
+        result['path'] = candidate
+        result['bytes'] = os.path.getsize(candidate)
+        return result
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f"Errore durante la verifica del documento ID {doc['id']}: {str(e)}"
+        return result
+
+def is_run_active(run):
+    """Verifica se un'esecuzione è in corso (aggiornata di recente) in questo o in un altro processo."""
+    if run is None or run.status != 'running':
+        return False
+    threshold = datetime.datetime.utcnow() - datetime.timedelta(minutes=STALE_RUN_MINUTES)
+    return run.updated_at is not None and run.updated_at > threshold
+
+def get_latest_run(job_type=JOB_TYPE):
+    """Restituisce l'ultima esecuzione registrata per il tipo di operazione."""
+    return MaintenanceRun.query.filter_by(job_type=job_type).order_by(MaintenanceRun.id.desc()).first()
+
+def get_resumable_run(job_type=JOB_TYPE):
+    """Restituisce l'ultima esecuzione interrotta o in pausa, se esiste."""
+    return MaintenanceRun.query.filter(
+        MaintenanceRun.job_type == job_type,
+        MaintenanceRun.status.in_(['running', 'paused'])
+    ).order_by(MaintenanceRun.id.desc()).first()
+
+def run_storage_verification(restart=False, batch_size=DEFAULT_BATCH_SIZE, max_workers=DEFAULT_MAX_WORKERS,
+                             verify_checksums=False, max_seconds=None, stop_event=None, user_id=None):
+    """
+    Esegue (o riprende) la verifica completa dello storage dei documenti.
+
+    Args:
+        restart: Se True, annulla l'esecuzione interrotta e riparte dall'inizio
+        batch_size: Documenti per blocco (e per checkpoint)
+        max_workers: Thread di verifica in parallelo
+        verify_checksums: Se True, verifica anche lo SHA-256 dei documenti nel blob store
+        max_seconds: Durata massima; allo scadere l'esecuzione viene messa in pausa
+        stop_event: threading.Event che, se impostato, mette in pausa l'esecuzione
+        user_id: Utente che ha avviato l'operazione
+
+    Returns:
+        MaintenanceRun: Lo stato finale dell'esecuzione
+    """
+    run = get_resumable_run()
+    if run is not None and restart:
+        run.status = 'cancelled'
+        run.finished_at = datetime.datetime.utcnow()
+        db.session.commit()
+        run = None
+
+    if run is None:
+        run = MaintenanceRun(
+            job_type=JOB_TYPE,
+            status='running',
+            cursor=0,
+            processed_count=0,
+            ok_count=0,
+            repaired_count=0,
+            failed_count=0,
+            bytes_processed=0,
+            elapsed_seconds=0.0,
+            options=json.dumps({'batch_size': batch_size, 'max_workers': max_workers,
+                                'verify_checksums': verify_checksums}),
+            started_by_id=user_id
+        )
+        db.session.add(run)
+    else:
+        logging.info(f"Ripresa della verifica #{run.id} dal documento ID {run.cursor}")
+
+    run.status = 'running'
+    run.total_count = Document.query.count()
+    db.session.commit()
+
+    errors = json.loads(run.errors) if run.errors else []
+    base_elapsed = run.elapsed_seconds or 0.0
+    started = time.monotonic()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                rows = db.session.query(
+                    Document.id, Document.file_path, Document.filename,
+                    Document.original_filename, Document.content_hash
+                ).filter(Document.id > run.cursor).order_by(Document.id).limit(batch_size).all()
+
+                if not rows:
+                    run.status = 'completed'
+                    run.finished_at = datetime.datetime.utcnow()
+                    break
+
+                docs = [row._asdict() for row in rows]
+                results = list(executor.map(lambda doc: check_document_file(doc, verify_checksums), docs))
+
+                # Percorsi riparati applicati con una sola query per blocco; le modifiche
+                # passano dall'ORM così che gli eventi aggiornino i contatori per area
+                path_updates = {r['id']: r['path'] for r in results if r['path']}
+                if path_updates:
+                    for document in Document.query.filter(Document.id.in_(list(path_updates))).all():
+                        document.file_path = path_updates[document.id]
+
+                for r in results:
+                    run.processed_count += 1
+                    run.bytes_processed += r['bytes']
+                    if r['status'] == 'ok':
+                        run.ok_count += 1
+                    elif r['status'] == 'repaired':
+                        run.repaired_count += 1
+                    else:
+                        run.failed_count += 1
+                        errors.append(r['error'])
+
+                # Checkpoint: cursore, contatori e tempo di lavoro salvati con la stessa commit
+                run.cursor = rows[-1].id
+                run.elapsed_seconds = base_elapsed + (time.monotonic() - started)
+                run.errors = json.dumps(errors[-MAX_STORED_ERRORS:])
+                db.session.commit()
+
+                logging.info(f"Verifica storage #{run.id}: {run.processed_count}/{run.total_count} documenti, "
+                             f"{run.docs_per_second:.1f} doc/s, {run.mb_per_second:.2f} MB/s")
+
+                if (stop_event is not None and stop_event.is_set()) or \
+                        (max_seconds is not None and time.monotonic() - started >= max_seconds):
+                    run.status = 'paused'
+                    break
+    except Exception as e:
+        db.session.rollback()
+        run.status = 'failed'
+        run.finished_at = datetime.datetime.utcnow()
+        errors.append(f"Errore durante la verifica dello storage: {str(e)}")
+        run.errors = json.dumps(errors[-MAX_STORED_ERRORS:])
+        logging.error(f"Errore durante la verifica dello storage: {str(e)}")
+
+    run.elapsed_seconds = base_elapsed + (time.monotonic() - started)
+    db.session.commit()
+    return run
+
+# Esecuzione in background (un solo thread di verifica per processo)
+_background_lock = threading.Lock()
+_background_thread = None
+_stop_event = threading.Event()
+
+def start_background_verification(app, **options):
+    """
+    Avvia la verifica in un thread in background, fuori dal ciclo della richiesta HTTP.
+
+    Args:
+        app: Applicazione Flask (per il contesto applicativo del thread)
+        **options: Parametri passati a run_storage_verification
+
+    Returns:
+        bool: True se la verifica è stata avviata, False se è già in corso
+    """
+    global _background_thread
+
+    with _background_lock:
+        if _background_thread is not None and _background_thread.is_alive():
+            return False
+        if is_run_active(get_resumable_run()):
+            # Verifica in corso in un altro processo
+            return False
+
+        _stop_event.clear()
+
+        def _worker():
+            with app.app_context():
+                try:
+                    run_storage_verification(stop_event=_stop_event, **options)
+                except Exception as e:
+                    logging.error(f"Errore nel thread di verifica dello storage: {str(e)}")
+                finally:
+                    db.session.remove()
+
+        _background_thread = threading.Thread(target=_worker, name='storage-verifier', daemon=True)
+        _background_thread.start()
+        return True
+
+def stop_background_verification():
+    """Chiede al thread di verifica di fermarsi dopo il blocco corrente (l'esecuzione resta riprendibile)."""
+    _stop_event.set()
@@ -0,0 +1,178 @@
+"""
+Scrittura in streaming dei file caricati.
+
+Il contenuto viene letto una sola volta, a blocchi, e durante questo unico
+passaggio vengono calcolati i checksum (SHA-256 e MD5), il numero di byte e il
+tipo MIME (dai primi byte, tramite python-magic), scrivendo ogni blocco su tutte
+le destinazioni richieste, comprese le eventuali repliche di backup.
+"""
+
+import os
+import uuid
+import hashlib
+import logging
+
+try:
+    import magic
+except ImportError:
+    magic = None
+
+# Dimensione dei blocchi letti dalla sorgente
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Byte iniziali usati per riconoscere il tipo MIME
+MIME_SNIFF_BYTES = 8192
+
+def detect_mime_type(header):
+    """
+    Riconosce il tipo MIME dai primi byte di un file.
+
+    Args:
+        header: Primi byte del contenuto
+
+    Returns:
+        str: Tipo MIME o None se python-magic non è disponibile
+    """
+    if magic is None or not header:
+        return None
+    try:
+        return magic.from_buffer(header, mime=True)
+    except Exception as e:
+        logging.warning(f"Impossibile determinare il tipo MIME: {str(e)}")
+        return None
+
+def open_source(file_obj=None, file_path=None):
+    """
+    Restituisce uno stream leggibile per un oggetto file Flask o un percorso.
+
+    Returns:
+        tuple: (stream, da_chiudere) dove da_chiudere indica se lo stream è stato aperto qui
+    """
+    if file_obj is not None:
+        return getattr(file_obj, 'stream', file_obj), False
+    if file_path is not None:
+        return open(file_path, 'rb'), True
+    raise ValueError("È necessario fornire o un oggetto file o un percorso file")
+
+def write_stream(source, paths, replica_paths=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Copia uno stream su una o più destinazioni leggendolo una sola volta.
+
+    Un errore su una destinazione in paths interrompe l'operazione; un errore su
+    una replica viene registrato e la replica viene abbandonata.
+
+    Args:
+        source: Stream leggibile (metodo read)
+        paths: Percorsi di destinazione obbligatori
+        replica_paths: Percorsi di replica facoltativi
+        chunk_size: Dimensione dei blocchi di lettura
+
+    Returns:
+        dict: Dimensione, checksum SHA-256 e MD5, tipo MIME e repliche scritte
+    """
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    size = 0
+    header = b''
+
+    outputs = [open(path, 'wb') for path in paths]
+    replicas = {}
+    try:
+        for path in replica_paths or []:
+            try:
+                replicas[path] = open(path, 'wb')
+            except OSError as e:
+                logging.warning(f"Impossibile creare la replica {path}: {str(e)}")
+
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+
+            size += len(chunk)
+            sha256.update(chunk)
+            md5.update(chunk)
+            if len(header) < MIME_SNIFF_BYTES:
+                header += chunk[:MIME_SNIFF_BYTES - len(header)]
+
+            for output in outputs:
+                output.write(chunk)
+
+            for path, output in list(replicas.items()):
+                try:
+                    output.write(chunk)
+                except OSError as e:
+                    logging.warning(f"Replica {path} abbandonata: {str(e)}")
+                    output.close()
+                    del replicas[path]
+                    _remove_quietly(path)
+    except Exception:
+        for output in outputs + list(replicas.values()):
+            output.close()
+        for path in list(paths) + list(replicas.keys()):
+            _remove_quietly(path)
+        raise
+
+    for output in outputs:
+        output.close()
+    for output in replicas.values():
+        output.close()
+
+    return {
+        'size': size,
+        'sha256': sha256.hexdigest(),
+        'md5': md5.hexdigest(),
+        'mime_type': detect_mime_type(header),
+        'replica_paths': list(replicas.keys())
+    }
+
+def stream_to_files(source, destinations, replica_destinations=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Come write_stream, ma scrive su file temporanei nella stessa directory e li
+    rinomina atomicamente sulle destinazioni finali solo a scrittura completata.
+
+    Args:
+        source: Stream leggibile (metodo read)
+        destinations: Percorsi finali obbligatori
+        replica_destinations: Percorsi finali facoltativi (copie di backup)
+        chunk_size: Dimensione dei blocchi di lettura
+
+    Returns:
+        dict: Come write_stream; replica_paths contiene i percorsi finali delle repliche scritte
+    """
+    temp_paths = {_temp_path_for(path): path for path in destinations}
+    temp_replicas = {_temp_path_for(path): path for path in replica_destinations or []}
+
+    result = write_stream(source, list(temp_paths.keys()),
+                          replica_paths=list(temp_replicas.keys()), chunk_size=chunk_size)
+
+    try:
+        for temp_path, final_path in temp_paths.items():
+            os.replace(temp_path, final_path)
+    except OSError:
+        for temp_path in list(temp_paths.keys()) + result['replica_paths']:
+            _remove_quietly(temp_path)
+        raise
+
+    written_replicas = []
+    for temp_path in result['replica_paths']:
+        try:
+            os.replace(temp_path, temp_replicas[temp_path])
+            written_replicas.append(temp_replicas[temp_path])
+        except OSError as e:
+            logging.warning(f"Impossibile finalizzare la replica {temp_replicas[temp_path]}: {str(e)}")
+            _remove_quietly(temp_path)
+
+    result['replica_paths'] = written_replicas
+    return result
+
+def _temp_path_for(path):
+    """Percorso temporaneo nella stessa directory della destinazione (rinomina atomica)."""
+    return f"{path}.{uuid.uuid4().hex[:8]}.part"
+
+def _remove_quietly(path):
+    """Rimuove un file ignorando gli errori."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,101 @@
+"""
+Miniature JPEG dei documenti immagine.
+
+Le miniature sono generate con Pillow e conservate nella cache degli artefatti
+(services/artifact_cache.py), con chiave l'hash del contenuto e la dimensione:
+ogni immagine viene ridimensionata una sola volta, anche se appartiene a più
+documenti o viene richiesta da più worker contemporaneamente.
+"""
+
+import io
+import logging
+from PIL import Image, ImageOps
+from services.artifact_cache import get_or_create_artifact
+from services.storage_backend import get_storage_backend, key_for_path
+
+# Tipi di file per cui è disponibile una miniatura
+THUMBNAIL_TYPES = {'jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'webp'}
+
+# Dimensioni disponibili (lato massimo in pixel)
+THUMBNAIL_SIZES = {
+    'small': 96,
+    'medium': 320,
+    'large': 800
+}
+
+THUMBNAIL_QUALITY = 80
+
+# Le immagini più grandi non vengono caricate in memoria per generare la miniatura
+THUMBNAIL_MAX_SOURCE_BYTES = 50 * 1024 * 1024
+
+def can_thumbnail(document):
+    """Verifica se per il documento è disponibile una miniatura."""
+    return (document.file_type or '').lower() in THUMBNAIL_TYPES
+
+def render_thumbnail(source_path, max_side, output):
+    """
+    Genera la miniatura JPEG di un'immagine salvata nello storage.
+
+    Args:
+        source_path: Percorso del file registrato nel database
+        max_side: Lato massimo della miniatura in pixel
+        output: Percorso o file di destinazione
+    """
+    backend = get_storage_backend()
+    key = key_for_path(source_path)
+    info = backend.stat(key)
+    if info is None:
+        raise FileNotFoundError(source_path)
+    if (info.get('size') or 0) > THUMBNAIL_MAX_SOURCE_BYTES:
+        raise ValueError(f"Immagine troppo grande per la miniatura: {info['size']} byte")
+
+    source = backend.open(key)
+    try:
+        data = source.read()
+    finally:
+        source.close()
+
+    with Image.open(io.BytesIO(data)) as image:
+        # Per i JPEG la decodifica avviene direttamente a risoluzione ridotta
+        image.draft('RGB', (max_side, max_side))
+        thumbnail = ImageOps.exif_transpose(image)
+        thumbnail.thumbnail((max_side, max_side))
+        if thumbnail.mode in ('RGBA', 'LA', 'P'):
+            thumbnail = thumbnail.convert('RGBA')
+            background = Image.new('RGB', thumbnail.size, (255, 255, 255))
+            background.paste(thumbnail, mask=thumbnail.getchannel('A'))
+            thumbnail = background
+        elif thumbnail.mode not in ('RGB', 'L'):
+            thumbnail = thumbnail.convert('RGB')
+        thumbnail.save(output, format='JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+
+def get_thumbnail(document, size='small'):
+    """
+    Restituisce la miniatura di un documento immagine, dalla cache se presente.
+
+    Args:
+        document: Documento immagine
+        size: Chiave di THUMBNAIL_SIZES
+
+    Returns:
+        bytes: Miniatura JPEG, o None se non è stato possibile generarla
+    """
+    max_side = THUMBNAIL_SIZES[size]
+
+    if not document.content_hash:
+        # Documenti precedenti al blob store: miniatura generata senza cache
+        output = io.BytesIO()
+        try:
+            render_thumbnail(document.file_path, max_side, output)
+        except Exception as e:
+            logging.error(f"Errore durante la generazione della miniatura del documento {document.id}: {str(e)}")
+            return None
+        return output.getvalue()
+
+    f = get_or_create_artifact(document.content_hash, 'thumbnail',
+                               lambda path: render_thumbnail(document.file_path, max_side, path),
+                               variant=str(max_side))
+    if f is None:
+        return None
+    with f:
+        return f.read()
@@ -0,0 +1,179 @@
+"""
+Esportazione in streaming di cartelle e selezioni di documenti come archivio ZIP.
+
+L'archivio viene generato mentre viene inviato: zipfile scrive su un buffer non
+posizionabile (le dimensioni e i CRC di ogni file finiscono nei data descriptor)
+e ogni blocco viene restituito al client appena prodotto. Nessun file temporaneo
+e nessun archivio in memoria: la memoria usata è quella di un blocco di lettura.
+
+I formati già compressi (immagini, video, archivi, documenti Office) vengono
+archiviati senza compressione (ZIP_STORED); gli altri con deflate.
+"""
+
+import os
+import zipfile
+import logging
+import posixpath
+from models import Document, User
+from services.storage_backend import get_storage_backend, key_for_path
+
+# Estensioni salvate senza compressione (il contenuto è già compresso)
+ZIP_STORED_EXTENSIONS = {
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic',
+    'mp4', 'mov', 'avi', 'mkv', 'mp3', 'm4a',
+    'zip', '7z', 'rar', 'gz', 'bz2', 'xz', 'zst',
+    'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp'
+}
+
+# Livello di compressione deflate (compromesso tra CPU e dimensione)
+ZIP_COMPRESSLEVEL = 6
+
+# Oltre questa dimensione l'entry usa le estensioni ZIP64
+ZIP64_THRESHOLD = 2 ** 31 - 1
+
+# Documenti caricati dal database per ogni blocco
+ZIP_QUERY_BATCH_SIZE = 200
+
+# Nome del file che elenca, in fondo all'archivio, i documenti non inclusi
+ZIP_ERRORS_FILENAME = '_file_non_inclusi.txt'
+
+class _StreamBuffer:
+    """Destinazione non posizionabile per zipfile: accumula i byte fino al prossimo drain()."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def _safe_name(name):
+    """Nome di file o cartella utilizzabile all'interno dell'archivio."""
+    name = (name or '').replace('/', '_').replace('\\', '_').strip()
+    return name if name not in ('', '.', '..') else 'senza_nome'
+
+def _unique_name(directory, name, used):
+    """Evita nomi duplicati nella stessa cartella dell'archivio (nome (2).ext, ...)."""
+    base, ext = os.path.splitext(name)
+    candidate = posixpath.join(directory, name)
+    counter = 2
+    while candidate in used:
+        candidate = posixpath.join(directory, f"{base} ({counter}){ext}")
+        counter += 1
+    used.add(candidate)
+    return candidate
+
+def folder_tree(folder):
+    """
+    Restituisce la cartella e tutte le sue sottocartelle con il percorso nell'archivio.
+
+    Args:
+        folder: Cartella radice dell'esportazione
+
+    Returns:
+        list: Coppie (ID cartella, percorso nell'archivio), in ordine di visita
+    """
+    tree = []
+    stack = [(folder, _safe_name(folder.name))]
+    while stack:
+        current, path = stack.pop()
+        tree.append((current.id, path))
+        for child in sorted(current.children, key=lambda child: child.name or '', reverse=True):
+            stack.append((child, posixpath.join(path, _safe_name(child.name))))
+    return tree
+
+def downloadable_documents(user):
+    """
+    Query dei documenti che l'utente può scaricare (le stesse regole di download_document).
+
+    Args:
+        user: Utente corrente
+
+    Returns:
+        Query: Documenti propri, condivisi con l'utente o tutti (amministratori)
+    """
+    query = Document.query
+    if not user.is_admin():
+        query = query.filter(
+            (Document.owner_id == user.id) | Document.shared_with.any(User.id == user.id)
+        )
+    return query
+
+def stream_zip(documents, directories=()):
+    """
+    Genera un archivio ZIP in streaming.
+
+    Args:
+        documents: Lista di (ID documento, cartella nell'archivio) nell'ordine di inserimento
+        directories: Cartelle dell'archivio da creare anche se vuote
+
+    Yields:
+        bytes: Blocchi dell'archivio, pronti per essere inviati al client
+    """
+    backend = get_storage_backend()
+    buffer = _StreamBuffer()
+    used = set()
+    skipped = []
+
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as archive:
+        for directory in directories:
+            archive.writestr(zipfile.ZipInfo(directory.rstrip('/') + '/'), b'')
+        yield buffer.drain()
+
+        for offset in range(0, len(documents), ZIP_QUERY_BATCH_SIZE):
+            batch = documents[offset:offset + ZIP_QUERY_BATCH_SIZE]
+            rows = {doc.id: doc for doc in Document.query.filter(Document.id.in_([doc_id for doc_id, _ in batch]))}
+
+            for doc_id, directory in batch:
+                doc = rows.get(doc_id)
+                if doc is None:
+                    continue
+                name = _unique_name(directory, _safe_name(doc.original_filename or doc.filename), used)
+                key = key_for_path(doc.file_path) if doc.file_path else None
+                info = backend.stat(key) if key else None
+                if info is None:
+                    skipped.append(f"{name}: file non disponibile (documento ID {doc.id})")
+                    continue
+
+                timestamp = doc.updated_at or doc.created_at
+                if timestamp is None or timestamp.year < 1980:
+                    entry = zipfile.ZipInfo(name)
+                else:
+                    entry = zipfile.ZipInfo(name, date_time=timestamp.timetuple()[:6])
+                extension = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+                if extension in ZIP_STORED_EXTENSIONS:
+                    entry.compress_type = zipfile.ZIP_STORED
+                else:
+                    entry.compress_type = zipfile.ZIP_DEFLATED
+                    entry._compresslevel = ZIP_COMPRESSLEVEL
+                size = info.get('size')
+
+                try:
+                    with archive.open(entry, 'w', force_zip64=size is None or size > ZIP64_THRESHOLD) as output:
+                        for chunk in backend.stream(key):
+                            output.write(chunk)
+                            if buffer.chunks:
+                                yield buffer.drain()
+                except Exception as e:
+                    # L'entry resta troncata: viene segnalata nell'elenco dei file non inclusi
+                    logging.error(f"Errore durante l'esportazione ZIP del documento ID {doc.id}: {str(e)}")
+                    skipped.append(f"{name}: errore di lettura ({str(e)})")
+                yield buffer.drain()
+
+        if skipped:
+            archive.writestr(ZIP_ERRORS_FILENAME, '\n'.join(skipped) + '\n')
+
+    yield buffer.drain()
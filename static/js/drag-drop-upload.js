@@ -129,15 +129,141 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    // Caricamento a blocchi riprendibile (protocollo tus, vedi services/chunked_upload.py)
+    const CHUNK_SIZE = 8 * 1024 * 1024;
+    const MAX_RETRIES = 8;
+    
+    function sleep(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+    
+    function base64Encode(bytes) {
+        let binary = '';
+        bytes.forEach(b => binary += String.fromCharCode(b));
+        return btoa(binary);
+    }
+    
+    function setProgress(fraction) {
+        if (!progressBar) return;
+        const percent = Math.floor(fraction * 100);
+        progressBar.style.width = percent + '%';
+        progressBar.setAttribute('aria-valuenow', percent);
+        progressBar.textContent = percent + '%';
+    }
+    
+    async function chunkChecksum(chunk) {
+        // crypto.subtle è disponibile solo in contesti sicuri (HTTPS o localhost)
+        if (!window.crypto || !window.crypto.subtle) return null;
+        const digest = await window.crypto.subtle.digest('SHA-256', await chunk.arrayBuffer());
+        return 'sha256 ' + base64Encode(new Uint8Array(digest));
+    }
+    
+    async function errorMessage(response) {
+        try {
+            const data = await response.json();
+            return data.message || response.statusText;
+        } catch (e) {
+            return response.statusText;
+        }
+    }
+    
+    async function uploadInChunks(file, createUrl, csrfToken) {
+        const headers = {'Tus-Resumable': '1.0.0', 'X-CSRFToken': csrfToken};
+        // La sessione viene ricordata per riprendere il caricamento dopo un errore o un ricaricamento della pagina
+        const storageKey = 'chunked-upload:' + file.name + ':' + file.size + ':' + file.lastModified;
+        let sessionUrl = localStorage.getItem(storageKey);
+        let offset = null;
+        
+        async function fetchOffset() {
+            const response = await fetch(sessionUrl, {method: 'HEAD', headers: headers, credentials: 'same-origin'});
+            if (!response.ok) return null;
+            return parseInt(response.headers.get('Upload-Offset'), 10);
+        }
+        
+        if (sessionUrl) {
+            offset = await fetchOffset();
+        }
+        if (offset === null) {
+            const response = await fetch(createUrl, {
+                method: 'POST',
+                credentials: 'same-origin',
+                headers: Object.assign({
+                    'Upload-Length': String(file.size),
+                    'Upload-Metadata': 'filename ' + base64Encode(new TextEncoder().encode(file.name))
+                }, headers)
+            });
+            if (response.status !== 201) {
+                throw new Error(await errorMessage(response));
+            }
+            sessionUrl = response.headers.get('Location');
+            localStorage.setItem(storageKey, sessionUrl);
+            offset = 0;
+        }
+        
+        let retries = 0;
+        setProgress(file.size ? offset / file.size : 1);
+        while (offset < file.size) {
+            const chunk = file.slice(offset, offset + CHUNK_SIZE);
+            let response = null;
+            try {
+                const chunkHeaders = Object.assign({
+                    'Content-Type': 'application/offset+octet-stream',
+                    'Upload-Offset': String(offset)
+                }, headers);
+                const checksum = await chunkChecksum(chunk);
+                if (checksum) {
+                    chunkHeaders['Upload-Checksum'] = checksum;
+                }
+                response = await fetch(sessionUrl, {method: 'PATCH', headers: chunkHeaders, body: chunk, credentials: 'same-origin'});
+            } catch (e) {
+                // Connessione interrotta: si riprende dall'offset confermato dal server
+                response = null;
+            }
+            
+            if (response && response.status === 204) {
+                offset = parseInt(response.headers.get('Upload-Offset'), 10);
+                retries = 0;
+                setProgress(offset / file.size);
+                continue;
+            }
+            if (response && [400, 404, 413, 415].includes(response.status)) {
+                localStorage.removeItem(storageKey);
+                throw new Error(await errorMessage(response));
+            }
+            
+            retries += 1;
+            if (retries > MAX_RETRIES) {
+                throw new Error('Caricamento interrotto: troppi tentativi falliti. Riprova per riprendere da dove si era fermato.');
+            }
+            await sleep(Math.min(30000, 500 * Math.pow(2, retries)));
+            const confirmed = await fetchOffset().catch(() => null);
+            if (confirmed !== null && !isNaN(confirmed)) {
+                offset = confirmed;
+            }
+        }
+        
+        localStorage.removeItem(storageKey);
+        return sessionUrl.split('/').pop();
+    }
+    
     // Gestione del form di upload
     if (uploadForm) {
-        uploadForm.addEventListener('submit', function() {
+        uploadForm.addEventListener('submit', function(e) {
             // Verifica che sia stato selezionato un file
             if (fileInput.files.length === 0) {
+                e.preventDefault();
                 alert('Seleziona un file da caricare');
                 return false;
             }
             
+            const createUrl = uploadForm.dataset.chunkedUploadUrl;
+            const csrfInput = uploadForm.querySelector('input[name="csrf_token"]');
+            if (!createUrl || !window.fetch) {
+                // Caricamento tradizionale in un'unica richiesta
+                return true;
+            }
+            e.preventDefault();
+            
             // Disabilita il pulsante e mostra lo stato di caricamento
             if (uploadBtn) {
                 uploadBtn.disabled = true;
@@ -149,21 +275,29 @@ document.addEventListener('DOMContentLoaded', function() {
                 progressContainer.classList.remove('d-none');
             }
             
-            // Simula l'avanzamento del caricamento
-            if (progressBar) {
-                let width = 0;
-                const interval = setInterval(function() {
-                    if (width >= 90) {
-                        clearInterval(interval);
-                    } else {
-                        width += 5;
-                        progressBar.style.width = width + '%';
-                        progressBar.setAttribute('aria-valuenow', width);
+            const originalLabel = '<i class="bi bi-cloud-upload"></i> Carica Documento';
+            uploadInChunks(fileInput.files[0], createUrl, csrfInput ? csrfInput.value : '')
+                .then(uploadId => {
+                    // Il file è già sul server: il modulo viene inviato con l'ID della sessione al posto del file
+                    const input = document.createElement('input');
+                    input.type = 'hidden';
+                    input.name = 'upload_id';
+                    input.value = uploadId;
+                    uploadForm.appendChild(input);
+                    fileInput.disabled = true;
+                    if (uploadBtn) {
+                        uploadBtn.innerHTML = '<span class="spinner-border spinner-border-sm" role="status" aria-hidden="true"></span> Elaborazione...';
                     }
-                }, 200);
-            }
-            
-            return true;
+                    uploadForm.submit();
+                })
+                .catch(error => {
+                    alert('Errore durante il caricamento: ' + error.message);
+                    if (uploadBtn) {
+                        uploadBtn.disabled = false;
+                        uploadBtn.innerHTML = originalLabel;
+                    }
+                });
+            return false;
         });
     }
 });
\ No newline at end of file
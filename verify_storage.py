@@ -0,0 +1,58 @@
+"""
+Script per la verifica e riparazione completa dello storage dei documenti.
+
+Usa il motore parallelo di services/storage_verifier.py: se un'esecuzione
+precedente è stata interrotta, riprende dall'ultimo checkpoint salvato.
+
+Uso:
+    python verify_storage.py [--workers N] [--batch-size N] [--checksums] [--restart] [--max-seconds N]
+"""
+
+import argparse
+import logging
+from app import app
+from services.storage_verifier import (
+    run_storage_verification,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_MAX_WORKERS
+)
+
+# Configura il logging
+logging.basicConfig(level=logging.INFO,
+                   format='%(asctime)s - %(levelname)s - %(message)s')
+
+def main():
+    """Funzione principale per avviare la verifica"""
+    parser = argparse.ArgumentParser(description='Verifica e ripara lo storage dei documenti')
+    parser.add_argument('--workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help='Thread di verifica in parallelo')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Documenti per blocco (un checkpoint per blocco)')
+    parser.add_argument('--checksums', action='store_true',
+                        help='Verifica anche lo SHA-256 del contenuto')
+    parser.add_argument('--restart', action='store_true',
+                        help="Ignora l'esecuzione interrotta e riparte dall'inizio")
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help="Durata massima; allo scadere l'esecuzione viene messa in pausa")
+    args = parser.parse_args()
+
+    with app.app_context():
+        run = run_storage_verification(
+            restart=args.restart,
+            batch_size=args.batch_size,
+            max_workers=args.workers,
+            verify_checksums=args.checksums,
+            max_seconds=args.max_seconds
+        )
+
+        logging.info("==== Riepilogo Verifica ====")
+        logging.info(f"Esecuzione: #{run.id} ({run.status})")
+        logging.info(f"Documenti verificati: {run.processed_count}/{run.total_count}")
+        logging.info(f"OK: {run.ok_count}, riparati: {run.repaired_count}, non recuperabili: {run.failed_count}")
+        logging.info(f"Throughput: {run.docs_per_second:.1f} doc/s, {run.mb_per_second:.2f} MB/s "
+                     f"in {run.elapsed_seconds:.1f} s")
+        for error in run.to_dict()['errors'][-10:]:
+            logging.warning(error)
+
+if __name__ == "__main__":
+    main()